@@ -40,6 +40,7 @@ warnings.filterwarnings(
 import array  # (Mute warnings before cause) pylint: disable=g-bad-import-order,g-import-not-at-top
 import base64
 import datetime
+import hashlib
 import logging
 import os
 import struct
@@ -47,6 +48,7 @@ import types
 
 import tlslite
 
+from simian.auth import rsa_backend
 from simian.auth import x509
 
 # Public certificate for CA
@@ -65,6 +67,14 @@ AGE_CN_SECONDS = 5 * 60
 AGE_DEFAULT_SECONDS = 6 * 60 * 60
 # Minimum value for Cn (client nonce) value
 MIN_VALUE_CN = 2**100
+# Maximum number of verified client certs to keep in the process cache
+VERIFIED_CERT_CACHE_SIZE = 2000
+
+# Parsed CA certificates, keyed by CA PEM string
+_ca_cert_cache = {}
+# Client certs which have already passed issuer and CA signature checks,
+# keyed by sha256 fingerprint of the cert PEM string
+_verified_cert_cache = {}
 
 # Level values supplied to DoMunkiAuth() and used in session data
 # Base
@@ -77,6 +87,12 @@ class Error(Exception):
   """Base."""
 
 
+def ResetCertCaches():
+  """Empty the process wide CA cert and verified client cert caches."""
+  _ca_cert_cache.clear()
+  _verified_cert_cache.clear()
+
+
 class NotAuthenticated(Error):
   """Not authenticated."""
 
@@ -765,6 +781,9 @@ class Auth1(AuthBase):
     """
     if not self._key:
       raise KeyNotLoaded
+    backend = rsa_backend.GetBackend()
+    if backend is not None and backend.HandlesKey(self._key, private=True):
+      return backend.Sign(self._key, datastr)
     data_bytes = array.array('B')
     data_bytes.fromstring(datastr)
     sig_bytes = self._key.hashAndSign(data_bytes)
@@ -799,6 +818,76 @@ class Auth1(AuthBase):
     self._cert = cert
     self._cert_str = certstr
 
+  def LoadCaCert(self):
+    """Load the CA certificate, reusing a previously parsed instance.
+
+    Returns:
+      x509.X509Certificate instance
+    """
+    ca_cert = _ca_cert_cache.get(self._ca_pem)
+    if ca_cert is None:
+      ca_cert = self.LoadOtherCert(self._ca_pem)
+      _ca_cert_cache[self._ca_pem] = ca_cert
+    return ca_cert
+
+  def _GetCertCacheKey(self, certstr):
+    """Return the verified cert cache key for a cert.
+
+    Args:
+      certstr: str, certificate in X509 PEM format
+    Returns:
+      str, hex sha256 fingerprint
+    """
+    return hashlib.sha256(certstr).hexdigest()
+
+  def GetVerifiedCert(self, certstr, utcnow=None):
+    """Return a cert object for a cert which was verified previously.
+
+    A cached cert is only returned when it was verified against the CA
+    and required issuer currently loaded, and "now" is still within its
+    validity window.
+
+    Args:
+      certstr: str, certificate in X509 PEM format
+      utcnow: datetime, optional, time to consider "now", in UTC
+    Returns:
+      x509.X509Certificate instance, or None if not cached
+    """
+    key = self._GetCertCacheKey(certstr)
+    entry = _verified_cert_cache.get(key)
+    if entry is None:
+      return None
+
+    (ca_pem, required_issuer, not_before, not_after, cert) = entry
+    if ca_pem != self._ca_pem or required_issuer != self._required_issuer:
+      return None
+
+    if utcnow is None:
+      utcnow = datetime.datetime.utcnow()
+    if utcnow < not_before or utcnow > not_after:
+      _verified_cert_cache.pop(key, None)
+      return None
+
+    return cert
+
+  def CacheVerifiedCert(self, certstr, cert):
+    """Cache a cert which passed issuer, validity and CA signature checks.
+
+    Args:
+      certstr: str, certificate in X509 PEM format
+      cert: x509.X509Certificate instance loaded from certstr
+    """
+    if len(_verified_cert_cache) >= VERIFIED_CERT_CACHE_SIZE:
+      # evict an arbitrary entry, the cache only needs to stay bounded.
+      try:
+        _verified_cert_cache.popitem()
+      except KeyError:
+        pass
+    _verified_cert_cache[self._GetCertCacheKey(certstr)] = (
+        self._ca_pem, self._required_issuer,
+        cert.GetDatetimeNotValidBefore(), cert.GetDatetimeNotValidAfter(),
+        cert)
+
   def VerifyCertSignedByCA(self, cert):
     """Verify that a client cert was signed by the required CA cert.
 
@@ -807,7 +896,7 @@ class Auth1(AuthBase):
     Returns:
       True or False
     """
-    ca_cert = self.LoadOtherCert(self._ca_pem)
+    ca_cert = self.LoadCaCert()
     try:
       # invoke the patch all the time.  tlslite decodes the long signature
       # back into an int and drops the padding which is correctly placed
@@ -838,6 +927,14 @@ class Auth1(AuthBase):
     if cert is None:
       cert = self._cert
 
+    backend = rsa_backend.GetBackend()
+    if backend is not None:
+      pk = cert.GetPublicKey()
+      if backend.HandlesKey(pk):
+        # works on the signature as a number, so a signature lacking
+        # padding needs no _PatchTlslite here.
+        return backend.Verify(pk, str(data), str(signature))
+
     signature_b = array.array('B')
     signature_b.fromstring(str(signature))
 
@@ -1048,33 +1145,43 @@ class Auth1(AuthBase):
         except TypeError, e:
           raise _Error('Invalid c or s parameter b64 format(%s)', str(e))
 
-        # load X509 client cert 'c' into object
-        try:
-          client_cert = self.LoadOtherCert(c)
-        except ValueError, e:
-          raise _Error('Invalid cert supplied %s' % str(e))
+        # a cert seen before has already been parsed, checked and verified
+        # against the CA, unless it has since left its validity window.
+        client_cert = self.GetVerifiedCert(c)
 
-        # sanity check
-        if not client_cert.GetPublicKey():
-          raise _Error('Malformed X509 cert with no public key')
+        if client_cert is None:
+          # load X509 client cert 'c' into object
+          try:
+            client_cert = self.LoadOtherCert(c)
+          except ValueError, e:
+            raise _Error('Invalid cert supplied %s' % str(e))
 
-        client_cert.SetRequiredIssuer(self._required_issuer)
-        try:
-          client_cert.CheckAll()
-        except x509.Error, e:
-          raise _Error('X509 certificate error: %s' % str(e))
+          # sanity check
+          if not client_cert.GetPublicKey():
+            raise _Error('Malformed X509 cert with no public key')
+
+          client_cert.SetRequiredIssuer(self._required_issuer)
+          try:
+            client_cert.CheckAll()
+          except x509.Error, e:
+            raise _Error('X509 certificate error: %s' % str(e))
 
-        # obtain uuid from cert
-        uuid = client_cert.GetSubject()
-        log_prefix = uuid
+          # obtain uuid from cert
+          uuid = client_cert.GetSubject()
+          log_prefix = uuid
 
-        # client_cert is loaded
-        #logging.debug('%s Client cert loaded', log_prefix)
-        #logging.debug('%s Message = %s', log_prefix, m)
+          # client_cert is loaded
+          #logging.debug('%s Client cert loaded', log_prefix)
+          #logging.debug('%s Message = %s', log_prefix, m)
 
-        # verify that the client cert is legitimate
-        if not self.VerifyCertSignedByCA(client_cert):
-          raise _Error('Client cert is not signed by the required CA')
+          # verify that the client cert is legitimate
+          if not self.VerifyCertSignedByCA(client_cert):
+            raise _Error('Client cert is not signed by the required CA')
+
+          self.CacheVerifiedCert(c, client_cert)
+        else:
+          uuid = client_cert.GetSubject()
+          log_prefix = uuid
 
         # verify that the message was signed by the client cert
         if not self.VerifyDataSignedWithCert(m, s, client_cert):
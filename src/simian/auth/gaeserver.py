@@ -27,6 +27,8 @@ Classes:
 Functions:
 
   DoMunkiAuth:                  Check Munki client auth credentials.
+  LogoutSession:                Log out of a session.
+  ResetTokenCache:              Empty the verified token cache.
 """
 
 
@@ -60,6 +62,22 @@ LEVEL_ADMIN = base.LEVEL_ADMIN
 LEVEL_UPLOADPKG = LEVEL_ADMIN
 # Deadline in seconds for datastore RPC operations
 DATASTORE_RPC_DEADLINE = 5
+# If True, store Cn/Sn nonce sessions in memcache only, not datastore.
+MEMCACHE_ONLY_CN_SESSIONS = True
+# If True, write other sessions to datastore with async RPCs.
+ASYNC_DATASTORE_PUT = True
+# Number of session keys fetched and deleted per batch when expiring sessions
+EXPIRE_BATCH_SIZE = 500
+# Max async delete RPCs outstanding at once when expiring sessions.
+EXPIRE_MAX_PENDING_RPCS = 10
+# Seconds that DoMunkiAuth trusts a verified token without checking its
+# session again.  Logouts on other instances take up to this long to apply.
+TOKEN_CACHE_TTL_SECONDS = 60
+# Maximum number of verified tokens to cache per instance
+TOKEN_CACHE_SIZE = 1000
+
+# Verified token sessions, keyed by token, values (expires datetime, session)
+_token_cache = {}
 
 
 class Error(Exception):
@@ -127,6 +145,17 @@ class Auth1ServerDatastoreSession(base.Auth1ServerSession):
     """
     session.put(rpc=self._GetConfig())
 
+  def _PutAsync(self, session):
+    """Start putting a session instance into storage.
+
+    Args:
+      session: db.Model, session instance
+    Returns:
+      google.appengine.api.apiproxy_stub_map.UserRPC, call get_result() on it
+      to complete the put.
+    """
+    return db.put_async(session, deadline=self.deadline)
+
   def DeleteById(self, sid):
     """Delete session data for a session id.
 
@@ -164,6 +193,56 @@ class Auth1ServerDatastoreSession(base.Auth1ServerSession):
     for session in gae_util.QueryIterator(q, step=100):
       yield session
 
+  def ExpireAllByAge(self, age_seconds, prefix=None):
+    """Delete all sessions older than a given age.
+
+    Session keys are fetched in batches and deleted with async RPCs, each
+    batch's delete overlapping the next fetch, with at most
+    EXPIRE_MAX_PENDING_RPCS deletes outstanding.
+
+    Args:
+      age_seconds: int, seconds of minimum age of sessions to delete.
+      prefix: str, optional, only delete sessions whose id has this prefix.
+        Only sessions in the key range of the prefix are queried, and their
+        age is checked as they are fetched.
+    Returns:
+      Integer number of sessions deleted.
+    """
+    delta = datetime.timedelta(seconds=age_seconds)
+    min_datetime = datetime.datetime.utcnow() - delta
+    if prefix:
+      # datastore allows inequality filters on one property only.
+      kind = self.model.kind()
+      q = self.model.all()
+      q.filter('__key__ >=', db.Key.from_path(kind, prefix))
+      q.filter('__key__ <', db.Key.from_path(
+          kind, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+    else:
+      q = self.model.all(keys_only=True).filter('mtime <', min_datetime)
+
+    deleted_count = 0
+    rpcs = []
+    while True:
+      results = q.fetch(EXPIRE_BATCH_SIZE)
+      if not results:
+        break
+      if prefix:
+        # as in the datastore, a missing mtime sorts before all datetimes.
+        keys = [s.key() for s in results
+                if s.mtime is None or s.mtime < min_datetime]
+      else:
+        keys = results
+      if keys:
+        if len(rpcs) >= EXPIRE_MAX_PENDING_RPCS:
+          rpcs.pop(0).get_result()
+        rpcs.append(db.delete_async(keys, deadline=self.deadline))
+        deleted_count += len(keys)
+      q.with_cursor(q.cursor())
+
+    for rpc in rpcs:
+      rpc.get_result()
+    return deleted_count
+
 
 class Auth1ServerDatastoreMemcacheSession(Auth1ServerDatastoreSession):
   """AuthSession data container which uses memcache as a frontend."""
@@ -172,6 +251,16 @@ class Auth1ServerDatastoreMemcacheSession(Auth1ServerDatastoreSession):
     super(Auth1ServerDatastoreMemcacheSession, self).__init__()
     self.prefix = 'a1sd_'
     self.ttl = 2 * 60
+    # sessions with ids starting with these prefixes are kept in memcache
+    # only, for memcache_only_ttl seconds.
+    self.memcache_only_prefixes = ()
+    self.memcache_only_ttl = self.ttl
+    self.async_put = ASYNC_DATASTORE_PUT
+    self._pending_puts = []
+
+  def _IsMemcacheOnly(self, sid):
+    """Returns True if the session with id sid is stored in memcache only."""
+    return sid.startswith(tuple(self.memcache_only_prefixes))
 
   def _CallSuperWithDefer(self, method_name, *args, **kwargs):
     """Call a superclass method and defer if a datastore error occurs.
@@ -212,13 +301,44 @@ class Auth1ServerDatastoreMemcacheSession(Auth1ServerDatastoreSession):
   def _Put(self, session):
     """Put a session instance into storage.
 
+    Memcache only sessions fall back to datastore if the memcache set fails.
+    With async_put, the datastore put is only started; call Flush() to
+    complete it.
+
     Args:
       session: db.Model, session instance
     """
-    memcache.set(
-        '%s%s' % (self.prefix, session.key().name()),
-        value=session, time=self.ttl)
-    self._CallSuperWithDefer('_Put', session)
+    sid = session.key().name()
+    if self._IsMemcacheOnly(sid):
+      if memcache.set(
+          '%s%s' % (self.prefix, sid),
+          value=session, time=self.memcache_only_ttl):
+        return
+      logging.warning('memcache set failed, putting session to datastore')
+    else:
+      memcache.set(
+          '%s%s' % (self.prefix, sid), value=session, time=self.ttl)
+
+    if self.async_put:
+      try:
+        rpc = super(Auth1ServerDatastoreMemcacheSession, self)._PutAsync(
+            session)
+      except (db.Error, apiproxy_errors.Error):
+        self._CallSuperWithDefer('_Put', session)
+      else:
+        self._pending_puts.append((rpc, session))
+    else:
+      self._CallSuperWithDefer('_Put', session)
+
+  def Flush(self):
+    """Complete pending async datastore puts, deferring any that fail."""
+    pending_puts = self._pending_puts
+    self._pending_puts = []
+    for rpc, session in pending_puts:
+      try:
+        rpc.get_result()
+      except (db.Error, apiproxy_errors.Error, runtime.DeadlineExceededError):
+        self._CallSuperWithDefer('_Put', session)
 
   def DeleteById(self, sid):
     """Delete session data for a session id.
@@ -227,6 +347,8 @@ class Auth1ServerDatastoreMemcacheSession(Auth1ServerDatastoreSession):
       sid: str, session id
     """
     memcache.delete('%s%s' % (self.prefix, sid))
+    if self._IsMemcacheOnly(sid):
+      return
     # slightly defer with countdown so that back to back _Put(cn, sn)
     # and DeleteById(cn) are more likely to run in the right order.    best
     # effort, the session cleaner cron will destroy anything leftover later
@@ -239,13 +361,22 @@ class Auth1ServerDatastoreMemcacheSession(Auth1ServerDatastoreSession):
     Args:
       session: db.Model, session instance
     """
-    memcache.delete('%s%s' % (self.prefix, session.key().name()))
+    sid = session.key().name()
+    memcache.delete('%s%s' % (self.prefix, sid))
+    if self._IsMemcacheOnly(sid):
+      return
     self._CallSuperWithDefer('Delete', session)
 
 
 class AuthSessionSimianServer(Auth1ServerDatastoreMemcacheSession):
   """AuthSession data container that uses the Simian AuthSession model."""
 
+  def __init__(self):
+    super(AuthSessionSimianServer, self).__init__()
+    if MEMCACHE_ONLY_CN_SESSIONS:
+      self.memcache_only_prefixes = (self.SESSION_TYPE_PREFIX_CN,)
+      self.memcache_only_ttl = base.AGE_CN_SECONDS
+
   @staticmethod
   def GetModelClass():
     return models.AuthSession
@@ -269,6 +400,21 @@ class AuthSessionSimianServer(Auth1ServerDatastoreMemcacheSession):
       age = datetime.timedelta(seconds=base.AGE_CN_SECONDS)
     return super(AuthSessionSimianServer, self).ExpireOne(session, age, now)
 
+  def ExpireAll(self):
+    """Expire all session data.
+
+    Cn sessions expire sooner than other sessions, so all old sessions are
+    expired first, then newer sessions which are Cn sessions.
+
+    Returns:
+      Integer number of sessions expired.
+    """
+    expired_sessions_count = self.ExpireAllByAge(
+        max(base.AGE_TOKEN_SECONDS, base.AGE_DEFAULT_SECONDS))
+    expired_sessions_count += self.ExpireAllByAge(
+        base.AGE_CN_SECONDS, prefix=self.SESSION_TYPE_PREFIX_CN)
+    return expired_sessions_count
+
 
 class AuthSimianServer(base.Auth1):
   """Auth1 server which uses AuthSessionSimian for session storage."""
@@ -301,6 +447,98 @@ class AuthSimianServer(base.Auth1):
   def GetSessionClass(self):
     return AuthSessionSimianServer
 
+  def SessionDelToken(self, token):
+    """Delete a token from session data.
+
+    Args:
+      token: str, token string from SessionCreateAuthToken
+    """
+    _InvalidateCachedToken(token)
+    super(AuthSimianServer, self).SessionDelToken(token)
+
+  def FlushSession(self):
+    """Complete pending session storage writes."""
+    self._session.Flush()
+
+
+def ResetTokenCache():
+  """Empty the verified token cache."""
+  _token_cache.clear()
+
+
+def _GetCachedTokenSession(token, require_level):
+  """Return the session for a recently verified token.
+
+  Args:
+    token: str, auth token
+    require_level: int, require at least this security level in the session
+  Returns:
+    models.AuthSession entity, or None if the token is not cached, has
+    expired from the cache, or the session level is too low.
+  """
+  entry = _token_cache.get(token)
+  if entry is None:
+    return None
+  expires, session = entry
+  if datetime.datetime.utcnow() >= expires:
+    _token_cache.pop(token, None)
+    return None
+  if require_level > session.level:
+    return None
+  return session
+
+
+def _CacheTokenSession(token, session):
+  """Cache the session for a verified token.
+
+  The entry expires after TOKEN_CACHE_TTL_SECONDS, or when the session
+  itself would expire if sooner.
+
+  Args:
+    token: str, auth token
+    session: models.AuthSession entity, verified by GetSessionIfAuthOK
+  """
+  expires = datetime.datetime.utcnow() + datetime.timedelta(
+      seconds=TOKEN_CACHE_TTL_SECONDS)
+  if session.mtime:
+    expires = min(expires, session.mtime + datetime.timedelta(
+        seconds=base.AGE_TOKEN_SECONDS))
+  if len(_token_cache) >= TOKEN_CACHE_SIZE:
+    # evict an arbitrary entry, the cache only needs to stay bounded.
+    try:
+      _token_cache.popitem()
+    except KeyError:
+      pass
+  _token_cache[token] = (expires, session)
+
+
+def _InvalidateCachedToken(token):
+  """Remove a token from the verified token cache.
+
+  Args:
+    token: str, auth token
+  """
+  _token_cache.pop(token, None)
+
+
+def _GetTokenFromCookieStr(cookie_str):
+  """Find the auth token in a cookie header without full cookie parsing.
+
+  Args:
+    cookie_str: str, HTTP Cookie header value
+  Returns:
+    str auth token, or None if there is no plain (unquoted) auth token
+    cookie and the header should be parsed with Cookie.SimpleCookie.
+  """
+  token = None
+  for part in cookie_str.split(';'):
+    name, unused_sep, value = part.partition('=')
+    if name.strip() == auth.AUTH_TOKEN_COOKIE:
+      token = value.strip()
+  if not token or token.startswith('"'):
+    return None
+  return token
+
 
 def DoMunkiAuth(fake_noauth=None, require_level=None):
   """Do Munki auth.
@@ -326,25 +564,31 @@ def DoMunkiAuth(fake_noauth=None, require_level=None):
     logging.info('HTTP_COOKIE is empty or nonexistent.')
     raise NotAuthenticated('NoCookie')
 
-  c = Cookie.SimpleCookie()
-  try:
-    c.load(cookie_str)
-  except TypeError, e:
-    logging.info('Cookie could not be loaded, %s: %s', str(e), cookie_str)
-    raise NotAuthenticated
-  except Cookie.CookieError, e:
-    logging.info(
-        'Cookie could not be loaded, %s: %s', str(e), cookie_str)
-    raise NotAuthenticated('CookieError')
-
-  if (auth.AUTH_TOKEN_COOKIE not in c
-      or not c[auth.AUTH_TOKEN_COOKIE]):
-    logging.info('Cookie data is empty or does not contain auth token %s',
-                 auth.AUTH_TOKEN_COOKIE)
-    raise NotAuthenticated('EmptyCookie')
+  token = _GetTokenFromCookieStr(cookie_str)
+  if token is None:
+    c = Cookie.SimpleCookie()
+    try:
+      c.load(cookie_str)
+    except TypeError, e:
+      logging.info('Cookie could not be loaded, %s: %s', str(e), cookie_str)
+      raise NotAuthenticated
+    except Cookie.CookieError, e:
+      logging.info(
+          'Cookie could not be loaded, %s: %s', str(e), cookie_str)
+      raise NotAuthenticated('CookieError')
+
+    if (auth.AUTH_TOKEN_COOKIE not in c
+        or not c[auth.AUTH_TOKEN_COOKIE]):
+      logging.info('Cookie data is empty or does not contain auth token %s',
+                   auth.AUTH_TOKEN_COOKIE)
+      raise NotAuthenticated('EmptyCookie')
+    token = c[auth.AUTH_TOKEN_COOKIE].value
+
+  session = _GetCachedTokenSession(token, require_level)
+  if session is not None:
+    return session
 
   a = AuthSimianServer()
-  token = c[auth.AUTH_TOKEN_COOKIE].value
   try:
     session = a.GetSessionIfAuthOK(token, require_level)
   except base.AuthSessionError, e:
@@ -358,6 +602,7 @@ def DoMunkiAuth(fake_noauth=None, require_level=None):
 
   # logging.debug('Auth client connected: uuid %s', session.uuid)
 
+  _CacheTokenSession(token, session)
   return session
 
 
@@ -367,6 +612,10 @@ def LogoutSession(session):
   Args:
     session: db.Model, session instance
   """
+  prefix = base.AuthSessionBase.SESSION_TYPE_PREFIX_TOKEN
+  sid = session.key().name()
+  if sid.startswith(prefix):
+    _InvalidateCachedToken(sid[len(prefix):])
   a = AuthSessionSimianServer()
   try:
     a.Delete(session)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""RSA signature backends used by Auth1 and x509.
+
+tlslite performs RSA in pure Python.  When an accelerated RSA library is
+importable, a backend here performs the raw RSA operations with it instead.
+PKCS#1 v1.5 encoding is done here, producing exactly the bytes tlslite
+produces, including its habit of dropping leading zero bytes from
+signatures.  Verification works on the signature as an integer, so short
+signatures verify without the _PatchTlslite workaround.
+
+Classes:
+
+  RSABackend:          PKCS#1 v1.5 signature encoding, raw RSA with pow()
+  PyCryptoRSABackend:  raw RSA operations done by PyCrypto
+
+Functions:
+
+  GetBackend: return the accelerated backend, or None to use tlslite
+"""
+
+
+
+import hashlib
+
+try:
+  from Crypto.PublicKey import RSA as pycrypto_rsa
+except ImportError:
+  pycrypto_rsa = None
+
+
+# Set False to always use the tlslite RSA implementation.
+USE_ACCELERATED = True
+
+# DER encoded DigestInfo prefixes for PKCS#1 v1.5 signatures, RFC 3447 9.2
+DIGEST_INFO_PREFIX = {
+    'sha1': '3021300906052b0e03021a05000414'.decode('hex'),
+    'sha256': '3031300d060960864801650304020105000420'.decode('hex'),
+}
+
+
+def _StrToNumber(s):
+  """Convert a big-endian byte string to a number.
+
+  Args:
+    s: str, bytes
+  Returns:
+    long
+  """
+  if not s:
+    return 0L
+  return long(s.encode('hex'), 16)
+
+
+def _NumberToStr(n):
+  """Convert a number to a big-endian byte string, as tlslite does.
+
+  Args:
+    n: int or long, >= 0
+  Returns:
+    str, bytes with no leading zero bytes
+  """
+  if not n:
+    return ''
+  h = '%x' % n
+  if len(h) % 2:
+    h = '0%s' % h
+  return h.decode('hex')
+
+
+def _NumBytes(n):
+  """Return the number of bytes needed to hold a number.
+
+  Args:
+    n: int or long, >= 0
+  Returns:
+    int
+  """
+  return len(_NumberToStr(n))
+
+
+class RSABackend(object):
+  """RSA backend doing PKCS#1 v1.5 encoding and raw RSA with pow().
+
+  Subclasses override _PublicOp and _PrivateOp with accelerated versions.
+  """
+
+  name = 'python'
+
+  def HandlesKey(self, key, private=False):
+    """Check whether this backend can operate with a key.
+
+    Private keys are only handled when their components are accessible,
+    e.g. tlslite's Python_RSAKey.
+
+    Args:
+      key: tlslite.utils.RSAKey.RSAKey instance
+      private: bool, True if the private key operation is needed
+    Returns:
+      bool
+    """
+    try:
+      if not key.n or not key.e:
+        return False
+      if private:
+        return bool(key.d and key.p and key.q)
+    except AttributeError:
+      return False
+    return True
+
+  def _PublicOp(self, key, c):
+    """Perform the raw RSA public key operation.
+
+    Args:
+      key: tlslite.utils.RSAKey.RSAKey instance
+      c: long, value
+    Returns:
+      long, c ** e mod n
+    """
+    return pow(c, key.e, key.n)
+
+  def _PrivateOp(self, key, m):
+    """Perform the raw RSA private key operation.
+
+    Args:
+      key: tlslite.utils.RSAKey.RSAKey instance with a private key
+      m: long, value
+    Returns:
+      long, m ** d mod n
+    """
+    return pow(m, key.d, key.n)
+
+  def _EncodeDigest(self, key, data, hash_name):
+    """Return the PKCS#1 v1.5 encoded digest of data, as a number.
+
+    Args:
+      key: tlslite.utils.RSAKey.RSAKey instance
+      data: str, data to hash
+      hash_name: str, 'sha1' or 'sha256'
+    Returns:
+      long
+    """
+    digest_info = (
+        DIGEST_INFO_PREFIX[hash_name] + hashlib.new(hash_name, data).digest())
+    pad_len = _NumBytes(key.n) - (len(digest_info) + 3)
+    # the leading zero byte is implied, as with tlslite.
+    return _StrToNumber(
+        '\x01%s\x00%s' % ('\xff' * pad_len, digest_info))
+
+  def Sign(self, key, data, hash_name='sha1'):
+    """Hash and sign data.
+
+    Args:
+      key: tlslite.utils.RSAKey.RSAKey instance with a private key
+      data: str, data to sign
+      hash_name: str, optional, 'sha1' (default) or 'sha256'
+    Returns:
+      str, signature
+    Raises:
+      ValueError: the key is too small for the encoded digest
+    """
+    m = self._EncodeDigest(key, data, hash_name)
+    if m >= key.n:
+      raise ValueError('RSA key is too small')
+    return _NumberToStr(self._PrivateOp(key, m))
+
+  def Verify(self, key, data, signature, hash_name='sha1'):
+    """Hash data and verify a signature on it.
+
+    Args:
+      key: tlslite.utils.RSAKey.RSAKey instance
+      data: str, data which was signed
+      signature: str, signature
+      hash_name: str, optional, 'sha1' (default) or 'sha256'
+    Returns:
+      True if the signature verifies, False if not
+    """
+    c = _StrToNumber(signature)
+    if c >= key.n:
+      return False
+    return self._PublicOp(key, c) == self._EncodeDigest(key, data, hash_name)
+
+
+class PyCryptoRSABackend(RSABackend):
+  """RSA backend using PyCrypto, which uses GMP when it is available."""
+
+  name = 'pycrypto'
+
+  def _GetPyCryptoKey(self, key):
+    """Return a PyCrypto key equivalent to a tlslite key.
+
+    The PyCrypto key is built once and kept on the tlslite key object.
+
+    Args:
+      key: tlslite.utils.RSAKey.RSAKey instance
+    Returns:
+      Crypto.PublicKey.RSA._RSAobj instance
+    """
+    pycrypto_key = getattr(key, '_pycrypto_key', None)
+    if pycrypto_key is None:
+      if getattr(key, 'd', None):
+        pycrypto_key = pycrypto_rsa.construct(
+            (long(key.n), long(key.e), long(key.d), long(key.p), long(key.q)))
+      else:
+        pycrypto_key = pycrypto_rsa.construct((long(key.n), long(key.e)))
+      key._pycrypto_key = pycrypto_key
+    return pycrypto_key
+
+  def _PublicOp(self, key, c):
+    return self._GetPyCryptoKey(key).encrypt(c, '')[0]
+
+  def _PrivateOp(self, key, m):
+    return self._GetPyCryptoKey(key).decrypt(m)
+
+
+def GetBackend():
+  """Return the accelerated RSA backend.
+
+  Returns:
+    RSABackend instance, or None if tlslite should be used
+  """
+  if not USE_ACCELERATED:
+    return None
+  # PyCrypto 2.x, pycryptodome does not offer raw RSA operations.
+  if pycrypto_rsa is not None and hasattr(pycrypto_rsa, '_RSAobj'):
+    return _PYCRYPTO_BACKEND
+  return None
+
+
+_PYCRYPTO_BACKEND = PyCryptoRSABackend()
@@ -47,6 +47,8 @@ import tlslite
 import tlslite.X509
 import tlslite.utils.keyfactory
 
+from simian.auth import rsa_backend
+
 
 # OIDs as a dict, for quick lookup of the OID
 OID_NAME = {
@@ -109,6 +111,28 @@ X509_CERT_VERSION_3 = 0x2
 # Regex for valid, standard base64 characters. (i.e. not websafe)
 BASE64_RE = re.compile(r'^[0-9A-Za-z/+=]+$')
 
+# Try the fast DER walker before the full pyasn1 decoder when loading certs.
+FAST_PARSE = True
+
+# DER tags understood by the fast certificate parser
+DER_TAG_BOOLEAN = 0x01
+DER_TAG_INTEGER = 0x02
+DER_TAG_BIT_STRING = 0x03
+DER_TAG_OCTET_STRING = 0x04
+DER_TAG_OID = 0x06
+DER_TAG_UTF8_STRING = 0x0c
+DER_TAG_PRINTABLE_STRING = 0x13
+DER_TAG_IA5_STRING = 0x16
+DER_TAG_UTC_TIME = 0x17
+DER_TAG_SEQUENCE = 0x30
+DER_TAG_SET = 0x31
+DER_TAG_VERSION = 0xa0       # [0] EXPLICIT, context specific constructed
+DER_TAG_EXTENSIONS = 0xa3    # [3] EXPLICIT, context specific constructed
+
+# DN value string types the fast parser handles itself
+DER_DN_STRING_TAGS = (
+    DER_TAG_UTF8_STRING, DER_TAG_PRINTABLE_STRING, DER_TAG_IA5_STRING)
+
 
 class Error(Exception):
   """Base Error."""
@@ -154,6 +178,14 @@ class CertificatePEMFormatError(CertificateFormatError, PEMFormatError):
   """Certificate PEM Format Error."""
 
 
+class FastParseError(CertificateParseError):
+  """Certificate uses structure which the fast parser does not handle.
+
+  Never raised to callers of LoadFromByteString(), which falls back to the
+  full pyasn1 parser instead.
+  """
+
+
 class RSAKeyPEMFormatError(PEMFormatError):
   """RSA Key PEM Format Error."""
 
@@ -162,6 +194,130 @@ class RSAPrivateKeyPEMFormatError(RSAKeyPEMFormatError):
   """RSA Private Key PEM Format Error."""
 
 
+def _DerReadItem(data, offset):
+  """Read the DER TLV item found at an offset.
+
+  Args:
+    data: str, DER bytes
+    offset: int, offset of the item tag
+  Returns:
+    tuple (tag, start, end) where data[start:end] is the item contents
+  Raises:
+    FastParseError: the item is truncated or uses unsupported encoding
+  """
+  try:
+    tag = ord(data[offset])
+    length = ord(data[offset + 1])
+  except IndexError:
+    raise FastParseError('Truncated DER item')
+
+  if tag & 0x1f == 0x1f:
+    raise FastParseError('High tag number form')
+
+  start = offset + 2
+  if length & 0x80:
+    n = length & 0x7f
+    # indefinite length (n == 0) is BER only.
+    if n == 0 or n > 4 or start + n > len(data):
+      raise FastParseError('Unsupported DER length')
+    length = 0
+    for c in data[start:start + n]:
+      length = (length << 8) | ord(c)
+    start += n
+
+  end = start + length
+  if end > len(data):
+    raise FastParseError('Truncated DER item')
+  return tag, start, end
+
+
+def _DerReadItems(data, start, end):
+  """Read all DER TLV items found between two offsets.
+
+  Args:
+    data: str, DER bytes
+    start: int, offset of the first item
+    end: int, offset following the last item
+  Returns:
+    list of (tag, start, end) tuples, as _DerReadItem() returns
+  Raises:
+    FastParseError: an item is truncated or overruns end
+  """
+  items = []
+  offset = start
+  while offset < end:
+    item = _DerReadItem(data, offset)
+    if item[2] > end:
+      raise FastParseError('DER item overruns its container')
+    items.append(item)
+    offset = item[2]
+  return items
+
+
+def _DerReadOnlyItem(data, start, end, tag):
+  """Read the single item of a given tag which spans start to end exactly.
+
+  Args:
+    data: str, DER bytes
+    start: int, offset of the item
+    end: int, offset following the item
+    tag: int, required tag
+  Returns:
+    tuple (start, end) of the item contents
+  Raises:
+    FastParseError: there is not exactly one item with this tag
+  """
+  items = _DerReadItems(data, start, end)
+  if len(items) != 1 or items[0][0] != tag:
+    raise FastParseError('Unexpected DER structure')
+  return items[0][1], items[0][2]
+
+
+def _DerDecodeOid(content):
+  """Decode DER OID contents.
+
+  Args:
+    content: str, OID contents
+  Returns:
+    tuple of ints, like OID_NAME keys
+  Raises:
+    FastParseError: the OID is malformed
+  """
+  if not content or ord(content[0]) & 0x80 or ord(content[-1]) & 0x80:
+    raise FastParseError('Unsupported OID encoding')
+  first = ord(content[0])
+  if first < 80:
+    oid = [first / 40, first % 40]
+  else:
+    oid = [2, first - 80]
+  value = 0
+  for c in content[1:]:
+    c = ord(c)
+    value = (value << 7) | (c & 0x7f)
+    if not c & 0x80:
+      oid.append(value)
+      value = 0
+  return tuple(oid)
+
+
+def _DerDecodeInteger(content):
+  """Decode DER INTEGER contents.
+
+  Args:
+    content: str, INTEGER contents
+  Returns:
+    int or long
+  Raises:
+    FastParseError: the INTEGER is empty
+  """
+  if not content:
+    raise FastParseError('Empty INTEGER')
+  value = long(content.encode('hex'), 16)
+  if ord(content[0]) & 0x80:
+    value -= 1 << (8 * len(content))
+  return int(value)
+
+
 class BaseDataObject(object):
   """Object which can auto-generate its own Get* methods."""
 
@@ -614,6 +770,195 @@ class X509Certificate(BaseDataObject):
     cert.update(sig)
     return cert
 
+  def _GetAlgorithmFromDer(self, data, start, end):
+    """Get a signature algorithm from a DER AlgorithmIdentifier.
+
+    Args:
+      data: str, DER bytes
+      start: int, offset of the AlgorithmIdentifier contents
+      end: int, offset following the AlgorithmIdentifier contents
+    Returns:
+      tuple, signature algorithm OID
+    Raises:
+      FastParseError: the algorithm is not one handled by the fast parser
+    """
+    items = _DerReadItems(data, start, end)
+    if len(items) != 2 or items[0][0] != DER_TAG_OID:
+      raise FastParseError('AlgorithmIdentifier structure')
+    oid = _DerDecodeOid(data[items[0][1]:items[0][2]])
+    if oid not in self.SIGNATURE_ALGORITHMS:
+      raise FastParseError('Signature algorithm %s' % str(oid))
+    return oid
+
+  def _AssembleDNFromDer(self, data, start, end):
+    """Assemble a DER Name into a string output.
+
+    Args:
+      data: str, DER bytes
+      start: int, offset of the Name contents
+      end: int, offset following the Name contents
+    Returns:
+      str like 'OU=Foo,C=Bar', as _AssembleDNSequence() returns
+    Raises:
+      FastParseError: the Name contains structure or values which only
+        the full parser handles
+    """
+    output = []
+    for tag, rdn_start, rdn_end in _DerReadItems(data, start, end):
+      if tag != DER_TAG_SET:
+        raise FastParseError('RDN structure')
+      (atv_start, atv_end) = _DerReadOnlyItem(
+          data, rdn_start, rdn_end, DER_TAG_SEQUENCE)
+      atv = _DerReadItems(data, atv_start, atv_end)
+      if (len(atv) != 2 or atv[0][0] != DER_TAG_OID or
+          atv[1][0] not in DER_DN_STRING_TAGS):
+        raise FastParseError('AttributeTypeAndValue structure')
+      oid = _DerDecodeOid(data[atv[0][1]:atv[0][2]])
+      if oid not in OID_NAME:
+        raise FastParseError('Unknown OID %s' % str(oid))
+      value = data[atv[1][1]:atv[1][2]]
+      if max(value or ' ') > '\x7e':
+        raise FastParseError('Non-ASCII DN value')
+      output.append('%s=%s' % (OID_NAME[oid], value))
+    return ','.join(output)
+
+  def _GetV3ExtensionFieldsFromDer(self, data, start, end):
+    """Get X509 V3 extension fields from DER Extensions.
+
+    Args:
+      data: str, DER bytes
+      start: int, offset of the Extensions contents
+      end: int, offset following the Extensions contents
+    Returns:
+      dict, as _GetV3ExtensionFieldsFromSequence() returns
+    Raises:
+      FastParseError: an extension needs the full parser
+    """
+    output = {}
+    cert_key_usage = []
+
+    for tag, ext_start, ext_end in _DerReadItems(data, start, end):
+      if tag != DER_TAG_SEQUENCE:
+        raise FastParseError('Extension structure')
+      ext = _DerReadItems(data, ext_start, ext_end)
+      if (len(ext) not in (2, 3) or ext[0][0] != DER_TAG_OID or
+          ext[-1][0] != DER_TAG_OCTET_STRING):
+        raise FastParseError('Extension structure')
+      oid = _DerDecodeOid(data[ext[0][1]:ext[0][2]])
+      (value_start, value_end) = ext[-1][1:]
+
+      if oid == OID_X509V3_BASIC_CONSTRAINTS:
+        (bc_start, bc_end) = _DerReadOnlyItem(
+            data, value_start, value_end, DER_TAG_SEQUENCE)
+        bc = _DerReadItems(data, bc_start, bc_end)
+        if not bc:
+          continue
+        # a pathLenConstraint, or anything else, is left to the full parser.
+        if len(bc) != 1 or bc[0][0] != DER_TAG_BOOLEAN:
+          raise FastParseError('X509V3 Basic Constraints structure')
+        if data[bc[0][1]:bc[0][2]].strip('\x00'):
+          output['may_act_as_ca'] = True
+
+      elif oid == OID_X509V3_KEY_USAGE:
+        (ku_start, ku_end) = _DerReadOnlyItem(
+            data, value_start, value_end, DER_TAG_BIT_STRING)
+        bits = data[ku_start:ku_end]
+        if not bits:
+          raise FastParseError('X509V3 Key Usage encoding')
+        n_bits = (len(bits) - 1) * 8 - ord(bits[0])
+        if n_bits > len(X509V3_KEY_USAGE_BIT_FIELDS):
+          raise FastParseError('X509V3 Key Usage length')
+        for n in xrange(n_bits):
+          if ord(bits[1 + n / 8]) & (0x80 >> (n % 8)):
+            cert_key_usage.append(X509V3_KEY_USAGE_BIT_FIELDS[n])
+
+      elif oid == OID_X509V3_SUBJECT_ALT_NAME:
+        raise FastParseError('X509V3 Subject Alt Name')
+
+    cert_key_usage = tuple(cert_key_usage)
+    if cert_key_usage:
+      output['key_usage'] = cert_key_usage
+    return output
+
+  def _GetCertFromByteStringFast(self, bytes_str):
+    """Get certificate contents by walking the DER bytes directly.
+
+    Only the fields which are needed to check and verify certificates are
+    decoded, without building a pyasn1 object tree.  The TBS certificate
+    bytes are sliced out as-is rather than re-encoded.
+
+    Args:
+      bytes_str: str, bytes for entire certificate
+    Returns:
+      dict combining all _Get* output, as the full parser produces
+    Raises:
+      FastParseError: the certificate needs the full parser
+      CertificateValueError: error in a value in the certificate
+    """
+    (tag, cert_start, cert_end) = _DerReadItem(bytes_str, 0)
+    if tag != DER_TAG_SEQUENCE or cert_end != len(bytes_str):
+      raise FastParseError('Certificate structure')
+
+    top = _DerReadItems(bytes_str, cert_start, cert_end)
+    if ([t[0] for t in top] !=
+        [DER_TAG_SEQUENCE, DER_TAG_SEQUENCE, DER_TAG_BIT_STRING]):
+      raise FastParseError('Certificate structure')
+    (tbs, sigalg, sig) = top
+
+    fields = _DerReadItems(bytes_str, tbs[1], tbs[2])
+    if len(fields) < 7 or [t[0] for t in fields[:7]] != [
+        DER_TAG_VERSION, DER_TAG_INTEGER, DER_TAG_SEQUENCE, DER_TAG_SEQUENCE,
+        DER_TAG_SEQUENCE, DER_TAG_SEQUENCE, DER_TAG_SEQUENCE]:
+      raise FastParseError('Certificate field structure')
+
+    (version_start, version_end) = _DerReadOnlyItem(
+        bytes_str, fields[0][1], fields[0][2], DER_TAG_INTEGER)
+    if (_DerDecodeInteger(bytes_str[version_start:version_end]) !=
+        X509_CERT_VERSION_3):
+      raise FastParseError('X509 version not supported')
+
+    validity = _DerReadItems(bytes_str, fields[4][1], fields[4][2])
+    if [t[0] for t in validity] != [DER_TAG_UTC_TIME, DER_TAG_UTC_TIME]:
+      raise FastParseError('Validity time structure')
+
+    if len(fields) == 7:
+      v3_output = {}
+    elif len(fields) == 8 and fields[7][0] == DER_TAG_EXTENSIONS:
+      (ext_start, ext_end) = _DerReadOnlyItem(
+          bytes_str, fields[7][1], fields[7][2], DER_TAG_SEQUENCE)
+      v3_output = self._GetV3ExtensionFieldsFromDer(
+          bytes_str, ext_start, ext_end)
+    else:
+      raise FastParseError('Optional certificate field structure')
+
+    # the full parser reads the signature algorithm inside the fields too,
+    # so require both to be supported.
+    self._GetAlgorithmFromDer(bytes_str, fields[2][1], fields[2][2])
+    sig_algorithm = self._GetAlgorithmFromDer(
+        bytes_str, sigalg[1], sigalg[2])
+
+    sig_bits = bytes_str[sig[1]:sig[2]]
+    if not sig_bits or sig_bits[0] != '\x00' or len(sig_bits) - 1 < 128:
+      raise FastParseError('Signature format')
+
+    cert = {
+        'serial_num': _DerDecodeInteger(
+            bytes_str[fields[1][1]:fields[1][2]]),
+        'issuer': unicode(
+            self._AssembleDNFromDer(bytes_str, fields[3][1], fields[3][2])),
+        'subject': unicode(
+            self._AssembleDNFromDer(bytes_str, fields[5][1], fields[5][2])),
+        'valid_notbefore': self._CertTimestampToDatetime(
+            bytes_str[validity[0][1]:validity[0][2]]),
+        'valid_notafter': self._CertTimestampToDatetime(
+            bytes_str[validity[1][1]:validity[1][2]]),
+        'fields_data': bytes_str[cert_start:tbs[2]],
+        'sig_algorithm': sig_algorithm,
+        'sig_data': sig_bits[1:],
+    }
+    cert.update(v3_output)
+    return cert
+
   def _GetPublicKeyFromByteString(self, bytes_str):
     """Get the public key from a byte string.
 
@@ -636,16 +981,26 @@ class X509Certificate(BaseDataObject):
     Args:
       bytes_str: str, bytes
     """
-    # break the client cert into pieces
-    try:
-      c = der_decoder.decode(bytes_str)
-    except pyasn1.error.PyAsn1Error, e:
-      raise CertificateASN1FormatError('DER decode: %s' % str(e))
-
     cert = {
         'entire_byte_string': bytes_str,
     }
-    cert.update(self._GetCertSequencesFromTopSequence(c))
+
+    fields = None
+    if FAST_PARSE:
+      try:
+        fields = self._GetCertFromByteStringFast(bytes_str)
+      except (FastParseError, IndexError, TypeError, ValueError):
+        fields = None  # anything unusual goes through the full parser.
+
+    if fields is None:
+      # break the client cert into pieces
+      try:
+        c = der_decoder.decode(bytes_str)
+      except pyasn1.error.PyAsn1Error, e:
+        raise CertificateASN1FormatError('DER decode: %s' % str(e))
+      fields = self._GetCertSequencesFromTopSequence(c)
+
+    cert.update(fields)
     cert.update(self._GetPublicKeyFromByteString(bytes_str))
     self.Reset()
     self._cert.update(cert)
@@ -719,9 +1074,19 @@ class X509Certificate(BaseDataObject):
     if not other_cert.GetMayActAsCA():
       raise CertificateValueError('Other cert is not a CA cert')
 
+    pk = other_cert.GetPublicKey()
+
+    backend = rsa_backend.GetBackend()
+    if backend is not None and backend.HandlesKey(pk):
+      if self._cert['sig_algorithm'] == OID_SHA256_WITH_RSA_ENC:
+        hash_name = 'sha256'
+      else:
+        hash_name = 'sha1'
+      return backend.Verify(
+          pk, self.GetFieldsData(), self.GetSignatureData(), hash_name)
+
     sig = self._StrToArray(self.GetSignatureData())
     fields = self._StrToArray(self.GetFieldsData())
-    pk = other_cert.GetPublicKey()
 
     if self._cert['sig_algorithm'] == OID_SHA256_WITH_RSA_ENC:
       # tlslite doesn't support SHA256, so manually construct bytes to verify.
@@ -22,15 +22,22 @@
 
 
 import datetime
+import email.utils
+import errno
 import getpass
+import hashlib
 import httplib
+import json
 import logging
 import mimetools
 import os
 import platform
+import Queue
+import random
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import urllib
 import urllib2
@@ -69,7 +76,32 @@ else:
 
 
 DEFAULT_HTTP_ATTEMPTS = 4
-DEFAULT_RETRY_HTTP_STATUS_CODES = frozenset([500, 502, 503, 504])
+DEFAULT_RETRY_HTTP_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+# Base and maximum seconds of the exponential backoff between attempts.
+RETRY_BACKOFF_BASE_SECONDS = 5
+RETRY_BACKOFF_MAX_SECONDS = 300
+# Retry policies by HTTP status, as (backoff base seconds, honor Retry-After
+# header) tuples; connection errors and other statuses use the default.
+DEFAULT_RETRY_POLICY = (RETRY_BACKOFF_BASE_SECONDS, False)
+RETRY_POLICIES = {
+    429: (RETRY_BACKOFF_BASE_SECONDS * 2, True),
+    503: (RETRY_BACKOFF_BASE_SECONDS, True),
+}
+# Maximum seconds of a Retry-After header that is honored.
+RETRY_AFTER_MAX_SECONDS = 600
+# Retries a process may make in a burst, and retries it regains per second.
+RETRY_BUDGET_SIZE = 20
+RETRY_BUDGET_REFILL_PER_SECOND = 0.1
+# Seconds an idle keep-alive connection is kept in the pool for reuse.
+CONNECTION_IDLE_TIMEOUT = 30
+# Suffix of the file a download is written to until it is complete.
+PARTIAL_DOWNLOAD_SUFFIX = '.partial'
+# Block size used to read and hash files.
+FILE_BLOCK_SIZE = 65536
+# Number of packages DownloadPackages() downloads concurrently by default.
+DOWNLOAD_CONCURRENCY = 4
+# Maximum number of concurrent downloads from one host.
+MAX_DOWNLOAD_CONCURRENCY_PER_HOST = 8
 SERVER_HOSTNAME = settings.SERVER_HOSTNAME
 SERVER_PORT = settings.SERVER_PORT
 AUTH_DOMAIN = settings.AUTH_DOMAIN
@@ -81,6 +113,17 @@ DEBUG = False
 if DEBUG:
   logging.getLogger().setLevel(logging.DEBUG)
 URL_UPLOADPKG = '/uploadpkg'
+URL_UPLOADPKG_CHUNKED = '/uploadpkg/chunked'
+# Packages at least this large are uploaded in resumable chunks.
+CHUNKED_UPLOAD_MIN_SIZE = 64 * 1024 * 1024
+# Number of chunk failures a chunked upload resumes after before giving up.
+CHUNKED_UPLOAD_ATTEMPTS = 10
+# Methods which are resent on a new connection after any failure of a
+# pooled connection, as repeating them has no further effect.
+IDEMPOTENT_HTTP_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE'])
+# Socket errnos which mean a pooled connection was closed by the server
+# before the request reached it.
+STALE_CONNECTION_ERRNOS = frozenset([errno.ECONNRESET, errno.EPIPE])
 
 
 class Error(Exception):
@@ -91,6 +134,10 @@ class HTTPError(Error):
   """HTTP error."""
 
 
+class ConnectionDroppedError(HTTPError):
+  """The connection was closed before any of the response was read."""
+
+
 class SimianServerError(Error):
   """Simian server error."""
 
@@ -166,6 +213,21 @@ class Response(object):
     """Returns True on client or server error, False otherwise."""
     return self.status >= 400 and self.status <= 599
 
+  def GetHeader(self, name, default=None):
+    """Returns the value of a header, matching its name case insensitively.
+
+    Args:
+      name: str, header name like 'Retry-After'
+      default: optional, value returned if the header is not present
+    Returns:
+      str header value, or default
+    """
+    name = name.lower()
+    for k, v in (self.headers or {}).iteritems():
+      if k.lower() == name:
+        return v
+    return default
+
 
 class MultiBodyConnection:  # pylint: disable=g-old-style-class,no-init
   """Connection which can send multiple items as request body."""
@@ -301,6 +363,269 @@ class HTTPMultiBodyConnection(MultiBodyConnection, httplib.HTTPConnection):
   _is_https = False
 
 
+class ResumableDownloadFile(object):
+  """File a download is written to, computing the sha256 of its content.
+
+  A 206 Partial Content response body is written after the first offset
+  bytes of the file, which are kept from an earlier attempt; any other
+  successful response body replaces the content of the file.  Error
+  response bodies are discarded, leaving the file as it was.
+  """
+
+  def __init__(self, f, offset=0, progress_callback=None):
+    """Init the instance.
+
+    Args:
+      f: file, opened for reading and writing.
+      offset: int, length of the content kept from an earlier attempt.
+      progress_callback: function, optional, which will receive
+          (bytes written, bytes total) arguments as the body is written.
+    """
+    self._f = f
+    self._offset = offset
+    self._progress_callback = progress_callback
+    self._sha256 = hashlib.sha256()
+    self._discard = False
+    self._bytes_written = 0
+    self._bytes_total = 0
+    self.etag = None
+
+  def Start(self, status, headers):
+    """Prepare the file for a response body, see HttpsClient._GetResponse().
+
+    Args:
+      status: int, response status.
+      headers: dict, response headers with lowercase names.
+    """
+    self._discard = status < 200 or status > 299
+    if self._discard:
+      return
+    self.etag = headers.get('etag')
+    if status == httplib.PARTIAL_CONTENT:
+      self._bytes_written = self._offset
+    else:
+      self._bytes_written = 0
+    self._SeekAndHash(self._bytes_written)
+    self.truncate()
+    # X-Download-Size is the size of the whole package, also for a range.
+    self._bytes_total = int(headers.get('x-download-size', 0)) or (
+        self._bytes_written + int(headers.get('content-length', 0)))
+    if self._progress_callback is not None:
+      self._progress_callback(self._bytes_written, self._bytes_total)
+
+  def _SeekAndHash(self, offset):
+    """Seek to an absolute offset, hashing the content kept before it.
+
+    Args:
+      offset: int, offset in the file.
+    """
+    self._sha256 = hashlib.sha256()
+    self._f.seek(0, SEEK_SET)
+    remaining = offset
+    while remaining > 0:
+      buf = self._f.read(min(remaining, FILE_BLOCK_SIZE))
+      if not buf:
+        break
+      self._sha256.update(buf)
+      remaining -= len(buf)
+    self._f.seek(offset, SEEK_SET)
+
+  def tell(self):
+    return self._f.tell()
+
+  def truncate(self):
+    self._f.truncate()
+
+  def write(self, buf):
+    if self._discard:
+      return
+    self._sha256.update(buf)
+    self._f.write(buf)
+    self._bytes_written += len(buf)
+    if self._progress_callback is not None:
+      self._progress_callback(self._bytes_written, self._bytes_total)
+
+  def close(self):
+    self._f.close()
+
+  def hexdigest(self):
+    """Returns the sha256 hex digest of the content written so far."""
+    return self._sha256.hexdigest()
+
+
+def ParseRetryAfter(value, now=None):
+  """Parses a Retry-After header value.
+
+  Args:
+    value: str, delay in seconds like '120', or a HTTP-date like
+        'Fri, 31 Dec 1999 23:59:59 GMT'
+    now: float, optional, current time; defaults to time.time()
+  Returns:
+    float seconds to wait, or None if the value is invalid
+  """
+  value = (value or '').strip()
+  if value.isdigit():
+    return float(value)
+  date = email.utils.parsedate_tz(value)
+  if date is None:
+    return None
+  if now is None:
+    now = time.time()
+  return max(0.0, email.utils.mktime_tz(date) - now)
+
+
+def GetRetryDelay(attempt, response=None):
+  """Returns seconds to wait before retrying a failed request.
+
+  The delay is exponential backoff with full jitter: a random delay of up to
+  the policy's base seconds * 2 ** (attempt - 1), capped at
+  RETRY_BACKOFF_MAX_SECONDS, so that clients which failed together do not
+  retry together.  For statuses whose policy honors Retry-After, the delay
+  the server asked for is added to it.
+
+  Args:
+    attempt: int, number of the attempt that failed, from 1
+    response: Response, optional, failed response; None for connection
+        errors
+  Returns:
+    float seconds
+  """
+  if response is None:
+    base_seconds, honor_retry_after = DEFAULT_RETRY_POLICY
+  else:
+    base_seconds, honor_retry_after = RETRY_POLICIES.get(
+        response.status, DEFAULT_RETRY_POLICY)
+  delay = random.uniform(
+      0, min(RETRY_BACKOFF_MAX_SECONDS, base_seconds * 2 ** (attempt - 1)))
+  if honor_retry_after:
+    retry_after = ParseRetryAfter(response.GetHeader('retry-after'))
+    if retry_after is not None:
+      delay += min(retry_after, RETRY_AFTER_MAX_SECONDS)
+  return delay
+
+
+class RetryBudget(object):
+  """Limits the retries of all requests sharing an instance.
+
+  A token bucket of RETRY_BUDGET_SIZE retries, refilling over time, so that
+  a process retries a server which keeps failing at a bounded rate instead
+  of multiplying its load by the attempts of every request.
+  """
+
+  def __init__(
+      self, size=RETRY_BUDGET_SIZE,
+      refill_per_second=RETRY_BUDGET_REFILL_PER_SECOND):
+    """Init the instance.
+
+    Args:
+      size: int, maximum retries in a burst
+      refill_per_second: float, retries regained per second
+    """
+    self._size = float(size)
+    self._refill_per_second = refill_per_second
+    self._tokens = self._size
+    self._last_time = None
+    self._lock = threading.Lock()
+
+  def Spend(self):
+    """Spends one retry from the budget.
+
+    Returns:
+      True if the retry may be made, False if the budget is exhausted
+    """
+    with self._lock:
+      now = time.time()
+      if self._last_time is not None:
+        self._tokens = min(
+            self._size,
+            self._tokens + (now - self._last_time) * self._refill_per_second)
+      self._last_time = now
+      if self._tokens < 1:
+        return False
+      self._tokens -= 1
+      return True
+
+
+# Retry budget shared by all HttpsClient instances of the process.
+_retry_budget = RetryBudget()
+
+
+class BandwidthLimiter(object):
+  """Limits the rate of the transfers of all threads sharing an instance."""
+
+  def __init__(self, bytes_per_second):
+    """Init the instance.
+
+    Args:
+      bytes_per_second: int, maximum transfer rate.
+    """
+    self._bytes_per_second = float(bytes_per_second)
+    self._lock = threading.Lock()
+    self._next_time = 0
+
+  def Transferred(self, num_bytes):
+    """Account for transferred bytes, sleeping to keep within the rate.
+
+    Args:
+      num_bytes: int, bytes transferred.
+    """
+    with self._lock:
+      now = time.time()
+      self._next_time = (
+          max(self._next_time, now) + num_bytes / self._bytes_per_second)
+      delay = self._next_time - now
+    if delay > 0:
+      time.sleep(delay)
+
+
+class DownloadProgress(object):
+  """Aggregates the progress of concurrent downloads."""
+
+  def __init__(self, progress_callback=None, bandwidth_limiter=None):
+    """Init the instance.
+
+    Args:
+      progress_callback: function, optional, which will receive
+          (bytes written, bytes total) arguments summed over all downloads.
+          bytes total grows as downloads start and report their size.
+      bandwidth_limiter: BandwidthLimiter, optional, to limit downloads by.
+    """
+    self._progress_callback = progress_callback
+    self._bandwidth_limiter = bandwidth_limiter
+    self._lock = threading.Lock()
+    self._progress = {}
+
+  def GetCallback(self, name):
+    """Returns a progress callback for one download.
+
+    Args:
+      name: str, unique name of the download.
+    Returns:
+      function, to pass to ResumableDownloadFile.
+    """
+    def _Callback(bytes_written, bytes_total):
+      self.Update(name, bytes_written, bytes_total)
+    return _Callback
+
+  def Update(self, name, bytes_written, bytes_total):
+    """Record the progress of one download.
+
+    Args:
+      name: str, unique name of the download.
+      bytes_written: int, bytes of the download written so far.
+      bytes_total: int, size of the download.
+    """
+    with self._lock:
+      last_written = self._progress.get(name, (0, 0))[0]
+      self._progress[name] = (bytes_written, bytes_total)
+      written = sum(w for w, unused_t in self._progress.itervalues())
+      total = sum(t for unused_w, t in self._progress.itervalues())
+    if self._bandwidth_limiter is not None and bytes_written > last_written:
+      self._bandwidth_limiter.Transferred(bytes_written - last_written)
+    if self._progress_callback is not None:
+      self._progress_callback(written, total)
+
+
 class HTTPSMultiBodyConnection(MultiBodyConnection, httplib.HTTPSConnection):
   """HTTP multi-body connection implemented over HTTPS."""
 
@@ -381,15 +706,31 @@ class HTTPSMultiBodyConnection(MultiBodyConnection, httplib.HTTPSConnection):
         'Loaded %d bytes of CA cert chain and configured ctx',
         len(self._ca_cert_chain))
 
+  def SetSSLContext(self, ctx):
+    """Set an already configured SSL context for connect() to use.
+
+    Args:
+      ctx: M2Crypto.SSL.Context, with a CA certificate chain loaded, as
+        returned by GetSSLContext() of an earlier connection.
+    """
+    self._ssl_ctx = ctx
+
+  def GetSSLContext(self):
+    """Returns the SSL context used by connect(), or None if not connected."""
+    return getattr(self, '_ssl_ctx', None)
+
   def connect(self):
     """Connect to the host and port specified in __init__."""
     server_address = ((self.host, self.port))
-    ctx = SSL.Context()
+    ctx = self.GetSSLContext()
 
-    if hasattr(self, '_ca_cert_chain'):
-      self._LoadCACertChain(ctx)
-    else:
-      raise SimianClientError('Missing CA certificate chain')
+    if ctx is None:
+      ctx = SSL.Context()
+      if hasattr(self, '_ca_cert_chain'):
+        self._LoadCACertChain(ctx)
+      else:
+        raise SimianClientError('Missing CA certificate chain')
+      self._ssl_ctx = ctx
 
     logging.debug('SSL configuring with context')
     sock = SSL.Connection(ctx)
@@ -455,6 +796,12 @@ class HttpsClient(object):
     self._LoadHost(hostname, port, proxy)
     self._progress_callback = None
     self._ca_cert_chain = None
+    self._keep_alive = True
+    self._idle_timeout = CONNECTION_IDLE_TIMEOUT
+    self._reuse_ssl_context = False
+    self._ssl_context = None
+    self._connection_pool = {}
+    self._connection_pool_lock = threading.Lock()
 
   def SetProgressCallback(self, fn):
     self._progress_callback = fn
@@ -467,6 +814,41 @@ class HttpsClient(object):
         another
     """
     self._ca_cert_chain = certs
+    self._ssl_context = None
+
+  def SetKeepAlive(self, keep_alive, idle_timeout=CONNECTION_IDLE_TIMEOUT):
+    """Set whether connections are kept open and reused between requests.
+
+    Args:
+      keep_alive: bool, True to pool connections for reuse.
+      idle_timeout: int, seconds an idle pooled connection may be reused
+        within, after which it is closed.
+    """
+    self._keep_alive = keep_alive
+    self._idle_timeout = idle_timeout
+    if not keep_alive:
+      self.CloseConnections()
+
+  def SetReuseSSLContext(self, reuse):
+    """Set whether new https connections share one SSL context.
+
+    The first connection creates the context and loads the CA certificate
+    chain into it; later connections skip both.
+
+    Args:
+      reuse: bool, True to share the SSL context.
+    """
+    self._reuse_ssl_context = reuse
+    self._ssl_context = None
+
+  def CloseConnections(self):
+    """Close all pooled connections."""
+    with self._connection_pool_lock:
+      pool = self._connection_pool
+      self._connection_pool = {}
+    for connections in pool.itervalues():
+      for conn, unused_last_used in connections:
+        conn.close()
 
   def _LoadHost(self, hostname, port=None, proxy=None):
     """Load hostname and port to connect to.
@@ -579,13 +961,65 @@ class HttpsClient(object):
     if use_https:
       if self._ca_cert_chain is not None:
         conn.SetCACertChain(self._ca_cert_chain)
+      if self._reuse_ssl_context and self._ssl_context is not None:
+        conn.SetSSLContext(self._ssl_context)
 
     try:
       conn.connect()
     except httplib.socket.error, e:
       raise SimianClientError('_Connect() httplib.socket.error: %s' % str(e))
+
+    if use_https and self._reuse_ssl_context:
+      self._ssl_context = conn.GetSSLContext()
     return conn
 
+  def _ConnectionPoolKey(self):
+    """Returns the key of pooled connections to the current host and proxy."""
+    return (
+        self.proxy_hostname, self.proxy_port, self.proxy_use_https,
+        self.hostname, self.port, self.use_https)
+
+  def _GetConnection(self):
+    """Returns an idle pooled connection, or a new one if there is none.
+
+    Returns:
+      tuple, (HTTP{,S}Connection, bool True if the connection was pooled)
+    """
+    now = time.time()
+    expired = []
+    conn = None
+    with self._connection_pool_lock:
+      idle = self._connection_pool.get(self._ConnectionPoolKey(), [])
+      while idle:
+        pooled_conn, last_used = idle.pop()
+        if now - last_used <= self._idle_timeout:
+          conn = pooled_conn
+          break
+        expired.append(pooled_conn)
+    for expired_conn in expired:
+      expired_conn.close()
+
+    if conn is not None:
+      logging.debug('Reusing keep-alive connection')
+      return conn, True
+    return self._Connect(), False
+
+  def _ReleaseConnection(self, conn):
+    """Returns a connection to the pool after a complete response.
+
+    Connections the server asked to close, which httplib has already closed,
+    are not pooled.
+
+    Args:
+      conn: HTTP{,S}Connection
+    """
+    if not self._keep_alive or conn.sock is None:
+      conn.close()
+      return
+    with self._connection_pool_lock:
+      self._connection_pool.setdefault(self._ConnectionPoolKey(), []).append(
+          (conn, time.time()))
+
   def _GetResponse(self, conn, output_file=None):
     """Obtain a response from the connection and interpret it.
 
@@ -603,6 +1037,9 @@ class HttpsClient(object):
 
     read_len = 8192   # some arbitrary block size
 
+    if isinstance(output_file, ResumableDownloadFile):
+      output_file.Start(status, dict(headers))
+
     if output_file:
       buf = response.read(read_len)
       while buf:
@@ -657,23 +1094,103 @@ class HttpsClient(object):
     Raises:
       HTTPError: if a connection level error occured
     """
+    # file positions to rewind to if a stale connection must be retried.
+    # a ResumableDownloadFile positions itself when the response starts.
+    files = [b for b in self._BodyItems(body) if hasattr(b, 'seek')]
+    if (output_file is not None and hasattr(output_file, 'seek') and
+        not isinstance(output_file, ResumableDownloadFile)):
+      files.append(output_file)
+    positions = [(f, f.tell()) for f in files]
+
     try:
       suffix = self.use_https * 's'
       logging.debug('Connecting to http%s://%s:%s',
                     suffix, self.hostname, self.port)
-      conn = self._Connect()
+      conn, pooled = self._GetConnection()
       # if proxy is in use, request the full URL including host.
       if self.proxy_hostname:
         url = 'http%s://%s%s' % (self.use_https * 's', self.netloc, url)
-      logging.debug('Requesting %s %s', method, url)
-      self._Request(method, conn, url, body=body, headers=headers)
-      logging.debug('Waiting for response')
-      response = self._GetResponse(conn, output_file=output_file)
-      logging.debug('Response status %d', response.status)
+      try:
+        response = self._RequestResponse(
+            method, conn, url, body, headers, output_file)
+      except (httplib.HTTPException, httplib.socket.error, SSL.SSLError,
+              ConnectionDroppedError), e:
+        conn.close()
+        # a non-idempotent request is resent only if the server cannot have
+        # answered it, i.e. it closed the idle keep-alive connection.
+        if not pooled or not (
+            isinstance(e, ConnectionDroppedError) or
+            method in IDEMPOTENT_HTTP_METHODS):
+          raise
+        logging.debug('Stale keep-alive connection, reconnecting: %s', e)
+        for f, pos in positions:
+          f.seek(pos, SEEK_SET)
+        if output_file in files:
+          output_file.truncate()
+        conn = self._Connect()
+        response = self._RequestResponse(
+            method, conn, url, body, headers, output_file)
+      self._ReleaseConnection(conn)
       return response
     except httplib.HTTPException, e:
       raise HTTPError(str(e))
 
+  def _BodyItems(self, body):
+    """Returns the list of items of a request body, see _Request()."""
+    if body is None:
+      return []
+    elif type(body) is list:
+      return body
+    return [body]
+
+  def _RequestResponse(self, method, conn, url, body, headers, output_file):
+    """Make a request on the supplied connection and obtain the response.
+
+    Args:
+      method: str, like 'GET' or 'POST'
+      conn: HTTP{,S}Connection
+      url: str, url to request
+      body: str or dict or file, optional, body to send with request
+      headers: dict, optional, headers to send with request
+      output_file: file, optional, file to write response body to
+    Returns:
+      Response instance
+    Raises:
+      ConnectionDroppedError: the connection was reset while the request
+          was sent, or closed without a status line.
+    """
+    logging.debug('Requesting %s %s', method, url)
+    try:
+      self._Request(method, conn, url, body=body, headers=headers)
+    except httplib.socket.error, e:
+      if e.errno in STALE_CONNECTION_ERRNOS:
+        raise ConnectionDroppedError(str(e))
+      raise
+    logging.debug('Waiting for response')
+    try:
+      response = self._GetResponse(conn, output_file=output_file)
+    except httplib.BadStatusLine, e:
+      raise ConnectionDroppedError(str(e))
+    logging.debug('Response status %d', response.status)
+    return response
+
+  def _ShouldRetry(self, attempt, attempt_times):
+    """Returns True if a failed request should be attempted again.
+
+    Args:
+      attempt: int, number of the attempt that failed, from 1
+      attempt_times: int, how many times to attempt the request
+    Returns:
+      False if the attempts are used up or the process retry budget is
+      exhausted, True otherwise
+    """
+    if attempt >= attempt_times:
+      return False
+    if not _retry_budget.Spend():
+      logging.warning('Retry budget exhausted, not retrying')
+      return False
+    return True
+
   def Do(
       self, method, url,
       body=None, headers=None, output_filename=None,
@@ -681,13 +1198,16 @@ class HttpsClient(object):
       attempt_times=DEFAULT_HTTP_ATTEMPTS, _open=open):
     """Make a request and return the response.
 
+    Failed attempts are retried after a GetRetryDelay() backoff, while the
+    process retry budget lasts.
+
     Args:
       method: str, like 'GET' or 'POST'
       url: str, url like '/foo.html', not 'http://host/foo.html'
       body: str or dict or file, optional, body to send with request
       headers: dict, optional, headers to send with request
       output_filename: str, optional, filename to write response body to
-      retry_on_status: list, default (500, 502, etc.), int status codes to
+      retry_on_status: list, default (429, 500, etc.), int status codes to
           retry upon receiving.
       attempt_times: int, default 4, how many times to attempt the request
       _open: func, optional, default builtin open, to open output_filename
@@ -709,8 +1229,10 @@ class HttpsClient(object):
       output_file = None
 
     n = 0
-    while n < attempt_times:
-      time.sleep(n * 5)
+    response = None
+    while True:
+      if n:
+        time.sleep(GetRetryDelay(n, response))
       n += 1
       logging.debug('Do(%s, %s) try #%d', method, url, n)
       try:
@@ -718,18 +1240,124 @@ class HttpsClient(object):
             method, url, body=body, headers=headers, output_file=output_file)
       except HTTPError:
         logging.warning('HTTPError in Do(%s, %s)', method, url)
-        if n == attempt_times:
+        response = None
+        if not self._ShouldRetry(n, attempt_times):
           raise
       else:
         if response.status not in retry_on_status:
           break
         logging.warning('Retry status hit for Do(%s, %s)', method, url)
+        if not self._ShouldRetry(n, attempt_times):
+          break
 
     if output_filename:
       output_file.close()
 
     return response
 
+  def DoDownload(
+      self, url, output_filename, headers=None, sha256=None,
+      progress_callback=None,
+      retry_on_status=DEFAULT_RETRY_HTTP_STATUS_CODES,
+      attempt_times=DEFAULT_HTTP_ATTEMPTS, _open=open):
+    """Download url to a file, resuming interrupted transfers.
+
+    The body is written to output_filename + PARTIAL_DOWNLOAD_SUFFIX and
+    renamed to output_filename once complete.  When an attempt is
+    interrupted, the next one requests only the missing bytes with a Range
+    header, and an If-Range header with the ETag (the sha256) of the
+    content, so the server sends the whole body again if it changed.  The
+    sha256 of the content is computed while it is written and compared to
+    the ETag.
+
+    Args:
+      url: str, url like '/foo.html', not 'http://host/foo.html'
+      output_filename: str, filename to write response body to
+      headers: dict, optional, headers to send with request
+      sha256: str, optional, sha256 of the content a partial file left
+          over by an earlier call was downloaded from, to resume it.  It is
+          only sent as If-Range; if the content changed since, the new
+          content is downloaded and verified against the new ETag instead.
+      progress_callback: function, optional, see ResumableDownloadFile.
+      retry_on_status: list, default (429, 500, etc.), int status codes to
+          retry upon receiving.
+      attempt_times: int, default 4, how many times to attempt the request
+      _open: func, optional, default builtin open, to open the partial file
+    Returns:
+      Response object
+    Raises:
+      HTTPError: if a connection level error occured, or the content does
+          not match its sha256, on the last attempt.
+    """
+    partial_filename = output_filename + PARTIAL_DOWNLOAD_SUFFIX
+    etag = sha256
+
+    n = 0
+    retry_response = None
+    while True:
+      if n:
+        time.sleep(GetRetryDelay(n, retry_response))
+      n += 1
+      retry_response = None
+      logging.debug('DoDownload(%s) try #%d', url, n)
+
+      request_headers = dict(headers or {})
+      offset = 0
+      if etag and os.path.isfile(partial_filename):
+        offset = os.path.getsize(partial_filename)
+      if offset:
+        logging.debug('Resuming download of %s at %d', url, offset)
+        request_headers['Range'] = 'bytes=%d-' % offset
+        request_headers['If-Range'] = etag
+        output_file = ResumableDownloadFile(
+            _open(partial_filename, 'r+b'), offset, progress_callback)
+      else:
+        output_file = ResumableDownloadFile(
+            _open(partial_filename, 'wb'), 0, progress_callback)
+
+      try:
+        try:
+          response = self._DoRequestResponse(
+              'GET', url, headers=request_headers, output_file=output_file)
+        finally:
+          output_file.close()
+      except HTTPError:
+        logging.warning('HTTPError in DoDownload(%s)', url)
+        # the headers were received if the body was interrupted.
+        etag = output_file.etag or etag
+        if not self._ShouldRetry(n, attempt_times):
+          raise
+        continue
+
+      if response.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+        # the partial file is not a prefix of the content; start over.
+        logging.warning('Range not satisfiable in DoDownload(%s)', url)
+        etag = None
+        if not self._ShouldRetry(n, attempt_times):
+          return response
+        continue
+      elif response.status in retry_on_status:
+        logging.warning('Retry status hit for DoDownload(%s)', url)
+        retry_response = response
+        if not self._ShouldRetry(n, attempt_times):
+          return response
+        continue
+      elif not response.IsSuccess():
+        os.unlink(partial_filename)
+        return response
+
+      etag = output_file.etag or etag
+      if etag and output_file.hexdigest() != etag.strip('"'):
+        logging.warning('sha256 mismatch in DoDownload(%s)', url)
+        os.unlink(partial_filename)
+        etag = None
+        if not self._ShouldRetry(n, attempt_times):
+          raise HTTPError('sha256 mismatch downloading %s' % url)
+        continue
+
+      os.rename(partial_filename, output_filename)
+      return response
+
   def DoMultipart(
       self, url, params, filename, input_filename=None, input_file=None):
     """Make a form/multipart POST request and return the response.
@@ -1423,6 +2051,8 @@ class SimianClient(HttpsAuthClient):
       raise SimianClientError('Simian client must not be run as root!')
 
     super(SimianClient, self).__init__(hostname, port)
+    # the CA chain is the same for every connection of a run.
+    self.SetReuseSSLContext(True)
 
   def IsDefaultHostClient(self):
     """Returns True if the client was initialized with default hostname."""
@@ -1452,9 +2082,12 @@ class SimianClient(HttpsAuthClient):
       SimianServerError: if the Simian server returned an error (status != 200)
     """
     try:
-      response = self.Do(
-          method, url, body=body, headers=headers,
-          output_filename=output_filename)
+      if output_filename and method == 'GET':
+        response = self.DoDownload(url, output_filename, headers=headers)
+      else:
+        response = self.Do(
+            method, url, body=body, headers=headers,
+            output_filename=output_filename)
     except HTTPError, e:
       raise SimianServerError(str(e))
 
@@ -1526,7 +2159,9 @@ class SimianClient(HttpsAuthClient):
         'GET', '/pkgs/%s' % urllib.quote(name),
         output_filename=output_filename)
 
-  def PutPackage(self, filename, params, input_filename=None, input_file=None):
+  def PutPackage(
+      self, filename, params, input_filename=None, input_file=None,
+      sha256=None):
     """Put a package file contents.
 
     Read the documentation at
@@ -1541,6 +2176,9 @@ class SimianClient(HttpsAuthClient):
       params: dict of params to send with the request.
       input_filename: str, optional, filename to upload
       input_file: file, optional, file handle to read from
+      sha256: str, optional, sha256 of the package in its pkginfo.  If
+          supplied, the server rejects the upload, before saving the
+          package, if the file does not match it.
     Returns:
       str UUID for the uploaded payload
     Raises:
@@ -1566,6 +2204,9 @@ class SimianClient(HttpsAuthClient):
     logging.debug('Uploading package...')
     # send the file contents
     post_url = path
+    if sha256:
+      params = params.copy()
+      params['sha256'] = sha256
     response = self._SimianFormUpload(
         post_url, filename, params,
         input_file=input_file, input_filename=input_filename)
@@ -1585,6 +2226,104 @@ class SimianClient(HttpsAuthClient):
     result = self._SimianRequest('GET', redirect_url)
     return result
 
+  def PutPackageChunked(
+      self, filename, params, input_filename, sha256=None, upload_id=None):
+    """Put a package file contents in resumable chunks.
+
+    The server assigns the upload an id and a chunk size.  Chunks are sent
+    in order; when one fails, the upload resumes from the first chunk the
+    server has not received.  The whole file is hashed once, as its chunks
+    are read.
+
+    Args:
+      filename: str, package filename
+      params: dict of params to send with the request, as PutPackage().
+      input_filename: str, filename to upload
+      sha256: str, optional, sha256 of the package in its pkginfo.  If
+          supplied, the upload is only finished if the file matches it.
+      upload_id: str, optional, id of an earlier upload of the file to
+          resume, as logged when it was started.
+    Returns:
+      str blobstore key of the uploaded package
+    Raises:
+      SimianServerError: if an error occured on the Simian server
+      SimianClientError: if the file does not match sha256
+    """
+    if upload_id:
+      url = '%s/%s' % (URL_UPLOADPKG_CHUNKED, upload_id)
+      status = json.loads(self._SimianRequest('GET', url))
+    else:
+      new_params = params.copy()
+      new_params['name'] = filename
+      new_params['user'] = '%s@%s' % (self._user, AUTH_DOMAIN)
+      new_params['size'] = os.path.getsize(input_filename)
+      for k, v in new_params.iteritems():
+        if type(v) is unicode:
+          new_params[k] = str(v.encode('utf-8'))
+      status = json.loads(
+          self._SimianRequest('POST', URL_UPLOADPKG_CHUNKED, new_params))
+      url = '%s/%s' % (URL_UPLOADPKG_CHUNKED, status['id'])
+      logging.debug('Started chunked upload %s', status['id'])
+
+    chunk_size = status['chunk_size']
+    file_sha256 = hashlib.sha256()
+    hashed_chunks = 0
+    failures = 0
+    f = open(input_filename, 'rb')
+    try:
+      while status['next_chunk'] < status['num_chunks']:
+        index = status['next_chunk']
+        # hash chunks an earlier upload sent before this one.
+        while hashed_chunks < index:
+          f.seek(hashed_chunks * chunk_size, SEEK_SET)
+          file_sha256.update(f.read(chunk_size))
+          hashed_chunks += 1
+        f.seek(index * chunk_size, SEEK_SET)
+        chunk = f.read(chunk_size)
+        if hashed_chunks == index:
+          file_sha256.update(chunk)
+          hashed_chunks += 1
+
+        logging.debug(
+            'Uploading chunk %d/%d of %s', index + 1, status['num_chunks'],
+            filename)
+        headers = {'X-Chunk-Sha256': hashlib.sha256(chunk).hexdigest()}
+        try:
+          status = json.loads(self._SimianRequest(
+              'PUT', '%s/%d' % (url, index), chunk, headers=headers))
+        except SimianServerError, e:
+          failures += 1
+          if failures >= CHUNKED_UPLOAD_ATTEMPTS:
+            raise
+          logging.warning(
+              'Chunk %d of %s failed, resuming: %s', index, filename, e)
+          status = json.loads(self._SimianRequest('GET', url))
+    finally:
+      f.close()
+
+    if sha256 and file_sha256.hexdigest() != sha256:
+      # the upload could never be finished, so free its storage now.
+      try:
+        self._SimianRequest('DELETE', url)
+      except SimianServerError, e:
+        logging.warning('Could not abort upload of %s: %s', filename, e)
+      raise SimianClientError(
+          '%s changed since its pkginfo was made: sha256 %s, expected %s' % (
+              filename, file_sha256.hexdigest(), sha256))
+
+    return self._SimianRequest('POST', url)
+
+  def AbortPackageChunked(self, upload_id):
+    """Abort a chunked package upload, deleting what it has sent.
+
+    Args:
+      upload_id: str, id of the upload, as logged when it was started.
+    Raises:
+      SimianServerError: if an error occured on the Simian server
+    """
+    self._SimianRequest(
+        'DELETE', '%s/%s' % (URL_UPLOADPKG_CHUNKED, upload_id))
+
   def GetPackageInfo(self, filename, get_hash=False):
     """Get package info.
 
@@ -1677,6 +2416,64 @@ class SimianClient(HttpsAuthClient):
         'GET', '/pkgs/%s' % urllib.quote(filename),
         output_filename=filename)
 
+  def DownloadPackages(
+      self, filenames, output_dir, concurrency=DOWNLOAD_CONCURRENCY,
+      bytes_per_second=None):
+    """Downloads packages concurrently.
+
+    Each package is downloaded with DoDownload(), over the pooled
+    connections of this client, and written into output_dir once its sha256
+    is verified.  The progress callback set with SetProgressCallback()
+    receives the progress of all downloads together.
+
+    Args:
+      filenames: list of str filenames of the packages to download.
+      output_dir: str, directory to write the packages to.
+      concurrency: int, number of packages to download at once, capped at
+          MAX_DOWNLOAD_CONCURRENCY_PER_HOST.
+      bytes_per_second: int, optional, maximum download rate of all
+          downloads together.
+    Returns:
+      dict of str filename to str error, of the packages which failed to
+      download.
+    """
+    work = Queue.Queue()
+    for filename in filenames:
+      work.put(filename)
+    concurrency = max(1, min(
+        concurrency, work.qsize(), MAX_DOWNLOAD_CONCURRENCY_PER_HOST))
+    bandwidth_limiter = None
+    if bytes_per_second:
+      bandwidth_limiter = BandwidthLimiter(bytes_per_second)
+    progress = DownloadProgress(self._progress_callback, bandwidth_limiter)
+    errors = {}
+
+    def _Worker():
+      while True:
+        try:
+          filename = work.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          response = self.DoDownload(
+              '/pkgs/%s' % urllib.quote(filename),
+              os.path.join(output_dir, os.path.basename(filename)),
+              progress_callback=progress.GetCallback(filename))
+          if not response.IsSuccess():
+            errors[filename] = '%s %s' % (response.status, response.reason)
+        except (Error, EnvironmentError), e:
+          errors[filename] = str(e)
+        if filename in errors:
+          logging.warning(
+              'Download of %s failed: %s', filename, errors[filename])
+
+    threads = [threading.Thread(target=_Worker) for _ in xrange(concurrency)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return errors
+
   def _IsPackageUploadNecessary(self, filename, upload_pkginfo):
     """Returns True if the package file should be uploaded.
 
@@ -1698,7 +2495,7 @@ class SimianClient(HttpsAuthClient):
 
   def UploadPackage(
       self, filename, description, display_name, catalogs, manifests,
-      install_types, pkginfo):
+      install_types, pkginfo, sha256=None):
     """Uploads a Munki PackageInfo plist along with a Package.
 
     Args:
@@ -1709,6 +2506,8 @@ class SimianClient(HttpsAuthClient):
       manifests: list of str manifest names.
       install_types: list of str install types.
       pkginfo: str package info.
+      sha256: str, optional, sha256 of the package in pkginfo, to verify the
+          uploaded file against before it is saved.
     Returns:
       Tuple. (Str response body from upload, filename,
               list of catalogs, list of manifests)
@@ -1725,7 +2524,13 @@ class SimianClient(HttpsAuthClient):
           'manifests': ','.join(manifests),
           'install_types': ','.join(install_types),
       }
-      response = self.PutPackage(filename, params, input_filename=file_path)
+      if (os.path.isfile(file_path) and
+          os.path.getsize(file_path) >= CHUNKED_UPLOAD_MIN_SIZE):
+        response = self.PutPackageChunked(
+            filename, params, file_path, sha256=sha256)
+      else:
+        response = self.PutPackage(
+            filename, params, input_filename=file_path, sha256=sha256)
     else:
       response = self.PutPackageInfo(
           filename, pkginfo, catalogs, manifests, install_types)
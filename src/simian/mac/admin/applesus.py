@@ -25,7 +25,6 @@ import calendar
 import datetime
 import json
 
-from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import deferred
 
@@ -172,9 +171,12 @@ class AppleSUSAdmin(admin.AdminHandler):
     # Regenerate catalogs for any changed tracks, if a task isn't already
     # queued to do so.
     for track in changed_tracks:
-      if gae_util.ObtainLock(applesus.CATALOG_REGENERATION_LOCK_NAME % track):
+      lock_token = gae_util.ObtainLock(
+          applesus.CATALOG_REGENERATION_LOCK_NAME % track, durable=True)
+      if lock_token:
         deferred.defer(
-            applesus.GenerateAppleSUSCatalogs, track=track, delay=180)
+            applesus.GenerateAppleSUSCatalogs, track=track, delay=180,
+            lock_token=lock_token)
     # TODO(user): add a visual cue to UI so admins know a generation is pending.
 
     self.response.headers['Content-Type'] = 'application/json'
@@ -221,8 +223,7 @@ class AppleSUSAdmin(admin.AdminHandler):
     catalogs_pending = {}
     for track in common.TRACKS:
       lock_name = applesus.CATALOG_REGENERATION_LOCK_NAME % track
-      catalogs_pending[track] = memcache.get(
-          gae_util.LOCK_NAME % lock_name) is not None
+      catalogs_pending[track] = gae_util.LockExists(lock_name, durable=True)
 
     install_counts, counts_mtime = models.ReportsCache.GetInstallCounts()
     data = {
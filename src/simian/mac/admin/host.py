@@ -30,6 +30,7 @@ from simian import settings
 from simian.mac import admin
 from simian.mac import models
 from simian.mac.common import auth
+from simian.mac.common import gae_util
 from simian.mac.common import util
 
 
@@ -102,25 +103,38 @@ class Host(admin.AdminHandler):
       limit = 1
     else:
       limit = SINGLE_HOST_DATA_FETCH_LIMIT
-    client_log_files = models.ClientLogFile.all().filter('uuid =', uuid).order(
-        '-mtime').fetch(limit)
-    msu_log = models.ComputerMSULog.all().filter('uuid =', uuid).order(
-        '-mtime').fetch(limit)
-    applesus_installs = models.InstallLog.all().filter('uuid =', uuid).filter(
-        'applesus =', True).order('-mtime').fetch(limit)
-    installs = models.InstallLog.all().filter('uuid =', uuid).filter(
-        'applesus =', False).order('-mtime').fetch(limit)
-    exits = models.PreflightExitLog.all().filter('uuid =', uuid).order(
-        '-mtime').fetch(limit)
-    install_problems = models.ClientLog.all().filter(
-        'action =', 'install_problem').filter('uuid =', uuid).order(
-            '-mtime').fetch(limit)
+    # start all queries at once so the page waits only for the slowest.
+    queries = {
+        'client_log_files': models.ClientLogFile.all().filter(
+            'uuid =', uuid).order('-mtime'),
+        'msu_log': models.ComputerMSULog.all().filter(
+            'uuid =', uuid).order('-mtime'),
+        'applesus_installs': models.InstallLog.all().filter(
+            'uuid =', uuid).filter('applesus =', True).order('-mtime'),
+        'installs': models.InstallLog.all().filter(
+            'uuid =', uuid).filter('applesus =', False).order('-mtime'),
+        'exits': models.PreflightExitLog.all().filter(
+            'uuid =', uuid).order('-mtime'),
+        'install_problems': models.ClientLog.all().filter(
+            'action =', 'install_problem').filter('uuid =', uuid).order(
+                '-mtime'),
+    }
+    if computer:
+      tag_keys_fetch = gae_util.AsyncFetch(
+          models.Tag.AllTagKeysForKeyQuery(computer.key()))
+    results = gae_util.FetchMulti(queries, limit)
+    client_log_files = results['client_log_files']
+    msu_log = results['msu_log']
+    applesus_installs = results['applesus_installs']
+    installs = results['installs']
+    exits = results['exits']
+    install_problems = results['install_problems']
 
     tags = {}
     tags_list = []
     if computer:
       # Generate tags data.
-      tags_list = models.Tag.GetAllTagNamesForEntity(computer)
+      tags_list = [k.name() for k in tag_keys_fetch.get_result()]
       for tag in tags_list:
         tags[tag] = True
       for tag in models.Tag.GetAllTagNames():
@@ -22,8 +22,6 @@
 
 
 
-from google.appengine.api import memcache
-
 from simian.mac import admin
 from simian.mac import common
 from simian.mac import models
@@ -33,10 +31,12 @@ PACKAGE = 'package'
 CATALOG = 'catalog'
 MANIFEST = 'manifest'
 LOCK_TYPES = {
-    PACKAGE: gae_util.LOCK_NAME % 'pkgsinfo_%s',
-    CATALOG: gae_util.LOCK_NAME % 'catalog_lock_%s',
-    MANIFEST: gae_util.LOCK_NAME % 'manifest_lock_%s',
+    PACKAGE: 'pkgsinfo_%s',
+    CATALOG: 'catalog_lock_%s',
+    MANIFEST: 'manifest_lock_%s',
 }
+# Lock types obtained with gae_util.ObtainLock(durable=True).
+DURABLE_LOCK_TYPES = frozenset([CATALOG])
 
 
 class LockAdmin(admin.AdminHandler):
@@ -53,7 +53,9 @@ class LockAdmin(admin.AdminHandler):
       return
 
     lock_name = self.request.get('lock_name')
-    memcache.delete(LOCK_TYPES[lock_type] % lock_name)
+    gae_util.ReleaseLock(
+        LOCK_TYPES[lock_type] % lock_name,
+        durable=lock_type in DURABLE_LOCK_TYPES)
     self.redirect('/admin/lock_admin?msg=Lock deleted successfully.')
 
   def get(self):
@@ -64,15 +66,15 @@ class LockAdmin(admin.AdminHandler):
     locks = []
     pkgs = [k.name() for k in models.PackageInfo.all(keys_only=True)]
     for pkg in pkgs:
-      if memcache.get(LOCK_TYPES[PACKAGE] % pkg):
+      if gae_util.LockExists(LOCK_TYPES[PACKAGE] % pkg):
         locks.append((PACKAGE, pkg))
 
     for catalog in common.TRACKS:
-      if memcache.get(LOCK_TYPES[CATALOG] % catalog):
+      if gae_util.LockExists(LOCK_TYPES[CATALOG] % catalog, durable=True):
         locks.append((CATALOG, catalog))
 
     for manifest in common.TRACKS:
-      if memcache.get(LOCK_TYPES[MANIFEST] % manifest):
+      if gae_util.LockExists(LOCK_TYPES[MANIFEST] % manifest):
         locks.append((MANIFEST, manifest))
 
     values = {'report_type': 'lock_admin', 'locks': locks}
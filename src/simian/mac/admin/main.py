@@ -36,6 +36,7 @@ from simian.mac.admin import package
 from simian.mac.admin import packages
 from simian.mac.admin import package_alias
 from simian.mac.admin import panic
+from simian.mac.admin import profiling
 from simian.mac.admin import release_report
 from simian.mac.admin import summary
 from simian.mac.admin import tags
@@ -82,6 +83,8 @@ app = webapp2.WSGIApplication([
 
     (r'/admin/panic/?$', panic.AdminPanic),
 
+    (r'/admin/profiling/?$', profiling.Profiling),
+
     (r'/admin/proposals/?$', packages.PackageProposals),
     (r'/admin/proposals/([\w\-]+)/?', packages.PackageProposals),
 
@@ -56,13 +56,12 @@ class Packages(admin.AdminHandler):
       else:
         self._DisplayPackagesList()
 
-  def _GetPackageQuery(self):
-    """Build query."""
+  def _IsListed(self, summary):
+    """Returns True if a package summary is to be listed."""
     all_packages = self.request.get('all_packages') == '1'
-    query = self.DATASTORE_MODEL.all()
     if self.REPORT_TYPE == 'packages' and not all_packages:
-      query.filter('catalogs IN', common.TRACKS)
-    return query
+      return bool(set(summary['catalogs']).intersection(common.TRACKS))
+    return True
 
   def _DisplayPackagesList(self):
     """Displays list of all installs/removals/etc."""
@@ -70,31 +69,33 @@ class Packages(admin.AdminHandler):
     pending, pending_mtime = models.ReportsCache.GetPendingCounts()
     packages = []
     all_packages = self.request.get('all_packages') == '1'
-    query = self._GetPackageQuery()
-    for p in query:
-      if not p.plist:
+    for p in self.DATASTORE_MODEL.GetSummaries():
+      if not self._IsListed(p):
+        continue
+      if p['broken_plist']:
         self.error(403)
-        self.response.out.write('Package %s has a broken plist!' % p.filename)
+        self.response.out.write(
+            'Package %s has a broken plist!' % p['filename'])
         return
+      munki_name = p['munki_name']
       pkg = {}
-      pkg['count'] = installs.get(p.munki_name, {}).get('install_count', 'N/A')
-      pkg['fail_count'] = installs.get(p.munki_name, {}).get(
+      pkg['count'] = installs.get(munki_name, {}).get('install_count', 'N/A')
+      pkg['fail_count'] = installs.get(munki_name, {}).get(
           'install_fail_count', 'N/A')
-      pkg['pending_count'] = pending.get(p.munki_name, 'N/A')
-      pkg['duration_seconds_avg'] = installs.get(p.munki_name, {}).get(
+      pkg['pending_count'] = pending.get(munki_name, 'N/A')
+      pkg['duration_seconds_avg'] = installs.get(munki_name, {}).get(
           'duration_seconds_avg', None) or 'N/A'
-      pkg['unattended'] = p.plist.get('unattended_install', False)
-      force_install_after_date = p.plist.get('force_install_after_date', None)
-      if force_install_after_date:
-        pkg['force_install_after_date'] = force_install_after_date
-      pkg['catalogs'] = p.catalog_matrix
-      pkg['manifests'] = p.manifest_matrix
-      pkg['munki_name'] = p.munki_name or p.plist.GetMunkiName()
-      pkg['filename'] = p.filename
-      pkg['file_size'] = p.plist.get('installer_item_size', 0) * 1024
-      pkg['install_types'] = p.install_types
-      pkg['manifest_mod_access'] = p.manifest_mod_access
-      pkg['description'] = p.description
+      pkg['unattended'] = p['unattended_install']
+      if p['force_install_after_date']:
+        pkg['force_install_after_date'] = p['force_install_after_date']
+      pkg['catalogs'] = p['catalog_matrix']
+      pkg['manifests'] = p['manifest_matrix']
+      pkg['munki_name'] = munki_name
+      pkg['filename'] = p['filename']
+      pkg['file_size'] = p['installer_item_size'] * 1024
+      pkg['install_types'] = p['install_types']
+      pkg['manifest_mod_access'] = p['manifest_mod_access']
+      pkg['description'] = p['description']
       packages.append(pkg)
 
     packages.sort(key=lambda pkg: pkg['munki_name'].lower())
@@ -200,6 +201,3 @@ class PackageProposals(Packages):
   LOG_REPORT_TYPE = 'proposal_logs'
   REPORT_TYPE = 'proposals'
 
-  def _GetPackageQuery(self):
-    return self.DATASTORE_MODEL.all()
-
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+"""Request profiling admin handler."""
+
+
+
+
+from simian.mac import admin
+from simian.mac.common import profiling
+
+
+class Profiling(admin.AdminHandler):
+  """Handler for /admin/profiling."""
+
+  def get(self):
+    """GET handler."""
+    if not self.IsAdminUser():
+      return
+
+    profiling.FlushStats(force=True)
+    values = {
+        'report_type': 'profiling',
+        'routes': profiling.GetRouteStats(),
+        'sample_rate': profiling.CPROFILE_SAMPLE_RATE,
+    }
+    self.Render('profiling.html', values)
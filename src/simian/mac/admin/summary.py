@@ -34,6 +34,7 @@ from simian.mac import admin
 from simian.mac import common
 from simian.mac import models
 from simian.mac.common import auth
+from simian.mac.common import gae_util
 
 
 ACTIVE_DAY_COUNTS = [30, 14, 7, 1]
@@ -99,7 +100,7 @@ class Summary(admin.AdminHandler):
     elif report_type == 'tag':
       tag = models.Tag.get_by_key_name(report_filter)
       if tag:
-        computers = [db.get(key) for key in tag.keys]
+        computers = [c for c in db.get(tag.keys) if c]
       else:
         computers = []
     elif report_type in REPORT_TYPES:
@@ -189,14 +190,15 @@ def GetComputerSummary(computers=None, query=None):
 
   # even though Tasks can now run up to 10 minutes, Datastore queries are
   # still limited to 30 seconds (2010-10-27). Treating a QuerySet as an
-  # iterator also trips this restriction, so fetch 500 at a time.
-  while True:
-    if query:
-      computers = query.fetch(500)
-    gc.collect()
-    if not computers:
-      break
+  # iterator also trips this restriction, so fetch 500 at a time, with the
+  # next 500 prefetched while the current ones are summarized.
+  if query:
+    pages = gae_util.QueryIterator(query, step=500).Pages()
+  else:
+    pages = [computers]
 
+  for computers in pages:
+    gc.collect()
     for c in computers:
       total_client_count += 1
       if c.connections_off_corp:
@@ -240,15 +242,6 @@ def GetComputerSummary(computers=None, query=None):
       summary['sites_histogram'][site] = (
           summary['sites_histogram'].get(site, 0) + 1)
 
-    if query:
-      cursor = str(query.cursor())
-      computers = None
-      gc.collect()
-      query.with_cursor(cursor)  # queue up the next fetch
-    else:
-      # if there was no query, we finished iterating through all computers.
-      break
-
   # Convert connections histogram to percentages.
   off_corp_connections_histogram_percent = []
   for bucket, count in DictToList(off_corp_connections_histogram):
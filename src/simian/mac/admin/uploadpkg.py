@@ -132,7 +132,8 @@ class UploadPackage(
 
     # Obtain a lock on the PackageInfo entity for this package.
     lock = 'pkgsinfo_%s' % blob_info.filename
-    if not gae_util.ObtainLock(lock, timeout=5.0):
+    lock_token = gae_util.ObtainLock(lock, timeout=5.0)
+    if not lock_token:
       gae_util.SafeBlobDel(blobstore_key)
       self.redirect(
           '/admin/uploadpkg?mode=error&msg=PackageInfo is locked')
@@ -140,14 +141,14 @@ class UploadPackage(
 
     p = models.PackageInfo.get_by_key_name(blob_info.filename)
     if not p:
-      gae_util.ReleaseLock(lock)
+      gae_util.ReleaseLock(lock, token=lock_token)
       gae_util.SafeBlobDel(blobstore_key)
       self.redirect(
           '/admin/uploadpkg?mode=error&msg=PackageInfo not found')
       return
 
     if not p.IsSafeToModify():
-      gae_util.ReleaseLock(lock)
+      gae_util.ReleaseLock(lock, token=lock_token)
       gae_util.SafeBlobDel(blobstore_key)
       self.redirect(
           '/admin/uploadpkg?mode=error&msg=PackageInfo is not modifiable')
@@ -156,7 +157,7 @@ class UploadPackage(
     installer_item_size = p.plist['installer_item_size']
     size_difference = int(blob_info.size / 1024) - installer_item_size
     if abs(size_difference) > 1:
-      gae_util.ReleaseLock(lock)
+      gae_util.ReleaseLock(lock, token=lock_token)
       gae_util.SafeBlobDel(blobstore_key)
       msg = 'Blob size (%s) does not match PackageInfo plist size (%s)' % (
           blob_info.size, installer_item_size)
@@ -166,7 +167,7 @@ class UploadPackage(
     old_blobstore_key = None
     if p.blob_info:
       # a previous blob exists.  delete it when the update has succeeded.
-      old_blobstore_key = p.blob_info.key()
+      old_blobstore_key = p.blobstore_key
 
     p.blob_info = blob_info
 
@@ -182,16 +183,16 @@ class UploadPackage(
     # an orphan.
     if error is not None:
       gae_util.SafeBlobDel(blobstore_key)
-      gae_util.ReleaseLock(lock)
+      gae_util.ReleaseLock(lock, token=lock_token)
       self.redirect('/admin/uploadpkg?mode=error&msg=%s' % error)
       return
 
     # if an old blob was associated with this Package, delete it.
     # the new blob that was just uploaded has replaced it.
     if old_blobstore_key:
-      gae_util.SafeBlobDel(old_blobstore_key)
+      models.PackageBlobInfo.SafeDelete(old_blobstore_key)
 
-    gae_util.ReleaseLock(lock)
+    gae_util.ReleaseLock(lock, token=lock_token)
 
     user = users.get_current_user().email()
     # Log admin upload to Datastore.
@@ -51,19 +51,22 @@ class PackageInfo(webapp2.RequestHandler):
 
     output = {}
 
-    for package in models.PackageInfo.all():
-      output[package.filename] = {
-          'name': package.name,
-          'catalogs': package.catalogs,
-          'created': package.created.isoformat(),
-          'install_types': package.install_types,
-          'manifests': package.manifests,
-          'munki_name': package.munki_name,
-          'mtime': package.mtime.isoformat(),
+    for package in models.PackageInfo.GetSummaries():
+      if package['broken_plist']:
+        logging.warning('Skipping broken pkginfo: %s', package['filename'])
+        continue
+      output[package['filename']] = {
+          'name': package['name'],
+          'catalogs': package['catalogs'],
+          'created': package['created'].isoformat(),
+          'install_types': package['install_types'],
+          'manifests': package['manifests'],
+          'munki_name': package['munki_name'],
+          'mtime': package['mtime'].isoformat(),
       }
 
-      for key, default in PKGINFO_PLIST_KEYS_AND_DEFAULTS:
-        output[package.filename][key] = package.plist.get(key, default)
+      for key, _ in PKGINFO_PLIST_KEYS_AND_DEFAULTS:
+        output[package['filename']][key] = package[key]
 
     self.response.headers['Content-Type'] = 'application/json'
     self.response.out.write(json.dumps(output))
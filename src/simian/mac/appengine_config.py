@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+"""App Engine configuration, loaded by the runtime from the app root."""
+
+
+
+
+def webapp_add_wsgi_middleware(app):
+  """Wrap every WSGI app in request profiling middleware.
+
+  Args:
+    app: WSGI app.
+  Returns:
+    WSGI app.
+  """
+  from simian.mac.common import profiling
+  return profiling.ProfileMiddleware(app)
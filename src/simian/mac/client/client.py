@@ -266,12 +266,6 @@ class SimianClient(BaseSimianClient, client.SimianClient):
         display_name = pkginfo['display_name']
         catalogs = pkginfo['catalogs']
 
-    response, unused_filename, catalogs, manifests = self.UploadPackage(
-        filename, description, display_name, catalogs, manifests,
-        install_types, pkginfo.GetXml())
-
-    name = pkginfo.GetPackageName()
-
     if 'installer_item_size' in pkginfo.GetContents():
       sha256_hash = pkginfo.GetContents()['installer_item_hash']
       size_kbytes = pkginfo.GetContents()['installer_item_size']
@@ -279,6 +273,14 @@ class SimianClient(BaseSimianClient, client.SimianClient):
       sha256_hash = pkginfo.GetContents()['uninstaller_item_hash']
       size_kbytes = pkginfo.GetContents()['uninstaller_item_size']
 
+    # the uploaded package is verified against the pkginfo hash before it is
+    # saved, to catch a file changed since makepkginfo hashed it.
+    response, unused_filename, catalogs, manifests = self.UploadPackage(
+        filename, description, display_name, catalogs, manifests,
+        install_types, pkginfo.GetXml(), sha256=sha256_hash)
+
+    name = pkginfo.GetPackageName()
+
     return (response, filename, name, catalogs, manifests, size_kbytes,
             sha256_hash)
 
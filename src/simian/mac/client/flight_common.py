@@ -20,21 +20,26 @@ import ctypes
 import ctypes.util
 import datetime
 import errno
-import fcntl
+import httplib
+import json
 import logging
 import os
 import platform
 import plistlib  # cannot read binary plists, be careful!
 import re
 import select
+import shutil
 import signal
+import StringIO
 import struct
 import subprocess
+import tarfile
 import tempfile
 import time
 import urllib
 import urlparse
 
+from simian.client import client as simian_client
 from simian.mac.client import version
 
 # Place all ObjC-dependent imports in this try/except block.
@@ -70,6 +75,27 @@ DEFAULT_FACTER_CACHE_TIME = datetime.timedelta(hours=3)
 # Global for holding the auth token to be used to communicate with the server.
 AUTH1_TOKEN = None
 HUNG_MSU_TIMEOUT = datetime.timedelta(hours=2)
+# Maximum bytes of JSON install reports uploaded in one request.
+INSTALL_REPORT_BATCH_MAX_BYTES = 512 * 1024
+# Prefix to prevent Cross Site Script Inclusion.
+JSON_PREFIX = ')]}\',\n'
+# Max bytes of each log file uploaded; larger logs are uploaded from their end.
+LOG_UPLOAD_MAX_BYTES = 2 * 1024 * 1024
+# File name of the compressed bundle of log files uploaded to the server.
+LOG_BUNDLE_NAME = 'logs.tar.gz'
+# Default max bytes of stdout and of stderr buffered by Exec(); the rest of
+# the output is read and discarded.
+EXEC_MAX_OUTPUT_BYTES = 16 * 1024 * 1024
+# Bytes read from a process pipe at a time by Exec().
+EXEC_READ_BYTES = 64 * 1024
+# Max seconds between checks on a process that closed its output pipes.
+EXEC_POLL_SECONDS = 0.05
+# Seconds facter may run for before it is killed.
+FACTER_TIMEOUT = 300
+# Seconds the on_corp_cmd may run for before it is killed.
+ON_CORP_CMD_TIMEOUT = 60
+# Config file holding the command telling if the computer is on corp.
+ON_CORP_CMD_CONFIG = '/etc/simian/on_corp_cmd'
 
 
 DEBUG = False
@@ -166,88 +192,252 @@ def _GetMachineInfoPlistValue(key):
   return ''
 
 
-def SetFileNonBlocking(f, non_blocking=True):
-  """Set non-blocking flag on a file object.
+_monotonic_time = []
+
+
+def _MonotonicTime():
+  """Returns float seconds from a monotonic clock.
+
+  mach_absolute_time() is used where available, falling back to time.time()
+  elsewhere.
+  """
+  if not _monotonic_time:
+    try:
+      libc = ctypes.cdll.LoadLibrary(ctypes.util.find_library('c'))
+      mach_absolute_time = libc.mach_absolute_time
+      mach_absolute_time.restype = ctypes.c_uint64
+      timebase = (ctypes.c_uint32 * 2)()  # mach_timebase_info_data_t
+      if libc.mach_timebase_info(ctypes.byref(timebase)) != 0:
+        raise OSError('mach_timebase_info() failed')
+      scale = float(timebase[0]) / timebase[1] / 1e9
+      _monotonic_time.append(lambda: mach_absolute_time() * scale)
+    except (AttributeError, OSError, TypeError):
+      _monotonic_time.append(time.time)
+  return _monotonic_time[0]()
+
+
+class _ExecOutput(object):
+  """Output of one pipe of a process started by Exec()."""
+
+  def __init__(self, max_bytes=None, output_file=None):
+    """Initializer.
+
+    Args:
+      max_bytes: int, optional, max bytes to buffer; the rest is discarded.
+      output_file: file, optional, file to write output to instead of
+        buffering it.
+    """
+    self.max_bytes = max_bytes
+    self.output_file = output_file
+    self.size = 0
+    self.truncated = False
+    self._buffer = []
+
+  def Write(self, data):
+    """Writes output data."""
+    if self.output_file is not None:
+      self.output_file.write(data)
+      return
+    if self.max_bytes is not None and self.size + len(data) > self.max_bytes:
+      self.truncated = True
+      data = data[:max(self.max_bytes - self.size, 0)]
+    self._buffer.append(data)
+    self.size += len(data)
+
+  def GetValue(self):
+    """Returns str buffered output."""
+    return ''.join(self._buffer)
+
+
+class _ExecProcess(object):
+  """A process started by Exec() or ExecParallel()."""
+
+  def __init__(self, cmd, env=None, timeout=0,
+               max_output_bytes=EXEC_MAX_OUTPUT_BYTES, stdout_file=None):
+    """Initializer; starts the process.
+
+    Args:
+      cmd: str or sequence, command and optional arguments to execute.
+      env: dict, optional, environment variables to set.
+      timeout: int or float, if >0, seconds after which the process is killed.
+      max_output_bytes: int, max bytes of stdout and of stderr to buffer, or
+        None for no limit.
+      stdout_file: file, optional, file to write stdout to instead of
+        buffering it.
+    Raises:
+      OSError: the process could not be started.
+    """
+    shell = type(cmd) is str
+
+    if env:
+      environ = os.environ.copy()
+      environ.update(env)
+      env = environ
+
+    self.cmd = cmd
+    self.killed = False
+    self.p = subprocess.Popen(
+        cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        shell=shell)
+    if timeout > 0:
+      self.deadline = _MonotonicTime() + timeout
+    else:
+      self.deadline = None
+    self.stdout = _ExecOutput(max_output_bytes, stdout_file)
+    self.stderr = _ExecOutput(max_output_bytes)
+    self.outputs = {
+        self.p.stdout.fileno(): self.stdout,
+        self.p.stderr.fileno(): self.stderr,
+    }
+
+  def IsRunning(self):
+    """Returns True if the process has neither exited nor been killed."""
+    return not self.killed and self.p.poll() is None
+
+  def Read(self, fd):
+    """Reads available output of the process from a pipe.
+
+    Args:
+      fd: int, file descriptor of the stdout or stderr pipe.
+    """
+    data = os.read(fd, EXEC_READ_BYTES)
+    if data:
+      self.outputs[fd].Write(data)
+    else:
+      del self.outputs[fd]
+
+  def Kill(self):
+    """Kills the process, which has run past its deadline."""
+    logging.error('cmd has timed out: %s', self.cmd)
+    logging.error('Sending SIGTERM to PID=%s', self.p.pid)
+    try:
+      os.kill(self.p.pid, signal.SIGTERM)
+    except OSError, e:
+      if e.errno != errno.ESRCH:
+        raise
+    self.killed = True
+    self.outputs = {}  # note: this is a hard timeout, we don't read() again.
+
+  def GetResult(self):
+    """Returns tuple of (int return code, str stdout, str stderr)."""
+    self.p.poll()
+    self.p.stdout.close()
+    self.p.stderr.close()
+    for name, output in (('stdout', self.stdout), ('stderr', self.stderr)):
+      if output.truncated:
+        logging.warning(
+            'cmd %s truncated to %d bytes: %s', name, output.max_bytes,
+            self.cmd)
+    return self.p.returncode, self.stdout.GetValue(), self.stderr.GetValue()
+
+
+def _WaitForProcesses(procs, waitfor=0):
+  """Reads the output of processes until they exit or time out.
+
+  Output of all processes is read as it becomes available, and each process
+  is killed when it runs past its own deadline.
 
   Args:
-    f: file
-    non_blocking: bool, default True, non-blocking mode or not
+    procs: list of _ExecProcess objects.
+    waitfor: int or float, if >0, seconds to wait after killing a process
+      before asking for its exit status one more time.
   """
-  flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFL)
-  if bool(flags & os.O_NONBLOCK) != non_blocking:
-    flags ^= os.O_NONBLOCK
-  fcntl.fcntl(f.fileno(), fcntl.F_SETFL, flags)
+  while True:
+    fds = {}
+    deadlines = []
+    for proc in procs:
+      for fd in proc.outputs:
+        fds[fd] = proc
+      if proc.deadline is not None and (proc.outputs or proc.IsRunning()):
+        deadlines.append(proc.deadline)
+
+    running = [proc for proc in procs if proc.IsRunning()]
+    if not fds and not running:
+      break
+
+    if deadlines:
+      select_timeout = max(min(deadlines) - _MonotonicTime(), 0)
+    else:
+      select_timeout = None
+    if not fds:
+      # output pipes are closed but processes have not exited yet.
+      if select_timeout is None or select_timeout > EXEC_POLL_SECONDS:
+        select_timeout = EXEC_POLL_SECONDS
+      time.sleep(select_timeout)
+    else:
+      try:
+        rlist, _, _ = select.select(fds.keys(), [], [], select_timeout)
+      except select.error, e:
+        if e[0] != errno.EINTR:
+          raise
+        rlist = []
+      for fd in rlist:
+        fds[fd].Read(fd)
+
+    now = _MonotonicTime()
+    for proc in procs:
+      if (proc.deadline is not None and now >= proc.deadline and
+          (proc.outputs or proc.IsRunning())):
+        proc.Kill()
+
+  # if a process was just killed, wait for waitfor seconds.
+  if waitfor > 0 and [proc for proc in procs if proc.killed]:
+    time.sleep(waitfor)
 
 
-def Exec(cmd, env=None, timeout=0, waitfor=0):
+def Exec(cmd, env=None, timeout=0, waitfor=0,
+         max_output_bytes=EXEC_MAX_OUTPUT_BYTES, stdout_file=None):
   """Executes a process and returns exit code, stdout, stderr.
 
   Args:
     cmd: str or sequence, command and optional arguments to execute.
     env: dict, optional, environment variables to set.
     timeout: int or float, if >0, Exec() will stop waiting for output
-      after timeout seconds and kill the process it started.  return code
+      timeout seconds after starting the process and kill it.  return code
       might be undefined, or -SIGTERM, use waitfor to make sure to obtain it.
-      values <1 will be crudely rounded off because of select() sleep time.
     waitfor: int or float, if >0, Exec() will wait waitfor seconds
       before asking for the process exit status one more time.
+    max_output_bytes: int, max bytes of stdout and of stderr to return, or
+      None for no limit.  Output past the limit is read and discarded.
+    stdout_file: file, optional, file to write stdout to as it is read,
+      instead of returning it; use for large outputs.
   Returns:
     Tuple. (Integer return code, string standard out, string standard error).
+  Raises:
+    OSError: the process could not be started.
   """
-  if type(cmd) is str:
-    shell = True
-  else:
-    shell = False
-
-  if env:
-    environ = os.environ.copy()
-    environ.update(env)
-    env = environ
-
-  p = subprocess.Popen(
-      cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell)
-
-  if timeout <= 0:
-    stdout, stderr = p.communicate()
-  else:
-    inactive = 0
-    stdout = []
-    stderr = []
-
-    SetFileNonBlocking(p.stdout)
-    SetFileNonBlocking(p.stderr)
-
-    returncode = None
-
-    while returncode is None:
-      rlist, _, _ = select.select([p.stdout, p.stderr], [], [], 1.0)
-
-      if not rlist:
-        inactive += 1
-        if inactive >= timeout:
-          logging.error('cmd has timed out: %s', cmd)
-          logging.error('Sending SIGTERM to PID=%s', p.pid)
-          os.kill(p.pid, signal.SIGTERM)
-          break  # note: this is a hard timeout, we don't read() again
-      else:
-        inactive = 0
-        for fd in rlist:
-          if fd is p.stdout:
-            stdout.append(fd.read())
-          elif fd is p.stderr:
-            stderr.append(fd.read())
+  proc = _ExecProcess(
+      cmd, env=env, timeout=timeout, max_output_bytes=max_output_bytes,
+      stdout_file=stdout_file)
+  _WaitForProcesses([proc], waitfor=waitfor)
+  return proc.GetResult()
 
-      returncode = p.poll()
 
-    # if the process was just killed, wait for waitfor seconds.
-    if inactive >= timeout and waitfor > 0:
-      time.sleep(waitfor)
-    # attempt to obtain returncode one last chance
-    returncode = p.poll()
-    stdout = ''.join(stdout)
-    stderr = ''.join(stderr)
+def ExecParallel(execs, waitfor=0):
+  """Executes independent processes concurrently.
 
-  return p.returncode, stdout, stderr
+  Args:
+    execs: list of dicts of Exec() keyword arguments, each with at least a
+      'cmd' key.
+    waitfor: int or float, if >0, seconds to wait after killing a timed out
+      process before asking for its exit status one more time.
+  Returns:
+    list of (Integer return code, string standard out, string standard error)
+    tuples, in the order of execs.
+  Raises:
+    OSError: a process could not be started.
+  """
+  procs = []
+  try:
+    for kwargs in execs:
+      procs.append(_ExecProcess(**kwargs))
+  except OSError:
+    for proc in procs:
+      proc.p.terminate()
+      proc.GetResult()
+    raise
+  _WaitForProcesses(procs, waitfor=waitfor)
+  return [proc.GetResult() for proc in procs]
 
 
 def GetPlistValue(key, secure=False, plist=None):
@@ -322,30 +512,35 @@ def GetUserSettings():
   return {}
 
 
-def CacheFacterContents():
-  """Run facter -p to cache its contents, and also return them.
+def _ParseFacterOutput(lines):
+  """Returns a dict of facter contents parsed from facter output lines."""
+  facts = {}
+  for line in lines:
+    try:
+      (key, unused_sep, value) = line.strip().split(' ', 2)
+      value = value.strip()
+      facts[key] = value
+    except ValueError:
+      logging.warning('Ignoring invalid facter output line: %s', line)
+  return facts
+
+
+def _CacheFacterOutput(return_code, stdout):
+  """Caches facter output, and also returns its contents.
 
+  Args:
+    return_code: int, facter exit code.
+    stdout: str, facter standard out.
   Returns:
-    dict, facter contents (which have now also been cached)
+    dict, facter contents (which have now also been cached), or {} if facter
+    failed.
   """
-  return_code, stdout, unused_stderr = Exec(
-      FACTER_CMD, timeout=300, waitfor=0.5)
-
   # If execution of factor was successful build the client identifier
   if return_code != 0:
     return {}
 
-  facts = {}
-
-  # Iterate over the facter output and create a dictionary of the output
   lines = stdout.splitlines()
-  for line in lines:
-    try:
-      (key, unused_sep, value) = line.split(' ', 2)
-      value = value.strip()
-      facts[key] = value
-    except ValueError:
-      logging.warning('Ignoring invalid facter output line: %s', line)
+  facts = _ParseFacterOutput(lines)
 
   try:
     f = open(DEFAULT_FACTER_CACHE_PATH, 'w')
@@ -356,12 +551,8 @@ def CacheFacterContents():
   return facts
 
 
-def GetMachineInfoFromFacter():
-  """Return facter contents.
-
-  Returns:
-    dict, facter contents
-  """
+def _GetCachedFacterContents():
+  """Returns cached facter contents, or {} if the cache is stale or missing."""
   now = datetime.datetime.now()
   facter = {}
 
@@ -379,22 +570,11 @@ def GetMachineInfoFromFacter():
   if now - cache_mtime < DEFAULT_FACTER_CACHE_TIME:
     try:
       f = open(DEFAULT_FACTER_CACHE_PATH, 'r')
-      lines = f.readlines()
-      for line in lines:
-        line = line.strip()
-        try:
-          (key, unused_sep, value) = line.split(' ', 2)
-          value = value.strip()
-          facter[key] = value
-        except ValueError:
-          logging.warning('Ignoring invalid facter output line: %s', line)
+      facter = _ParseFacterOutput(f.readlines())
       f.close()
     except (EOFError, IOError):
       facter = {}
 
-  if not facter:
-    facter = CacheFacterContents()
-
   return facter
 
 
@@ -450,6 +630,21 @@ def GetDiskFree(path=None):
   return st.f_frsize * st.f_bavail  # f_bavail matches df(1) output
 
 
+def _GetOnCorpCmd():
+  """Returns the str on_corp_cmd, or '' if none is configured."""
+  on_corp_cmd = ''
+  if os.path.isfile(ON_CORP_CMD_CONFIG):
+    try:
+      f = open(ON_CORP_CMD_CONFIG, 'r')
+      on_corp_cmd = f.read()
+      on_corp_cmd = on_corp_cmd.strip()
+      f.close()
+    except IOError, e:
+      logging.exception(
+          'Error reading %s: %s', ON_CORP_CMD_CONFIG, str(e))
+  return on_corp_cmd
+
+
 def GetClientIdentifier(runtype=None):
   """Assembles the client identifier based on information collected by facter.
 
@@ -458,7 +653,41 @@ def GetClientIdentifier(runtype=None):
   Returns:
     dict client identifier.
   """
-  facts = GetMachineInfoFromFacter()
+  on_corp_cmd = _GetOnCorpCmd()
+  facts = _GetCachedFacterContents()
+
+  # facter and on_corp_cmd may each take a while, so run them concurrently.
+  execs = []
+  if not facts:
+    execs.append({'cmd': FACTER_CMD, 'timeout': FACTER_TIMEOUT})
+  if on_corp_cmd:
+    execs.append({'cmd': on_corp_cmd, 'timeout': ON_CORP_CMD_TIMEOUT})
+  try:
+    results = ExecParallel(execs, waitfor=0.5)
+  except OSError, e:
+    # one could not be started, and the other was stopped; run them one at
+    # a time so that a failure of one does not discard the other's result.
+    logging.warning('OSError calling facter and on_corp_cmd: %s', str(e))
+    results = []
+    for kwargs in execs:
+      try:
+        results.append(Exec(waitfor=0.5, **kwargs))
+      except OSError, e:
+        # for on_corp_cmd, we don't know if on corp or not so don't log either.
+        logging.exception('OSError calling %s: %s', kwargs['cmd'], str(e))
+        results.append((None, '', ''))
+
+  if not facts:
+    return_code, stdout, unused_stderr = results.pop(0)
+    facts = _CacheFacterOutput(return_code, stdout)
+
+  # Determine if the computer is on the corp network or not.
+  on_corp = None
+  if on_corp_cmd:
+    return_code, unused_stdout, unused_stderr = results.pop(0)
+    if return_code is not None:
+      # exit=0 means on corp, so reverse.
+      on_corp = '%d' % (not return_code)
 
   uuid = (facts.get('certname', None) or
           facts.get('uuid', None) or _GetMachineInfoPlistValue('MachineUUID') or
@@ -491,30 +720,6 @@ def GetClientIdentifier(runtype=None):
   mgmt_enabled = '%d' % (
       facts.get('client_management_enabled', 'true') == 'true')
 
-  # Determine if the computer is on the corp network or not.
-  on_corp = None
-  on_corp_cmd = ''
-  on_corp_cmd_config = '/etc/simian/on_corp_cmd'
-  if not on_corp_cmd and os.path.isfile(on_corp_cmd_config):
-    try:
-      f = open(on_corp_cmd_config, 'r')
-      on_corp_cmd = f.read()
-      on_corp_cmd = on_corp_cmd.strip()
-      f.close()
-    except IOError, e:
-      logging.exception(
-          'Error reading %s: %s', on_corp_cmd_config, str(e))
-  if on_corp_cmd:
-    try:
-      on_corp, unused_stdout, unused_stderr = Exec(
-          on_corp_cmd, timeout=60, waitfor=0.5)
-      # exit=0 means on corp, so reverse.
-      on_corp = '%d' % (not on_corp)
-    except OSError, e:
-      # in this case, we don't know if on corp or not so don't log either.
-      logging.exception('OSError calling on_corp_cmd: %s', str(e))
-      on_corp = None
-
   # LastNotifiedDate comes as local time from FoundationPlist,
   # so convert to epoc timestamp then to UTC datetime.
   last_notified_datetime_str = GetPlistDateValue(
@@ -721,67 +926,141 @@ def GetRemainingPackagesToInstall():
   return pkgs_to_install, apple_updates_to_install
 
 
-def _UploadManagedInstallReport(client, on_corp, install_report):
-  """Reports any installs, updates, uninstalls back to Simian server.
+def _GetReportableInstallReport(install_report):
+  """Returns the installs, updates, uninstalls of a ManagedInstallReport.
 
   Args:
-    client: SimianAuthClient.
-    on_corp: str, on_corp status from GetClientIdentifier.
     install_report: plist object for ManagedInstallsReport.plist.
+  Returns:
+    dict of Python native installs, removals and problem_installs lists, or
+    None if there is nothing to report.
   """
   if not install_report:
-    return
+    return None
 
-  installs = install_report.get('InstallResults', [])  # includes updates.
-  removals = install_report.get('RemovalResults', [])
-  problem_installs = install_report.get('ProblemInstalls', [])
+  installs = []
+  for install in install_report.get('InstallResults', []):  # includes updates.
+    install = dict(Flatten(install))
+    # If 'time' exists, convert it to an epoc timestamp.
+    install_time = install.get('time', None)
+    if hasattr(install_time, 'timeIntervalSince1970'):
+      install['time'] = install_time.timeIntervalSince1970()
+    installs.append(install)
 
-  # encode all strings to utf-8 for unicode character support.
-  for item_list in [removals]:
-    for i in xrange(len(item_list)):
-      item_list[i] = unicode(item_list[i]).encode('utf-8')
+  removals = [
+      unicode(removal) for removal in install_report.get('RemovalResults', [])]
 
-  # convert dict problems to strings, and encode as utf-8.
-  for i in xrange(len(problem_installs)):
-    # TODO(user): send dict to server so details can be stored separately:
-    #    problem_installs[i] = DictToStr(problem_installs[i])
-    p = problem_installs[i]
+  # convert dict problems to strings.
+  problem_installs = []
+  for p in install_report.get('ProblemInstalls', []):
+    # TODO(user): send dict to server so details can be stored separately.
     if hasattr(p, 'keys'):
       p = u'%s: %s' % (p.get('name', ''), p.get('note', ''))
-    problem_installs[i] = p.encode('utf-8')
+    problem_installs.append(unicode(p))
 
-  for i in xrange(len(installs)):
-    # If 'time' exists, convert it to an epoc timestamp.
-    install_time = installs[i].get('time', None)
-    if hasattr(install_time, 'timeIntervalSince1970'):
-      installs[i]['time'] = install_time.timeIntervalSince1970()
-    # TODO(user): if we moved all of this code to simianauth, we could just use
-    #      JSON instead of doing all this DictToStr nonsense just to pass it
-    #      over the commandline. JSON wasn't used initially since it was not
-    #      built into python2.5 we didn't want to depend on simplejson install.
-    installs[i] = DictToStr(installs[i])
-
-  if installs or removals or problem_installs:
-    data = {
-        'on_corp': on_corp,
-        'installs': installs,
-        'removals': removals,
-        'problem_installs': problem_installs,
-    }
-    client.PostReport('install_report', data)
+  if not (installs or removals or problem_installs):
+    return None
+  return {
+      'installs': installs,
+      'removals': removals,
+      'problem_installs': problem_installs,
+  }
+
+
+def _BatchInstallReports(install_reports):
+  """Splits install reports into batches of at most the maximum size.
+
+  Args:
+    install_reports: list of (key, dict report) tuples.
+  Returns:
+    list of lists of (key, dict report, str JSON report) tuples.  A report
+    larger than INSTALL_REPORT_BATCH_MAX_BYTES is a batch of its own.
+  """
+  batches = []
+  batch = []
+  batch_size = 0
+  for key, report in install_reports:
+    # unknown types, e.g. dates of unexpected keys, are sent as strings.
+    report_json = json.dumps(report, default=unicode)
+    if batch and batch_size + len(report_json) > INSTALL_REPORT_BATCH_MAX_BYTES:
+      batches.append(batch)
+      batch = []
+      batch_size = 0
+    batch.append((key, report, report_json))
+    batch_size += len(report_json)
+  if batch:
+    batches.append(batch)
+  return batches
+
+
+def _UploadInstallReportBatch(client, on_corp, batch):
+  """Uploads a batch of install reports with a single request.
+
+  Args:
+    client: SimianAuthClient.
+    on_corp: str, on_corp status from GetClientIdentifier.
+    batch: list of (key, dict report, str JSON report) tuples.
+  Raises:
+    ServerRequestError: the server did not acknowledge the upload.  A batch
+        the server rejected as malformed is acknowledged, as resending it
+        would be rejected again.
+  """
+  params = {
+      'on_corp': on_corp,
+      'reports': '[%s]' % ','.join(
+          report_json for _, _, report_json in batch),
+  }
+  try:
+    response = client.PostReport('install_report_batch', params)
+  except simian_client.SimianServerError, e:
+    if e.args and e.args[0] == httplib.BAD_REQUEST:
+      logging.warning(
+          'Dropping install_report_batch of %d reports rejected by the '
+          'server: %s', len(batch), str(e))
+      return
+    raise ServerRequestError(str(e))
+  except simian_client.Error, e:
+    raise ServerRequestError(str(e))
+
+  try:
+    ack = json.loads(response[len(JSON_PREFIX):])
+    acked_reports = ack.get('reports')
+  except (AttributeError, TypeError, ValueError):
+    acked_reports = None
+  if acked_reports != len(batch):
+    raise ServerRequestError(
+        'install_report_batch of %d reports not acknowledged: %r' % (
+            len(batch), response))
+
+
+def _DeleteInstallReportArchive(install_report_path):
+  """Deletes an archived ManagedInstallReport.plist."""
+  try:
+    os.unlink(install_report_path)
+  except (IOError, OSError):
+    logging.warning(
+        'Failed to delete ManagedInstallsReport.plist: %s',
+        install_report_path)
 
 
 def UploadAllManagedInstallReports(client, on_corp):
   """Uploads any installs, updates, uninstalls back to Simian server.
 
+  The current ManagedInstallReport.plist and any archived ones are merged
+  into as few size capped batches as possible, each uploaded with a single
+  request.  The reports of a batch are deleted, or cleared for the current
+  one, once the server acknowledges the batch.
+
   Args:
     client: A SimianAuthClient.
     on_corp: str, on_corp status from GetClientIdentifier.
   """
+  install_reports = []
+
   # Report installs from the ManagedInstallsReport archives.
   archives_dir = os.path.join(munkicommon.pref('ManagedInstallDir'), 'Archives')
   if os.path.isdir(archives_dir):
-    for fname in os.listdir(archives_dir):
+    for fname in sorted(os.listdir(archives_dir)):
       if not fname.startswith('ManagedInstallReport-'):
         continue
       install_report_path = os.path.join(archives_dir, fname)
@@ -789,33 +1068,78 @@ def UploadAllManagedInstallReports(client, on_corp):
         continue
       install_report, _ = GetManagedInstallReport(
           install_report_path=install_report_path)
-      try:
-        _UploadManagedInstallReport(client, on_corp, install_report)
-        try:
-          os.unlink(install_report_path)
-        except (IOError, OSError):
-          logging.warning(
-              'Failed to delete ManagedInstallsReport.plist: %s',
-              install_report_path)
-      except ServerRequestError:
-        logging.exception('Error uploading ManagedInstallReport installs.')
+      report = _GetReportableInstallReport(install_report)
+      if report:
+        install_reports.append((install_report_path, report))
+      else:
+        _DeleteInstallReportArchive(install_report_path)
 
   # Report installs from the current ManagedInstallsReport.plist.
-  install_report, install_report_path = GetManagedInstallReport()
+  current_report, current_report_path = GetManagedInstallReport()
+  report = _GetReportableInstallReport(current_report)
+  if report:
+    install_reports.append((None, report))
+
+  for batch in _BatchInstallReports(install_reports):
+    try:
+      _UploadInstallReportBatch(client, on_corp, batch)
+    except ServerRequestError:
+      logging.exception('Error uploading ManagedInstallReport installs.')
+      continue
+    for install_report_path, _, _ in batch:
+      if install_report_path:
+        _DeleteInstallReportArchive(install_report_path)
+      else:
+        # Clear reportable information now that is has been published.
+        current_report['InstallResults'] = []
+        current_report['RemovalResults'] = []
+        current_report['ProblemInstalls'] = []
+        fpl.writePlist(current_report, current_report_path)
+
+
+def _TailFile(path, max_bytes=LOG_UPLOAD_MAX_BYTES):
+  """Returns the end of a file.
+
+  Args:
+    path: str, path of the file.
+    max_bytes: int, maximum number of bytes to return.
+  Returns:
+    str, the file contents, prefixed with a truncation notice if the file
+    was larger than max_bytes.
+  """
+  f = open(path, 'rb')
   try:
-    _UploadManagedInstallReport(client, on_corp, install_report)
-    # Clear reportable information now that is has been published.
-    install_report['InstallResults'] = []
-    install_report['RemovalResults'] = []
-    install_report['ProblemInstalls'] = []
-    fpl.writePlist(install_report, install_report_path)
-  except ServerRequestError:
-    logging.exception('Error uploading ManagedInstallReport installs.')
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size <= max_bytes:
+      f.seek(0)
+      return f.read()
+    f.seek(size - max_bytes)
+    return '*** Log truncated by Simian due to size ***\n\n' + f.read()
+  finally:
+    f.close()
+
+
+def _AddLogToBundle(bundle, name, data):
+  """Adds a log file to a log bundle.
+
+  Args:
+    bundle: tarfile.TarFile, open for writing.
+    name: str, log file name.
+    data: str, log file contents.
+  """
+  info = tarfile.TarInfo(name)
+  info.size = len(data)
+  info.mtime = time.time()
+  bundle.addfile(info, StringIO.StringIO(data))
 
 
 def UploadClientLogFiles(client):
   """Uploads the Munki client log files to the server.
 
+  The log files, each tailed to LOG_UPLOAD_MAX_BYTES, and the output of
+  'ps -ef' are uploaded in a single gzip compressed tar archive.
+
   Args:
     client: A SimianAuthClient object.
   """
@@ -829,20 +1153,32 @@ def UploadClientLogFiles(client):
       '/var/log/debug.log',
       '/var/log/install.log',
   ]
-  for log_file_path in log_file_paths:
-    if os.path.exists(log_file_path):
-      client.UploadFile(log_file_path, 'log')
-
-  # Upload output of 'ps -ef'.
-  return_code, stdout, _ = Exec(['/bin/ps', '-ef'])
-  if not return_code:
-    path = os.path.join(
-        tempfile.mkdtemp(prefix='munki_ps_ef_output_', dir='/tmp'),
-        'ps_ef_output')
-    f = open(path, 'w')
-    f.write(stdout)
-    f.close()
-    client.UploadFile(path, 'log')
+
+  temp_dir = tempfile.mkdtemp(prefix='munki_logs_', dir='/tmp')
+  try:
+    bundle_path = os.path.join(temp_dir, LOG_BUNDLE_NAME)
+    bundle = tarfile.open(bundle_path, 'w:gz')
+    try:
+      for log_file_path in log_file_paths:
+        if not os.path.exists(log_file_path):
+          continue
+        try:
+          data = _TailFile(log_file_path, LOG_UPLOAD_MAX_BYTES)
+        except IOError, e:
+          logging.warning('Error reading %s: %s', log_file_path, str(e))
+          continue
+        _AddLogToBundle(bundle, os.path.basename(log_file_path), data)
+
+      # Include output of 'ps -ef'.
+      return_code, stdout, _ = Exec(['/bin/ps', '-ef'])
+      if not return_code:
+        _AddLogToBundle(bundle, 'ps_ef_output', stdout)
+    finally:
+      bundle.close()
+
+    client.UploadFile(bundle_path, 'logbundle')
+  finally:
+    shutil.rmtree(temp_dir, ignore_errors=True)
 
 
 def KillHungManagedSoftwareUpdate():
@@ -23,6 +23,7 @@ import errno
 import json
 import logging
 import os
+import random
 import re
 import shutil
 import sys
@@ -43,8 +44,13 @@ STATUS_SUCCESS = (0, 'SUCCESS')
 STATUS_FAIL_AUTH = (10, 'failure obtaining auth token')
 STATUS_FAIL_CONFIG_SETUP = (13, 'Config setup errors')
 STATUS_SERVER_EXIT_FEEDBACK = (14, 'Server send EXIT command')
+STATUS_SERVER_DEFER_FEEDBACK = (15, 'Server sent DEFER command')
 # End exit codes
 LAST_RUN_FILE = '/Library/Managed Installs/lastrun'
+# File holding the time until which automatic runs are deferred by the server.
+DEFER_UNTIL_FILE = '/Library/Managed Installs/defer_until'
+# Maximum seconds automatic runs are deferred by, e.g. after a clock change.
+MAX_DEFER_SECONDS = 4 * 3600
 MUNKI_CLIENT_ID_HEADER_KEY = 'X-munki-client-id'
 MAX_ATTEMPTS = 4
 MSULOGFILE = '/Users/Shared/.com.googlecode.munki.ManagedSoftwareUpdate.log'
@@ -90,7 +96,8 @@ def WriteRootCaCerts(client):
   logging.debug('WriteRootCaCerts: success')
 
 
-def LoginToServer(secure_config, client_id, user_settings, client_exit=None):
+def LoginToServer(
+    secure_config, client_id, user_settings, client_exit=None, runtype=None):
   """Sets an auth token cookie header to a plist object.
 
   Args:
@@ -99,6 +106,7 @@ def LoginToServer(secure_config, client_id, user_settings, client_exit=None):
     user_settings: dict of user settings.
     client_exit: optional, default None, str explaining why the client is
       requesting to exit its execution.
+    runtype: optional, default None, str Munki runtype, e.g. "auto".
   Returns:
     Tuple of a SimianAuthClient, a dict containing feedback from the server.
   """
@@ -132,6 +140,9 @@ def LoginToServer(secure_config, client_id, user_settings, client_exit=None):
   }
   if client_exit:
     client_params['client_exit'] = client_exit
+  if runtype:
+    # the server only defers the checkin of automatic runs.
+    client_params['runtype'] = runtype
 
   client_params = urllib.urlencode(client_params)
 
@@ -390,6 +401,34 @@ def NoteLastRun(open_=open):
   output_file.write('Run')
 
 
+def DeferCheckin(defer_seconds, jitter_seconds=0, open_=open):
+  """Defers automatic runs by defer_seconds plus a random jitter.
+
+  Args:
+    defer_seconds: int, seconds to defer by.
+    jitter_seconds: int, optional, maximum random seconds to add.
+    open_: func, optional, default builtin open, for tests.
+  """
+  defer_until = time.time() + defer_seconds + random.uniform(0, jitter_seconds)
+  output_file = open_(DEFER_UNTIL_FILE, 'w')
+  output_file.write('%d' % defer_until)
+  output_file.close()
+
+
+def IsCheckinDeferred(open_=open):
+  """Returns True if automatic runs are deferred by the server."""
+  try:
+    input_file = open_(DEFER_UNTIL_FILE, 'r')
+    try:
+      defer_until = float(input_file.read())
+    finally:
+      input_file.close()
+  except (IOError, ValueError):
+    return False
+  now = time.time()
+  return now < defer_until <= now + MAX_DEFER_SECONDS
+
+
 def RunPreflight(runtype, server_url=None):
   """Run the full Preflight script."""
   NoteLastRun()
@@ -399,6 +438,12 @@ def RunPreflight(runtype, server_url=None):
   if runtype == 'logoutinstall':
     sys.exit(0)
 
+  # the server asked automatic runs to defer their checkin; the launchd
+  # scheduled runs check in again once the defer time has passed.
+  if runtype == 'auto' and IsCheckinDeferred():
+    logging.info('preflight checkin is deferred by server; exiting....')
+    sys.exit(STATUS_SERVER_DEFER_FEEDBACK[0])
+
   # load the NONSECURE ManagedInstalls.plist
   regular_config = munkicommon.ManagedInstallsPreferences()
 
@@ -428,7 +473,7 @@ def RunPreflight(runtype, server_url=None):
 
   # get a client auth token/cookie from the server, and post connection data.
   client, feedback = LoginToServer(
-      secure_config, client_id, user_settings, client_exit)
+      secure_config, client_id, user_settings, client_exit, runtype=runtype)
 
   WriteRootCaCerts(client)
 
@@ -458,6 +503,13 @@ def RunPreflight(runtype, server_url=None):
     logging.warning('preflight received EXIT feedback from server; exiting....')
     sys.exit(STATUS_SERVER_EXIT_FEEDBACK[0])
 
+  if feedback.get('defer_seconds') and runtype == 'auto':
+    logging.warning(
+        'preflight received DEFER feedback from server; exiting....')
+    DeferCheckin(
+        feedback['defer_seconds'], feedback.get('defer_jitter_seconds', 0))
+    sys.exit(STATUS_SERVER_DEFER_FEEDBACK[0])
+
   # post recent MSU logs
   logs = GetManagedSoftwareUpdateLogs()
   PostManagedSoftwareUpdateLogs(client, logs)
@@ -42,6 +42,7 @@ from simian.mac.munki import plist
 OS_VERSIONS = frozenset(
     ['10.7', '10.8', '10.9', '10.10', '10.11'])
 
+# Name of the durable lock held while a track's catalog regeneration is pending
 CATALOG_REGENERATION_LOCK_NAME = 'applesus_catalog_regeneration_%s'
 
 MON, TUE, WED, THU, FRI, SAT, SUN = range(0, 7)
@@ -162,7 +163,8 @@ class DistFileDocument(object):
                     self._installer_script.get('SU_VERSION'))
 
 
-def GenerateAppleSUSCatalogs(track=None, tracks=None, delay=0):
+def GenerateAppleSUSCatalogs(
+    track=None, tracks=None, delay=0, lock_token=None):
   """Generates Apple SUS catalogs for a given track, set of tracks, or all.
   Note: this generates tracks for all os_versions on the given track/tracks.
 
@@ -170,6 +172,8 @@ def GenerateAppleSUSCatalogs(track=None, tracks=None, delay=0):
     track: string track to generate catalog for. OR,
     tracks: list of string tracks.
     delay: int. if > 0, defer generating the catalogs by this many seconds.
+    lock_token: str, optional, owner token of the catalog regeneration lock,
+        to release it only if still held by that owner.
   """
   if track and tracks:
     raise ValueError('only one of track and tracks is allowed')
@@ -188,11 +192,11 @@ def GenerateAppleSUSCatalogs(track=None, tracks=None, delay=0):
         try:
           deferred.defer(
               GenerateAppleSUSCatalog, os_version, track,
-              _countdown=delay, _name=deferred_name)
+              lock_token=lock_token, _countdown=delay, _name=deferred_name)
         except taskqueue.TaskAlreadyExistsError:
           logging.info('Skipping duplicate Apple SUS Catalog generation task.')
       else:
-        GenerateAppleSUSCatalog(os_version, track)
+        GenerateAppleSUSCatalog(os_version, track, lock_token=lock_token)
 
   if delay:
     now_str = datetime.datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S')
@@ -207,7 +211,8 @@ def GenerateAppleSUSCatalogs(track=None, tracks=None, delay=0):
     GenerateAppleSUSMetadataCatalog()
 
 
-def GenerateAppleSUSCatalog(os_version, track, _datetime=datetime.datetime):
+def GenerateAppleSUSCatalog(
+    os_version, track, _datetime=datetime.datetime, lock_token=None):
   """Generates an Apple SUS catalog for a given os_version and track.
 
   This function loads the untouched/raw Apple SUS catalog, removes any
@@ -218,6 +223,8 @@ def GenerateAppleSUSCatalog(os_version, track, _datetime=datetime.datetime):
     os_version: str OS version to generate the catalog for.
     track: str track name to generate the catalog for.
     _datetime: datetime module; only used for stub during testing.
+    lock_token: str, optional, owner token of the catalog regeneration lock;
+        without it, the lock is released regardless of owner.
   Returns:
     tuple, new models.AppleSUSCatalog object and plist.ApplePlist object. Or,
     if there is no "untouched" catalog for the os_version, then (None, None) is
@@ -226,7 +233,8 @@ def GenerateAppleSUSCatalog(os_version, track, _datetime=datetime.datetime):
   logging.info('Generating catalog: %s_%s', os_version, track)
 
   # clear any locks on this track, potentially set by admin product changes.
-  gae_util.ReleaseLock(CATALOG_REGENERATION_LOCK_NAME % track)
+  gae_util.ReleaseLock(
+      CATALOG_REGENERATION_LOCK_NAME % track, token=lock_token, durable=True)
 
   catalog_key = '%s_untouched' % os_version
   untouched_catalog_obj = models.AppleSUSCatalog.get_by_key_name(catalog_key)
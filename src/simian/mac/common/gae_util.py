@@ -21,27 +21,240 @@
 
 
 
+import collections
+import datetime
 import logging
 import time
+import uuid
 
 from google.appengine.api import memcache
 from google.appengine.ext import blobstore
 from google.appengine.ext import db
+from google.appengine.runtime import apiproxy_errors
 
 
 LOCK_NAME = 'lock_%s'
+LOCK_STATS_NAME = 'lock_stats_%s_'
+
+# Default seconds a lock lease lasts if it is not released
+LOCK_DEFAULT_TTL = 10 * 60
+# First and maximum seconds to sleep between attempts to obtain a lock
+LOCK_WAIT_MIN_SLEEP = 0.05
+LOCK_WAIT_MAX_SLEEP = 1.0
+
+# Maximum number of batch RPCs BatchDatastoreOp keeps in flight at once
+BATCH_OP_MAX_IN_FLIGHT = 4
+# Maximum number of entities or keys in one batch, the datastore limit
+BATCH_OP_MAX_SIZE = 500
+# Maximum approximate encoded size in bytes of the entities in one put batch
+BATCH_OP_MAX_BYTES = 512 * 1024
+# Batch RPC latency in seconds above which the batch size is reduced
+BATCH_OP_TARGET_LATENCY = 1.0
+# Number of times a batch is retried after a transient error
+BATCH_OP_RETRIES = 3
+# Seconds to wait before the first retry of a batch, doubled on each retry
+BATCH_OP_RETRY_DELAY = 0.1
+
+# Errors after which a datastore batch operation may succeed if retried
+TRANSIENT_DATASTORE_ERRORS = (
+    db.Timeout, db.InternalError, db.TransactionFailedError,
+    apiproxy_errors.DeadlineExceededError)
+
+# Async equivalents of synchronous batch datastore operations
+_ASYNC_DATASTORE_OPS = {
+    db.put: db.put_async,
+    db.delete: db.delete_async,
+}
+
+# Value left in memcache by a lock released by its owner; it may be taken
+# over with cas() by the next owner
+LOCK_RELEASED = ''
+# Seconds a released lock value is kept in memcache
+LOCK_RELEASED_TTL = 60
+
+
+class Error(Exception):
+  """Base error."""
+
+
+class BatchDatastoreOpError(Error, db.Error):
+  """Some batches of a BatchDatastoreOp failed."""
+
+
+class BatchOpStats(object):
+  """Statistics from one BatchDatastoreOpAsync call."""
+
+  def __init__(self):
+    self.items = 0
+    self.batches = 0
+    self.retries = 0
+    self.failed_items = 0
+    self.seconds = 0.0
+
+  def ItemsPerSecond(self):
+    """Returns the overall throughput in entities or keys per second."""
+    if not self.seconds:
+      return 0.0
+    return self.items / self.seconds
+
+  def __str__(self):
+    return ('%d items in %d batches, %d retries, %d failed, %.2fs, '
+            '%.1f items/s' % (
+                self.items, self.batches, self.retries, self.failed_items,
+                self.seconds, self.ItemsPerSecond()))
+
+
+def _EntitySize(entity_or_key):
+  """Returns the approximate encoded size of an entity, or 0 for keys.
+
+  Args:
+    entity_or_key: db.Key or db.Model instance.
+  Returns:
+    int, bytes
+  """
+  if isinstance(entity_or_key, db.Model):
+    return db.model_to_protobuf(entity_or_key).ByteSize()
+  return 0
+
+
+def _IsRetryable(op, batch):
+  """Returns True if a failed batch may be safely attempted again.
+
+  A put which timed out may have committed; putting entities without a
+  complete key again would create duplicates with new ids.
+
+  Args:
+    op: func, Datastore operation of the batch.
+    batch: list, db.Key or db.Model instances.
+  Returns:
+    bool
+  """
+  if op is not db.put:
+    return True
+  for entity in batch:
+    if isinstance(entity, db.Model) and not entity.has_key():
+      return False
+  return True
+
+
+def BatchDatastoreOpAsync(op, entities_or_keys, batch_size=25):
+  """Performs a batch Datastore operation with several batches in flight.
+
+  Up to BATCH_OP_MAX_IN_FLIGHT batch RPCs run at once.  The batch size
+  starts at batch_size and adapts: it is halved when a batch takes longer
+  than BATCH_OP_TARGET_LATENCY or fails with a transient error, and grows
+  while batches are fast, within BATCH_OP_MAX_SIZE entities and
+  BATCH_OP_MAX_BYTES bytes.  A batch failing with a transient error is split
+  and retried up to BATCH_OP_RETRIES times, unless it puts entities without
+  a complete key; a failed batch does not stop the other batches.  The size
+  of put batches is estimated from the encoded size of their first entity.
+
+  Args:
+    op: func, Datastore operation to perform, db.put or db.delete.  Other
+        operations are performed synchronously, one batch at a time.
+    entities_or_keys: sequence, db.Key or db.Model instances.
+    batch_size: int, initial number of keys or entities per batch.
+  Returns:
+    BatchOpStats instance.
+  """
+  stats = BatchOpStats()
+  start_time = time.time()
+  async_op = _ASYNC_DATASTORE_OPS.get(op)
+  batch_size = max(1, min(batch_size, BATCH_OP_MAX_SIZE))
+  check_size = op is db.put
+
+  def _NextBatch(i):
+    """Returns the index after the next batch starting at index i."""
+    end = min(i + batch_size, len(entities_or_keys))
+    if check_size:
+      entity_size = _EntitySize(entities_or_keys[i])
+      if entity_size:
+        end = min(end, i + max(1, BATCH_OP_MAX_BYTES // entity_size))
+    return end
+
+  def _Start(batch):
+    """Starts a batch, returns an rpc or None if the batch failed."""
+    stats.batches += 1
+    try:
+      if async_op is None:
+        op(batch)
+        return None
+      return async_op(batch)
+    except db.Error, e:
+      logging.warning('BatchDatastoreOp batch failed: %s', str(e))
+      stats.failed_items += len(batch)
+      return None
+
+  pending = collections.deque()
+  i = 0
+  while i < len(entities_or_keys) or pending:
+    while i < len(entities_or_keys) and len(pending) < BATCH_OP_MAX_IN_FLIGHT:
+      end = _NextBatch(i)
+      batch = entities_or_keys[i:end]
+      i = end
+      stats.items += len(batch)
+      rpc = _Start(batch)
+      if rpc is not None:
+        pending.append((rpc, batch, time.time(), 0))
+
+    if not pending:
+      continue
+
+    rpc, batch, batch_start, attempt = pending.popleft()
+    try:
+      rpc.get_result()
+    except TRANSIENT_DATASTORE_ERRORS, e:
+      batch_size = max(1, batch_size // 2)
+      if attempt >= BATCH_OP_RETRIES or not _IsRetryable(op, batch):
+        logging.warning(
+            'BatchDatastoreOp batch failed after %d retries: %s',
+            attempt, str(e))
+        stats.failed_items += len(batch)
+        continue
+      time.sleep(BATCH_OP_RETRY_DELAY * (2 ** attempt))
+      half = max(1, len(batch) // 2)
+      for retry_batch in (batch[:half], batch[half:]):
+        if not retry_batch:
+          continue
+        stats.retries += 1
+        rpc = _Start(retry_batch)
+        if rpc is not None:
+          pending.append((rpc, retry_batch, time.time(), attempt + 1))
+      continue
+    except db.Error, e:
+      logging.warning('BatchDatastoreOp batch failed: %s', str(e))
+      stats.failed_items += len(batch)
+      continue
+
+    latency = time.time() - batch_start
+    if latency > BATCH_OP_TARGET_LATENCY:
+      batch_size = max(1, batch_size // 2)
+    elif latency < BATCH_OP_TARGET_LATENCY / 2:
+      batch_size = min(BATCH_OP_MAX_SIZE, batch_size + batch_size // 2 + 1)
+
+  stats.seconds = time.time() - start_time
+  return stats
 
 
 def BatchDatastoreOp(op, entities_or_keys, batch_size=25):
   """Performs a batch Datastore operation on a sequence of keys or entities.
 
+  See BatchDatastoreOpAsync; all batches are attempted before any failure
+  is raised.
+
   Args:
     op: func, Datastore operation to perform, i.e. db.put or db.delete.
     entities_or_keys: sequence, db.Key or db.Model instances.
     batch_size: int, number of keys or entities to batch per operation.
+  Returns:
+    BatchOpStats instance.
+  Raises:
+    BatchDatastoreOpError: some entities or keys failed; a db.Error.
   """
-  for i in xrange(0, len(entities_or_keys), batch_size):
-    op(entities_or_keys[i:i + batch_size])
+  stats = BatchDatastoreOpAsync(op, entities_or_keys, batch_size)
+  if stats.failed_items:
+    raise BatchDatastoreOpError(str(stats))
+  return stats
 
 
 def SafeBlobDel(blobstore_key):
@@ -93,34 +306,243 @@ def GetBlobAndDel(blobstore_key):
 class QueryIterator(object):
   """Class to assist with iterating over big App Engine Datastore queries.
 
+  Results are fetched a page at a time, each page resuming from the cursor
+  of the last, to avoid query time limits.  With prefetch, the next page is
+  fetched in the background while the caller processes the current one.
+  Keys-only and projection queries are supported.
+
+  The cursor attribute is a checkpoint: a QueryIterator created with it
+  resumes without skipping results which were not yet processed, repeating
+  at most the rest of the page being processed.
+
   NOTE: this class is not compatible with queries using filters with IN or !=.
   """
 
-  def __init__(self, query, step=1000):
+  def __init__(self, query, step=1000, prefetch=True, max_step=None,
+               cursor=None):
+    """Initializer.
+
+    Args:
+      query: db.Query or db.GqlQuery instance.
+      step: int, number of results in the first page.
+      prefetch: bool, True to fetch the next page while the current page is
+          processed.
+      max_step: int, optional, double the page size after each page until
+          it reaches max_step.  Default is to keep all pages at step results.
+      cursor: str, optional, cursor to resume from.
+    """
     self._query = query
     self._step = step
+    self._max_step = max(step, max_step or step)
+    self._prefetch = prefetch
+    self.cursor = cursor
+    if cursor:
+      self._query.with_cursor(cursor)
+
+  def _Fetch(self, step):
+    """Start fetching a page, returning an AsyncFetch if prefetching."""
+    if self._prefetch:
+      return AsyncFetch(self._query, step)
+    return None
+
+  def Pages(self):
+    """Iterate over pages of results.
+
+    Yields:
+      list of results, entities or keys.
+    """
+    step = self._step
+    fetch = self._Fetch(step)
+    while True:
+      if fetch is None:
+        entities = self._query.fetch(step)
+      else:
+        entities = fetch.get_result()
+      if not entities:
+        return
+      next_cursor = self._query.cursor()
+      next_step = min(step * 2, self._max_step)
+      if len(entities) < step:
+        fetch = None
+        finished = True
+      else:
+        self._query.with_cursor(next_cursor)
+        fetch = self._Fetch(next_step)
+        finished = False
+      yield entities
+      self.cursor = next_cursor
+      if finished:
+        return
+      step = next_step
 
   def __iter__(self):
     """Iterate over query results safely avoiding 30s query limitations."""
-    while True:
-      entities = self._query.fetch(self._step)
-      if not entities:
-        raise StopIteration
+    for entities in self.Pages():
       for entity in entities:
         yield entity
-      self._query.with_cursor(self._query.cursor())
 
 
+class AsyncFetch(object):
+  """A query fetch running in the background.
+
+  Creating an instance starts the query's first batch RPC, so several
+  queries can be in flight at once.  get_result() waits for the results.
+  """
+
+  def __init__(self, query, limit=None):
+    """Initializer.
+
+    Args:
+      query: db.Query or db.GqlQuery instance.
+      limit: int, optional, maximum number of results, None for all.
+    """
+    if limit is None:
+      self._iterator = query.run()
+    else:
+      self._iterator = query.run(limit=limit, batch_size=limit)
+    self._results = None
+
+  def get_result(self):
+    """Returns the list of query results, waiting for them if needed."""
+    if self._results is None:
+      self._results = list(self._iterator)
+    return self._results
+
+
+def FetchMulti(queries, limit=None):
+  """Fetch results of several queries concurrently.
+
+  Args:
+    queries: dict, of db.Query or db.GqlQuery instances.
+    limit: int, optional, maximum number of results per query, None for all.
+  Returns:
+    dict, with the same keys as queries, of lists of query results.
+  """
+  fetches = dict((k, AsyncFetch(q, limit)) for k, q in queries.iteritems())
+  return dict((k, f.get_result()) for k, f in fetches.iteritems())
+
+
+class DatastoreLock(db.Model):
+  """A lock lease stored in Datastore, for ObtainLock(durable=True).
+
+  key = lock name
+  """
+
+  owner = db.StringProperty()
+  expires = db.DateTimeProperty()
+
+
+def LockExists(name, durable=False):
+  """Returns True if a lock with the given str name exists, False otherwise.
 
-def LockExists(name):
-  """Returns True if a lock with the given str name exists, False otherwise."""
+  Args:
+    name: str, name of lock
+    durable: bool, True if the lock is stored in Datastore.
+  """
+  if durable:
+    lock = DatastoreLock.get_by_key_name(name)
+    return bool(lock and lock.expires > datetime.datetime.utcnow())
   memcache_key = LOCK_NAME % name
-  return memcache.get(memcache_key) is not None
+  return bool(memcache.get(memcache_key))
+
+
+def _AcquireDatastoreLock(name, token, ttl):
+  """Attempt once to acquire a lock stored in Datastore.
+
+  Args:
+    name: str, name of lock
+    token: str, owner token to store in the lock
+    ttl: int, lease seconds
+  Returns:
+    True if the lock was acquired, False otherwise.
+  """
+  def _Txn():
+    now = datetime.datetime.utcnow()
+    lock = DatastoreLock.get_by_key_name(name)
+    if lock and lock.expires > now:
+      return False
+    DatastoreLock(
+        key_name=name, owner=token,
+        expires=now + datetime.timedelta(seconds=ttl)).put()
+    return True
+
+  try:
+    acquired = db.run_in_transaction(_Txn)
+  except db.TransactionFailedError:
+    return False
+  if acquired:
+    # so that memcache based lock checks, e.g. lock admin, see it.
+    memcache.set(LOCK_NAME % name, token, time=ttl)
+  return acquired
+
+
+def _AcquireLock(name, token, ttl, durable):
+  """Attempt once to acquire a lock.
+
+  Args:
+    name: str, name of lock
+    token: str, owner token to store in the lock
+    ttl: int, lease seconds
+    durable: bool, True to store the lock in Datastore.
+  Returns:
+    True if the lock was acquired, False otherwise.
+  """
+  if durable:
+    return _AcquireDatastoreLock(name, token, ttl)
+  memcache_key = LOCK_NAME % name
+  if memcache.add(memcache_key, token, time=ttl):
+    return True
+  # a lock released by its owner holds LOCK_RELEASED until it expires.
+  client = memcache.Client()
+  if client.gets(memcache_key) == LOCK_RELEASED:
+    return bool(client.cas(memcache_key, token, time=ttl))
+  return False
 
 
-def ObtainLock(name, timeout=0):
+def _RecordLockStats(name, attempts, wait_seconds, acquired):
+  """Record lock acquisition metrics in memcache counters.
+
+  Args:
+    name: str, name of lock
+    attempts: int, number of acquire attempts made
+    wait_seconds: float, seconds spent acquiring or waiting
+    acquired: bool, True if the lock was acquired
+  """
+  counters = {
+      'attempts': attempts,
+      'contended': int(attempts > 1),
+      'acquired': int(acquired),
+      'failed': int(not acquired),
+      'wait_ms': int(wait_seconds * 1000),
+  }
+  try:
+    memcache.offset_multi(
+        counters, key_prefix=LOCK_STATS_NAME % name, initial_value=0)
+  except Exception, e:  # pylint: disable=broad-except
+    logging.warning('Could not record lock stats for %s: %s', name, str(e))
+
+
+def GetLockStats(name):
+  """Returns lock acquisition metrics recorded for a lock.
+
+  Args:
+    name: str, name of lock
+  Returns:
+    dict with int values for keys 'attempts', 'contended', 'acquired',
+    'failed' and 'wait_ms', the total milliseconds spent acquiring.
+  """
+  keys = ['attempts', 'contended', 'acquired', 'failed', 'wait_ms']
+  values = memcache.get_multi(keys, key_prefix=LOCK_STATS_NAME % name)
+  return dict((k, int(values.get(k, 0))) for k in keys)
+
+
+def ObtainLock(name, timeout=0, ttl=None, durable=False):
   """Obtain a lock, given a name.
 
+  Locks are leases which expire after ttl seconds, so a lock left behind by
+  a crashed holder is released eventually.  While waiting for a lock,
+  attempts are made with exponential backoff.
+
   Args:
     name: str, name of lock
     timeout: int, if >0, wait timeout seconds for a lock if it cannot
@@ -128,25 +550,69 @@ def ObtainLock(name, timeout=0):
       than the AppEngine deadline will be hazardous to your health.
       The deadline is 30s for live http, 10m for offline tasks as of
       this note.
+    ttl: int, optional, lease seconds, default LOCK_DEFAULT_TTL.
+    durable: bool, optional, True to store the lock in Datastore, so it
+      survives memcache eviction.  Release it with durable=True as well.
   Returns:
-    True if lock was obtained
+    str owner token, which is True, if lock was obtained
     False if lock was not obtained, some other process has the lock
   """
-  memcache_key = LOCK_NAME % name
-  while 1:
-    locked = memcache.incr(memcache_key, initial_value=0) == 1
-    timeout -= 1
-    if locked or timeout < 0:
-      return locked
-    time.sleep(1)
-  return False
-
-
-def ReleaseLock(name):
+  if ttl is None:
+    ttl = LOCK_DEFAULT_TTL
+  token = uuid.uuid4().hex
+  start = time.time()
+  deadline = start + timeout
+  sleep = LOCK_WAIT_MIN_SLEEP
+  attempts = 0
+  while True:
+    attempts += 1
+    if _AcquireLock(name, token, ttl, durable):
+      _RecordLockStats(name, attempts, time.time() - start, True)
+      return token
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      _RecordLockStats(name, attempts, time.time() - start, False)
+      return False
+    time.sleep(min(sleep, remaining))
+    sleep = min(sleep * 2, LOCK_WAIT_MAX_SLEEP)
+
+
+def ReleaseLock(name, token=None, durable=False):
   """Release a lock, given its name.
 
+  With an owner token, the lock is only released if it is still held by
+  that owner, so a lock whose lease expired and was obtained by another
+  owner is left alone.  Pass the token when releasing a lock obtained in
+  another request, e.g. from a deferred task.
+
   Args:
     name: str, name of lock
+    token: str, optional, owner token returned by ObtainLock.  Without it,
+      the lock is released regardless of owner.
+    durable: bool, True if the lock is stored in Datastore.
   """
   memcache_key = LOCK_NAME % name
-  memcache.delete(memcache_key)
+  if durable:
+    def _Txn():
+      lock = DatastoreLock.get_by_key_name(name)
+      if lock and (token is None or lock.owner == token):
+        lock.delete()
+        return True
+      return False
+
+    if db.run_in_transaction(_Txn) or token is None:
+      memcache.delete(memcache_key)
+    else:
+      logging.warning('Lock %s is no longer held by this owner.', name)
+    return
+
+  if token is None:
+    memcache.delete(memcache_key)
+    return
+
+  # compare and release atomically; memcache has no compare and delete.
+  client = memcache.Client()
+  if (client.gets(memcache_key) == token and
+      client.cas(memcache_key, LOCK_RELEASED, time=LOCK_RELEASED_TTL)):
+    return
+  logging.warning('Lock %s is no longer held by this owner.', name)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+"""Google Cloud Storage objects, over the XML API.
+
+Objects are written with resumable uploads: a session is started once and
+each part of the object is sent at its byte offset, so resending a part the
+session already has is ignored rather than appended again.  Objects are
+named /bucket/object, and served with blob keys from GetBlobKey().
+"""
+
+
+
+import httplib
+import logging
+import urllib
+import urlparse
+
+from google.appengine.api import app_identity
+from google.appengine.api import urlfetch
+from google.appengine.ext import blobstore
+
+
+# Host of the Cloud Storage XML API.
+GCS_API_URL = 'https://storage.googleapis.com'
+# OAuth scope of the requests made to Cloud Storage.
+GCS_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
+# Deadline of each request to Cloud Storage, in seconds.
+GCS_DEADLINE = 60
+# Status of a resumable upload which has not received the whole object yet.
+RESUME_INCOMPLETE = 308
+
+
+class Error(Exception):
+  """Cloud Storage request failed."""
+
+
+def GetDefaultBucket():
+  """Returns the name of the default Cloud Storage bucket of the app."""
+  return app_identity.get_default_gcs_bucket_name()
+
+
+def GetBlobKey(filename):
+  """Returns the blob key to serve an object with, e.g. with send_blob().
+
+  Args:
+    filename: str, object name like /bucket/object.
+  Returns:
+    str blob key.
+  """
+  return blobstore.create_gs_key('/gs' + filename)
+
+
+def _Fetch(method, filename, payload=None, headers=None, params=None):
+  """Makes a Cloud Storage request.
+
+  Args:
+    method: str, like 'PUT'.
+    filename: str, object name like /bucket/object.
+    payload: str, optional, request body.
+    headers: dict, optional, request headers.
+    params: dict, optional, query parameters.
+  Returns:
+    urlfetch response.
+  Raises:
+    Error: the request failed.
+  """
+  url = GCS_API_URL + urllib.quote(filename)
+  if params:
+    url += '?' + urllib.urlencode(params)
+  headers = dict(headers or {})
+  token, _ = app_identity.get_access_token([GCS_SCOPE])
+  headers['Authorization'] = 'OAuth %s' % token
+  try:
+    return urlfetch.fetch(
+        url, payload=payload, method=method, headers=headers,
+        follow_redirects=False, deadline=GCS_DEADLINE)
+  except urlfetch.Error, e:
+    raise Error('%s %s: %s' % (method, filename, e))
+
+
+def StartUpload(filename, content_type='application/octet-stream'):
+  """Starts a resumable upload of an object.
+
+  Args:
+    filename: str, object name like /bucket/object.
+    content_type: str, optional, content type of the object.
+  Returns:
+    str upload id of the session, see PutUpload().
+  Raises:
+    Error: the upload could not be started.
+  """
+  response = _Fetch('POST', filename, headers={
+      'x-goog-resumable': 'start', 'content-type': content_type})
+  if response.status_code != httplib.CREATED:
+    raise Error('POST %s: status %d' % (filename, response.status_code))
+  query = urlparse.urlsplit(response.headers['location']).query
+  return urlparse.parse_qs(query)['upload_id'][0]
+
+
+def PutUpload(filename, upload_id, data, offset, size=None):
+  """Sends part of an object to a resumable upload.
+
+  Args:
+    filename: str, object name like /bucket/object.
+    upload_id: str, upload id from StartUpload().
+    data: str, content of the object at offset.  Unless it is the last
+        part, its length must be a multiple of 256 KB.
+    offset: int, offset of data in the object.
+    size: int, optional, size of the whole object, if this is the last part.
+  Raises:
+    Error: the part was not received.
+  """
+  if data:
+    content_range = 'bytes %d-%d/%s' % (
+        offset, offset + len(data) - 1, '*' if size is None else size)
+  else:
+    content_range = 'bytes */%d' % size
+  response = _Fetch(
+      'PUT', filename, payload=data, params={'upload_id': upload_id},
+      headers={'content-range': content_range})
+  if response.status_code not in [
+      httplib.OK, httplib.CREATED, RESUME_INCOMPLETE]:
+    raise Error('PUT %s %s: status %d' % (
+        filename, content_range, response.status_code))
+
+
+def GetSize(filename):
+  """Returns the size of an object, or None if it does not exist.
+
+  Args:
+    filename: str, object name like /bucket/object.
+  Raises:
+    Error: the request failed.
+  """
+  response = _Fetch('HEAD', filename)
+  if response.status_code == httplib.NOT_FOUND:
+    return None
+  elif response.status_code != httplib.OK:
+    raise Error('HEAD %s: status %d' % (filename, response.status_code))
+  return int(response.headers['x-goog-stored-content-length'])
+
+
+def SafeDelete(filename):
+  """Deletes an object, logging failures.
+
+  Args:
+    filename: str, object name like /bucket/object.
+  """
+  try:
+    response = _Fetch('DELETE', filename)
+  except Error, e:
+    logging.warning('%s; this object is now probably orphaned.', e)
+    return
+  if response.status_code not in [httplib.NO_CONTENT, httplib.NOT_FOUND]:
+    logging.warning(
+        'DELETE %s: status %d; this object is now probably orphaned.',
+        filename, response.status_code)
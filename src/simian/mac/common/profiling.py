@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+"""Request profiling for the Simian WSGI apps.
+
+ProfileMiddleware times each request per route, and apiproxy hooks count
+and time the memcache, datastore and other RPCs the request makes.  Each
+request is logged as one structured log line.  Per route latency histograms
+are aggregated in instance memory and flushed to memcache periodically, from
+where GetRouteStats() reads them for the admin profiling page.  A small
+fraction of requests is run under cProfile and the profile logged.
+
+Classes:
+
+  RequestStats:       timings of one request
+  ProfileMiddleware:  WSGI middleware which profiles requests
+
+Functions:
+
+  InstallHooks:       install the apiproxy RPC hooks
+  GetRouteStats:      return aggregated per route stats
+  Percentile:         estimate a percentile from a latency histogram
+"""
+
+
+
+
+import cProfile
+import json
+import logging
+import pstats
+import random
+import StringIO
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+
+# Set False to disable request profiling.
+PROFILE_ENABLED = True
+# Fraction of requests which are run under cProfile, with the profile logged.
+CPROFILE_SAMPLE_RATE = 0.001
+# Number of functions listed in logged cProfile output.
+CPROFILE_TOP_FUNCTIONS = 40
+# Upper bounds in ms of the latency histogram buckets, a last bucket is
+# unbounded.
+LATENCY_BUCKETS_MS = (
+    10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+# Seconds between flushes of instance stats to memcache.
+STATS_FLUSH_SECONDS = 10
+# memcache namespace of the aggregated stats.
+STATS_NAMESPACE = 'profiling'
+# memcache key holding the list of routes with stats.
+STATS_ROUTES_KEY = 'routes'
+# memcache key prefix of the stats counters of one route.
+STATS_ROUTE_PREFIX = 'route_%s_'
+# Route name used for requests which match no route.
+UNMATCHED_ROUTE = 'unmatched'
+# Module prefix stripped from handler names in route names.
+HANDLER_MODULE_PREFIX = 'simian.mac.'
+# Key the apiproxy hooks are registered under.
+HOOK_KEY = 'simian_profiling'
+
+# Thread local state, holding the RequestStats of the current request.
+_local = threading.local()
+# Stats of this instance not yet flushed to memcache, per route.
+_pending_stats = {}
+# Routes known to be in the memcache routes list.
+_known_routes = set()
+# time.time() of the last flush to memcache.
+_last_flush = [0]
+
+
+def _NewCounters():
+  """Returns a dict of zeroed stats counters for one route."""
+  counters = {'requests': 0, 'total_ms': 0, 'rpc_count': 0, 'rpc_ms': 0}
+  for i in xrange(len(LATENCY_BUCKETS_MS) + 1):
+    counters['bucket_%d' % i] = 0
+  return counters
+
+
+def _BucketIndex(ms):
+  """Returns the index of the latency histogram bucket for ms."""
+  for i, bound in enumerate(LATENCY_BUCKETS_MS):
+    if ms <= bound:
+      return i
+  return len(LATENCY_BUCKETS_MS)
+
+
+def Percentile(buckets, fraction):
+  """Estimate a percentile from a latency histogram.
+
+  Args:
+    buckets: list of int request counts, one per latency histogram bucket.
+    fraction: float, between 0 and 1, e.g. 0.95 for p95.
+  Returns:
+    int upper bound in ms of the bucket holding the percentile, None for the
+    last, unbounded, bucket or if there are no requests.
+  """
+  total = sum(buckets)
+  if not total:
+    return None
+  target = fraction * total
+  cumulative = 0
+  for i, count in enumerate(buckets):
+    cumulative += count
+    if cumulative >= target:
+      break
+  if i < len(LATENCY_BUCKETS_MS):
+    return LATENCY_BUCKETS_MS[i]
+  return None
+
+
+class RequestStats(object):
+  """Timings of one request and the RPCs it made."""
+
+  def __init__(self, route, method):
+    self.route = route
+    self.method = method
+    self.start = time.time()
+    self.ms = 0
+    self.status = None
+    self.rpcs = {}  # 'service.call' => [count, ms]
+    self._rpc_starts = {}
+
+  def RpcStarted(self, service, call, request):
+    """Record the start of an RPC."""
+    self._rpc_starts[id(request)] = time.time()
+    rpc_stats = self.rpcs.setdefault('%s.%s' % (service, call), [0, 0.0])
+    rpc_stats[0] += 1
+
+  def RpcFinished(self, service, call, request):
+    """Record the end of an RPC."""
+    start = self._rpc_starts.pop(id(request), None)
+    if start is not None:
+      rpc_stats = self.rpcs.setdefault('%s.%s' % (service, call), [0, 0.0])
+      rpc_stats[1] += (time.time() - start) * 1000
+
+  def Finish(self, status=None):
+    """Record the end of the request."""
+    self.ms = (time.time() - self.start) * 1000
+    self.status = status
+
+  def RpcCount(self):
+    """Returns the number of RPCs made."""
+    return sum(c for c, unused_ms in self.rpcs.itervalues())
+
+  def RpcMs(self):
+    """Returns the total ms spent waiting for RPCs."""
+    return sum(ms for unused_c, ms in self.rpcs.itervalues())
+
+  def ToDict(self):
+    """Returns a dict of the stats, for structured logging."""
+    return {
+        'route': self.route,
+        'method': self.method,
+        'status': self.status,
+        'ms': int(self.ms),
+        'rpc_count': self.RpcCount(),
+        'rpc_ms': int(self.RpcMs()),
+        'rpcs': dict(
+            (k, {'count': c, 'ms': int(ms)})
+            for k, (c, ms) in self.rpcs.iteritems()),
+    }
+
+
+def _PreCallHook(service, call, request, unused_response):
+  """apiproxy hook called before each RPC."""
+  stats = getattr(_local, 'stats', None)
+  if stats is not None:
+    stats.RpcStarted(service, call, request)
+
+
+def _PostCallHook(
+    service, call, request, unused_response, unused_rpc=None,
+    unused_error=None):
+  """apiproxy hook called after each RPC, including failed ones."""
+  stats = getattr(_local, 'stats', None)
+  if stats is not None:
+    stats.RpcFinished(service, call, request)
+
+
+def InstallHooks():
+  """Install the apiproxy RPC hooks; installing them again does nothing."""
+  apiproxy = apiproxy_stub_map.apiproxy
+  apiproxy.GetPreCallHooks().Append(HOOK_KEY, _PreCallHook)
+  apiproxy.GetPostCallHooks().Append(HOOK_KEY, _PostCallHook)
+
+
+def _RecordRequest(stats):
+  """Add a finished request to the instance stats for its route.
+
+  Args:
+    stats: RequestStats instance.
+  """
+  counters = _pending_stats.setdefault(stats.route, _NewCounters())
+  counters['requests'] += 1
+  counters['total_ms'] += int(stats.ms)
+  counters['rpc_count'] += stats.RpcCount()
+  counters['rpc_ms'] += int(stats.RpcMs())
+  counters['bucket_%d' % _BucketIndex(stats.ms)] += 1
+
+
+def _AddRoutes(routes):
+  """Add routes to the memcache list of routes with stats.
+
+  Args:
+    routes: list of str route names.
+  """
+  client = memcache.Client()
+  for unused_attempt in xrange(3):
+    known = client.gets(STATS_ROUTES_KEY, namespace=STATS_NAMESPACE)
+    if known is None:
+      if client.add(
+          STATS_ROUTES_KEY, sorted(routes), namespace=STATS_NAMESPACE):
+        return
+      continue
+    missing = set(routes) - set(known)
+    if not missing:
+      return
+    if client.cas(
+        STATS_ROUTES_KEY, sorted(set(known) | missing),
+        namespace=STATS_NAMESPACE):
+      return
+
+
+def FlushStats(force=False):
+  """Flush instance stats to memcache, at most every STATS_FLUSH_SECONDS.
+
+  Args:
+    force: bool, True to flush regardless of the time since the last flush.
+  """
+  now = time.time()
+  if not _pending_stats or (
+      not force and now - _last_flush[0] < STATS_FLUSH_SECONDS):
+    return
+  _last_flush[0] = now
+  pending = _pending_stats.copy()
+  _pending_stats.clear()
+  try:
+    new_routes = [r for r in pending if r not in _known_routes]
+    if new_routes:
+      _AddRoutes(new_routes)
+      _known_routes.update(new_routes)
+    for route, counters in pending.iteritems():
+      memcache.offset_multi(
+          counters, key_prefix=STATS_ROUTE_PREFIX % route,
+          namespace=STATS_NAMESPACE, initial_value=0)
+  except Exception, e:  # pylint: disable=broad-except
+    logging.warning('Could not flush profiling stats: %s', str(e))
+
+
+def GetRouteStats():
+  """Returns aggregated per route stats.
+
+  Returns:
+    list of dicts, sorted by total ms, each with keys route, requests,
+    total_ms, mean_ms, p50, p95, p99, rpc_count and rpc_ms, the latter two
+    per request.
+  """
+  routes = memcache.get(STATS_ROUTES_KEY, namespace=STATS_NAMESPACE) or []
+  keys = _NewCounters().keys()
+  results = []
+  for route in routes:
+    values = memcache.get_multi(
+        keys, key_prefix=STATS_ROUTE_PREFIX % route,
+        namespace=STATS_NAMESPACE)
+    requests = int(values.get('requests', 0))
+    if not requests:
+      continue
+    buckets = [int(values.get('bucket_%d' % i, 0))
+               for i in xrange(len(LATENCY_BUCKETS_MS) + 1)]
+    total_ms = int(values.get('total_ms', 0))
+    results.append({
+        'route': route,
+        'requests': requests,
+        'total_ms': total_ms,
+        'mean_ms': total_ms / requests,
+        'p50': Percentile(buckets, 0.50),
+        'p95': Percentile(buckets, 0.95),
+        'p99': Percentile(buckets, 0.99),
+        'rpc_count': float(values.get('rpc_count', 0)) / requests,
+        'rpc_ms': int(values.get('rpc_ms', 0)) / requests,
+    })
+  results.sort(key=lambda r: r['total_ms'], reverse=True)
+  return results
+
+
+class ProfileMiddleware(object):
+  """WSGI middleware which profiles each request."""
+
+  def __init__(self, app):
+    """Initializer.
+
+    Args:
+      app: WSGI app, if it is a webapp2.WSGIApplication requests are named
+        after the handler of their route.
+    """
+    self.app = app
+    InstallHooks()
+
+  def _RouteName(self, environ):
+    """Returns the route name for a request.
+
+    Args:
+      environ: dict, WSGI environment.
+    Returns:
+      str, e.g. 'munki.handlers.catalogs.Catalogs'.
+    """
+    router = getattr(self.app, 'router', None)
+    if router is None:
+      return UNMATCHED_ROUTE
+    try:
+      request = self.app.request_class(environ)
+      route = router.match(request)[0]
+    except Exception:  # pylint: disable=broad-except
+      return UNMATCHED_ROUTE
+    handler = route.handler
+    if isinstance(handler, basestring):
+      name = handler
+    else:
+      name = '%s.%s' % (handler.__module__, handler.__name__)
+    if name.startswith(HANDLER_MODULE_PREFIX):
+      name = name[len(HANDLER_MODULE_PREFIX):]
+    return name
+
+  def __call__(self, environ, start_response):
+    if not PROFILE_ENABLED:
+      return self.app(environ, start_response)
+
+    stats = RequestStats(
+        self._RouteName(environ), environ.get('REQUEST_METHOD'))
+    status = []
+
+    def _StartResponse(response_status, headers, exc_info=None):
+      status.append(response_status.split(' ', 1)[0])
+      return start_response(response_status, headers, exc_info)
+
+    profiler = None
+    if random.random() < CPROFILE_SAMPLE_RATE:
+      profiler = cProfile.Profile()
+    _local.stats = stats
+    try:
+      if profiler:
+        profiler.enable()
+      try:
+        return self.app(environ, _StartResponse)
+      finally:
+        if profiler:
+          profiler.disable()
+    finally:
+      _local.stats = None
+      stats.Finish(status[0] if status else None)
+      self._Record(stats, profiler)
+
+  def _Record(self, stats, profiler):
+    """Log and record the stats of a finished request.
+
+    Args:
+      stats: RequestStats instance.
+      profiler: cProfile.Profile instance, or None.
+    """
+    logging.info('request_profile %s', json.dumps(stats.ToDict()))
+    if profiler:
+      output = StringIO.StringIO()
+      p = pstats.Stats(profiler, stream=output)
+      p.sort_stats('cumulative').print_stats(CPROFILE_TOP_FUNCTIONS)
+      logging.info(
+          'request_cprofile %s %s\n%s', stats.method, stats.route,
+          output.getvalue())
+    _RecordRequest(stats)
+    FlushStats()
@@ -43,6 +43,8 @@ app = webapp2.WSGIApplication([
     ('/cron/maintenance/mark_computers_inactive',
      maintenance.MarkComputersInactive),
     ('/cron/maintenance/verify_packages', maintenance.VerifyPackages),
+    ('/cron/maintenance/package_upload_cleanup',
+     maintenance.PackageUploadCleanup),
     ('/cron/maintenance/update_avg_install_durations',
      maintenance.UpdateAverageInstallDurations),
 
@@ -41,6 +41,8 @@ from simian.mac import common
 from simian.mac import models
 from simian.mac.common import gae_util
 from simian.mac.munki import plist
+from simian.mac.munki.handlers import pkgs
+from simian.mac.munki.handlers import uploadpkg
 
 
 class AuthSessionCleanup(webapp2.RequestHandler):
@@ -60,8 +62,8 @@ class MarkComputersInactive(webapp2.RequestHandler):
   def get(self):
     """Handle GET."""
     #logging.debug('Marking inactive computers....')
-    count = models.Computer.MarkInactive()
-    #logging.debug('Complete! Marked %s inactive.' % count)
+    shards = models.Computer.MarkInactive()
+    logging.info('Started %d MarkInactive shard tasks.', shards)
 
 
 class UpdateAverageInstallDurations(webapp2.RequestHandler):
@@ -84,7 +86,8 @@ class UpdateAverageInstallDurations(webapp2.RequestHandler):
 
       # Obtain a lock on the PackageInfo entity for this package, or skip.
       lock = 'pkgsinfo_%s' % p.filename
-      if not gae_util.ObtainLock(lock, timeout=5.0):
+      lock_token = gae_util.ObtainLock(lock, timeout=5.0)
+      if not lock_token:
         continue  # Skip; it'll get updated next time around.
 
       # Append the avg duration text to the description; in the future the
@@ -99,7 +102,7 @@ class UpdateAverageInstallDurations(webapp2.RequestHandler):
       p.description = '%s\n\n%s' % (p.description, avg_duration_text)
       if p.plist['description'] != old_desc:
         p.put()  # Only bother putting the entity if the description changed.
-      gae_util.ReleaseLock(lock)
+      gae_util.ReleaseLock(lock, token=lock_token)
 
     # Asyncronously regenerate all Catalogs to include updated pkginfo plists.
     delay = 0
@@ -108,6 +111,16 @@ class UpdateAverageInstallDurations(webapp2.RequestHandler):
       models.Catalog.Generate(track, delay=delay)
 
 
+class PackageUploadCleanup(webapp2.RequestHandler):
+  """Class to delete idle chunked package uploads."""
+
+  def get(self):
+    """Handle GET."""
+    deleted = uploadpkg.DeleteIdleUploads()
+    if deleted:
+      logging.info('PackageUploadCleanup: %d idle uploads deleted.', deleted)
+
+
 class VerifyPackages(webapp2.RequestHandler):
   """Class to verify all packages have matching Blobstore blobs."""
 
@@ -116,7 +129,7 @@ class VerifyPackages(webapp2.RequestHandler):
     # Verify that all PackageInfo entities older than a week have a file in
     # Blobstore.
     for p in models.PackageInfo.all():
-      if p.blobstore_key and blobstore.BlobInfo.get(p.blobstore_key):
+      if p.blobstore_key and pkgs.GetBlobInfo(p.blobstore_key):
         continue
       elif p.mtime < (datetime.datetime.utcnow() - datetime.timedelta(days=7)):
         m = mail.EmailMessage()
@@ -154,3 +167,22 @@ class VerifyPackages(webapp2.RequestHandler):
           break
         time.sleep(1)
 
+
+    # Verify all packages stored in Cloud Storage have associated PackageInfo
+    # entities.  Newer ones may belong to chunked uploads still finishing.
+    for b in models.PackageBlobInfo.all():
+      if b.creation > (
+          datetime.datetime.utcnow() - datetime.timedelta(days=7)):
+        continue
+      key = b.key().name()
+      if models.PackageInfo.all().filter('blobstore_key =', key).get():
+        continue
+      m = mail.EmailMessage()
+      m.to = [settings.EMAIL_ADMIN_LIST]
+      m.sender = settings.EMAIL_SENDER
+      m.subject = 'Orphaned package in Cloud Storage: %s' % b.gcs_filename
+      m.body = (
+          'An orphaned package exists in Cloud Storage. Use the Cloud '
+          'Console\'s storage browser to locate and delete this object.\n\n'
+          'Object: %s\nBlobstore Key: %s' % (b.gcs_filename, key))
+      m.send()
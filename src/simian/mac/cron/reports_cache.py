@@ -106,8 +106,8 @@ class ReportsCache(webapp2.RequestHandler):
       lock_name = '%s_%s' % (lock_name, since)
       cursor_name = '%s_%s' % (cursor_name, since)
 
-    lock = gae_util.ObtainLock(lock_name)
-    if not lock:
+    lock_token = gae_util.ObtainLock(lock_name)
+    if not lock_token:
       logging.warning('GenerateMsuUserSummary lock found; exiting.')
       return
 
@@ -209,7 +209,7 @@ class ReportsCache(webapp2.RequestHandler):
       summary_tmp = models.ReportsCache.DeleteMsuUserSummary(
           since=since, tmp=True)
 
-    gae_util.ReleaseLock(lock_name)
+    gae_util.ReleaseLock(lock_name, token=lock_token)
 
   def _GeneratePendingCounts(self):
     """Generates a dictionary of all install names and their pending count."""
@@ -226,8 +226,8 @@ def _GenerateInstallCounts():
 
     # Obtain a lock.
     lock_name = 'pkgs_list_cron_lock'
-    lock = gae_util.ObtainLock(lock_name)
-    if not lock:
+    lock_token = gae_util.ObtainLock(lock_name)
+    if not lock_token:
       logging.warning('GenerateInstallCounts: lock found; exiting.')
       return
 
@@ -249,7 +249,7 @@ def _GenerateInstallCounts():
     if not installs:
       #logging.debug('No more installs to process.')
       models.ReportsCache.SetInstallCounts(pkgs)
-      gae_util.ReleaseLock(lock_name)
+      gae_util.ReleaseLock(lock_name, token=lock_token)
       return
 
     i = 0
@@ -296,7 +296,7 @@ def _GenerateInstallCounts():
     cursor_obj.put()
 
     # Delete the lock.
-    gae_util.ReleaseLock(lock_name)
+    gae_util.ReleaseLock(lock_name, token=lock_token)
 
     deferred.defer(_GenerateInstallCounts)
 
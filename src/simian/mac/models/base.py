@@ -22,9 +22,9 @@
 
 import datetime
 import difflib
-import gc
 import logging
 import re
+import time
 
 from google.appengine import runtime
 from google.appengine.api import memcache
@@ -53,6 +53,15 @@ class InvalidArgumentsError(Error):
 
 # The number of days a client is silent before being considered inactive.
 COMPUTER_ACTIVE_DAYS = 30
+# Number of parallel deferred tasks Computer.MarkInactive splits work into
+MARK_INACTIVE_SHARDS = 8
+# Hours before the inactivity cutoff split evenly between all but the last
+# MarkInactive shard; the last shard covers anything older.
+MARK_INACTIVE_SHARD_WINDOW_HOURS = 24
+# Seconds a MarkInactive shard task runs before deferring itself to continue
+MARK_INACTIVE_TASK_SECONDS = 8 * 60
+# Number of computers fetched and put per MarkInactive batch
+MARK_INACTIVE_BATCH_SIZE = 500
 # Default memcache seconds for memcache-backed datastore entities
 MEMCACHE_SECS = 300
 
@@ -447,29 +456,93 @@ class Computer(db.Model):
     return cls.all(keys_only=keys_only).filter('active =', True)
 
   @classmethod
-  def MarkInactive(cls):
-    """Marks any inactive computers as such."""
-    count = 0
+  def _GetMarkInactiveShardRanges(cls, earliest_active_date, shards):
+    """Split the preflight_datetime range of inactive computers into shards.
+
+    Args:
+      earliest_active_date: datetime.datetime, computers with older
+          preflight_datetime values are inactive.
+      shards: int, number of shards.
+    Returns:
+      list of (start, end) datetime.datetime tuples, newest first; start is
+      None for the last shard.
+    """
+    ranges = []
+    end = earliest_active_date
+    if shards > 1:
+      step = datetime.timedelta(
+          hours=MARK_INACTIVE_SHARD_WINDOW_HOURS) / (shards - 1)
+      for unused_i in xrange(shards - 1):
+        ranges.append((end - step, end))
+        end -= step
+    ranges.append((None, end))
+    return ranges
+
+  @classmethod
+  def MarkInactive(cls, shards=None):
+    """Marks any inactive computers as such.
+
+    Computers are split into shards by preflight_datetime, each processed
+    by MarkInactiveShard in a deferred task.
+
+    Args:
+      shards: int, optional, number of shards, default MARK_INACTIVE_SHARDS.
+    Returns:
+      int, number of shard tasks started.
+    """
+    if shards is None:
+      shards = MARK_INACTIVE_SHARDS
     now = datetime.datetime.utcnow()
     earliest_active_date = now - datetime.timedelta(days=COMPUTER_ACTIVE_DAYS)
-    query = cls.AllActive().filter('preflight_datetime <', earliest_active_date)
-    gc.collect()
-    while True:
-      computers = query.fetch(500)
-      if not computers:
-        break
-      for c in computers:
-        c.active = False  # this isn't neccessary, but makes more obvious.
-        c.put()
-        count += 1
-      cursor = str(query.cursor())
-      del(computers)
-      del(query)
-      gc.collect()
-      query = cls.AllActive().filter(
-          'preflight_datetime <', earliest_active_date)
-      query.with_cursor(cursor)
-    return count
+    ranges = cls._GetMarkInactiveShardRanges(earliest_active_date, shards)
+    for start, end in ranges:
+      deferred.defer(cls.MarkInactiveShard, start, end)
+    return len(ranges)
+
+  @classmethod
+  def MarkInactiveShard(cls, start, end, cursor=None, count=0):
+    """Marks active computers with preflight_datetime in a range inactive.
+
+    Computers are put in batches.  If the task runs longer than
+    MARK_INACTIVE_TASK_SECONDS or hits its deadline, it defers itself to
+    continue from a cursor checkpoint.
+
+    Args:
+      start: datetime.datetime, inclusive start of the preflight_datetime
+          range, or None for no start.
+      end: datetime.datetime, exclusive end of the preflight_datetime range.
+      cursor: str, optional, query cursor to continue from.
+      count: int, optional, number of computers marked inactive by earlier
+          tasks for this shard.
+    Returns:
+      int, number of computers marked inactive, or None if the shard was
+      deferred to continue.
+    """
+    task_deadline = time.time() + MARK_INACTIVE_TASK_SECONDS
+    query = cls.AllActive().filter('preflight_datetime <', end)
+    if start is not None:
+      query.filter('preflight_datetime >=', start)
+    computers_iter = gae_util.QueryIterator(
+        query, step=MARK_INACTIVE_BATCH_SIZE, cursor=cursor)
+    try:
+      for i, computers in enumerate(computers_iter.Pages()):
+        # process at least one page per task, so each task makes progress.
+        if i and time.time() > task_deadline:
+          break
+        for c in computers:
+          c.active = False
+        gae_util.BatchDatastoreOp(db.put, computers)
+        count += len(computers)
+      else:
+        logging.info(
+            'MarkInactiveShard(%s, %s): %d marked inactive.', start, end, count)
+        return count
+    except runtime.DeadlineExceededError:
+      pass
+
+    deferred.defer(
+        cls.MarkInactiveShard, start, end,
+        cursor=computers_iter.cursor, count=count)
 
   def put(self, update_active=True):
     """Forcefully set active according to preflight_datetime."""
@@ -1023,11 +1096,15 @@ class Tag(BaseModel):
       memcache.set(cls.ALL_TAGS_MEMCACHE_KEY, tags)
     return tags
 
+  @classmethod
+  def AllTagKeysForKeyQuery(cls, key):
+    """Returns a keys only query for all tags on a given db.Key."""
+    return cls.all(keys_only=True).filter('keys =', key)
+
   @classmethod
   def GetAllTagNamesForKey(cls, key):
     """Returns a list of all tag names for a given db.Key."""
-    return [k.name() for k in
-            cls.all(keys_only=True).filter('keys =', key)]
+    return [k.name() for k in cls.AllTagKeysForKeyQuery(key)]
 
   @classmethod
   def GetAllTagNamesForEntity(cls, entity):
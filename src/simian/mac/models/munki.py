@@ -25,9 +25,11 @@ import datetime
 import logging
 import os
 import re
+import time
 import urllib
 
 from google.appengine.api import mail as mail_tool
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import blobstore
@@ -37,12 +39,21 @@ from google.appengine.runtime import apiproxy_errors
 
 from simian.mac import common
 from simian.mac.common import gae_util
+from simian.mac.common import gcs
+from simian.mac.common import util
 from simian.mac.models import base
 from simian.mac.models import constants
 from simian.mac.models import settings
 from simian.mac.munki import plist as plist_lib
 
 
+# Memcache key of cached PackageInfo summaries, formatted with the model kind
+# and the current summaries generation.
+PACKAGE_SUMMARIES_MEMCACHE_KEY = 'pkginfo_summaries_%s_%s'
+# Memcache key of the summaries generation, bumped on every pkginfo change.
+PACKAGE_SUMMARIES_GENERATION_MEMCACHE_KEY = 'pkginfo_summaries_generation'
+
+
 class MunkiError(base.Error):
   """Class for domain specific exceptions."""
 
@@ -92,9 +103,45 @@ class Catalog(BaseMunkiModel):
   """
 
   package_names = db.StringListProperty()
+  # serialized dict of pkginfo name to munki name, built by Generate().
+  packagemap = db.TextProperty()
 
   PLIST_LIB_CLASS = plist_lib.MunkiPlist
 
+  @classmethod
+  def _BuildPackageMap(cls, package_infos):
+    """Returns a dict of pkginfo name to "display_name-version" munki name.
+
+    Args:
+      package_infos: iterable of PackageInfo entities.
+    Returns:
+      dict, like {'Firefox': 'Mozilla Firefox-3.6.10'}.
+    """
+    packagemap = {}
+    for p in package_infos:
+      display_name = p.plist.get('display_name', None) or p.plist.get('name')
+      version = p.plist.get('version', '')
+      packagemap[p.name] = '%s-%s' % (display_name.strip(), version)
+    return packagemap
+
+  @classmethod
+  def GetPackageMap(cls, name):
+    """Returns the packagemap of a catalog, wrapped by Memcache.
+
+    Catalogs generated before packagemaps were stored have theirs built from
+    the catalog's PackageInfo entities.
+
+    Args:
+      name: str, catalog name.
+    Returns:
+      dict of pkginfo name to munki name, empty if the catalog does not exist.
+    """
+    packagemap = cls.MemcacheWrappedGet(name, prop_name='packagemap')
+    if packagemap:
+      return util.Deserialize(packagemap)
+    return cls._BuildPackageMap(
+        PackageInfo.all().filter('catalogs =', name))
+
   @classmethod
   def Generate(cls, name, delay=0):
     """Generates a Catalog plist and entity from matching PackageInfo entities.
@@ -112,8 +159,10 @@ class Catalog(BaseMunkiModel):
       return
 
     lock = 'catalog_lock_%s' % name
-    # Obtain a lock on the catalog name.
-    if not gae_util.ObtainLock(lock):
+    # Obtain a lock on the catalog name; it is kept in Datastore, as losing it
+    # to memcache eviction lets two generations overwrite each other.
+    lock_token = gae_util.ObtainLock(lock, durable=True)
+    if not lock_token:
       # If catalog creation for this name is already in progress then delay.
       logging.debug('Catalog creation for %s is locked. Delaying....', name)
       cls.Generate(name, delay=10)
@@ -136,17 +185,19 @@ class Catalog(BaseMunkiModel):
 
       c = cls.get_or_insert(name)
       c.package_names = package_names
+      c.packagemap = util.Serialize(cls._BuildPackageMap(package_infos))
       c.name = name
       c.plist = catalog
       c.put()
       cls.DeleteMemcacheWrap(name, prop_name='plist_xml')
+      cls.DeleteMemcacheWrap(name, prop_name='packagemap')
       # Generate manifest for newly generated catalog.
       Manifest.Generate(name, delay=1)
     except (db.Error, plist_lib.Error):
       logging.exception('Catalog.Generate failure for catalog: %s', name)
       raise
     finally:
-      gae_util.ReleaseLock(lock)
+      gae_util.ReleaseLock(lock, token=lock_token, durable=True)
 
 
 class Manifest(BaseMunkiModel):
@@ -177,7 +228,8 @@ class Manifest(BaseMunkiModel):
       return
 
     lock = 'manifest_lock_%s' % name
-    if not gae_util.ObtainLock(lock):
+    lock_token = gae_util.ObtainLock(lock)
+    if not lock_token:
       logging.debug(
           'Manifest.Generate for %s is locked. Delaying....', name)
       cls.Generate(name, delay=5)
@@ -213,7 +265,7 @@ class Manifest(BaseMunkiModel):
       logging.exception('Manifest.Generate failure: %s', name)
       raise
     finally:
-      gae_util.ReleaseLock(lock)
+      gae_util.ReleaseLock(lock, token=lock_token)
 
 
 class PackageInfo(BaseMunkiModel):
@@ -229,6 +281,21 @@ class PackageInfo(BaseMunkiModel):
       '%d users have installed this with an average duration of %d seconds.')
   AVG_DURATION_REGEX = re.compile(
       '\d+ users have installed this with an average duration of \d+ seconds\.')
+  # plist keys denormalized into properties of the same name on put(), with
+  # the default used when the key is missing from the plist.
+  PLIST_FIELDS_AND_DEFAULTS = (
+      ('display_name', None),
+      ('version', None),
+      ('autoremove', False),
+      ('forced_install', False),
+      ('unattended_install', False),
+      ('uninstallable', True),
+      ('force_install_after_date', None),
+      ('installer_item_size', 0),
+  )
+  # bump when PLIST_FIELDS_AND_DEFAULTS changes; entities put with an older
+  # version are summarized from their plist until they are put again.
+  PLIST_FIELDS_VERSION = 1
 
   # catalog names this pkginfo belongs to; unstable, testing, stable.
   catalogs = db.StringListProperty()
@@ -253,6 +320,21 @@ class PackageInfo(BaseMunkiModel):
   # str group name(s) in common.MANIFEST_MOD_GROUPS that have access to inject
   # this package into manifests.
   manifest_mod_access = db.StringListProperty()
+  # the following are denormalized from the plist on put(), so that package
+  # listings do not need to parse every plist.
+  display_name = db.StringProperty()
+  version = db.StringProperty()
+  autoremove = db.BooleanProperty(default=False)
+  forced_install = db.BooleanProperty(default=False)
+  unattended_install = db.BooleanProperty(default=False)
+  uninstallable = db.BooleanProperty(default=True)
+  force_install_after_date = db.DateTimeProperty()
+  # installer item size in KB.
+  installer_item_size = db.IntegerProperty(default=0)
+  # admin portion of the plist description; see _GetDescription().
+  admin_description = db.TextProperty()
+  # PLIST_FIELDS_VERSION the properties above were denormalized with, or 0.
+  plist_fields_version = db.IntegerProperty(default=0)
 
   def _GetDescription(self):
     """Returns only admin portion of the desc, omitting avg duration text."""
@@ -283,10 +365,14 @@ class PackageInfo(BaseMunkiModel):
   description = property(_GetDescription, _SetDescription)
 
   def _GetBlobInfo(self):
-    """Returns the blobstore.BlobInfo object for the PackageInfo."""
+    """Returns the blobstore.BlobInfo object for the PackageInfo.
+
+    For a package stored in Cloud Storage, its PackageBlobInfo is returned.
+    """
     if not self.blobstore_key:
       return None
-    return blobstore.BlobInfo.get(self.blobstore_key)
+    return (blobstore.BlobInfo.get(self.blobstore_key) or
+            PackageBlobInfo.get_by_key_name(self.blobstore_key))
 
   def _SetBlobInfo(self, blob_info):
     """Sets the blobstore_key property from a given blobstore.BlobInfo object.
@@ -319,6 +405,143 @@ class PackageInfo(BaseMunkiModel):
   def manifest_matrix(self):
     return common.util.MakeTrackMatrix(self.manifests, self.proposal.manifests)
 
+  @classmethod
+  def _GetTrackCounterparts(cls):
+    """Returns dict of filename to the entity tracks are compared against."""
+    return dict((p.filename, p) for p in PackageInfoProposal.all())
+
+  def _MakeTrackMatrices(self, proposal):
+    """Returns catalog and manifest track matrices against a proposal.
+
+    Args:
+      proposal: PackageInfoProposal entity for this package, or None.
+    Returns:
+      tuple, (catalog_matrix, manifest_matrix) dicts.
+    """
+    proposal = proposal or self
+    return (
+        common.util.MakeTrackMatrix(self.catalogs, proposal.catalogs),
+        common.util.MakeTrackMatrix(self.manifests, proposal.manifests))
+
+  def _UpdatePlistFields(self):
+    """Denormalizes PLIST_FIELDS_AND_DEFAULTS from the plist to properties."""
+    self.plist_fields_version = 0
+    if not self.plist:
+      return
+    properties = self.properties()
+    try:
+      for key, default in self.PLIST_FIELDS_AND_DEFAULTS:
+        value = self.plist.get(key, default)
+        try:
+          if value is not None and properties[key].data_type is basestring:
+            value = unicode(value)
+          setattr(self, key, value)
+        except (db.BadValueError, UnicodeDecodeError):
+          logging.warning(
+              'Invalid pkginfo %s value in %s: %r', key, self.filename, value)
+          setattr(self, key, default)
+      self.admin_description = self.description
+    except plist_lib.PlistNotParsedError:
+      return
+    self.plist_fields_version = self.PLIST_FIELDS_VERSION
+
+  def _GetSummary(self, counterpart):
+    """Returns a dict summarizing this package for listings.
+
+    Properties denormalized on put() are used when current, otherwise the
+    plist is parsed.
+
+    Args:
+      counterpart: entity from _GetTrackCounterparts() for this package, or
+          None.
+    Returns:
+      dict of package properties, plist fields, description and track
+      matrices, with broken_plist True if the plist could not be parsed.
+    """
+    summary = {
+        'filename': self.filename,
+        'name': self.name,
+        'munki_name': self.munki_name,
+        'catalogs': self.catalogs,
+        'manifests': self.manifests,
+        'install_types': self.install_types,
+        'manifest_mod_access': self.manifest_mod_access,
+        'created': self.created,
+        'mtime': self.mtime,
+        'broken_plist': False,
+    }
+    if self.plist_fields_version == self.PLIST_FIELDS_VERSION:
+      for key, _ in self.PLIST_FIELDS_AND_DEFAULTS:
+        summary[key] = getattr(self, key)
+      summary['description'] = self.admin_description
+    elif self.plist:
+      for key, default in self.PLIST_FIELDS_AND_DEFAULTS:
+        summary[key] = self.plist.get(key, default)
+      summary['description'] = self.description
+      summary['munki_name'] = self.munki_name or self.plist.GetMunkiName()
+    else:
+      summary['broken_plist'] = True
+      return summary
+    summary['catalog_matrix'], summary['manifest_matrix'] = (
+        self._MakeTrackMatrices(counterpart))
+    return summary
+
+  @classmethod
+  def _NewGeneration(cls):
+    """Returns an int generation to seed the summaries generation with."""
+    return int(time.time() * 1000000)
+
+  @classmethod
+  def _GetSummariesGeneration(cls):
+    """Returns the current generation of cached summaries.
+
+    The generation is seeded from the clock in microseconds so that, if it is
+    evicted, a new one never matches summaries cached under an older one.
+
+    Returns:
+      int generation.
+    """
+    generation = memcache.get(PACKAGE_SUMMARIES_GENERATION_MEMCACHE_KEY)
+    if generation is None:
+      memcache.add(
+          PACKAGE_SUMMARIES_GENERATION_MEMCACHE_KEY, cls._NewGeneration())
+      generation = memcache.get(PACKAGE_SUMMARIES_GENERATION_MEMCACHE_KEY)
+    return generation
+
+  @classmethod
+  def GetSummaries(cls):
+    """Returns summaries of all entities of this kind, cached in memcache.
+
+    Summaries are cached under the current generation, read before the
+    datastore is queried, so a reader racing a put or delete caches its
+    possibly stale result under a generation no later reader uses.
+
+    Returns:
+      list of dicts, see _GetSummary().
+    """
+    generation = cls._GetSummariesGeneration()
+    summaries = None
+    if generation is not None:
+      memcache_key = PACKAGE_SUMMARIES_MEMCACHE_KEY % (cls.kind(), generation)
+      summaries = memcache.get(memcache_key)
+    if summaries is None:
+      counterparts = cls._GetTrackCounterparts()
+      summaries = [
+          p._GetSummary(counterparts.get(p.filename)) for p in cls.all()]
+      if generation is not None:
+        try:
+          memcache.set(memcache_key, summaries, base.MEMCACHE_SECS)
+        except ValueError, e:
+          logging.warning('GetSummaries: failure to memcache.set: %s', str(e))
+    return summaries
+
+  @classmethod
+  def InvalidateSummariesCache(cls):
+    """Invalidates cached summaries of both packages and proposals."""
+    memcache.incr(
+        PACKAGE_SUMMARIES_GENERATION_MEMCACHE_KEY,
+        initial_value=cls._NewGeneration())
+
   def IsSafeToModify(self):
     """Returns True if the pkginfo is modifiable, False otherwise."""
     if self.approval_required:
@@ -338,7 +561,7 @@ class PackageInfo(BaseMunkiModel):
       self.Update(catalogs=[], manifests=[])
 
   def put(self, *args, **kwargs):
-    """Put to Datastore, generating and setting the "munki_name" property.
+    """Put to Datastore, generating the "munki_name" and plist properties.
 
     Args:
       *args: list, optional, args to superclass put()
@@ -360,7 +583,10 @@ class PackageInfo(BaseMunkiModel):
       self.munki_name = self.plist.GetMunkiName()
     except plist_lib.PlistNotParsedError:
       self.munki_name = None
-    return super(PackageInfo, self).put(*args, **kwargs)
+    self._UpdatePlistFields()
+    ret = super(PackageInfo, self).put(*args, **kwargs)
+    self.InvalidateSummariesCache()
+    return ret
 
   def delete(self, *args, **kwargs):
     """Deletes a PackageInfo and cleans up associated data in other models.
@@ -375,10 +601,11 @@ class PackageInfo(BaseMunkiModel):
       return value from superlass delete()
     """
     ret = super(PackageInfo, self).delete(*args, **kwargs)
+    self.InvalidateSummariesCache()
     for catalog in self.catalogs:
       Catalog.Generate(catalog)
     if self.blobstore_key:
-      gae_util.SafeBlobDel(self.blobstore_key)
+      PackageBlobInfo.SafeDelete(self.blobstore_key)
     return ret
 
   def VerifyPackageIsEligibleForNewCatalogs(self, new_catalogs):
@@ -471,12 +698,13 @@ class PackageInfo(BaseMunkiModel):
     filename = plist['installer_item_location']
 
     lock = 'pkgsinfo_%s' % filename
-    if not gae_util.ObtainLock(lock, timeout=5.0):
+    lock_token = gae_util.ObtainLock(lock, timeout=5.0)
+    if not lock_token:
       raise PackageInfoLockError('This PackageInfo is locked.')
 
     if create_new:
       if cls.get_by_key_name(filename):
-        gae_util.ReleaseLock(lock)
+        gae_util.ReleaseLock(lock, token=lock_token)
         raise PackageInfoUpdateError(
             'An existing pkginfo exists for: %s' % filename)
       pkginfo = cls._New(filename)
@@ -487,12 +715,12 @@ class PackageInfo(BaseMunkiModel):
     else:
       pkginfo = cls.get_by_key_name(filename)
       if not pkginfo:
-        gae_util.ReleaseLock(lock)
+        gae_util.ReleaseLock(lock, token=lock_token)
         raise PackageInfoNotFoundError('pkginfo not found: %s' % filename)
       original_plist = pkginfo.plist.GetXml()
 
     if not pkginfo.IsSafeToModify():
-      gae_util.ReleaseLock(lock)
+      gae_util.ReleaseLock(lock, token=lock_token)
       raise PackageInfoUpdateError(
           'PackageInfo is not safe to modify; move to unstable first.')
 
@@ -505,10 +733,10 @@ class PackageInfo(BaseMunkiModel):
       cls._PutAndLogPackageInfoUpdate(
           pkginfo, original_plist, original_catalogs)
     except PackageInfoUpdateError:
-      gae_util.ReleaseLock(lock)
+      gae_util.ReleaseLock(lock, token=lock_token)
       raise
 
-    gae_util.ReleaseLock(lock)
+    gae_util.ReleaseLock(lock, token=lock_token)
 
     return pkginfo
 
@@ -554,7 +782,8 @@ class PackageInfo(BaseMunkiModel):
     original_plist = self.plist.GetXml()
 
     lock = 'pkgsinfo_%s' % self.filename
-    if not gae_util.ObtainLock(lock, timeout=5.0):
+    lock_token = gae_util.ObtainLock(lock, timeout=5.0)
+    if not lock_token:
       raise PackageInfoLockError
 
     if self.IsSafeToModify():
@@ -611,7 +840,7 @@ class PackageInfo(BaseMunkiModel):
           else:
             failure_message = ('PackageInfo is not safe to modify;'
                                ' please move to unstable first.')
-          gae_util.ReleaseLock(lock)
+          gae_util.ReleaseLock(lock, token=lock_token)
           raise PackageInfoUpdateError(failure_message)
 
     original_catalogs = self.catalogs
@@ -629,10 +858,10 @@ class PackageInfo(BaseMunkiModel):
     try:
       self._PutAndLogPackageInfoUpdate(self, original_plist, original_catalogs)
     except PackageInfoUpdateError:
-      gae_util.ReleaseLock(lock)
+      gae_util.ReleaseLock(lock, token=lock_token)
       raise
 
-    gae_util.ReleaseLock(lock)
+    gae_util.ReleaseLock(lock, token=lock_token)
 
   @classmethod
   def GetManifestModPkgNames(
@@ -699,6 +928,25 @@ class PackageInfoProposal(PackageInfo):
   def manifest_matrix(self):
     return common.util.MakeTrackMatrix(self.pkginfo.manifests, self.manifests)
 
+  @classmethod
+  def _GetTrackCounterparts(cls):
+    """Returns dict of filename to the PackageInfo of each proposal."""
+    return dict((p.filename, p) for p in PackageInfo.all())
+
+  def _MakeTrackMatrices(self, pkginfo):
+    """Returns catalog and manifest track matrices against the pkginfo.
+
+    Args:
+      pkginfo: PackageInfo entity this proposal is for, or None.
+    Returns:
+      tuple, (catalog_matrix, manifest_matrix) dicts.
+    """
+    catalogs = pkginfo.catalogs if pkginfo else []
+    manifests = pkginfo.manifests if pkginfo else []
+    return (
+        common.util.MakeTrackMatrix(catalogs, self.catalogs),
+        common.util.MakeTrackMatrix(manifests, self.manifests))
+
   @classmethod
   def FindOrCreatePackageInfoProposal(cls, pkginfo):
     proposal = PackageInfoProposal.get_by_key_name(pkginfo.filename)
@@ -783,7 +1031,8 @@ class PackageInfoProposal(PackageInfo):
       PackageInfoUpdateError: Package is not eligible for catalogs.
     """
     lock = 'pkgsinfo_%s' % self.filename
-    if not gae_util.ObtainLock(lock, timeout=5.0):
+    lock_token = gae_util.ObtainLock(lock, timeout=5.0)
+    if not lock_token:
       raise PackageInfoLockError
 
     new_catalogs = [c for c in self.catalogs if c not in self.pkginfo.catalogs]
@@ -792,7 +1041,7 @@ class PackageInfoProposal(PackageInfo):
       self.pkginfo.VerifyPackageIsEligibleForNewCatalogs(
           new_catalogs)
     except PackageInfoUpdateError:
-      gae_util.ReleaseLock(lock)
+      gae_util.ReleaseLock(lock, token=lock_token)
       raise
 
     approver = users.get_current_user().email()
@@ -813,7 +1062,7 @@ class PackageInfoProposal(PackageInfo):
 
     self.pkginfo.PutAndLogFromProposal(original_plist, original_catalogs)
 
-    gae_util.ReleaseLock(lock)
+    gae_util.ReleaseLock(lock, token=lock_token)
 
     self.ProposalMailer('approval')
 
@@ -876,3 +1125,92 @@ class PackageInfoProposal(PackageInfo):
     filename = urllib.quote(filename)
     body += '\nhttps://%s/admin/package/%s' % (hostname, filename)
     return body
+
+
+class PackageUpload(base.BaseModel):
+  """A chunked, resumable package upload, keyed by a random upload id.
+
+  Chunks are sent in order, at their offsets, to a resumable upload of a
+  Cloud Storage object, which is complete once all of them are received.
+  """
+
+  user = db.StringProperty()
+  filename = db.StringProperty()
+  pkginfo = db.TextProperty()
+  catalogs = db.StringListProperty()
+  manifests = db.StringListProperty()
+  install_types = db.StringListProperty()
+  size = db.IntegerProperty()
+  chunk_size = db.IntegerProperty()
+  # sha256 of each chunk received, in order.
+  chunk_sha256s = db.StringListProperty(indexed=False)
+  # Cloud Storage object name and resumable upload id, see common.gcs.
+  gcs_filename = db.StringProperty(indexed=False)
+  gcs_upload_id = db.StringProperty(indexed=False)
+  mtime = db.DateTimeProperty(auto_now=True)
+
+  def NumChunks(self):
+    """Returns the number of chunks the package is uploaded in."""
+    return max(1, (self.size + self.chunk_size - 1) // self.chunk_size)
+
+  def ChunkLength(self, index):
+    """Returns the length of chunk index, or None if there is no such chunk.
+
+    Args:
+      index: int, chunk index.
+    """
+    if index < 0 or index >= self.NumChunks():
+      return None
+    return min(self.chunk_size, self.size - index * self.chunk_size)
+
+  def ChunkOffset(self, index):
+    """Returns the offset of chunk index in the package.
+
+    Args:
+      index: int, chunk index.
+    """
+    return index * self.chunk_size
+
+  def IsComplete(self):
+    """Returns True if all chunks have been received."""
+    return len(self.chunk_sha256s) == self.NumChunks()
+
+  def GetStatus(self):
+    """Returns a dict status of the upload for the uploading client."""
+    return {
+        'id': self.key().name(),
+        'chunk_size': self.chunk_size,
+        'num_chunks': self.NumChunks(),
+        'next_chunk': len(self.chunk_sha256s),
+    }
+
+
+class PackageBlobInfo(base.BaseModel):
+  """The BlobInfo of a package stored in Cloud Storage, keyed by blob key.
+
+  Blobstore only has a BlobInfo of the blobs it stores; packages uploaded in
+  chunks are Cloud Storage objects, served with a blob key from
+  blobstore.create_gs_key().
+  """
+
+  gcs_filename = db.StringProperty(indexed=False)
+  size = db.IntegerProperty(indexed=False)
+  creation = db.DateTimeProperty(indexed=False)
+
+  @classmethod
+  def SafeDelete(cls, blobstore_key):
+    """Deletes a package blob and its PackageBlobInfo, if any.
+
+    Args:
+      blobstore_key: str, blob key of the package.
+    """
+    blob_info = cls.get_by_key_name(blobstore_key)
+    if blob_info:
+      gcs.SafeDelete(blob_info.gcs_filename)
+      try:
+        blob_info.delete()
+      except db.Error, e:
+        logging.warning(
+            'PackageBlobInfo.delete(%s) failed: %s', blobstore_key, e)
+    else:
+      gae_util.SafeBlobDel(blobstore_key)
@@ -104,6 +104,13 @@ SETTINGS = {
         'comment': 'Restricts Apple SUS promotion to business hours only.',
         'default': 20,
     },
+    'checkin_budget_per_minute': {
+        'type': 'integer',
+        'title': 'Client Checkin Budget Per Minute',
+        'comment': ('Clients checking in beyond this rate are asked to defer '
+                    'their checkin; 0 disables checkin spreading.'),
+        'default': 0,
+    },
     'uuid_lookup_url': {
         'type': 'string',
         'title': 'UUID lookup tool URL',
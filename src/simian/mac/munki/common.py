@@ -192,8 +192,10 @@ def LogClientConnection(
 
       # Increment the number of preflight connections since the last successful
       # postflight, but only if the current connection is not going to exit due
-      # to report feedback (WWAN, GoGo InFlight, etc.)
-      if not _report_feedback or not _report_feedback.get('exit'):
+      # to report feedback (WWAN, GoGo InFlight, etc.) or defer its checkin.
+      if not _report_feedback or not (
+          _report_feedback.get('exit') or
+          _report_feedback.get('defer_seconds')):
         if c.preflight_count_since_postflight is not None:
           c.preflight_count_since_postflight += 1
         else:
@@ -599,7 +601,8 @@ def GetComputerManifest(uuid=None, client_id=None, packagemap=False):
     return manifest_plist_xml
 
   # Step 2: Build lookup table from PackageName to PackageName-VersionNumber
-  # for packages found in catalogs used by the client.
+  # for packages found in catalogs used by the client.  Catalogs listed
+  # first take precedence, as they do for Munki.
 
   manifest_plist = plist_module.MunkiManifestPlist(manifest_plist_xml)
   manifest_plist.Parse()
@@ -607,12 +610,8 @@ def GetComputerManifest(uuid=None, client_id=None, packagemap=False):
   catalogs = manifest_plist['catalogs']
   packages = {}
 
-  query = models.PackageInfo.all()
-  for p in query:
-    display_name = p.plist.get('display_name', None) or p.plist.get('name')
-    display_name = display_name.strip()
-    version = p.plist.get('version', '')
-    packages[p.name] = '%s-%s' % (display_name, version)
+  for catalog in reversed(catalogs):
+    packages.update(models.Catalog.GetPackageMap(catalog))
 
   return {
       'plist': manifest_plist,
@@ -20,6 +20,8 @@ from simian.mac.munki import common
 
 
 HEADER_DATE_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
+# Seconds clients are asked to wait before retrying a 503 response.
+RETRY_AFTER_SECONDS = 60
 
 
 class Error(Exception):
@@ -164,3 +166,15 @@ class AuthenticationHandler(webapp2.RequestHandler):
       return
 
     super(AuthenticationHandler, self).handle_exception(exception, debug_mode)
+
+  def ServiceUnavailable(self, retry_after=RETRY_AFTER_SECONDS):
+    """Sends a 503 response asking the client to retry later.
+
+    Clients back off for the Retry-After seconds, plus a random jitter, so
+    they do not all retry at once when the server is overloaded.
+
+    Args:
+      retry_after: int, seconds the client should wait before retrying.
+    """
+    self.error(503)
+    self.response.headers['Retry-After'] = str(retry_after)
@@ -104,6 +104,7 @@ class Auth(handlers.AuthenticationHandler):
         self.response.headers['Set-Cookie'] = '%s=%s; secure; httponly;' % (
             auth.AUTH_TOKEN_COOKIE, output)
         self.response.out.write(auth.AUTH_TOKEN_COOKIE)
+        auth1.FlushSession()
       else:
         logging.critical('Auth is OK but there is no output.')
         raise base.NotAuthenticated('AuthOkOutputEmpty')
@@ -25,7 +25,6 @@ import logging
 
 from simian.auth import gaeserver
 from simian.mac import models
-from simian.mac.common import gae_util
 from simian.mac.munki import handlers
 
 
@@ -53,9 +52,9 @@ class DeletePackage(handlers.AuthenticationHandler):
 
     #logging.info('Deleting package: %s', filename)
     blobstore_key = pkginfo.blobstore_key
-    # Delete the PackageInfo entity, and then the package Blobstore entity.
+    # Delete the PackageInfo entity, and then the package blob.
     pkginfo.delete()
-    gae_util.SafeBlobDel(blobstore_key)
+    models.PackageBlobInfo.SafeDelete(blobstore_key)
     # Recreate catalogs so references to this package don't exist anywhere.
     for catalog in catalogs:
       models.Catalog.Generate(catalog)
@@ -58,12 +58,12 @@ class Manifests(handlers.AuthenticationHandler):
       return
     except common.ManifestDisabledError, e:
       logging.info('Disabled manifest requested: %s', str(e))
-      self.response.set_status(503)
+      self.ServiceUnavailable()
       return
     except common.Error, e:
       logging.exception(
           '%s, client_id_str=%s', str(e.__class__.__name__), client_id_str)
-      self.response.set_status(503)
+      self.ServiceUnavailable()
       return
 
     self.response.headers['Content-Type'] = 'text/xml; charset=utf-8'
@@ -45,6 +45,19 @@ def PackageExists(filename):
   return models.PackageInfo.get_by_key_name(filename) is not None
 
 
+def GetBlobInfo(blobstore_key):
+  """Returns the BlobInfo of a package blob, or None if it does not exist.
+
+  Args:
+    blobstore_key: str, blob key of the package.
+  Returns:
+    blobstore.BlobInfo, or models.PackageBlobInfo of a package stored in
+    Cloud Storage, or None.
+  """
+  return (blobstore.BlobInfo.get(blobstore_key) or
+          models.PackageBlobInfo.get_by_key_name(blobstore_key))
+
+
 class Packages(
     handlers.AuthenticationHandler,
     blobstore_handlers.BlobstoreDownloadHandler):
@@ -73,14 +86,14 @@ class Packages(
       return
 
     if common.IsPanicModeNoPackages():
-      self.error(503)
+      self.ServiceUnavailable()
       return
 
     # Get the Blobstore BlobInfo for this package; memcache wrapped.
     memcache_key = 'blobinfo_%s' % filename
     blob_info = memcache.get(memcache_key)
     if not blob_info:
-      blob_info = blobstore.BlobInfo.get(pkg.blobstore_key)
+      blob_info = GetBlobInfo(pkg.blobstore_key)
       if blob_info:
         memcache.set(memcache_key, blob_info, 300)  # cache for 5 minutes.
       else:
@@ -93,6 +106,8 @@ class Packages(
     header_date_str = self.request.headers.get('If-Modified-Since', '')
     etag_nomatch_str = self.request.headers.get('If-None-Match', 0)
     etag_match_str = self.request.headers.get('If-Match', 0)
+    range_str = self.request.headers.get('Range', '')
+    etag_range_str = self.request.headers.get('If-Range', '').strip('"')
     pkg_date = blob_info.creation
     pkg_size_bytes = blob_info.size
 
@@ -129,7 +144,12 @@ class Packages(
       self.response.headers['Last-Modified'] = pkg_date.strftime(
           handlers.HEADER_DATE_FORMAT)
       self.response.headers['X-Download-Size'] = str(pkg_size_bytes)
-      self.send_blob(pkg.blobstore_key)
+      self.response.headers['Accept-Ranges'] = 'bytes'
+      # Resume a partial download only if the client's partial file is of
+      # this package version; otherwise send the whole blob.
+      use_range = bool(range_str) and (
+          not etag_range_str or etag_range_str == pkg.pkgdata_sha256)
+      self.send_blob(pkg.blobstore_key, use_range=use_range)
     else:
       # Client doesn't need to do anything, current version is OK based on
       # ETag and/or last modified date.
@@ -72,7 +72,8 @@ class PackagesInfo(handlers.AuthenticationHandler):
 
       if hash_str:
         lock = 'pkgsinfo_%s' % filename
-        if not gae_util.ObtainLock(lock, timeout=5.0):
+        lock_token = gae_util.ObtainLock(lock, timeout=5.0)
+        if not lock_token:
           self.response.set_status(403)
           self.response.out.write('Could not lock pkgsinfo')
           return
@@ -85,12 +86,12 @@ class PackagesInfo(handlers.AuthenticationHandler):
         self.response.out.write(pkginfo.plist)
       else:
         if hash_str:
-          gae_util.ReleaseLock(lock)
+          gae_util.ReleaseLock(lock, token=lock_token)
         self.response.set_status(404)
         return
 
       if hash_str:
-        gae_util.ReleaseLock(lock)
+        gae_util.ReleaseLock(lock, token=lock_token)
     else:
       query = models.PackageInfo.all()
 
@@ -106,11 +107,15 @@ class PackagesInfo(handlers.AuthenticationHandler):
       for catalog in catalogs:
         query.filter('catalogs =', catalog)
 
+      # plist fields denormalized by PackageInfo.put() are left out, the
+      # pkginfo plist itself remains the source of truth for clients.
+      omit = set(k for k, _ in models.PackageInfo.PLIST_FIELDS_AND_DEFAULTS)
+      omit.update(['_plist', 'admin_description', 'plist_fields_version'])
       pkgs = []
       for p in query:
         pkg = {}
         for k in p.properties():
-          if k != '_plist':
+          if k not in omit:
             pkg[k] = getattr(p, k)
         pkgs.append(pkg)
       self.response.out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
@@ -163,7 +168,8 @@ class PackagesInfo(handlers.AuthenticationHandler):
       return
 
     lock = 'pkgsinfo_%s' % filename
-    if not gae_util.ObtainLock(lock, timeout=5.0):
+    lock_token = gae_util.ObtainLock(lock, timeout=5.0)
+    if not lock_token:
       self.response.set_status(403)
       self.response.out.write('Could not lock pkgsinfo')
       return
@@ -176,7 +182,7 @@ class PackagesInfo(handlers.AuthenticationHandler):
           'pkginfo "%s" does not exist; PUT only allows updates.', filename)
       self.response.set_status(403)
       self.response.out.write('Only updates supported')
-      gae_util.ReleaseLock(lock)
+      gae_util.ReleaseLock(lock, token=lock_token)
       return
 
     # If the pkginfo is not modifiable, ensure only manifests have changed.
@@ -187,7 +193,7 @@ class PackagesInfo(handlers.AuthenticationHandler):
             filename)
         self.response.set_status(403)
         self.response.out.write('Changes to pkginfo not allowed')
-        gae_util.ReleaseLock(lock)
+        gae_util.ReleaseLock(lock, token=lock_token)
         return
 
     # If the update parameter asked for a careful update, by supplying
@@ -197,7 +203,7 @@ class PackagesInfo(handlers.AuthenticationHandler):
       if self._Hash(pkginfo.plist) != hash_str:
         self.response.set_status(409)
         self.response.out.write('Update hash does not match')
-        gae_util.ReleaseLock(lock)
+        gae_util.ReleaseLock(lock, token=lock_token)
         return
 
     # All verification has passed, so let's create the PackageInfo entity.
@@ -211,7 +217,7 @@ class PackagesInfo(handlers.AuthenticationHandler):
       pkginfo.install_types = install_types
     pkginfo.put()
 
-    gae_util.ReleaseLock(lock)
+    gae_util.ReleaseLock(lock, token=lock_token)
 
     for track in pkginfo.catalogs:
       models.Catalog.Generate(track, delay=1)
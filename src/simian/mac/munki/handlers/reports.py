@@ -25,8 +25,11 @@ import json
 import logging
 import os
 import re
+import time
 import urllib
 
+from google.appengine.api import memcache
+
 from simian.auth import gaeserver
 from simian.mac import common as main_common
 from simian.mac import models
@@ -57,6 +60,24 @@ LEGACY_INSTALL_RESULTS_STRING_REGEX = re.compile(
 DOWNLOAD_FAILED_STRING_REGEX = re.compile(
     r'([\s\w\.\-]+): Download failed \((.*)\)')
 
+# int seconds of the windows preflight checkins are counted in.
+CHECKIN_WINDOW_SECONDS = 60
+
+# memcache namespace of the per window preflight checkin counters.
+CHECKIN_COUNTER_NAMESPACE = 'preflight_checkins'
+
+# int maximum seconds a client is asked to defer its checkin by.
+MAX_CHECKIN_DEFER_SECONDS = 4 * 3600
+
+# int seconds after which checkin counters and reservations expire.
+CHECKIN_COUNTER_EXPIRY_SECONDS = MAX_CHECKIN_DEFER_SECONDS + 3600
+
+# memcache namespace of the windows reserved for deferred clients, by uuid.
+CHECKIN_RESERVATION_NAMESPACE = 'preflight_checkin_reservations'
+
+# int maximum full windows probed when reserving a window for a client.
+CHECKIN_MAX_RESERVE_ATTEMPTS = 4
+
 # For legacy clients that do not support multiple feedback commands via JSON,
 # this list is used to determine which single command to send, if any, in
 # increasing importance order.
@@ -76,6 +97,73 @@ def IsExitFeedbackIpAddress(ip_address):
       models.KeyValueCache.IpInList('client_exit_ip_blocks', ip_address))
 
 
+def _CountCheckin(window):
+  """Counts a preflight checkin in a window and returns the new count.
+
+  Args:
+    window: int, number of the CHECKIN_WINDOW_SECONDS window.
+  Returns:
+    int count of checkins in the window, or None if memcache failed.
+  """
+  key = str(window)
+  memcache.add(
+      key, 0, time=CHECKIN_COUNTER_EXPIRY_SECONDS,
+      namespace=CHECKIN_COUNTER_NAMESPACE)
+  return memcache.incr(key, namespace=CHECKIN_COUNTER_NAMESPACE)
+
+
+def GetCheckinDeferSeconds(uuid, can_defer=True, now=None):
+  """Counts a preflight checkin and returns seconds to defer it by.
+
+  Checkins are counted in memcache per CHECKIN_WINDOW_SECONDS window.  Once
+  a window exceeds the checkin_budget_per_minute setting, a deferred client
+  is sent to the start of a later window, which is reserved by counting the
+  client in that window right away.  The client is remembered by uuid, so
+  its returning checkin is not counted a second time.
+
+  Args:
+    uuid: str, computer uuid.
+    can_defer: bool, optional, False if the client cannot act on a defer;
+        its checkin is then only counted.
+    now: float, optional, current time; defaults to time.time()
+  Returns:
+    int seconds, 0 if the client should check in now.
+  """
+  budget, _ = models.Settings.GetItem('checkin_budget_per_minute')
+  if not budget:
+    return 0
+  if now is None:
+    now = time.time()
+
+  if memcache.get(uuid, namespace=CHECKIN_RESERVATION_NAMESPACE):
+    # the client returns from a defer; its checkin was counted then.
+    memcache.delete(uuid, namespace=CHECKIN_RESERVATION_NAMESPACE)
+    return 0
+
+  window = int(now // CHECKIN_WINDOW_SECONDS)
+  count = _CountCheckin(window)
+  budget_per_window = max(1, budget * CHECKIN_WINDOW_SECONDS // 60)
+  if count is None or count <= budget_per_window or not can_defer:
+    # do not defer when memcache is unavailable, rather than guess.
+    return 0
+
+  # the last window whose checkins, with jitter, end within the maximum.
+  last_window = int(
+      (now + MAX_CHECKIN_DEFER_SECONDS) // CHECKIN_WINDOW_SECONDS) - 1
+  target = window
+  for _ in xrange(CHECKIN_MAX_RESERVE_ATTEMPTS):
+    # skip the windows the checkins counted before this one were sent to.
+    target = min(last_window, target + (count - 1) // budget_per_window)
+    count = _CountCheckin(target)
+    if count is None or count <= budget_per_window or target == last_window:
+      break
+
+  memcache.set(
+      uuid, target, time=CHECKIN_COUNTER_EXPIRY_SECONDS,
+      namespace=CHECKIN_RESERVATION_NAMESPACE)
+  return int(target * CHECKIN_WINDOW_SECONDS - now) + 1
+
+
 class Reports(handlers.AuthenticationHandler):
   """Handler for /reports/."""
 
@@ -90,6 +178,7 @@ class Reports(handlers.AuthenticationHandler):
           message: str, optional, message from client
           details: str, optional, details from client
           ip_address: str, optional, IP address of client
+          can_defer: bool, optional, True if the client acts on a defer
     Returns:
       common.ReportFeedback.* constant
     """
@@ -136,6 +225,13 @@ class Reports(handlers.AuthenticationHandler):
           feedback['logging_level'] = 3
           feedback['upload_logs'] = True
 
+    if report_type == 'preflight' and not client_exit:
+      # only clients without other commands to act upon are deferred.
+      defer_seconds = GetCheckinDeferSeconds(
+          uuid, can_defer=kwargs.get('can_defer', False) and not feedback)
+      if defer_seconds:
+        feedback['defer_seconds'] = defer_seconds
+        feedback['defer_jitter_seconds'] = CHECKIN_WINDOW_SECONDS
 
     return feedback
 
@@ -143,7 +239,8 @@ class Reports(handlers.AuthenticationHandler):
     """Logs a batch of installs for a given computer.
 
     Args:
-      installs: list, of str install data from a preflight/postflight report.
+      installs: list, of str install data from a preflight/postflight report,
+          or of dict install data from an install_report_batch report.
       computer: models.Computer entity.
     """
     if not installs:
@@ -159,7 +256,12 @@ class Reports(handlers.AuthenticationHandler):
 
     to_put = []
     for install in installs:
-      if install.startswith('Install of'):
+      if isinstance(install, dict):
+        # values are converted to str like those of 'name=pkg|...' strings.
+        d = dict(
+            (k, None if v is None else unicode(v))
+            for k, v in install.iteritems())
+      elif install.startswith('Install of'):
         d = {
             'applesus': 'false',
             'duration_seconds': None,
@@ -226,6 +328,55 @@ class Reports(handlers.AuthenticationHandler):
 
     gae_util.BatchDatastoreOp(models.db.put, to_put)
 
+  def _LogRemovalsAndProblems(self, uuid, removals, problem_installs, computer):
+    """Logs a batch of removals and problem installs for a given computer.
+
+    Args:
+      uuid: str, computer uuid.
+      removals: list, of str removals.
+      problem_installs: list, of str problem installs.
+      computer: models.Computer entity.
+    """
+    if not removals and not problem_installs:
+      return
+
+    to_put = []
+    for removal in removals:
+      to_put.append(models.ClientLog(
+          uuid=uuid, computer=computer, action='removal', details=removal))
+    for problem in problem_installs:
+      to_put.append(models.ClientLog(
+          uuid=uuid, computer=computer, action='install_problem',
+          details=problem))
+
+    gae_util.BatchDatastoreOp(models.db.put, to_put)
+
+  def _ParseInstallReport(self, report):
+    """Parses an install report of an install_report_batch report.
+
+    Args:
+      report: dict, JSON decoded install report.
+    Returns:
+      tuple of installs list of dicts, removals and problem_installs lists of
+      str.
+    Raises:
+      ValueError: the report is malformed.
+    """
+    if not isinstance(report, dict):
+      raise ValueError('report is not a dict: %r' % (report,))
+    installs = report.get('installs', [])
+    removals = report.get('removals', [])
+    problem_installs = report.get('problem_installs', [])
+    if (not isinstance(installs, list) or
+        not all(isinstance(i, dict) for i in installs)):
+      raise ValueError('installs is not a list of dicts: %r' % (installs,))
+    for name, items in [
+        ('removals', removals), ('problem_installs', problem_installs)]:
+      if (not isinstance(items, list) or
+          not all(isinstance(i, basestring) for i in items)):
+        raise ValueError('%s is not a list of str: %r' % (name, items))
+    return installs, removals, problem_installs
+
   def post(self):
     """Reports get handler.
 
@@ -264,11 +415,14 @@ class Reports(handlers.AuthenticationHandler):
       if report_type == 'preflight':
         # we want to get feedback now, before preflight_datetime changes.
         client_exit = self.request.get('client_exit', None)
+        json_feedback = self.request.get('json') == '1'
+        # legacy clients and runs other than automatic ones ignore a defer.
+        can_defer = json_feedback and self.request.get('runtype') == 'auto'
         report_feedback = self.GetReportFeedback(
             uuid, report_type, computer=computer, ip_address=ip_address,
-            client_exit=client_exit)
+            client_exit=client_exit, can_defer=can_defer)
 
-        if self.request.get('json') == '1':
+        if json_feedback:
           self.response.out.write(JSON_PREFIX + json.dumps(report_feedback))
         else:
           # For legacy clients that accept a single string, not JSON.
@@ -297,16 +451,48 @@ class Reports(handlers.AuthenticationHandler):
       computer = models.Computer.get_by_key_name(uuid)
 
       self._LogInstalls(self.request.get_all('installs'), computer)
+      self._LogRemovalsAndProblems(
+          uuid, self.request.get_all('removals'),
+          self.request.get_all('problem_installs'), computer)
+    elif report_type == 'install_report_batch':
+      # a JSON list of install reports, e.g. all archived ones of a client.
+      try:
+        reports = json.loads(self.request.get('reports'))
+        if not isinstance(reports, list):
+          raise ValueError('reports is not a list')
+      except ValueError, e:
+        # the client drops a batch rejected with a 400, as resending it
+        # could never succeed.
+        logging.warning('Invalid install_report_batch: %s', str(e))
+        self.response.set_status(400)
+        return
+
+      installs = []
+      removals = []
+      problem_installs = []
+      for report in reports:
+        try:
+          report_installs, report_removals, report_problems = (
+              self._ParseInstallReport(report))
+        except ValueError, e:
+          # skip it rather than reject the batch, which would block the
+          # client's valid reports.
+          logging.warning('Skipping invalid install report: %s', str(e))
+          continue
+        installs.extend(report_installs)
+        removals.extend(report_removals)
+        problem_installs.extend(report_problems)
 
-      for removal in self.request.get_all('removals'):
-        common.WriteClientLog(
-            models.ClientLog, uuid, computer=computer, action='removal',
-            details=removal)
-
-      for problem in self.request.get_all('problem_installs'):
-        common.WriteClientLog(
-            models.ClientLog, uuid, computer=computer,
-            action='install_problem', details=problem)
+      computer = models.Computer.get_by_key_name(uuid)
+      self._LogInstalls(installs, computer)
+      self._LogRemovalsAndProblems(
+          uuid, removals, problem_installs, computer)
+
+      # the client deletes the reports once their upload is acknowledged;
+      # skipped reports are acknowledged too, as they cannot be logged.
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.out.write(
+          JSON_PREFIX + json.dumps({'reports': len(reports)}))
     elif report_type == 'broken_client':
       # Default reason of "objc" to support legacy clients, existing when objc
       # was the only broken state ever reported.
@@ -73,6 +73,7 @@ class UserAuth(handlers.AuthenticationHandler):
       self.response.headers['Set-Cookie'] = '%s=%s; secure; httponly;' % (
           auth_init.AUTH_TOKEN_COOKIE, output)
       self.response.out.write(auth_init.AUTH_TOKEN_COOKIE)
+      a.FlushSession()
     else:
       #logging.info('Uauth: unknown token')
       raise NotAuthenticated
@@ -24,8 +24,11 @@ import datetime
 import logging
 import os
 import re
+import StringIO
+import tarfile
 import time
 import urllib
+import zlib
 
 from google.appengine.api import mail
 from google.appengine.ext import deferred
@@ -38,12 +41,104 @@ from simian.mac import models
 from simian.mac.munki import handlers
 
 
+# Datastore has a 1MB entity limit and models.ClientLogFile.log_file uses zlib
+# compression. Anecdotal evidence of a handlful of log files over 8MB in size
+# compress down to well under 1MB. Therefore, logs too large to put are
+# truncated to their end at this conservative max before retrying.
+MAX_LOG_SIZE_BYTES = 5 * 1024 * 1024
+# Maximum number of log files stored from one log bundle.
+MAX_LOG_BUNDLE_FILES = 20
+# Max bytes of a log file in a log bundle.  Clients tail logs to 2 MB, so
+# larger files are ignored.
+MAX_LOG_BUNDLE_FILE_BYTES = 3 * 1024 * 1024
+# Max decompressed bytes of a log bundle, ignored files included as they are
+# decompressed to skip them.
+MAX_LOG_BUNDLE_BYTES = 16 * 1024 * 1024
+# Bytes of a log file read from a log bundle at a time.
+LOG_BUNDLE_READ_BYTES = 256 * 1024
+# Log file names allowed in a log bundle.
+LOG_NAME_REGEX = re.compile(r'^[\w\-\.]+$')
+
+
+class LogBundleError(handlers.Error):
+  """The log bundle is too large."""
+
+
+def ReadLogBundle(bundle):
+  """Reads the log files of a log bundle.
+
+  Args:
+    bundle: str, a gzip compressed tar archive of log files.
+  Returns:
+    list of (str log name, str log data) tuples.
+  Raises:
+    LogBundleError: the bundle decompresses to over MAX_LOG_BUNDLE_BYTES.
+    tarfile.TarError, IOError, EOFError, zlib.error: the bundle is invalid.
+  """
+  logs = []
+  total_bytes = 0
+  tar = tarfile.open(fileobj=StringIO.StringIO(bundle), mode='r:gz')
+  try:
+    for member in tar:
+      if len(logs) >= MAX_LOG_BUNDLE_FILES:
+        logging.warning('Log bundle has too many files; ignoring the rest.')
+        break
+      total_bytes += member.size
+      if total_bytes > MAX_LOG_BUNDLE_BYTES:
+        raise LogBundleError(
+            'Log bundle is over %d bytes decompressed' % MAX_LOG_BUNDLE_BYTES)
+      name = os.path.basename(member.name)
+      if not member.isfile() or not LOG_NAME_REGEX.match(name):
+        logging.warning('Ignoring log bundle member: %r', member.name)
+        continue
+      if member.size > MAX_LOG_BUNDLE_FILE_BYTES:
+        logging.warning(
+            'Ignoring log bundle member of %d bytes: %r',
+            member.size, member.name)
+        continue
+      f = tar.extractfile(member)
+      chunks = []
+      chunk = f.read(LOG_BUNDLE_READ_BYTES)
+      while chunk:
+        chunks.append(chunk)
+        chunk = f.read(LOG_BUNDLE_READ_BYTES)
+      logs.append((name, ''.join(chunks)))
+  finally:
+    tar.close()
+  return logs
+
+
 class UploadFile(handlers.AuthenticationHandler):
   """Handler for /uploadfile."""
 
+  def _PutClientLogFile(self, uuid, file_name, log_file):
+    """Stores a client log file.
+
+    Args:
+      uuid: str, computer uuid.
+      file_name: str, log file name.
+      log_file: str, log file contents.
+    """
+    key = '%s_%s' % (uuid, file_name)
+    l = models.ClientLogFile(key_name=key)
+    l.log_file = log_file
+    l.uuid = uuid
+    l.name = file_name
+    try:
+      l.put()
+    except apiproxy_errors.RequestTooLargeError:
+      logging.warning('UploadFile log too large; truncating...')
+      l.log_file = ('*** Log truncated by Simian due to size ***\n\n' +
+                    log_file[-1 * MAX_LOG_SIZE_BYTES:])
+      l.put()
+
   def put(self, file_type=None, file_name=None):
     """UploadFile PUT handler.
 
+    file_type 'log' uploads a single log file named file_name, and
+    'logbundle' a gzip compressed tar archive of log files, each stored as
+    if uploaded on its own.
+
     Returns:
       A webapp.Response() response.
     """
@@ -56,38 +151,33 @@ class UploadFile(handlers.AuthenticationHandler):
       return
 
     if file_type == 'log':
-      key = '%s_%s' % (uuid, file_name)
-      l = models.ClientLogFile(key_name=key)
-      l.log_file = self.request.body
-      l.uuid = uuid
-      l.name = file_name
+      logs = [(file_name, self.request.body)]
+    elif file_type == 'logbundle':
       try:
-        l.put()
-      except apiproxy_errors.RequestTooLargeError:
-        logging.warning('UploadFile log too large; truncating...')
-        # Datastore has a 1MB entity limit and models.ClientLogFile.log_file
-        # uses zlib compression. Anecdotal evidence of a handlful of log files
-        # over 8MB in size compress down to well under 1MB. Therefore, slice
-        # the top of the log data off at a conversative max, before retrying the
-        # Datastore put.
-        max_log_size_bytes = 5 * 1024 * 1024
-        l.log_file = ('*** Log truncated by Simian due to size ***\n\n' +
-                      self.request.body[-1 * max_log_size_bytes:])
-        l.put()
-
-      c = models.Computer.get_by_key_name(uuid)
-      recipients = c.upload_logs_and_notify
-      c.upload_logs_and_notify = None
-      c.put()
-
-      # c.upload_logs_and_notify may be None from a previous upload, as multiple
-      # files may be uploaded in different requests per execution.
-      if recipients:
-        recipients = recipients.split(',')
-        deferred.defer(
-            SendNotificationEmail, recipients, c, settings.SERVER_HOSTNAME)
+        logs = ReadLogBundle(self.request.body)
+      except (
+          LogBundleError, tarfile.TarError, IOError, EOFError, zlib.error), e:
+        logging.warning('UploadFile invalid log bundle: %s', str(e))
+        self.error(400)
+        return
     else:
       self.error(404)
+      return
+
+    for log_name, log_file in logs:
+      self._PutClientLogFile(uuid, log_name, log_file)
+
+    c = models.Computer.get_by_key_name(uuid)
+    recipients = c.upload_logs_and_notify
+    c.upload_logs_and_notify = None
+    c.put()
+
+    # c.upload_logs_and_notify may be None from a previous upload, as multiple
+    # files may be uploaded in different requests per execution.
+    if recipients:
+      recipients = recipients.split(',')
+      deferred.defer(
+          SendNotificationEmail, recipients, c, settings.SERVER_HOSTNAME)
 
 
 def SendNotificationEmail(recipients, c, server_fqdn):
@@ -20,7 +20,12 @@
 
 
 
+import datetime
+import hashlib
+import json
 import logging
+import urllib
+import uuid
 
 from google.appengine.ext import db
 from google.appengine.ext import blobstore
@@ -29,11 +34,193 @@ from google.appengine.ext.webapp import blobstore_handlers
 from simian.auth import gaeserver
 from simian.mac import models
 from simian.mac.common import gae_util
+from simian.mac.common import gcs
 from simian.mac.munki import handlers
 from simian.mac.munki import plist as plist_lib
 from simian.mac.munki.handlers import pkgs
 
 
+# Length of the chunks of a chunked upload, well under the request size limit;
+# a multiple of 256 KB, as Cloud Storage requires of resumable upload parts.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Idle time after which a chunked upload can no longer be resumed.
+UPLOAD_IDLE_TIMEOUT = datetime.timedelta(days=1)
+
+
+class UploadPackageError(handlers.Error):
+  """Error saving an uploaded package; str() is the message for the client."""
+
+
+def GetBlobSha256(blobstore_key):
+  """Returns the sha256 hex digest of a blob.
+
+  Args:
+    blobstore_key: str, blobstore key.
+  Returns:
+    str sha256 hex digest.
+  """
+  sha256 = hashlib.sha256()
+  reader = blobstore.BlobReader(
+      blobstore_key, buffer_size=blobstore.MAX_BLOB_FETCH_SIZE)
+  try:
+    buf = reader.read(blobstore.MAX_BLOB_FETCH_SIZE)
+    while buf:
+      sha256.update(buf)
+      buf = reader.read(blobstore.MAX_BLOB_FETCH_SIZE)
+  finally:
+    reader.close()
+  return sha256.hexdigest()
+
+
+def SavePackage(
+    blobstore_key, user, pkginfo_str, catalogs, manifests, install_types,
+    delete_blob_on_failure=True):
+  """Creates or updates the PackageInfo of an uploaded package blob.
+
+  On success the blob it replaces is deleted.  Saving a package already
+  saved with the blob again is harmless.
+
+  Args:
+    blobstore_key: str, blobstore key of the uploaded package.
+    user: str, user uploading the package.
+    pkginfo_str: str, pkginfo plist XML of the package.
+    catalogs: list of str catalog names.
+    manifests: list of str manifest names.
+    install_types: list of str install types.
+    delete_blob_on_failure: bool, default True, delete the new blob if the
+        package cannot be saved.
+  Returns:
+    models.PackageInfo entity.
+  Raises:
+    UploadPackageError: the package could not be saved.
+  """
+  # Parse, validate, and encode the pkginfo plist.
+  def _DeleteBlob():
+    if delete_blob_on_failure:
+      models.PackageBlobInfo.SafeDelete(blobstore_key)
+
+  plist = plist_lib.MunkiPackageInfoPlist(pkginfo_str)
+  try:
+    plist.Parse()
+  except plist_lib.PlistError, e:
+    logging.exception('Invalid pkginfo plist uploaded:\n%s\n', pkginfo_str)
+    _DeleteBlob()
+    raise UploadPackageError('No valid pkginfo received')
+
+  filename = plist['installer_item_location']
+  pkgdata_sha256 = plist['installer_item_hash']
+
+  # verify the blob was actually written; in case Blobstore failed to write
+  # the blob but still POSTed to this handler (very, very rare).
+  blob_info = pkgs.GetBlobInfo(blobstore_key)
+  if not blob_info:
+    logging.critical(
+        'Blobstore returned a key for %s that does not exist: %s',
+        filename, blobstore_key)
+    raise UploadPackageError('Blobstore failure')
+
+  # Obtain a lock on the PackageInfo entity for this package.
+  lock = 'pkgsinfo_%s' % filename
+  lock_token = gae_util.ObtainLock(lock, timeout=5.0)
+  if not lock_token:
+    _DeleteBlob()
+    raise UploadPackageError('Could not lock pkgsinfo')
+
+  old_blobstore_key = None
+  pkg = models.PackageInfo.get_or_insert(filename)
+  if not pkg.IsSafeToModify():
+    gae_util.ReleaseLock(lock, token=lock_token)
+    _DeleteBlob()
+    raise UploadPackageError('Package is not modifiable')
+
+  if pkg.blobstore_key and pkg.blobstore_key != blobstore_key:
+    # a previous blob exists.  delete it when the update has succeeded.
+    old_blobstore_key = pkg.blobstore_key
+
+  pkg.blobstore_key = blobstore_key
+  pkg.name = plist.GetPackageName()
+  pkg.filename = filename
+  pkg.user = user
+  pkg.catalogs = catalogs
+  pkg.manifests = manifests
+  pkg.install_types = install_types
+  pkg.plist = plist
+  pkg.pkgdata_sha256 = pkgdata_sha256
+
+  # update the PackageInfo model with the new plist string and blobstore key.
+  try:
+    pkg.put()
+    success = True
+  except db.Error:
+    logging.exception('error on PackageInfo.put()')
+    success = False
+
+  # if it failed, delete the blob that was just uploaded -- it's
+  # an orphan.
+  if not success:
+    _DeleteBlob()
+    # if this is a new entity (get_or_insert puts), attempt to delete it.
+    if not old_blobstore_key:
+      gae_util.SafeEntityDel(pkg)
+    gae_util.ReleaseLock(lock, token=lock_token)
+    raise UploadPackageError('')
+
+  # if an old blob was associated with this Package, delete it.
+  # the new blob that was just uploaded has replaced it.
+  if old_blobstore_key:
+    models.PackageBlobInfo.SafeDelete(old_blobstore_key)
+
+  gae_util.ReleaseLock(lock, token=lock_token)
+
+  # Generate catalogs for newly uploaded pkginfo plist.
+  for catalog in pkg.catalogs:
+    models.Catalog.Generate(catalog, delay=1)
+
+  # Log admin upload to Datastore.
+  admin_log = models.AdminPackageLog(
+      user=user, action='uploadpkg', filename=filename, catalogs=catalogs,
+      manifests=manifests, install_types=install_types,
+      plist=pkg.plist.GetXml())
+  admin_log.put()
+
+  return pkg
+
+
+def DeleteUpload(upload):
+  """Deletes a chunked upload and its Cloud Storage object.
+
+  The object is kept if a package was saved with it, in case the upload was
+  finished but failed to be deleted then.
+
+  Args:
+    upload: models.PackageUpload entity.
+  """
+  blobstore_key = gcs.GetBlobKey(upload.gcs_filename)
+  if not models.PackageInfo.all().filter(
+      'blobstore_key =', blobstore_key).get():
+    models.PackageBlobInfo.SafeDelete(blobstore_key)
+    gcs.SafeDelete(upload.gcs_filename)
+  upload.delete()
+
+
+def DeleteIdleUploads(now=None):
+  """Deletes chunked uploads idle for over UPLOAD_IDLE_TIMEOUT.
+
+  Args:
+    now: datetime, optional, the current UTC time.
+  Returns:
+    int number of uploads deleted.
+  """
+  if now is None:
+    now = datetime.datetime.utcnow()
+  cutoff = now - UPLOAD_IDLE_TIMEOUT
+  deleted = 0
+  for upload in models.PackageUpload.all().filter('mtime <', cutoff):
+    DeleteUpload(upload)
+    deleted += 1
+  return deleted
+
+
 class UploadPackage(
     handlers.AuthenticationHandler,
     blobstore_handlers.BlobstoreUploadHandler):
@@ -84,6 +271,8 @@ class UploadPackage(
       file: package file contents
       pkginfo: packageinfo file contents
       name: filename of package e.g. 'Firefox-1.0.dmg'
+      sha256: optional, sha256 of the package in its pkginfo; the upload is
+          rejected if the file does not match it.
     """
     # Only blobstore/upload service/scotty requests should be
     # invoking this handler.
@@ -132,93 +321,248 @@ class UploadPackage(
     blob_info = upload_files[0]
     blobstore_key = str(blob_info.key())
 
-    # Parse, validate, and encode the pkginfo plist.
-    plist = plist_lib.MunkiPackageInfoPlist(pkginfo_str)
-    try:
-      plist.Parse()
-    except plist_lib.PlistError, e:
-      logging.exception('Invalid pkginfo plist uploaded:\n%s\n', pkginfo_str)
+    # a package changed since its pkginfo was made must not replace the
+    # package the pkginfo describes.
+    sha256 = self.request.get('sha256')
+    if sha256 and GetBlobSha256(blobstore_key) != sha256:
+      logging.warning('uploadpkg POST of %s: sha256 mismatch', filename)
       gae_util.SafeBlobDel(blobstore_key)
-      self.redirect('/uploadpkg?mode=error&msg=No%20valid%20pkginfo%20received')
+      self.redirect('/uploadpkg?mode=error&msg=sha256%20mismatch')
       return
 
-    filename = plist['installer_item_location']
-    pkgdata_sha256 = plist['installer_item_hash']
-
-    # verify the blob was actually written; in case Blobstore failed to write
-    # the blob but still POSTed to this handler (very, very rare).
-    blob_info = blobstore.BlobInfo.get(blobstore_key)
-    if not blob_info:
-      logging.critical(
-          'Blobstore returned a key for %s that does not exist: %s',
-          filename, blobstore_key)
-      self.redirect('/uploadpkg?mode=error&msg=Blobstore%20failure')
+    try:
+      SavePackage(
+          blobstore_key, user, pkginfo_str, catalogs, manifests,
+          install_types)
+    except UploadPackageError, e:
+      if str(e):
+        self.redirect('/uploadpkg?mode=error&msg=%s' % urllib.quote(str(e)))
+      else:
+        self.redirect('/uploadpkg?mode=error')
       return
 
-    # Obtain a lock on the PackageInfo entity for this package.
-    lock = 'pkgsinfo_%s' % filename
-    if not gae_util.ObtainLock(lock, timeout=5.0):
-      gae_util.SafeBlobDel(blobstore_key)
-      self.redirect('/uploadpkg?mode=error&msg=Could%20not%20lock%20pkgsinfo')
-      return
+    self.redirect('/uploadpkg?mode=success&key=%s' % blobstore_key)
 
-    old_blobstore_key = None
-    pkg = models.PackageInfo.get_or_insert(filename)
-    if not pkg.IsSafeToModify():
-      gae_util.ReleaseLock(lock)
-      gae_util.SafeBlobDel(blobstore_key)
-      self.redirect('/uploadpkg?mode=error&msg=Package%20is%20not%20modifiable')
-      return
 
-    if pkg.blobstore_key:
-      # a previous blob exists.  delete it when the update has succeeded.
-      old_blobstore_key = pkg.blobstore_key
+class ChunkedUploadPackage(handlers.AuthenticationHandler):
+  """Handler for /uploadpkg/chunked, a resumable alternative to /uploadpkg.
+
+  POST /uploadpkg/chunked starts an upload, with the form parameters of
+    UploadPackage.post() and the package size.
+  GET /uploadpkg/chunked/<id> returns the status of an upload.
+  PUT /uploadpkg/chunked/<id>/<n> sends chunk n, in order, with its sha256
+    hex digest in a X-Chunk-Sha256 header.  Resending a chunk already
+    received is harmless.
+  POST /uploadpkg/chunked/<id> finishes the upload, saving the package like
+    UploadPackage.post(), and returns the blobstore key.  Retrying a finish,
+    failed or not, is harmless.
+  DELETE /uploadpkg/chunked/<id> aborts an upload.  Uploads idle for over
+    UPLOAD_IDLE_TIMEOUT are deleted by a cron, see DeleteIdleUploads().
 
-    pkg.blobstore_key = blobstore_key
-    pkg.name = plist.GetPackageName()
-    pkg.filename = filename
-    pkg.user = user
-    pkg.catalogs = catalogs
-    pkg.manifests = manifests
-    pkg.install_types = install_types
-    pkg.plist = plist
-    pkg.pkgdata_sha256 = pkgdata_sha256
+  The package is written to a Cloud Storage object with a resumable upload,
+  each chunk at its offset, see common.gcs.
 
-    # update the PackageInfo model with the new plist string and blobstore key.
+  Statuses are JSON dicts, see models.PackageUpload.GetStatus(); next_chunk
+  is the first chunk the server has not received.
+  """
+
+  def _Error(self, status, msg):
+    """Sends an error response.
+
+    Args:
+      status: int, HTTP status.
+      msg: str, error message.
+    """
+    logging.warning('ChunkedUploadPackage: %s', msg)
+    self.response.set_status(status)
+    self.response.out.write(msg)
+
+  def _GetUpload(self, upload_id):
+    """Returns the PackageUpload of upload_id, or None after a 404 error."""
+    upload = models.PackageUpload.get_by_key_name(upload_id)
+    if (not upload or
+        upload.mtime < datetime.datetime.utcnow() - UPLOAD_IDLE_TIMEOUT):
+      self._Error(404, 'Upload not found')
+      return None
+    return upload
+
+  def _WriteStatus(self, upload):
+    """Sends the status of an upload."""
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps(upload.GetStatus()))
+
+  def get(self, upload_id):
+    """GET status of an upload."""
+    gaeserver.DoMunkiAuth(require_level=gaeserver.LEVEL_UPLOADPKG)
+    upload = self._GetUpload(upload_id)
+    if upload:
+      self._WriteStatus(upload)
+
+  def post(self, upload_id=None):
+    """POST to start or finish an upload."""
+    gaeserver.DoMunkiAuth(require_level=gaeserver.LEVEL_UPLOADPKG)
+    if upload_id is None:
+      self._Start()
+    else:
+      self._Finish(upload_id)
+
+  def _GetGcsFilename(self, upload_id):
+    """Returns the Cloud Storage object name of the package of upload_id."""
+    return '/%s/uploadpkg/%s' % (gcs.GetDefaultBucket(), upload_id)
+
+  def _Start(self):
+    """Start an upload."""
+    user = self.request.get('user')
+    filename = self.request.get('name')
+    install_types = self.request.get('install_types')
+    catalogs = self.request.get('catalogs', None)
+    manifests = self.request.get('manifests', None)
+    pkginfo_str = self.request.get('pkginfo')
     try:
-      pkg.put()
-      success = True
-    except db.Error:
-      logging.exception('error on PackageInfo.put()')
-      success = False
-
-    # if it failed, delete the blob that was just uploaded -- it's
-    # an orphan.
-    if not success:
-      gae_util.SafeBlobDel(blobstore_key)
-      # if this is a new entity (get_or_insert puts), attempt to delete it.
-      if not old_blobstore_key:
-        gae_util.SafeEntityDel(pkg)
-      gae_util.ReleaseLock(lock)
-      self.redirect('/uploadpkg?mode=error')
+      size = int(self.request.get('size'))
+    except ValueError:
+      size = -1
+    if (catalogs is None or not install_types or not user or not filename or
+        not pkginfo_str or size < 0):
+      self._Error(400, 'uploadpkg POST required parameters missing')
       return
 
-    # if an old blob was associated with this Package, delete it.
-    # the new blob that was just uploaded has replaced it.
-    if old_blobstore_key:
-      gae_util.SafeBlobDel(old_blobstore_key)
+    upload_id = uuid.uuid4().hex
+    gcs_filename = self._GetGcsFilename(upload_id)
+    try:
+      gcs_upload_id = gcs.StartUpload(gcs_filename)
+    except gcs.Error, e:
+      self._Error(503, 'Could not start upload: %s' % e)
+      return
+    upload = models.PackageUpload(
+        key_name=upload_id, user=user, filename=filename,
+        pkginfo=pkginfo_str, install_types=install_types.split(','),
+        catalogs=[c for c in catalogs.split(',') if c],
+        manifests=[m for m in (manifests or '').split(',') if m],
+        size=size, chunk_size=UPLOAD_CHUNK_SIZE,
+        gcs_filename=gcs_filename, gcs_upload_id=gcs_upload_id)
+    upload.put()
+    self._WriteStatus(upload)
+
+  def put(self, upload_id, index):
+    """PUT a chunk of an upload."""
+    gaeserver.DoMunkiAuth(require_level=gaeserver.LEVEL_UPLOADPKG)
+    index = int(index)
+    chunk = self.request.body
+    chunk_sha256 = hashlib.sha256(chunk).hexdigest()
+    if chunk_sha256 != self.request.headers.get('X-Chunk-Sha256'):
+      self._Error(400, 'Chunk %d sha256 mismatch' % index)
+      return
 
-    gae_util.ReleaseLock(lock)
+    # chunks are received in order, one at a time.
+    lock = 'uploadpkg_chunked_%s' % upload_id
+    lock_token = gae_util.ObtainLock(lock, timeout=5.0)
+    if not lock_token:
+      self._Error(503, 'Could not lock upload')
+      return
+    try:
+      upload = self._GetUpload(upload_id)
+      if not upload:
+        return
+      received = len(upload.chunk_sha256s)
+      if index < received:
+        if upload.chunk_sha256s[index] != chunk_sha256:
+          self._Error(409, 'Chunk %d differs from the one received' % index)
+          return
+      elif index > received:
+        self._Error(409, 'Chunk %d is not the next chunk' % index)
+        return
+      elif len(chunk) != upload.ChunkLength(index):
+        self._Error(400, 'Chunk %d has the wrong length' % index)
+        return
+      else:
+        # the chunk is written at its offset, so if upload.put() fails the
+        # resent chunk replaces it rather than being appended again.
+        if index == upload.NumChunks() - 1:
+          size = upload.size
+        else:
+          size = None
+        try:
+          gcs.PutUpload(
+              upload.gcs_filename, upload.gcs_upload_id, chunk,
+              upload.ChunkOffset(index), size=size)
+        except gcs.Error, e:
+          self._Error(503, 'Could not write chunk %d: %s' % (index, e))
+          return
+        upload.chunk_sha256s.append(chunk_sha256)
+        upload.put()
+      self._WriteStatus(upload)
+    finally:
+      gae_util.ReleaseLock(lock, token=lock_token)
+
+  def delete(self, upload_id):
+    """DELETE to abort an upload."""
+    gaeserver.DoMunkiAuth(require_level=gaeserver.LEVEL_UPLOADPKG)
+    lock = 'uploadpkg_chunked_%s' % upload_id
+    lock_token = gae_util.ObtainLock(lock, timeout=5.0)
+    if not lock_token:
+      self._Error(503, 'Could not lock upload')
+      return
+    try:
+      upload = self._GetUpload(upload_id)
+      if upload:
+        DeleteUpload(upload)
+    finally:
+      gae_util.ReleaseLock(lock, token=lock_token)
+
+  def _Finish(self, upload_id):
+    """Finish an upload, saving the package."""
+    lock = 'uploadpkg_chunked_%s' % upload_id
+    lock_token = gae_util.ObtainLock(lock, timeout=5.0)
+    if not lock_token:
+      self._Error(503, 'Could not lock upload')
+      return
+    try:
+      self._FinishLocked(upload_id)
+    finally:
+      gae_util.ReleaseLock(lock, token=lock_token)
+
+  def _FinishLocked(self, upload_id):
+    """Finish an upload, with its lock held."""
+    blobstore_key = gcs.GetBlobKey(self._GetGcsFilename(upload_id))
+    if not models.PackageUpload.get_by_key_name(upload_id):
+      # the upload is only deleted once its package is saved, so this may be
+      # a retry of a finish whose response was lost.
+      pkg = models.PackageInfo.all().filter(
+          'blobstore_key =', blobstore_key).get()
+      if pkg:
+        self.response.out.write(blobstore_key)
+        return
+
+    upload = self._GetUpload(upload_id)
+    if not upload:
+      return
+    if not upload.IsComplete():
+      self._Error(409, 'Upload is missing chunks')
+      return
 
-    # Generate catalogs for newly uploaded pkginfo plist.
-    for catalog in pkg.catalogs:
-      models.Catalog.Generate(catalog, delay=1)
+    try:
+      size = gcs.GetSize(upload.gcs_filename)
+    except gcs.Error, e:
+      self._Error(503, 'Could not stat package: %s' % e)
+      return
+    if size != upload.size:
+      DeleteUpload(upload)
+      self._Error(400, 'Uploaded package has the wrong size')
+      return
 
-    # Log admin upload to Datastore.
-    admin_log = models.AdminPackageLog(
-        user=user, action='uploadpkg', filename=filename, catalogs=catalogs,
-        manifests=manifests, install_types=install_types,
-        plist=pkg.plist.GetXml())
-    admin_log.put()
+    models.PackageBlobInfo(
+        key_name=blobstore_key, gcs_filename=upload.gcs_filename,
+        size=size, creation=datetime.datetime.utcnow()).put()
+    try:
+      # keep the package object, so that the finish can be retried.
+      SavePackage(
+          blobstore_key, upload.user, upload.pkginfo.encode('utf-8'),
+          upload.catalogs, upload.manifests, upload.install_types,
+          delete_blob_on_failure=False)
+    except UploadPackageError, e:
+      self._Error(400, str(e) or 'Could not save package')
+      return
 
-    self.redirect('/uploadpkg?mode=success&key=%s' % blobstore_key)
+    upload.delete()
+    self.response.out.write(blobstore_key)
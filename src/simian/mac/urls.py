@@ -64,6 +64,11 @@ app = webapp2.WSGIApplication([
     (r'/deletepkg$', deletepkg.DeletePackage),
     # POST to upload a munki pkginfo/package pair.
     (r'/uploadpkg$', uploadpkg.UploadPackage),
+    # POST to start, GET status, PUT chunks and POST to finish a chunked
+    # munki package upload.
+    (r'/uploadpkg/chunked/?$', uploadpkg.ChunkedUploadPackage),
+    (r'/uploadpkg/chunked/(\w+)$', uploadpkg.ChunkedUploadPackage),
+    (r'/uploadpkg/chunked/(\w+)/(\d+)$', uploadpkg.ChunkedUploadPackage),
     # POST reports from munki.
     (r'/reports$', reports.Reports),
     # PUT uploadfile from munki.
@@ -618,6 +618,9 @@ class SimianDictSettings(DictSettings):  # pylint: disable=abstract-method
     self._SetValidation(
         'hour_stop', self._VALIDATION_REGEX,
         r'^[0-9]+$')
+    self._SetValidation(
+        'checkin_budget_per_minute', self._VALIDATION_REGEX,
+        r'^[0-9]+$')
     self._SetValidation(
         'uuid_lookup_url', self._VALIDATION_REGEX,
         r'^https?\:\/\/[a-zA-Z0-9\-\.]+(\.[a-zA-Z]{2,3})?(\/\S*)?$')
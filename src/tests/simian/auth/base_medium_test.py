@@ -95,6 +95,8 @@ class Auth1Test(base_test.AuthTestingBase):
     mock_cert.SetRequiredIssuer(self.ba._required_issuer).AndReturn(None)
     mock_cert.CheckAll().AndReturn(None)
     mock_cert.GetSubject().AndReturn(uuid)
+    mock_cert.GetDatetimeNotValidBefore().AndReturn(None)
+    mock_cert.GetDatetimeNotValidAfter().AndReturn(None)
 
     self.mox.StubOutWithMock(self.ba, '_SplitMessage')
     self.mox.StubOutWithMock(base.base64, 'urlsafe_b64decode')
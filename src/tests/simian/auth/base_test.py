@@ -63,6 +63,7 @@ class AuthTestingBase(mox.MoxTestBase):
   def setUp(self):
     mox.MoxTestBase.setUp(self)
     self.stubs = stubout.StubOutForTesting()
+    base.ResetCertCaches()
     self.ba = self.GetTestClass()
 
   def tearDown(self):
@@ -744,6 +745,7 @@ class Auth1Test(AuthTestingBase):
 
   def testSign(self):
     """Test Sign()."""
+    self.stubs.Set(base.rsa_backend, 'USE_ACCELERATED', False)
     data = 'hello'
     sig_bytes = base.array.array('B', 'signed')
     self.ba._key = self.mox.CreateMockAnything()
@@ -752,6 +754,19 @@ class Auth1Test(AuthTestingBase):
     self.assertEqual(self.ba.Sign(data), 'signed')
     self.mox.VerifyAll()
 
+  def testSignWhenBackend(self):
+    """Test Sign()."""
+    data = 'hello'
+    mock_backend = self.mox.CreateMockAnything()
+    self.ba._key = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(base.rsa_backend, 'GetBackend')
+    base.rsa_backend.GetBackend().AndReturn(mock_backend)
+    mock_backend.HandlesKey(self.ba._key, private=True).AndReturn(True)
+    mock_backend.Sign(self.ba._key, data).AndReturn('signed')
+    self.mox.ReplayAll()
+    self.assertEqual(self.ba.Sign(data), 'signed')
+    self.mox.VerifyAll()
+
   def testSignWhenKeyNotLoaded(self):
     """Test Sign()."""
     data = 'hello'
@@ -811,8 +826,85 @@ class Auth1Test(AuthTestingBase):
     self.assertTrue(self.ba.VerifyCertSignedByCA(mock_cert))
     self.mox.VerifyAll()
 
+  def testLoadCaCert(self):
+    """Test LoadCaCert()."""
+    self.mox.StubOutWithMock(self.ba, 'LoadOtherCert')
+    self.ba._ca_pem = 'ca pem'
+    mock_ca_cert = self.mox.CreateMockAnything()
+    # only loaded once, the second call is served from the cache.
+    self.ba.LoadOtherCert(self.ba._ca_pem).AndReturn(mock_ca_cert)
+    self.mox.ReplayAll()
+    self.assertEqual(mock_ca_cert, self.ba.LoadCaCert())
+    self.assertEqual(mock_ca_cert, self.ba.LoadCaCert())
+    self.mox.VerifyAll()
+
+  def testCacheVerifiedCert(self):
+    """Test CacheVerifiedCert() and GetVerifiedCert()."""
+    now = datetime.datetime(2015, 6, 1)
+    self.ba._ca_pem = 'ca pem'
+    self.ba._required_issuer = 'CN=issuer'
+    mock_cert = self.mox.CreateMockAnything()
+    mock_cert.GetDatetimeNotValidBefore().AndReturn(
+        datetime.datetime(2015, 1, 1))
+    mock_cert.GetDatetimeNotValidAfter().AndReturn(
+        datetime.datetime(2016, 1, 1))
+    self.mox.ReplayAll()
+    self.assertEqual(None, self.ba.GetVerifiedCert('cert', utcnow=now))
+    self.ba.CacheVerifiedCert('cert', mock_cert)
+    self.assertEqual(mock_cert, self.ba.GetVerifiedCert('cert', utcnow=now))
+    self.assertEqual(None, self.ba.GetVerifiedCert('other', utcnow=now))
+    self.mox.VerifyAll()
+
+  def testGetVerifiedCertWhenCaParametersDiffer(self):
+    """Test GetVerifiedCert()."""
+    now = datetime.datetime(2015, 6, 1)
+    self.ba._ca_pem = 'ca pem'
+    self.ba._required_issuer = 'CN=issuer'
+    mock_cert = self.mox.CreateMockAnything()
+    mock_cert.GetDatetimeNotValidBefore().AndReturn(
+        datetime.datetime(2015, 1, 1))
+    mock_cert.GetDatetimeNotValidAfter().AndReturn(
+        datetime.datetime(2016, 1, 1))
+    self.mox.ReplayAll()
+    self.ba.CacheVerifiedCert('cert', mock_cert)
+    self.ba._required_issuer = 'CN=other'
+    self.assertEqual(None, self.ba.GetVerifiedCert('cert', utcnow=now))
+    self.ba._required_issuer = 'CN=issuer'
+    self.ba._ca_pem = 'other ca pem'
+    self.assertEqual(None, self.ba.GetVerifiedCert('cert', utcnow=now))
+    self.mox.VerifyAll()
+
+  def testGetVerifiedCertWhenExpired(self):
+    """Test GetVerifiedCert()."""
+    mock_cert = self.mox.CreateMockAnything()
+    mock_cert.GetDatetimeNotValidBefore().AndReturn(
+        datetime.datetime(2015, 1, 1))
+    mock_cert.GetDatetimeNotValidAfter().AndReturn(
+        datetime.datetime(2016, 1, 1))
+    self.mox.ReplayAll()
+    self.ba.CacheVerifiedCert('cert', mock_cert)
+    self.assertEqual(
+        None,
+        self.ba.GetVerifiedCert('cert', utcnow=datetime.datetime(2016, 1, 2)))
+    self.assertEqual(0, len(base._verified_cert_cache))
+    self.mox.VerifyAll()
+
+  def testCacheVerifiedCertWhenFull(self):
+    """Test CacheVerifiedCert()."""
+    self.stubs.Set(base, 'VERIFIED_CERT_CACHE_SIZE', 2)
+    mock_cert = self.mox.CreateMockAnything()
+    for unused_i in xrange(3):
+      mock_cert.GetDatetimeNotValidBefore().AndReturn(None)
+      mock_cert.GetDatetimeNotValidAfter().AndReturn(None)
+    self.mox.ReplayAll()
+    for certstr in ['a', 'b', 'c']:
+      self.ba.CacheVerifiedCert(certstr, mock_cert)
+    self.assertEqual(2, len(base._verified_cert_cache))
+    self.mox.VerifyAll()
+
   def testVerifyDataSignedWithCert(self):
     """Test VerifyDataSignedWithCert()."""
+    self.stubs.Set(base.rsa_backend, 'USE_ACCELERATED', False)
     data = 'data'
     signature = 's' * 128
 
@@ -847,8 +939,30 @@ class Auth1Test(AuthTestingBase):
         data, signature), -1)
     self.mox.VerifyAll()
 
+  def testVerifyDataSignedWithCertWhenBackend(self):
+    """Test VerifyDataSignedWithCert()."""
+    data = 'data'
+    signature = 's' * 127
+
+    mock_cert = self.mox.CreateMockAnything()
+    mock_publickey = self.mox.CreateMockAnything()
+    mock_backend = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(base.rsa_backend, 'GetBackend')
+    self.mox.StubOutWithMock(self.ba, '_PatchTlslite')
+
+    base.rsa_backend.GetBackend().AndReturn(mock_backend)
+    mock_cert.GetPublicKey().AndReturn(mock_publickey)
+    mock_backend.HandlesKey(mock_publickey).AndReturn(True)
+    mock_backend.Verify(mock_publickey, data, signature).AndReturn(True)
+
+    self.mox.ReplayAll()
+    self.assertTrue(self.ba.VerifyDataSignedWithCert(
+        data, signature, mock_cert))
+    self.mox.VerifyAll()
+
   def testVerifyDataSignedWithCertWhenShortSignature(self):
     """Test VerifyDataSignedWithCert()."""
+    self.stubs.Set(base.rsa_backend, 'USE_ACCELERATED', False)
     data = 'data'
     modulus_len = 128
     signature = 's' * (modulus_len - 2)   # short signature
@@ -887,6 +1001,7 @@ class Auth1Test(AuthTestingBase):
 
   def testVerifyDataSignedWithCertWhenAssertionError(self):
     """Test VerifyDataSignedWithCert()."""
+    self.stubs.Set(base.rsa_backend, 'USE_ACCELERATED', False)
     data = 'data'
     signature = 'signature'
 
@@ -1282,6 +1397,7 @@ class Auth1Test(AuthTestingBase):
     self.mox.StubOutWithMock(self.ba, 'AuthFail')
     self.mox.StubOutWithMock(self.ba, 'LoadOtherCert')
     self.mox.StubOutWithMock(self.ba, 'VerifyCertSignedByCA')
+    self.mox.StubOutWithMock(self.ba, 'CacheVerifiedCert')
     self.mox.StubOutWithMock(self.ba, 'VerifyDataSignedWithCert')
 
     self.ba._SplitMessage(m, 3).AndReturn([c, cn, sn])
@@ -1293,6 +1409,7 @@ class Auth1Test(AuthTestingBase):
     mock_client_cert.CheckAll().AndReturn(None)
     mock_client_cert.GetSubject().AndReturn(uuid)
     self.ba.VerifyCertSignedByCA(mock_client_cert).AndReturn(True)
+    self.ba.CacheVerifiedCert(c, mock_client_cert).AndReturn(None)
     self.ba.VerifyDataSignedWithCert(m, s, mock_client_cert).AndReturn(False)
     self.ba.AuthFail()
     self.ba.SessionDelCn(cn)
@@ -1317,6 +1434,7 @@ class Auth1Test(AuthTestingBase):
     self.mox.StubOutWithMock(self.ba, 'AuthFail')
     self.mox.StubOutWithMock(self.ba, 'LoadOtherCert')
     self.mox.StubOutWithMock(self.ba, 'VerifyCertSignedByCA')
+    self.mox.StubOutWithMock(self.ba, 'CacheVerifiedCert')
     self.mox.StubOutWithMock(self.ba, 'VerifyDataSignedWithCert')
 
     self.ba._SplitMessage(m, 3).AndReturn([c, cn, sn])
@@ -1328,6 +1446,7 @@ class Auth1Test(AuthTestingBase):
     mock_client_cert.CheckAll().AndReturn(None)
     mock_client_cert.GetSubject().AndReturn(uuid)
     self.ba.VerifyCertSignedByCA(mock_client_cert).AndReturn(True)
+    self.ba.CacheVerifiedCert(c, mock_client_cert).AndReturn(None)
     self.ba.VerifyDataSignedWithCert(
         m, s, mock_client_cert).AndRaise(base.CryptoError)
     self.ba.AuthFail()
@@ -1353,6 +1472,7 @@ class Auth1Test(AuthTestingBase):
     self.mox.StubOutWithMock(self.ba, 'AuthFail')
     self.mox.StubOutWithMock(self.ba, 'LoadOtherCert')
     self.mox.StubOutWithMock(self.ba, 'VerifyCertSignedByCA')
+    self.mox.StubOutWithMock(self.ba, 'CacheVerifiedCert')
     self.mox.StubOutWithMock(self.ba, 'VerifyDataSignedWithCert')
     self.mox.StubOutWithMock(self.ba, 'SessionVerifyKnownCnSn')
 
@@ -1365,6 +1485,7 @@ class Auth1Test(AuthTestingBase):
     mock_client_cert.CheckAll().AndReturn(None)
     mock_client_cert.GetSubject().AndReturn(uuid)
     self.ba.VerifyCertSignedByCA(mock_client_cert).AndReturn(True)
+    self.ba.CacheVerifiedCert(c, mock_client_cert).AndReturn(None)
     self.ba.VerifyDataSignedWithCert(m, s, mock_client_cert).AndReturn(True)
     self.ba.SessionVerifyKnownCnSn(cn, sn).AndReturn(False)
     self.ba.AuthFail()
@@ -1395,6 +1516,7 @@ class Auth1Test(AuthTestingBase):
     self.mox.StubOutWithMock(self.ba, 'SessionVerifyKnownCnSn')
     self.mox.StubOutWithMock(self.ba, 'SessionCreateAuthToken')
     self.mox.StubOutWithMock(self.ba, '_AddOutput')
+    self.mox.StubOutWithMock(self.ba, 'CacheVerifiedCert')
 
     self.ba._SplitMessage(m, 3).AndReturn([c, cn, sn])
     base.base64.urlsafe_b64decode(s).AndReturn(s)
@@ -1405,6 +1527,45 @@ class Auth1Test(AuthTestingBase):
     mock_client_cert.CheckAll().AndReturn(None)
     mock_client_cert.GetSubject().AndReturn(uuid)
     self.ba.VerifyCertSignedByCA(mock_client_cert).AndReturn(True)
+    self.ba.CacheVerifiedCert(c, mock_client_cert).AndReturn(None)
+    self.ba.VerifyDataSignedWithCert(m, s, mock_client_cert).AndReturn(True)
+    self.ba.SessionVerifyKnownCnSn(cn, sn).AndReturn(True)
+    self.ba.SessionCreateAuthToken(uuid).AndReturn(token)
+    self.ba._AddOutput(token).AndReturn(None)
+    self.ba.SessionDelCn(cn)
+
+    self.mox.ReplayAll()
+    self.ba.Input(m=m, s=s)
+    self.assertEqual(self.ba._auth_state, base.AuthState.OK)
+    self.mox.VerifyAll()
+
+  def testInputStep2WhenCertIsCached(self):
+    """Test Input()."""
+    m = 'c cn sn'
+    s = 'b64sig'
+    c = 'cert'
+    cn = '12345'
+    sn = '12345'
+    uuid = 'subjectcn'
+    mock_client_cert = self.mox.CreateMockAnything()
+    token = 'token1234'
+
+    self.mox.StubOutWithMock(self.ba, '_SplitMessage')
+    self.mox.StubOutWithMock(self.ba, 'SessionDelCn')
+    self.mox.StubOutWithMock(base.base64, 'urlsafe_b64decode')
+    self.mox.StubOutWithMock(self.ba, 'GetVerifiedCert')
+    self.mox.StubOutWithMock(self.ba, 'LoadOtherCert')
+    self.mox.StubOutWithMock(self.ba, 'VerifyCertSignedByCA')
+    self.mox.StubOutWithMock(self.ba, 'VerifyDataSignedWithCert')
+    self.mox.StubOutWithMock(self.ba, 'SessionVerifyKnownCnSn')
+    self.mox.StubOutWithMock(self.ba, 'SessionCreateAuthToken')
+    self.mox.StubOutWithMock(self.ba, '_AddOutput')
+
+    self.ba._SplitMessage(m, 3).AndReturn([c, cn, sn])
+    base.base64.urlsafe_b64decode(s).AndReturn(s)
+    base.base64.urlsafe_b64decode(c).AndReturn(c)
+    self.ba.GetVerifiedCert(c).AndReturn(mock_client_cert)
+    mock_client_cert.GetSubject().AndReturn(uuid)
     self.ba.VerifyDataSignedWithCert(m, s, mock_client_cert).AndReturn(True)
     self.ba.SessionVerifyKnownCnSn(cn, sn).AndReturn(True)
     self.ba.SessionCreateAuthToken(uuid).AndReturn(token)
@@ -40,6 +40,7 @@ class GaeserverModuleTest(mox.MoxTestBase):
   def setUp(self):
     mox.MoxTestBase.setUp(self)
     self.stubs = stubout.StubOutForTesting()
+    gaeserver.ResetTokenCache()
 
   def tearDown(self):
     self.mox.UnsetStubs()
@@ -61,6 +62,8 @@ class GaeserverModuleTest(mox.MoxTestBase):
     mock_valobj.value = token
     mock_session = self.mox.CreateMockAnything()
     mock_session.uuid = 'session uuid'
+    mock_session.level = level
+    mock_session.mtime = gaeserver.datetime.datetime.utcnow()
 
     mock_environ = self.mox.CreateMockAnything()
     mock_cookie = self.mox.CreateMockAnything()
@@ -132,15 +135,94 @@ class GaeserverModuleTest(mox.MoxTestBase):
     self.assertEqual(uuid, session.uuid)  # 6
     self.mox.VerifyAll()
 
+  def _GetMockTokenSession(self, level=0, age_seconds=0):
+    """Return a mock token session."""
+    session = self.mox.CreateMockAnything()
+    session.level = level
+    session.mtime = gaeserver.datetime.datetime.utcnow() - (
+        gaeserver.datetime.timedelta(seconds=age_seconds))
+    return session
+
+  def testDoMunkiAuthWhenTokenCached(self):
+    """Test DoMunkiAuth() with a cached token."""
+    token = 'tok+en=='
+    mock_session = self._GetMockTokenSession(level=gaeserver.LEVEL_ADMIN)
+    mock_auth1 = self.mox.CreateMockAnything()
+    self.stubs.Set(gaeserver.os, 'environ', {
+        'HTTP_COOKIE': 'foo=bar; %s=%s' % (
+            gaeserver.auth.AUTH_TOKEN_COOKIE, token)})
+    self.mox.StubOutWithMock(gaeserver.Cookie, 'SimpleCookie', True)
+    self.mox.StubOutWithMock(gaeserver, 'AuthSimianServer', True)
+
+    gaeserver.AuthSimianServer().AndReturn(mock_auth1)
+    mock_auth1.GetSessionIfAuthOK(
+        token, gaeserver.LEVEL_BASE).AndReturn(mock_session)
+
+    self.mox.ReplayAll()
+    self.assertEqual(mock_session, gaeserver.DoMunkiAuth())
+    self.assertEqual(mock_session, gaeserver.DoMunkiAuth())
+    self.assertEqual(
+        mock_session,
+        gaeserver.DoMunkiAuth(require_level=gaeserver.LEVEL_ADMIN))
+    self.mox.VerifyAll()
+
+  def testGetCachedTokenSession(self):
+    """Test _GetCachedTokenSession()."""
+    session = self._GetMockTokenSession(level=gaeserver.LEVEL_BASE)
+    self.assertEqual(None, gaeserver._GetCachedTokenSession('t', 0))
+    gaeserver._CacheTokenSession('t', session)
+    self.assertEqual(session, gaeserver._GetCachedTokenSession('t', 0))
+    self.assertEqual(
+        None,
+        gaeserver._GetCachedTokenSession('t', gaeserver.LEVEL_ADMIN))
+
+  def testGetCachedTokenSessionWhenExpired(self):
+    """Test _GetCachedTokenSession() when the cache entry expired."""
+    self.stubs.Set(gaeserver, 'TOKEN_CACHE_TTL_SECONDS', -1)
+    gaeserver._CacheTokenSession('t', self._GetMockTokenSession())
+    self.assertEqual(None, gaeserver._GetCachedTokenSession('t', 0))
+    self.assertFalse('t' in gaeserver._token_cache)
+
+  def testGetCachedTokenSessionWhenSessionExpires(self):
+    """Test _GetCachedTokenSession() when the session expires first."""
+    session = self._GetMockTokenSession(
+        age_seconds=gaeserver.base.AGE_TOKEN_SECONDS + 1)
+    gaeserver._CacheTokenSession('t', session)
+    self.assertEqual(None, gaeserver._GetCachedTokenSession('t', 0))
+
+  def testCacheTokenSessionWhenFull(self):
+    """Test _CacheTokenSession() when the cache is full."""
+    self.stubs.Set(gaeserver, 'TOKEN_CACHE_SIZE', 2)
+    for token in ['t1', 't2', 't3']:
+      gaeserver._CacheTokenSession(token, self._GetMockTokenSession())
+    self.assertEqual(2, len(gaeserver._token_cache))
+    self.assertTrue('t3' in gaeserver._token_cache)
+
+  def testGetTokenFromCookieStr(self):
+    """Test _GetTokenFromCookieStr()."""
+    name = gaeserver.auth.AUTH_TOKEN_COOKIE
+    self.assertEqual(
+        'abc=', gaeserver._GetTokenFromCookieStr('%s=abc=' % name))
+    self.assertEqual(
+        'abc', gaeserver._GetTokenFromCookieStr('a=b; %s=abc ;c=d' % name))
+    self.assertEqual(None, gaeserver._GetTokenFromCookieStr('a=b'))
+    self.assertEqual(None, gaeserver._GetTokenFromCookieStr('%s=' % name))
+    self.assertEqual(
+        None, gaeserver._GetTokenFromCookieStr('%s="abc"' % name))
+
   def testLogoutSession(self):
     """Test LogoutSession."""
-    session = 'foo'
+    session = self.mox.CreateMockAnything()
+    gaeserver._CacheTokenSession('token', self._GetMockTokenSession())
     self.mox.StubOutWithMock(gaeserver, 'AuthSessionSimianServer', True)
     mock_session = self.mox.CreateMockAnything()
+    session.key().AndReturn(session)
+    session.name().AndReturn('t_token')
     gaeserver.AuthSessionSimianServer().AndReturn(mock_session)
     mock_session.Delete(session).AndReturn(None)
     self.mox.ReplayAll()
     gaeserver.LogoutSession(session)
+    self.assertFalse('token' in gaeserver._token_cache)
     self.mox.VerifyAll()
 
 
@@ -360,6 +442,120 @@ class Auth1ServerDatastoreSessionTest(DatastoreModelTest):
     ads.Delete(session)
     self.mox.VerifyAll()
 
+  def testPutAsync(self):
+    """Test _PutAsync()."""
+    self._StubGetModelClass()
+    ads = self._GetAds()
+    session = 'session'
+    self.mox.StubOutWithMock(gaeserver.db, 'put_async')
+    gaeserver.db.put_async(session, deadline=ads.deadline).AndReturn('rpc')
+
+    self.mox.ReplayAll()
+    self.assertEqual('rpc', ads._PutAsync(session))
+    self.mox.VerifyAll()
+
+  def testExpireAllByAge(self):
+    """Test ExpireAllByAge()."""
+    mock_query = self.mox.CreateMockAnything()
+    self._StubDatetime()
+    self._StubGetModelClass()
+    ads = self._GetAds()
+    self.mox.StubOutWithMock(gaeserver.db, 'delete_async')
+    self.stubs.Set(gaeserver, 'EXPIRE_BATCH_SIZE', 2)
+
+    keys1 = [self.mox.CreateMockAnything(), self.mox.CreateMockAnything()]
+    keys2 = [self.mox.CreateMockAnything()]
+    rpc1 = self.mox.CreateMockAnything()
+    rpc2 = self.mox.CreateMockAnything()
+
+    gaeserver.datetime.timedelta(seconds=120).AndReturn(120)
+    gaeserver.datetime.datetime.utcnow().AndReturn(220)
+    ads.model.all(keys_only=True).AndReturn(mock_query)
+    mock_query.filter('mtime <', 100).AndReturn(mock_query)
+    mock_query.fetch(2).AndReturn(keys1)
+    gaeserver.db.delete_async(keys1, deadline=ads.deadline).AndReturn(rpc1)
+    mock_query.cursor().AndReturn('c1')
+    mock_query.with_cursor('c1').AndReturn(None)
+    mock_query.fetch(2).AndReturn(keys2)
+    gaeserver.db.delete_async(keys2, deadline=ads.deadline).AndReturn(rpc2)
+    mock_query.cursor().AndReturn('c2')
+    mock_query.with_cursor('c2').AndReturn(None)
+    mock_query.fetch(2).AndReturn([])
+    rpc1.get_result().AndReturn(None)
+    rpc2.get_result().AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.assertEqual(3, ads.ExpireAllByAge(120))
+    self.mox.VerifyAll()
+
+  def testExpireAllByAgeWhenManyBatches(self):
+    """Test ExpireAllByAge() waits on delete RPCs in a bounded window."""
+    mock_query = self.mox.CreateMockAnything()
+    self._StubDatetime()
+    self._StubGetModelClass()
+    ads = self._GetAds()
+    self.mox.StubOutWithMock(gaeserver.db, 'delete_async')
+    self.stubs.Set(gaeserver, 'EXPIRE_BATCH_SIZE', 1)
+    self.stubs.Set(gaeserver, 'EXPIRE_MAX_PENDING_RPCS', 2)
+
+    rpcs = [self.mox.CreateMockAnything() for _ in xrange(3)]
+
+    gaeserver.datetime.timedelta(seconds=120).AndReturn(120)
+    gaeserver.datetime.datetime.utcnow().AndReturn(220)
+    ads.model.all(keys_only=True).AndReturn(mock_query)
+    mock_query.filter('mtime <', 100).AndReturn(mock_query)
+    for i, rpc in enumerate(rpcs):
+      mock_query.fetch(1).AndReturn(['k%d' % i])
+      if i == 2:
+        rpcs[0].get_result().AndReturn(None)
+      gaeserver.db.delete_async(
+          ['k%d' % i], deadline=ads.deadline).AndReturn(rpc)
+      mock_query.cursor().AndReturn('c')
+      mock_query.with_cursor('c').AndReturn(None)
+    mock_query.fetch(1).AndReturn([])
+    rpcs[1].get_result().AndReturn(None)
+    rpcs[2].get_result().AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.assertEqual(3, ads.ExpireAllByAge(120))
+    self.mox.VerifyAll()
+
+  def testExpireAllByAgeWithPrefix(self):
+    """Test ExpireAllByAge() with a session id prefix."""
+    mock_query = self.mox.CreateMockAnything()
+    self._StubDatetime()
+    self._StubGetModelClass()
+    ads = self._GetAds()
+    self.mox.StubOutWithMock(gaeserver.db, 'delete_async')
+    self.mox.StubOutWithMock(gaeserver.db.Key, 'from_path')
+
+    old_session = self.mox.CreateMockAnything()
+    old_session.mtime = 50
+    new_session = self.mox.CreateMockAnything()
+    new_session.mtime = 150
+    rpc = self.mox.CreateMockAnything()
+
+    gaeserver.datetime.timedelta(seconds=120).AndReturn(120)
+    gaeserver.datetime.datetime.utcnow().AndReturn(220)
+    ads.model.kind().AndReturn('Kind')
+    ads.model.all().AndReturn(mock_query)
+    gaeserver.db.Key.from_path('Kind', 'cn_').AndReturn('start')
+    mock_query.filter('__key__ >=', 'start').AndReturn(mock_query)
+    gaeserver.db.Key.from_path('Kind', 'cn`').AndReturn('end')
+    mock_query.filter('__key__ <', 'end').AndReturn(mock_query)
+    mock_query.fetch(gaeserver.EXPIRE_BATCH_SIZE).AndReturn(
+        [old_session, new_session])
+    old_session.key().AndReturn('cn_1')
+    gaeserver.db.delete_async(['cn_1'], deadline=ads.deadline).AndReturn(rpc)
+    mock_query.cursor().AndReturn('c1')
+    mock_query.with_cursor('c1').AndReturn(None)
+    mock_query.fetch(gaeserver.EXPIRE_BATCH_SIZE).AndReturn([])
+    rpc.get_result().AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.assertEqual(1, ads.ExpireAllByAge(120, prefix='cn_'))
+    self.mox.VerifyAll()
+
   def testMtime(self):
     """Test _Mtime()."""
     session = self.mox.CreateMockAnything()
@@ -553,6 +749,7 @@ class Auth1ServerDatastoreMemcacheSessionTest(DatastoreModelTest):
 
   def testPut(self):
     """Test _Put()."""
+    self.ams.async_put = False
     session = self._GetMockSession()
     self._MockMemcache(
         'set', self._Key(self.sid),
@@ -564,6 +761,64 @@ class Auth1ServerDatastoreMemcacheSessionTest(DatastoreModelTest):
     self.ams._Put(session)
     self.mox.VerifyAll()
 
+  def testPutWhenAsync(self):
+    """Test _Put() with async_put."""
+    self.ams.async_put = True
+    session = self._GetMockSession()
+    self._MockMemcache(
+        'set', self._Key(self.sid),
+        value=session,
+        time=self.ams.ttl).AndReturn(True)
+    self._MockSuper('_PutAsync', session).AndReturn('rpc')
+
+    self.mox.ReplayAll()
+    self.ams._Put(session)
+    self.assertEqual([('rpc', session)], self.ams._pending_puts)
+    self.mox.VerifyAll()
+
+  def testPutWhenMemcacheOnly(self):
+    """Test _Put() with a memcache only session."""
+    self.ams.memcache_only_prefixes = ('cn_',)
+    self.ams.memcache_only_ttl = 300
+    session = self._GetMockSession('cn_1')
+    self._MockMemcache(
+        'set', self._Key('cn_1'), value=session, time=300).AndReturn(True)
+
+    self.mox.ReplayAll()
+    self.ams._Put(session)
+    self.assertEqual([], self.ams._pending_puts)
+    self.mox.VerifyAll()
+
+  def testPutWhenMemcacheOnlyAndMemcacheFails(self):
+    """Test _Put() with a memcache only session when memcache set fails."""
+    self.ams.memcache_only_prefixes = ('cn_',)
+    self.ams.async_put = False
+    session = self._GetMockSession('cn_1')
+    self._MockMemcache(
+        'set', self._Key('cn_1'), value=session,
+        time=self.ams.memcache_only_ttl).AndReturn(False)
+    self._MockSuper('_Put', session).AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.ams._Put(session)
+    self.mox.VerifyAll()
+
+  def testFlush(self):
+    """Test Flush()."""
+    rpc1 = self.mox.CreateMockAnything()
+    rpc2 = self.mox.CreateMockAnything()
+    self.ams._pending_puts = [(rpc1, 'session1'), (rpc2, 'session2')]
+    self.mox.StubOutWithMock(self.ams, '_CallSuperWithDefer')
+
+    rpc1.get_result().AndReturn(None)
+    rpc2.get_result().AndRaise(gaeserver.db.Timeout)
+    self.ams._CallSuperWithDefer('_Put', 'session2').AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.ams.Flush()
+    self.assertEqual([], self.ams._pending_puts)
+    self.mox.VerifyAll()
+
   def testDeleteById(self):
     """Test DeleteById()."""
     sid = self.sid
@@ -587,6 +842,25 @@ class Auth1ServerDatastoreMemcacheSessionTest(DatastoreModelTest):
     self.ams.Delete(session)
     self.mox.VerifyAll()
 
+  def testDeleteByIdWhenMemcacheOnly(self):
+    """Test DeleteById() with a memcache only session."""
+    self.ams.memcache_only_prefixes = ('cn_',)
+    self._MockMemcache('delete', self._Key('cn_1')).AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.ams.DeleteById('cn_1')
+    self.mox.VerifyAll()
+
+  def testDeleteWhenMemcacheOnly(self):
+    """Test Delete() with a memcache only session."""
+    self.ams.memcache_only_prefixes = ('cn_',)
+    session = self._GetMockSession('cn_1')
+    self._MockMemcache('delete', self._Key('cn_1')).AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.ams.Delete(session)
+    self.mox.VerifyAll()
+
 
 class AuthSessionSimianServer(mox.MoxTestBase):
   """Test AuthSessionSimianServer class."""
@@ -613,6 +887,31 @@ class AuthSessionSimianServer(mox.MoxTestBase):
         (gaeserver.AuthSessionSimianServer.GetModelClass() is
         gaeserver.models.AuthSession))
 
+  def testInit(self):
+    """Test __init__()."""
+    self.assertEqual(
+        (self.asps.SESSION_TYPE_PREFIX_CN,), self.asps.memcache_only_prefixes)
+    self.assertEqual(
+        gaeserver.base.AGE_CN_SECONDS, self.asps.memcache_only_ttl)
+
+  def testInitWhenNotMemcacheOnly(self):
+    """Test __init__()."""
+    self.stubs.Set(gaeserver, 'MEMCACHE_ONLY_CN_SESSIONS', False)
+    asps = gaeserver.AuthSessionSimianServer()
+    self.assertEqual((), asps.memcache_only_prefixes)
+
+  def testExpireAll(self):
+    """Test ExpireAll()."""
+    self.mox.StubOutWithMock(self.asps, 'ExpireAllByAge')
+    self.asps.ExpireAllByAge(gaeserver.base.AGE_TOKEN_SECONDS).AndReturn(2)
+    self.asps.ExpireAllByAge(
+        gaeserver.base.AGE_CN_SECONDS,
+        prefix=self.asps.SESSION_TYPE_PREFIX_CN).AndReturn(3)
+
+    self.mox.ReplayAll()
+    self.assertEqual(5, self.asps.ExpireAll())
+    self.mox.VerifyAll()
+
   def _TestExpireOneSession(self, session_prefix, session_age_seconds):
     """Test ExpireOne() with a token session item.
 
@@ -742,6 +1041,26 @@ class AuthSimianServer(mox.MoxTestBase):
     self.assertTrue(
         self.aps.GetSessionClass() is gaeserver.AuthSessionSimianServer)
 
+  def testSessionDelToken(self):
+    """Test SessionDelToken()."""
+    gaeserver._token_cache['token'] = ('expires', 'session')
+    self.aps._session = self.mox.CreateMockAnything()
+    self.aps._session.DelToken('token').AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.aps.SessionDelToken('token')
+    self.assertFalse('token' in gaeserver._token_cache)
+    self.mox.VerifyAll()
+
+  def testFlushSession(self):
+    """Test FlushSession()."""
+    self.aps._session = self.mox.CreateMockAnything()
+    self.aps._session.Flush().AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.aps.FlushSession()
+    self.mox.VerifyAll()
+
 
 def main(unused_argv):
   basetest.main()
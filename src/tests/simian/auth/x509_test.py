@@ -18,6 +18,8 @@
 
 
 
+import logging
+import timeit
 import types
 from google.apputils import app
 from google.apputils import basetest
@@ -27,6 +29,51 @@ from pyasn1.type import univ
 from simian.auth import x509
 
 
+# Certificates for the fast parser and benchmark tests; the first is a
+# self-signed /CN=TestCert1 certificate with basic constraints, the second has
+# all known DN OIDs in its subject and issuer.
+FIXTURE_CERTS_PEM = [
+    """
+-----BEGIN CERTIFICATE-----
+MIICDTCCAXagAwIBAgICMDkwDQYJKoZIhvcNAQEFBQAwFDESMBAGA1UEAxMJVGVz
+dENlcnQxMB4XDTExMDkwNjE5NTMyNVoXDTIxMDkwMzE5NTMyNVowFDESMBAGA1UE
+AxMJVGVzdENlcnQxMIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQCa7S9PpvYh
+Utkw9Wu4pnV4B/kD0BaGU3irDZWhIwVEmmFkcF2GtPhSvy12Jthj1M45ME8wpyzW
+svXcUMhYac12WsgFXEjqjeWhztlUZVeSUAZQW3MierrDhAR/LAeWyBGYUf6CGan6
+O44OCELGJSTEg44/f1Ivj8aPYV7BuSlHawIDAQABo24wbDAdBgNVHQ4EFgQUMhwL
+eP1SzD8YCkUFvX+3kC/2iYEwPQYDVR0jBDYwNIAUMhwLeP1SzD8YCkUFvX+3kC/2
+iYGhGKQWMBQxEjAQBgNVBAMTCVRlc3RDZXJ0MYICMDkwDAYDVR0TBAUwAwEB/zAN
+BgkqhkiG9w0BAQUFAAOBgQAsMvV0CygBEY2jkTnD/rJ4JbN+yAbpHt17FUi1k972
+ww4F3igrInfF6pgk+x866HWQvrZvAXJPdMkG6V0GIaORmNaFVyAHu9bAbDTCYMri
+hIYnz+CPRvK8o5NWjeGSDKZ/z5PV8j1jaKcy2S0N5pm3izDQayQdc4chRfInqkzN
+Xw==
+-----END CERTIFICATE-----
+""",
+    """
+-----BEGIN CERTIFICATE-----
+MIIC2zCCAkSgAwIBAgICMDkwDQYJKoZIhvcNAQEFBQAwgYkxDTALBgNVBAMMBF9j
+bl8xCzAJBgNVBAYTAlVTMQwwCgYDVQQHDANfbF8xCzAJBgNVBAgMAk5ZMQwwCgYD
+VQQKDANfb18xDTALBgNVBAsMBF9vdV8xHTAbBgkqhkiG9w0BCQEWDl9lbWFpbGFk
+ZHJlc3NfMRQwEgYKCZImiZPyLGQBGRYEX2RjXzAeFw0xNDA3MTExNDU2MDhaFw0y
+NDA3MDgxNDU2MDhaMIGJMQ0wCwYDVQQDDARfY25fMQswCQYDVQQGEwJVUzEMMAoG
+A1UEBwwDX2xfMQswCQYDVQQIDAJOWTEMMAoGA1UECgwDX29fMQ0wCwYDVQQLDARf
+b3VfMR0wGwYJKoZIhvcNAQkBFg5fZW1haWxhZGRyZXNzXzEUMBIGCgmSJomT8ixk
+ARkWBF9kY18wgZ8wDQYJKoZIhvcNAQEBBQADgY0AMIGJAoGBAPMwxsyuen866REz
+P4AZbErBkzCS0+aWSrz/Qy7Lup4/zESgcd1bDIiP22yn5/HKBfYoe06DzGfi0fV+
+7a+K0alrJI1ZrH6TcmJnS7HNZo5cABwvpm3c7ddprPgtRqggMXj1fuMgEtwewoVi
+qs7RYt7p4VGLoWuj4zFhzgl+LKrnAgMBAAGjUDBOMB0GA1UdDgQWBBTsXLjH3R1W
+K5L+k9AmuqiOczoRLzAfBgNVHSMEGDAWgBTsXLjH3R1WK5L+k9AmuqiOczoRLzAM
+BgNVHRMEBTADAQH/MA0GCSqGSIb3DQEBBQUAA4GBANz4q1NtjB3e/Inh3exaky8i
+HBrHDY2/3eVnU2bv/gPPdFxA3rFUpxoC7a15wiiVa9uvGeplqeJ9ioDJSTXkWkS1
+AHtYlWyrqlLr3qziOWTTCQhMZBxLSLx1TUYkfeeiJIoA8ZBp5i9KyKRIiSdzR7qZ
+ujvfJAGJoIOC4OIor+fk
+-----END CERTIFICATE-----
+""",
+]
+# Times each fixture certificate is loaded by the benchmark test.
+BENCHMARK_ITERATIONS = 50
+
+
 class Error(Exception):
   """Base Error."""
 
@@ -235,6 +282,98 @@ class X509ModuleTest(mox.MoxTestBase):
     self.mox.VerifyAll()
 
 
+class DerModuleTest(mox.MoxTestBase):
+  """Test the DER helper functions used by the fast parser."""
+
+  def testDerReadItem(self):
+    """Test _DerReadItem()."""
+    self.assertEqual((0x02, 2, 3), x509._DerReadItem('\x02\x01\x05', 0))
+    data = '\x00\x04\x82\x01\x00' + 'a' * 256
+    self.assertEqual((0x04, 5, 261), x509._DerReadItem(data, 1))
+
+  def testDerReadItemWhenTruncated(self):
+    """Test _DerReadItem()."""
+    self.assertRaises(x509.FastParseError, x509._DerReadItem, '\x02', 0)
+    self.assertRaises(
+        x509.FastParseError, x509._DerReadItem, '\x02\x02\x05', 0)
+
+  def testDerReadItemWhenIndefiniteLength(self):
+    """Test _DerReadItem()."""
+    self.assertRaises(
+        x509.FastParseError, x509._DerReadItem, '\x30\x80\x00\x00', 0)
+
+  def testDerReadItems(self):
+    """Test _DerReadItems()."""
+    data = '\x02\x01\x05\x01\x01\xff'
+    self.assertEqual(
+        [(0x02, 2, 3), (0x01, 5, 6)], x509._DerReadItems(data, 0, 6))
+    self.assertRaises(x509.FastParseError, x509._DerReadItems, data, 0, 5)
+
+  def testDerDecodeOid(self):
+    """Test _DerDecodeOid()."""
+    self.assertEqual(
+        x509.OID_SHA256_WITH_RSA_ENC,
+        x509._DerDecodeOid('\x2a\x86\x48\x86\xf7\x0d\x01\x01\x0b'))
+    self.assertEqual(
+        x509.OID_ID['DC'],
+        x509._DerDecodeOid('\x09\x92\x26\x89\x93\xf2\x2c\x64\x01\x19'))
+    self.assertRaises(x509.FastParseError, x509._DerDecodeOid, '\x2a\x86')
+
+  def testDerDecodeInteger(self):
+    """Test _DerDecodeInteger()."""
+    self.assertEqual(12345, x509._DerDecodeInteger('\x30\x39'))
+    self.assertEqual(-1, x509._DerDecodeInteger('\xff'))
+    self.assertRaises(x509.FastParseError, x509._DerDecodeInteger, '')
+
+
+class FastParseTest(mox.MoxTestBase):
+  """Test the fast parser against the full parser on real certificates."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _LoadCertificate(self, pem, fast_parse):
+    """Returns an X509Certificate loaded with or without the fast parser."""
+    self.stubs.Set(x509, 'FAST_PARSE', fast_parse)
+    return x509.LoadCertificateFromPEM(pem)
+
+  def testFastParseMatchesFullParse(self):
+    """Test the fast parser produces the same contents as the full parser."""
+    for pem in FIXTURE_CERTS_PEM:
+      full = self._LoadCertificate(pem, False)
+      fast = self._LoadCertificate(pem, True)
+
+      # make sure the fast parser did not fall back.
+      fields = fast._GetCertFromByteStringFast(
+          fast._cert['entire_byte_string'])
+      self.assertEqual(full.GetFieldsData(), fields['fields_data'])
+
+      for k in full._cert:
+        if k != 'public_key':
+          self.assertEqual(full._cert[k], fast._cert[k], k)
+      self.assertEqual(full.GetPublicKey().n, fast.GetPublicKey().n)
+      self.assertEqual(full.GetPublicKey().e, fast.GetPublicKey().e)
+
+  def testBenchmark(self):
+    """Benchmark the fast parser against the full parser."""
+    for i, pem in enumerate(FIXTURE_CERTS_PEM):
+      seconds = {}
+      for fast_parse in [False, True]:
+        self.stubs.Set(x509, 'FAST_PARSE', fast_parse)
+        seconds[fast_parse] = timeit.timeit(
+            lambda: x509.LoadCertificateFromPEM(pem),
+            number=BENCHMARK_ITERATIONS) / BENCHMARK_ITERATIONS
+      logging.info(
+          'x509 fixture %d: full parse %.3fms, fast parse %.3fms', i,
+          seconds[False] * 1000, seconds[True] * 1000)
+      self.assertTrue(seconds[True] < seconds[False])
+
+
 class BaseDataObjectTest(mox.MoxTestBase):
   """Test BaseDataObject class."""
 
@@ -978,6 +1117,7 @@ class X509CertificateTest(mox.MoxTestBase):
     self.x.Reset()
     base_cert = self.x._cert
 
+    self.mox.StubOutWithMock(self.x, '_GetCertFromByteStringFast')
     self.mox.StubOutWithMock(x509.der_decoder, 'decode', True)
     self.mox.StubOutWithMock(self.x, '_GetCertSequencesFromTopSequence')
     self.mox.StubOutWithMock(self.x, '_GetPublicKeyFromByteString')
@@ -992,6 +1132,8 @@ class X509CertificateTest(mox.MoxTestBase):
     cert.update(certseq)
     cert.update(pubkey)
 
+    self.x._GetCertFromByteStringFast(bytes).AndRaise(
+        x509.FastParseError('unusual'))
     x509.der_decoder.decode(bytes).AndReturn(seq)
     self.x._GetCertSequencesFromTopSequence(seq).AndReturn(certseq)
     self.x._GetPublicKeyFromByteString(bytes).AndReturn(pubkey)
@@ -1002,6 +1144,33 @@ class X509CertificateTest(mox.MoxTestBase):
     self.assertEqual(self.x._cert, cert)
     self.mox.VerifyAll()
 
+  def testLoadFromByteStringWhenFastParse(self):
+    """Test LoadFromByteString()."""
+    self.x.Reset()
+    base_cert = self.x._cert
+
+    self.mox.StubOutWithMock(self.x, '_GetCertFromByteStringFast')
+    self.mox.StubOutWithMock(x509.der_decoder, 'decode', True)
+    self.mox.StubOutWithMock(self.x, '_GetPublicKeyFromByteString')
+    self.mox.StubOutWithMock(self.x, 'Reset')
+
+    bytes = 'bytes'
+    fields = {'fields': 1}
+    pubkey = {'pubkey': 1}
+    cert = { 'entire_byte_string': bytes }
+    cert.update(base_cert)
+    cert.update(fields)
+    cert.update(pubkey)
+
+    self.x._GetCertFromByteStringFast(bytes).AndReturn(fields)
+    self.x._GetPublicKeyFromByteString(bytes).AndReturn(pubkey)
+    self.x.Reset().AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.x.LoadFromByteString(bytes)
+    self.assertEqual(self.x._cert, cert)
+    self.mox.VerifyAll()
+
   def testLoadFromByteStringWhenPyAsn1Error(self):
     """Test LoadFromByteString()."""
     self.mox.StubOutWithMock(x509.der_decoder, 'decode', True)
@@ -1093,6 +1262,7 @@ class X509CertificateTest(mox.MoxTestBase):
 
   def testIsSignedBy(self):
     """Test IsSignedBy()."""
+    self.stubs.Set(x509.rsa_backend, 'USE_ACCELERATED', False)
     self.mox.StubOutWithMock(self.x, '_StrToArray')
     self.mox.StubOutWithMock(self.x, 'GetSignatureData')
     self.mox.StubOutWithMock(self.x, 'GetFieldsData')
@@ -1110,6 +1280,29 @@ class X509CertificateTest(mox.MoxTestBase):
     self.assertTrue(self.x.IsSignedBy(mock_othercert))
     self.mox.VerifyAll()
 
+  def testIsSignedByWhenBackend(self):
+    """Test IsSignedBy()."""
+    self.mox.StubOutWithMock(x509.rsa_backend, 'GetBackend')
+    self.mox.StubOutWithMock(self.x, 'GetSignatureData')
+    self.mox.StubOutWithMock(self.x, 'GetFieldsData')
+    mock_othercert = self.mox.CreateMockAnything()
+    mock_publickey = self.mox.CreateMockAnything()
+    mock_backend = self.mox.CreateMockAnything()
+    self.x._cert['sig_algorithm'] = x509.OID_SHA256_WITH_RSA_ENC
+
+    mock_othercert.GetMayActAsCA().AndReturn(True)
+    mock_othercert.GetPublicKey().AndReturn(mock_publickey)
+    x509.rsa_backend.GetBackend().AndReturn(mock_backend)
+    mock_backend.HandlesKey(mock_publickey).AndReturn(True)
+    self.x.GetFieldsData().AndReturn('fieldsdata')
+    self.x.GetSignatureData().AndReturn('sigdata')
+    mock_backend.Verify(
+        mock_publickey, 'fieldsdata', 'sigdata', 'sha256').AndReturn(True)
+
+    self.mox.ReplayAll()
+    self.assertTrue(self.x.IsSignedBy(mock_othercert))
+    self.mox.VerifyAll()
+
   def testIsSignedByWhenOtherCertNotCA(self):
     """Test IsSignedBy()."""
     mock_othercert = self.mox.CreateMockAnything()
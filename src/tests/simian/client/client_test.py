@@ -20,8 +20,13 @@
 
 
 
+import hashlib
+import json
 import logging
+import os
+import shutil
 import sys
+import tempfile
 
 import mox
 import stubout
@@ -58,6 +63,77 @@ class ClientModuleTest(mox.MoxTestBase):
         'DEBUG', 'URL_UPLOADPKG']:
       self.assertTrue(hasattr(client, a))
 
+  def testParseRetryAfter(self):
+    """Test ParseRetryAfter()."""
+    self.assertEqual(120.0, client.ParseRetryAfter('120'))
+    self.assertEqual(
+        30.0,
+        client.ParseRetryAfter(
+            'Thu, 01 Jan 1970 00:01:30 GMT', now=60.0))
+    self.assertEqual(
+        0.0,
+        client.ParseRetryAfter('Thu, 01 Jan 1970 00:01:30 GMT', now=100.0))
+    self.assertEqual(None, client.ParseRetryAfter('soon'))
+    self.assertEqual(None, client.ParseRetryAfter(None))
+
+  def testGetRetryDelay(self):
+    """Test GetRetryDelay() backs off exponentially with full jitter."""
+    self.mox.StubOutWithMock(client.random, 'uniform')
+    client.random.uniform(0, 5).AndReturn(1.0)
+    client.random.uniform(0, 20).AndReturn(2.0)
+    client.random.uniform(0, client.RETRY_BACKOFF_MAX_SECONDS).AndReturn(3.0)
+    self.mox.ReplayAll()
+    self.assertEqual(1.0, client.GetRetryDelay(1))
+    self.assertEqual(
+        2.0, client.GetRetryDelay(3, client.Response(500, headers={})))
+    self.assertEqual(3.0, client.GetRetryDelay(10))
+    self.mox.VerifyAll()
+
+  def testGetRetryDelayWithRetryAfter(self):
+    """Test GetRetryDelay() adds the Retry-After delay of a 503 or 429."""
+    self.mox.StubOutWithMock(client.random, 'uniform')
+    client.random.uniform(0, 5).AndReturn(1.0)
+    client.random.uniform(0, 10).AndReturn(1.0)
+    client.random.uniform(0, 5).AndReturn(1.0)
+    client.random.uniform(0, 5).AndReturn(1.0)
+    self.mox.ReplayAll()
+    self.assertEqual(
+        61.0,
+        client.GetRetryDelay(1, client.Response(503, headers=[
+            ('retry-after', '60')])))
+    self.assertEqual(
+        31.0,
+        client.GetRetryDelay(1, client.Response(429, headers={
+            'Retry-After': '30'})))
+    self.assertEqual(
+        1.0 + client.RETRY_AFTER_MAX_SECONDS,
+        client.GetRetryDelay(1, client.Response(503, headers={
+            'Retry-After': '86400'})))
+    # Retry-After is not honored for other statuses.
+    self.assertEqual(
+        1.0,
+        client.GetRetryDelay(1, client.Response(500, headers={
+            'Retry-After': '60'})))
+    self.mox.VerifyAll()
+
+  def testRetryBudget(self):
+    """Test RetryBudget.Spend()."""
+    self.mox.StubOutWithMock(client.time, 'time')
+    client.time.time().AndReturn(10.0)
+    client.time.time().AndReturn(10.0)
+    client.time.time().AndReturn(10.0)
+    # one retry is regained after 1 / refill_per_second seconds.
+    client.time.time().AndReturn(14.0)
+    client.time.time().AndReturn(14.0)
+    self.mox.ReplayAll()
+    budget = client.RetryBudget(size=2, refill_per_second=0.25)
+    self.assertTrue(budget.Spend())
+    self.assertTrue(budget.Spend())
+    self.assertFalse(budget.Spend())
+    self.assertTrue(budget.Spend())
+    self.assertFalse(budget.Spend())
+    self.mox.VerifyAll()
+
 
 class MultiBodyConnectionTest(mox.MoxTestBase):
   """Test MultiBodyConnection class."""
@@ -395,6 +471,23 @@ class HTTPSMultiBodyConnectionTest(mox.MoxTestBase):
     self.assertEqual(self.mbc.sock, conn)
     self.mox.VerifyAll()
 
+  def testConnectWithSSLContext(self):
+    """Test connect() with a SSL context set by SetSSLContext()."""
+    context = self.mox.CreateMockAnything()
+    conn = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(client, 'SSL')
+    self.mox.StubOutWithMock(client.SSL, 'Connection')
+
+    client.SSL.Connection(context).AndReturn(conn)
+    conn.connect((self.mbc.host, self.mbc.port)).AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.mbc.SetSSLContext(context)
+    self.mbc.connect()
+    self.assertEqual(self.mbc.sock, conn)
+    self.assertEqual(context, self.mbc.GetSSLContext())
+    self.mox.VerifyAll()
+
   def testConnectWhenNoCACertChain(self):
     """Test connect()."""
     context = self.mox.CreateMockAnything()
@@ -408,6 +501,135 @@ class HTTPSMultiBodyConnectionTest(mox.MoxTestBase):
     self.mox.VerifyAll()
 
 
+class ResumableDownloadFileTest(mox.MoxTestBase):
+  """Test ResumableDownloadFile."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.tempdir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.tempdir, 'file')
+    f = open(self.filename, 'wb')
+    f.write('hello')
+    f.close()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+    shutil.rmtree(self.tempdir)
+
+  def _Read(self):
+    f = open(self.filename, 'rb')
+    content = f.read()
+    f.close()
+    return content
+
+  def testPartialContent(self):
+    """Test a 206 response body continues the content kept."""
+    f = client.ResumableDownloadFile(open(self.filename, 'r+b'), 5)
+    f.Start(206, {'etag': 'etag'})
+    f.write(' world')
+    f.close()
+    self.assertEqual('etag', f.etag)
+    self.assertEqual('hello world', self._Read())
+    self.assertEqual(hashlib.sha256('hello world').hexdigest(), f.hexdigest())
+
+  def testWholeContent(self):
+    """Test a 200 response body replaces the content kept."""
+    f = client.ResumableDownloadFile(open(self.filename, 'r+b'), 5)
+    f.Start(200, {})
+    f.write('bye')
+    f.close()
+    self.assertEqual(None, f.etag)
+    self.assertEqual('bye', self._Read())
+    self.assertEqual(hashlib.sha256('bye').hexdigest(), f.hexdigest())
+
+  def testProgressCallback(self):
+    """Test progress is reported against the whole package size."""
+    progress = []
+    f = client.ResumableDownloadFile(
+        open(self.filename, 'r+b'), 5,
+        lambda *args: progress.append(args))
+    f.Start(206, {'x-download-size': '11', 'content-length': '6'})
+    f.write(' wor')
+    f.write('ld')
+    f.close()
+    self.assertEqual([(5, 11), (9, 11), (11, 11)], progress)
+
+  def testErrorResponse(self):
+    """Test an error response body is discarded."""
+    f = client.ResumableDownloadFile(open(self.filename, 'r+b'), 5)
+    f.Start(503, {'etag': 'etag'})
+    f.write('error')
+    f.close()
+    self.assertEqual(None, f.etag)
+    self.assertEqual('hello', self._Read())
+
+
+class BandwidthLimiterTest(mox.MoxTestBase):
+  """Test BandwidthLimiter."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testTransferred(self):
+    """Test Transferred() sleeps until the bytes are within the rate."""
+    self.mox.StubOutWithMock(client.time, 'time')
+    self.mox.StubOutWithMock(client.time, 'sleep')
+    client.time.time().AndReturn(10.0)
+    client.time.sleep(0.5)
+    client.time.time().AndReturn(10.5)
+    client.time.sleep(1.0)
+    # the budget was unused for a while, so no sleep is needed.
+    client.time.time().AndReturn(20.0)
+    client.time.sleep(0.25)
+
+    self.mox.ReplayAll()
+    limiter = client.BandwidthLimiter(100)
+    limiter.Transferred(50)
+    limiter.Transferred(100)
+    limiter.Transferred(25)
+    self.mox.VerifyAll()
+
+
+class DownloadProgressTest(mox.MoxTestBase):
+  """Test DownloadProgress."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testUpdate(self):
+    """Test Update() sums downloads and limits the bytes transferred."""
+    callback = self.mox.CreateMockAnything()
+    limiter = self.mox.CreateMock(client.BandwidthLimiter)
+    limiter.Transferred(10)
+    callback(10, 100)
+    limiter.Transferred(5)
+    callback(15, 150)
+    callback(5, 150)
+    limiter.Transferred(20)
+    callback(25, 150)
+
+    self.mox.ReplayAll()
+    progress = client.DownloadProgress(callback, limiter)
+    progress.Update('a', 10, 100)
+    progress.GetCallback('b')(5, 50)
+    # a 200 response replaced a partial download, nothing transferred.
+    progress.Update('a', 0, 100)
+    progress.Update('a', 20, 100)
+    self.mox.VerifyAll()
+
+
 class HttpsClientTest(mox.MoxTestBase):
   """Test HttpsClient class."""
 
@@ -417,6 +639,7 @@ class HttpsClientTest(mox.MoxTestBase):
     self.hostname = 'hostname'
     self.port = None
     self.client = client.HttpsClient(self.hostname)
+    self.stubs.Set(client, '_retry_budget', client.RetryBudget())
 
   def tearDown(self):
     self.mox.UnsetStubs()
@@ -633,6 +856,9 @@ class HttpsClientTest(mox.MoxTestBase):
         method, conn, req_url, body=body, headers=headers).AndReturn(None)
     test_client._GetResponse(
         conn, output_file=output_file).AndReturn(response)
+    # the server closed the connection, so it is not pooled.
+    conn.sock = None
+    conn.close().AndReturn(None)
 
     test_client._Connect().AndRaise(client.httplib.HTTPException)
 
@@ -680,6 +906,203 @@ class HttpsClientTest(mox.MoxTestBase):
     req_url = 'https://' + self.hostname + '/url'
     self._TestDoRequestResponse(test_client, '/url', req_url)
 
+  def testDoRequestResponseReusesConnection(self):
+    """Test _DoRequestResponse() reuses a keep-alive connection."""
+    conn = self.mox.CreateMockAnything()
+    conn.sock = 'sock'
+    response = client.Response(status=200)
+
+    self.mox.StubOutWithMock(self.client, '_Connect')
+    self.mox.StubOutWithMock(self.client, '_Request')
+    self.mox.StubOutWithMock(self.client, '_GetResponse')
+
+    self.client._Connect().AndReturn(conn)
+    for unused_i in xrange(2):
+      self.client._Request(
+          'GET', conn, '/url', body=None, headers=None).AndReturn(None)
+      self.client._GetResponse(conn, output_file=None).AndReturn(response)
+
+    self.mox.ReplayAll()
+    self.assertEqual(response, self.client._DoRequestResponse('GET', '/url'))
+    self.assertEqual(response, self.client._DoRequestResponse('GET', '/url'))
+    self.assertEqual(
+        [conn], [c for c, _ in self.client._connection_pool.values()[0]])
+    self.mox.VerifyAll()
+
+  def testDoRequestResponseWhenStaleConnection(self):
+    """Test _DoRequestResponse() reconnects when a pooled conn is stale."""
+    stale_conn = self.mox.CreateMockAnything()
+    conn = self.mox.CreateMockAnything()
+    conn.sock = 'sock'
+    body = self.mox.CreateMockAnything()
+    response = client.Response(status=200)
+    self.client._connection_pool[self.client._ConnectionPoolKey()] = [
+        (stale_conn, client.time.time())]
+
+    self.mox.StubOutWithMock(self.client, '_Connect')
+    self.mox.StubOutWithMock(self.client, '_Request')
+    self.mox.StubOutWithMock(self.client, '_GetResponse')
+
+    body.tell().AndReturn(5)
+    self.client._Request(
+        'POST', stale_conn, '/url', body=body, headers=None).AndReturn(None)
+    self.client._GetResponse(stale_conn, output_file=None).AndRaise(
+        client.httplib.BadStatusLine(''))
+    stale_conn.close().AndReturn(None)
+    body.seek(5, client.SEEK_SET).AndReturn(None)
+    self.client._Connect().AndReturn(conn)
+    self.client._Request(
+        'POST', conn, '/url', body=body, headers=None).AndReturn(None)
+    self.client._GetResponse(conn, output_file=None).AndReturn(response)
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        response, self.client._DoRequestResponse('POST', '/url', body=body))
+    self.mox.VerifyAll()
+
+  def _StubPooledConnection(self):
+    """Pool a stale connection and stub out connecting and requesting."""
+    stale_conn = self.mox.CreateMockAnything()
+    self.client._connection_pool[self.client._ConnectionPoolKey()] = [
+        (stale_conn, client.time.time())]
+    self.mox.StubOutWithMock(self.client, '_Connect')
+    self.mox.StubOutWithMock(self.client, '_Request')
+    self.mox.StubOutWithMock(self.client, '_GetResponse')
+    return stale_conn
+
+  def testDoRequestResponseWhenResetOnSend(self):
+    """Test _DoRequestResponse() resends a POST reset while sending it."""
+    stale_conn = self._StubPooledConnection()
+    conn = self.mox.CreateMockAnything()
+    conn.sock = 'sock'
+    response = client.Response(status=200)
+
+    self.client._Request(
+        'POST', stale_conn, '/url', body='body', headers=None).AndRaise(
+            client.httplib.socket.error(client.errno.EPIPE, 'Broken pipe'))
+    stale_conn.close().AndReturn(None)
+    self.client._Connect().AndReturn(conn)
+    self.client._Request(
+        'POST', conn, '/url', body='body', headers=None).AndReturn(None)
+    self.client._GetResponse(conn, output_file=None).AndReturn(response)
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        response, self.client._DoRequestResponse('POST', '/url', body='body'))
+    self.mox.VerifyAll()
+
+  def testDoRequestResponseWhenPostResponseFails(self):
+    """Test _DoRequestResponse() does not resend a POST the server read."""
+    stale_conn = self._StubPooledConnection()
+
+    self.client._Request(
+        'POST', stale_conn, '/url', body='body', headers=None).AndReturn(None)
+    self.client._GetResponse(stale_conn, output_file=None).AndRaise(
+        client.httplib.socket.timeout('timed out'))
+    stale_conn.close().AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        client.httplib.socket.timeout,
+        self.client._DoRequestResponse, 'POST', '/url', body='body')
+    self.mox.VerifyAll()
+
+  def testDoRequestResponseWhenGetResponseFails(self):
+    """Test _DoRequestResponse() resends an idempotent GET after any error."""
+    stale_conn = self._StubPooledConnection()
+    conn = self.mox.CreateMockAnything()
+    conn.sock = 'sock'
+    response = client.Response(status=200)
+
+    self.client._Request(
+        'GET', stale_conn, '/url', body=None, headers=None).AndReturn(None)
+    self.client._GetResponse(stale_conn, output_file=None).AndRaise(
+        client.httplib.IncompleteRead('partial'))
+    stale_conn.close().AndReturn(None)
+    self.client._Connect().AndReturn(conn)
+    self.client._Request(
+        'GET', conn, '/url', body=None, headers=None).AndReturn(None)
+    self.client._GetResponse(conn, output_file=None).AndReturn(response)
+
+    self.mox.ReplayAll()
+    self.assertEqual(response, self.client._DoRequestResponse('GET', '/url'))
+    self.mox.VerifyAll()
+
+  def testDoRequestResponseWhenNewConnectionFails(self):
+    """Test _DoRequestResponse() does not retry a new connection."""
+    conn = self.mox.CreateMockAnything()
+
+    self.mox.StubOutWithMock(self.client, '_Connect')
+    self.mox.StubOutWithMock(self.client, '_Request')
+
+    self.client._Connect().AndReturn(conn)
+    self.client._Request(
+        'GET', conn, '/url', body=None, headers=None).AndRaise(
+            client.httplib.CannotSendRequest)
+    conn.close().AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        client.HTTPError, self.client._DoRequestResponse, 'GET', '/url')
+    self.assertEqual({}, self.client._connection_pool)
+    self.mox.VerifyAll()
+
+  def testGetConnectionWhenIdleTimeout(self):
+    """Test _GetConnection() closes connections idle for too long."""
+    idle_conn = self.mox.CreateMockAnything()
+    new_conn = self.mox.CreateMockAnything()
+    self.client._connection_pool[self.client._ConnectionPoolKey()] = [
+        (idle_conn, 100)]
+
+    self.mox.StubOutWithMock(client.time, 'time')
+    self.mox.StubOutWithMock(self.client, '_Connect')
+    client.time.time().AndReturn(100 + client.CONNECTION_IDLE_TIMEOUT + 1)
+    idle_conn.close().AndReturn(None)
+    self.client._Connect().AndReturn(new_conn)
+
+    self.mox.ReplayAll()
+    self.assertEqual((new_conn, False), self.client._GetConnection())
+    self.mox.VerifyAll()
+
+  def testConnectionPoolKeyWithProxy(self):
+    """Test connections via a proxy are pooled apart from direct ones."""
+    test_client = client.HttpsClient(self.hostname, proxy='proxyhost:123')
+    self.assertNotEqual(
+        self.client._ConnectionPoolKey(), test_client._ConnectionPoolKey())
+
+  def testSetKeepAliveFalse(self):
+    """Test SetKeepAlive(False) closes pooled connections."""
+    conn = self.mox.CreateMockAnything()
+    self.client._connection_pool['key'] = [(conn, 0)]
+    conn.close().AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.client.SetKeepAlive(False)
+    self.assertEqual({}, self.client._connection_pool)
+    self.mox.VerifyAll()
+
+  def testConnectWithReuseSSLContext(self):
+    """Test _Connect() shares the SSL context between connections."""
+    m = self.mox.CreateMockAnything()
+    self.stubs.Set(client, 'HTTPSMultiBodyConnection', m)
+    self.client.SetCACertChain('cert chain')
+    self.client.SetReuseSSLContext(True)
+
+    m(self.hostname, self.port).AndReturn(m)
+    m.SetCACertChain('cert chain').AndReturn(None)
+    m.connect().AndReturn(None)
+    m.GetSSLContext().AndReturn('ctx')
+    m(self.hostname, self.port).AndReturn(m)
+    m.SetCACertChain('cert chain').AndReturn(None)
+    m.SetSSLContext('ctx').AndReturn(None)
+    m.connect().AndReturn(None)
+    m.GetSSLContext().AndReturn('ctx')
+
+    self.mox.ReplayAll()
+    self.client._Connect()
+    self.client._Connect()
+    self.mox.VerifyAll()
+
   def testDoWithInvalidMethod(self):
     """Test Do() with invalid method."""
     self.assertRaises(
@@ -696,18 +1119,19 @@ class HttpsClientTest(mox.MoxTestBase):
     output_filename = None
 
     self.mox.StubOutWithMock(client.time, 'sleep')
+    self.mox.StubOutWithMock(client, 'GetRetryDelay')
     self.mox.StubOutWithMock(self.client, '_DoRequestResponse')
     # HTTP 500 should retry.
     mock_response_fail = self.mox.CreateMockAnything()
     mock_response_fail.status = 500
-    client.time.sleep(0).AndReturn(None)
     self.client._DoRequestResponse(
         method, url, body=body, headers={}, output_file=output_file).AndReturn(
             mock_response_fail)
     # HTTP 200 should succeed.
     mock_response = self.mox.CreateMockAnything()
     mock_response.status = 200
-    client.time.sleep(5).AndReturn(None)
+    client.GetRetryDelay(1, mock_response_fail).AndReturn(3.5)
+    client.time.sleep(3.5).AndReturn(None)
     self.client._DoRequestResponse(
         method, url, body=body, headers={}, output_file=output_file).AndReturn(
             mock_response)
@@ -725,11 +1149,14 @@ class HttpsClientTest(mox.MoxTestBase):
     output_filename = None
 
     self.mox.StubOutWithMock(client.time, 'sleep')
+    self.mox.StubOutWithMock(client, 'GetRetryDelay')
     mock_response = self.mox.CreateMockAnything()
     mock_response.status = 500
     self.mox.StubOutWithMock(self.client, '_DoRequestResponse')
     for i in xrange(0, client.DEFAULT_HTTP_ATTEMPTS):
-      client.time.sleep(i * 5).AndReturn(None)
+      if i:
+        client.GetRetryDelay(i, mock_response).AndReturn(i)
+        client.time.sleep(i).AndReturn(None)
       self.client._DoRequestResponse(
           method, url, body=body, headers={},
           output_file=output_file).AndReturn(mock_response)
@@ -748,9 +1175,12 @@ class HttpsClientTest(mox.MoxTestBase):
     output_filename = None
 
     self.mox.StubOutWithMock(client.time, 'sleep')
+    self.mox.StubOutWithMock(client, 'GetRetryDelay')
     self.mox.StubOutWithMock(self.client, '_DoRequestResponse')
     for i in xrange(0, client.DEFAULT_HTTP_ATTEMPTS):
-      client.time.sleep(i * 5).AndReturn(None)
+      if i:
+        client.GetRetryDelay(i, None).AndReturn(i)
+        client.time.sleep(i).AndReturn(None)
       self.client._DoRequestResponse(
           method, url, body=body, headers={},
           output_file=output_file).AndRaise(client.HTTPError)
@@ -762,6 +1192,22 @@ class HttpsClientTest(mox.MoxTestBase):
         method, url, body, headers, output_filename)
     self.mox.VerifyAll()
 
+  def testDoWhenRetryBudgetExhausted(self):
+    """Test Do() stops retrying when the retry budget is exhausted."""
+    self.stubs.Set(client, '_retry_budget', client.RetryBudget(size=1))
+    self.mox.StubOutWithMock(client.time, 'sleep')
+    self.mox.StubOutWithMock(self.client, '_DoRequestResponse')
+    mock_response = client.Response(status=503, headers={})
+    for _ in xrange(2):
+      self.client._DoRequestResponse(
+          'GET', 'url', body=None, headers={}, output_file=None).AndReturn(
+              mock_response)
+    client.time.sleep(mox.IsA(float)).AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.assertEqual(mock_response, self.client.Do('GET', 'url'))
+    self.mox.VerifyAll()
+
   def testDoWithOutputFilename(self):
     """Test Do() where an output_filename is supplied."""
     method = 'GET'
@@ -785,6 +1231,118 @@ class HttpsClientTest(mox.MoxTestBase):
         method, url, body, headers, output_filename, _open=mock_open)
     self.mox.VerifyAll()
 
+  def _StubDoRequestResponse(self, responses):
+    """Stub _DoRequestResponse() to answer with responses, in order.
+
+    Args:
+      responses: list of (status, headers, body, raise_error) tuples.
+    Returns:
+      list, to which the headers of each request are appended.
+    """
+    requests = []
+    responses = list(responses)
+
+    def _DoRequestResponse(method, url, headers=None, output_file=None):
+      self.assertEqual('GET', method)
+      requests.append(headers)
+      status, response_headers, body, raise_error = responses.pop(0)
+      output_file.Start(status, response_headers)
+      output_file.write(body)
+      if raise_error:
+        raise client.HTTPError('connection reset')
+      return client.Response(status=status, headers=response_headers)
+
+    self.stubs.Set(self.client, '_DoRequestResponse', _DoRequestResponse)
+    self.stubs.Set(client.time, 'sleep', lambda unused_s: None)
+    return requests
+
+  def _MakeTempdir(self):
+    tempdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tempdir)
+    return os.path.join(tempdir, 'pkg.dmg')
+
+  def _ReadFile(self, filename):
+    f = open(filename, 'rb')
+    content = f.read()
+    f.close()
+    return content
+
+  def testDoDownloadResumes(self):
+    """Test DoDownload() resumes an interrupted download with Range."""
+    filename = self._MakeTempdir()
+    sha256 = hashlib.sha256('hello world').hexdigest()
+    requests = self._StubDoRequestResponse([
+        (200, {'etag': sha256}, 'hello', True),
+        (206, {'etag': sha256}, ' world', False)])
+
+    response = self.client.DoDownload('/pkgs/pkg.dmg', filename)
+
+    self.assertEqual(206, response.status)
+    self.assertEqual(
+        [{}, {'Range': 'bytes=5-', 'If-Range': sha256}], requests)
+    self.assertEqual('hello world', self._ReadFile(filename))
+    self.assertFalse(
+        os.path.exists(filename + client.PARTIAL_DOWNLOAD_SUFFIX))
+
+  def testDoDownloadWhenPackageChanged(self):
+    """Test DoDownload() of a partial file of another package version."""
+    filename = self._MakeTempdir()
+    f = open(filename + client.PARTIAL_DOWNLOAD_SUFFIX, 'wb')
+    f.write('old')
+    f.close()
+    sha256 = hashlib.sha256('new package').hexdigest()
+    requests = self._StubDoRequestResponse([
+        (200, {'etag': sha256}, 'new package', False)])
+
+    self.client.DoDownload(
+        '/pkgs/pkg.dmg', filename, headers={'foo': 'bar'}, sha256='oldsha')
+
+    self.assertEqual(
+        [{'foo': 'bar', 'Range': 'bytes=3-', 'If-Range': 'oldsha'}],
+        requests)
+    self.assertEqual('new package', self._ReadFile(filename))
+
+  def testDoDownloadRetryStatusKeepsPartial(self):
+    """Test DoDownload() keeps the partial file across a retry status."""
+    filename = self._MakeTempdir()
+    sha256 = hashlib.sha256('hello world').hexdigest()
+    requests = self._StubDoRequestResponse([
+        (200, {'etag': sha256}, 'hello', True),
+        (503, {}, 'busy', False),
+        (206, {'etag': sha256}, ' world', False)])
+
+    self.client.DoDownload('/pkgs/pkg.dmg', filename)
+
+    self.assertEqual('bytes=5-', requests[2]['Range'])
+    self.assertEqual('hello world', self._ReadFile(filename))
+
+  def testDoDownloadSha256Mismatch(self):
+    """Test DoDownload() raises HTTPError when the sha256 never matches."""
+    filename = self._MakeTempdir()
+    requests = self._StubDoRequestResponse([
+        (200, {'etag': 'a' * 64}, 'corrupt', False),
+        (200, {'etag': 'a' * 64}, 'corrupt', False)])
+
+    self.assertRaises(
+        client.HTTPError,
+        self.client.DoDownload, '/pkgs/pkg.dmg', filename, attempt_times=2)
+    self.assertEqual([{}, {}], requests)
+    self.assertFalse(os.path.exists(filename))
+    self.assertFalse(
+        os.path.exists(filename + client.PARTIAL_DOWNLOAD_SUFFIX))
+
+  def testDoDownloadNotFound(self):
+    """Test DoDownload() returns error responses without a file."""
+    filename = self._MakeTempdir()
+    self._StubDoRequestResponse([(404, {}, 'not found', False)])
+
+    response = self.client.DoDownload('/pkgs/pkg.dmg', filename)
+
+    self.assertEqual(404, response.status)
+    self.assertFalse(os.path.exists(filename))
+    self.assertFalse(
+        os.path.exists(filename + client.PARTIAL_DOWNLOAD_SUFFIX))
+
   def testDoWithProxy(self):
     """Test Do() with a proxy specified."""
     method = 'GET'
@@ -1179,6 +1737,19 @@ class SimianClientTest(mox.MoxTestBase):
         self.client._SimianRequest(method, url, headers=headers))
     self.mox.VerifyAll()
 
+  def testSimianRequestWithOutputFilename(self):
+    """Test _SimianRequest() downloading to output_filename."""
+    response = client.Response(status=200)
+    self.mox.StubOutWithMock(self.client, 'DoDownload')
+    self.client.DoDownload(
+        '/url', 'filename', headers=None).AndReturn(response)
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        None,
+        self.client._SimianRequest('GET', '/url', output_filename='filename'))
+    self.mox.VerifyAll()
+
   def testSimianRequestWithError(self):
     """Test _SimianRequest() with an error status returned."""
     method = 'zGET'
@@ -1322,6 +1893,162 @@ class SimianClientTest(mox.MoxTestBase):
         self.client.PutPackage(filename, params, input_file=input_file))
     self.mox.VerifyAll()
 
+  def _TestPutPackageWithSha256(self):
+    """Test PutPackage() sends the sha256 for the server to verify."""
+    filename = 'name.dmg'
+    params = {'pkginfo': 'xml'}
+    post_path = '/_ah/upload-here.cgi'
+    post_url = 'http://%s%s' % (self.hostname, post_path)
+    redirect_path = '/uploadpkg?mode=success&key=fookey'
+    redirect_url = 'http://%s%s' % (self.hostname, redirect_path)
+    input_file = 'input_file'
+    mock_response = self.mox.CreateMockAnything()
+
+    self.mox.StubOutWithMock(self.client, '_SimianRequest')
+    self.mox.StubOutWithMock(self.client, '_SimianFormUpload')
+    self.client._SimianRequest('GET', '/uploadpkg').AndReturn(post_url)
+    self.client._SimianFormUpload(
+        post_path, filename, {'pkginfo': 'xml', 'sha256': 'sha256'},
+        input_file=input_file, input_filename=None).AndReturn(mock_response)
+    mock_response.headers = {'location': redirect_url}
+    mock_response.IsRedirect().AndReturn(True)
+    return self.client._SimianRequest('GET', redirect_path)
+
+  def testPutPackageWithSha256(self):
+    """Test PutPackage() with a sha256 the server accepts."""
+    self._TestPutPackageWithSha256().AndReturn('fookey')
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        'fookey',
+        self.client.PutPackage(
+            'name.dmg', {'pkginfo': 'xml'}, input_file='input_file',
+            sha256='sha256'))
+    self.mox.VerifyAll()
+
+  def testPutPackageWithSha256WhenChanged(self):
+    """Test PutPackage() with a sha256 the server rejects."""
+    params = {'pkginfo': 'xml'}
+    self._TestPutPackageWithSha256().AndRaise(
+        client.SimianServerError(400, 'Bad Request', 'sha256 mismatch'))
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        client.SimianServerError,
+        self.client.PutPackage, 'name.dmg', params, input_file='input_file',
+        sha256='sha256')
+    self.assertEqual({'pkginfo': 'xml'}, params)
+    self.mox.VerifyAll()
+
+  def _StubChunkedUploadServer(self, content, fail_chunks=(), next_chunk=0):
+    """Stub _SimianRequest() with a /uploadpkg/chunked server.
+
+    Args:
+      content: str, content of the file to upload.
+      fail_chunks: list of int chunks to fail once, after storing them.
+      next_chunk: int, first chunk the server has not received.
+    Returns:
+      list, to which (method, url) of each request are appended.
+    """
+    requests = []
+    fail_chunks = set(fail_chunks)
+    status = {
+        'id': 'upid', 'chunk_size': 4, 'next_chunk': next_chunk,
+        'num_chunks': (len(content) + 3) // 4}
+    received = [content[:next_chunk * 4]]
+
+    def _SimianRequest(method, url, body=None, headers=None):
+      requests.append((method, url))
+      if url.startswith('/uploadpkg/chunked/upid/'):
+        index = int(url.rsplit('/', 1)[1])
+        self.assertEqual(status['next_chunk'], index)
+        self.assertEqual(
+            hashlib.sha256(body).hexdigest(), headers['X-Chunk-Sha256'])
+        received.append(body)
+        status['next_chunk'] += 1
+        if index in fail_chunks:
+          fail_chunks.remove(index)
+          raise client.SimianServerError(503, 'busy')
+      elif method == 'POST' and url == '/uploadpkg/chunked/upid':
+        self.assertEqual(content, ''.join(received))
+        return 'blobkey'
+      elif method == 'POST':
+        self.assertEqual(len(content), body['size'])
+        self.assertEqual('name.dmg', body['name'])
+      return json.dumps(status)
+
+    self.stubs.Set(self.client, '_SimianRequest', _SimianRequest)
+    return requests
+
+  def _MakeTempFile(self, content):
+    input_filename = os.path.join(tempfile.mkdtemp(), 'name.dmg')
+    self.addCleanup(shutil.rmtree, os.path.dirname(input_filename))
+    f = open(input_filename, 'wb')
+    f.write(content)
+    f.close()
+    return input_filename
+
+  def testPutPackageChunked(self):
+    """Test PutPackageChunked() resuming after a failed chunk."""
+    content = 'hello world'
+    input_filename = self._MakeTempFile(content)
+    requests = self._StubChunkedUploadServer(content, fail_chunks=[1])
+    self.client._user = 'user'
+
+    self.assertEqual(
+        'blobkey',
+        self.client.PutPackageChunked(
+            'name.dmg', {'pkginfo': 'xml'}, input_filename,
+            sha256=hashlib.sha256(content).hexdigest()))
+    self.assertEqual(
+        [('POST', '/uploadpkg/chunked'),
+         ('PUT', '/uploadpkg/chunked/upid/0'),
+         ('PUT', '/uploadpkg/chunked/upid/1'),
+         ('GET', '/uploadpkg/chunked/upid'),
+         ('PUT', '/uploadpkg/chunked/upid/2'),
+         ('POST', '/uploadpkg/chunked/upid')],
+        requests)
+
+  def testPutPackageChunkedWithUploadId(self):
+    """Test PutPackageChunked() resuming an earlier upload."""
+    content = 'hello world'
+    input_filename = self._MakeTempFile(content)
+    requests = self._StubChunkedUploadServer(content, next_chunk=2)
+
+    self.assertEqual(
+        'blobkey',
+        self.client.PutPackageChunked(
+            'name.dmg', {}, input_filename,
+            sha256=hashlib.sha256(content).hexdigest(), upload_id='upid'))
+    self.assertEqual(
+        [('GET', '/uploadpkg/chunked/upid'),
+         ('PUT', '/uploadpkg/chunked/upid/2'),
+         ('POST', '/uploadpkg/chunked/upid')],
+        requests)
+
+  def testPutPackageChunkedWhenChanged(self):
+    """Test PutPackageChunked() does not finish when sha256 mismatches."""
+    content = 'hello world'
+    input_filename = self._MakeTempFile(content)
+    requests = self._StubChunkedUploadServer(content)
+    self.client._user = 'user'
+
+    self.assertRaises(
+        client.SimianClientError,
+        self.client.PutPackageChunked,
+        'name.dmg', {}, input_filename, sha256='other')
+    self.assertFalse(('POST', '/uploadpkg/chunked/upid') in requests)
+    self.assertEqual(('DELETE', '/uploadpkg/chunked/upid'), requests[-1])
+
+  def testAbortPackageChunked(self):
+    """Test AbortPackageChunked()."""
+    self.mox.StubOutWithMock(self.client, '_SimianRequest')
+    self.client._SimianRequest('DELETE', '/uploadpkg/chunked/upid')
+
+    self.mox.ReplayAll()
+    self.client.AbortPackageChunked('upid')
+    self.mox.VerifyAll()
+
   def testPutPackageWhenNotRedirect(self):
     """Test PutPackage() where a redirect was not received.
 
@@ -1452,6 +2179,56 @@ class SimianClientTest(mox.MoxTestBase):
         '_SimianRequest', 'GET',
         '/pkgs/%s' % filename, output_filename=filename)
 
+  def testDownloadPackages(self):
+    """Test DownloadPackages()."""
+    downloads = []
+    progress = []
+    lock = client.threading.Lock()
+
+    def _DoDownload(url, output_filename, progress_callback=None):
+      with lock:
+        downloads.append((url, output_filename))
+      progress_callback(0, 10)
+      progress_callback(10, 10)
+      if url == '/pkgs/missing.dmg':
+        return client.Response(status=404, reason='Not Found')
+      elif url == '/pkgs/broken.dmg':
+        raise client.HTTPError('sha256 mismatch')
+      return client.Response(status=200)
+
+    self.stubs.Set(self.client, 'DoDownload', _DoDownload)
+    self.client.SetProgressCallback(lambda *args: progress.append(args))
+    filenames = ['a b.dmg', 'missing.dmg', 'broken.dmg', 'c.dmg']
+
+    errors = self.client.DownloadPackages(
+        filenames, '/cache', concurrency=20)
+
+    self.assertEqual(
+        {'missing.dmg': '404 Not Found', 'broken.dmg': 'sha256 mismatch'},
+        errors)
+    self.assertEqual(
+        sorted([('/pkgs/a%20b.dmg', '/cache/a b.dmg'),
+                ('/pkgs/missing.dmg', '/cache/missing.dmg'),
+                ('/pkgs/broken.dmg', '/cache/broken.dmg'),
+                ('/pkgs/c.dmg', '/cache/c.dmg')]),
+        sorted(downloads))
+    self.assertEqual((40, 40), progress[-1])
+
+  def testDownloadPackagesConcurrency(self):
+    """Test DownloadPackages() caps the number of download threads."""
+    self.mox.StubOutWithMock(client.threading, 'Thread')
+    thread = self.mox.CreateMockAnything()
+    for _ in xrange(client.MAX_DOWNLOAD_CONCURRENCY_PER_HOST):
+      client.threading.Thread(target=mox.IgnoreArg()).AndReturn(thread)
+    thread.start().MultipleTimes()
+    thread.join().MultipleTimes()
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        {}, self.client.DownloadPackages(
+            ['pkg%d' % i for i in xrange(20)], '/cache', concurrency=20))
+    self.mox.VerifyAll()
+
   def testPostReport(self):
     """Test PostReport()."""
     report_type = 'foo'
@@ -1559,7 +2336,8 @@ class SimianClientTest(mox.MoxTestBase):
 
     self.client._IsPackageUploadNecessary(file_path, pkginfo).AndReturn(True)
     self.client.PutPackage(
-        filename, params, input_filename=file_path).AndReturn('Success')
+        filename, params, input_filename=file_path, sha256=None).AndReturn(
+            'Success')
 
     self.mox.ReplayAll()
     r = self.client.UploadPackage(
@@ -1572,6 +2350,36 @@ class SimianClientTest(mox.MoxTestBase):
     self.assertEqual(len(r), 4)
     self.mox.VerifyAll()
 
+  def testUploadPackageWhenLargePackage(self):
+    """Test UploadPackage() uploads a large package in chunks."""
+    file_path = '/path/to/filename.dmg'
+    catalogs = ['catalog1']
+    install_types = ['managed_installs']
+    params = {
+        'pkginfo': 'pkginfo',
+        'catalogs': 'catalog1',
+        'manifests': '',
+        'install_types': 'managed_installs',
+    }
+    self.mox.StubOutWithMock(self.client, 'PutPackageChunked')
+    self.mox.StubOutWithMock(self.client, '_IsPackageUploadNecessary')
+    self.mox.StubOutWithMock(client.os.path, 'isfile')
+    self.mox.StubOutWithMock(client.os.path, 'getsize')
+
+    self.client._IsPackageUploadNecessary(file_path, 'pkginfo').AndReturn(True)
+    client.os.path.isfile(file_path).AndReturn(True)
+    client.os.path.getsize(file_path).AndReturn(
+        client.CHUNKED_UPLOAD_MIN_SIZE)
+    self.client.PutPackageChunked(
+        'filename.dmg', params, file_path, sha256='hash').AndReturn('key')
+
+    self.mox.ReplayAll()
+    r = self.client.UploadPackage(
+        file_path, 'desc', 'name', catalogs, None, install_types, 'pkginfo',
+        sha256='hash')
+    self.assertEqual(('key', 'filename.dmg', catalogs, []), r)
+    self.mox.VerifyAll()
+
   def testUploadPackageWhenUploadNotNecessary(self):
     """Test UploadPackage()."""
     file_path = '/path/to/filename.dmg'
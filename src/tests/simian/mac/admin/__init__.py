@@ -98,6 +98,8 @@ def GetMenu():
             'name': 'IP Blacklist'},
            {'type': 'lock_admin', 'url': '/admin/lock_admin',
             'name': 'Lock Admin'},
+           {'type': 'profiling', 'url': '/admin/profiling',
+            'name': 'Request Profiling'},
            {'type': 'release_report', 'url': '/admin/release_report',
             'name': 'Release Report'},
            {'type': 'panic', 'url': '/admin/panic', 'name': 'Panic Mode'}
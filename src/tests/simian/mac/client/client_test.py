@@ -424,16 +424,17 @@ class SimianClient(mox.MoxTestBase):
     pkginfo.__setitem__('forced_install', True).AndReturn(None)
     pkginfo.__setitem__('name', pkginfo_name).AndReturn(None)
     pkginfo.Validate().AndReturn(None)
+    pkginfo.GetContents().AndReturn(pkginfo_dict)
+    pkginfo.GetContents().AndReturn(pkginfo_dict)
+    pkginfo.GetContents().AndReturn(pkginfo_dict)
     pkginfo.GetXml().AndReturn('pkginfo xml')
 
     self.client.UploadPackage(
         filename, description, display_name, catalogs, manifests, install_types,
-        'pkginfo xml').AndReturn((response, filename, catalogs, manifests))
+        'pkginfo xml', sha256='hash').AndReturn(
+            (response, filename, catalogs, manifests))
 
     pkginfo.GetPackageName().AndReturn('pkg name')
-    pkginfo.GetContents().AndReturn(pkginfo_dict)
-    pkginfo.GetContents().AndReturn(pkginfo_dict)
-    pkginfo.GetContents().AndReturn(pkginfo_dict)
 
     self.mox.ReplayAll()
     self.assertEqual(
@@ -470,16 +471,17 @@ class SimianClient(mox.MoxTestBase):
     pkginfo.__setitem__('unattended_uninstall', True).AndReturn(None)
     pkginfo.__setitem__('forced_uninstall', True).AndReturn(None)
     pkginfo.Validate().AndReturn(None)
+    pkginfo.GetContents().AndReturn(pkginfo_dict)
+    pkginfo.GetContents().AndReturn(pkginfo_dict)
+    pkginfo.GetContents().AndReturn(pkginfo_dict)
     pkginfo.GetXml().AndReturn('pkginfo xml')
 
     self.client.UploadPackage(
         filename, description, display_name, catalogs, manifests, install_types,
-        'pkginfo xml').AndReturn((response, filename, catalogs, manifests))
+        'pkginfo xml', sha256='hash').AndReturn(
+            (response, filename, catalogs, manifests))
 
     pkginfo.GetPackageName().AndReturn('pkg name')
-    pkginfo.GetContents().AndReturn(pkginfo_dict)
-    pkginfo.GetContents().AndReturn(pkginfo_dict)
-    pkginfo.GetContents().AndReturn(pkginfo_dict)
 
     self.mox.ReplayAll()
     self.assertEqual(
@@ -515,16 +517,17 @@ class SimianClient(mox.MoxTestBase):
         filename, description, display_name, catalogs).AndReturn(pkginfo)
     pkginfo_hooks[0](pkginfo).AndReturn(True)
     pkginfo.Validate().AndReturn(None)
+    pkginfo.GetContents().AndReturn(pkginfo_dict)
+    pkginfo.GetContents().AndReturn(pkginfo_dict)
+    pkginfo.GetContents().AndReturn(pkginfo_dict)
     pkginfo.GetXml().AndReturn('pkginfo xml')
 
     self.client.UploadPackage(
         filename, description, display_name, catalogs, manifests, install_types,
-        'pkginfo xml').AndReturn((response, filename, catalogs, manifests))
+        'pkginfo xml', sha256='hash').AndReturn(
+            (response, filename, catalogs, manifests))
 
     pkginfo.GetPackageName().AndReturn('pkg name')
-    pkginfo.GetContents().AndReturn(pkginfo_dict)
-    pkginfo.GetContents().AndReturn(pkginfo_dict)
-    pkginfo.GetContents().AndReturn(pkginfo_dict)
 
     self.mox.ReplayAll()
     self.assertEqual(
@@ -596,16 +599,17 @@ class SimianClient(mox.MoxTestBase):
     pkginfo.__getitem__('description').AndReturn(description)
     pkginfo.__getitem__('display_name').AndReturn(display_name)
     pkginfo.__getitem__('catalogs').AndReturn(catalogs)
+    pkginfo.GetContents().AndReturn(pkginfo_dict)
+    pkginfo.GetContents().AndReturn(pkginfo_dict)
+    pkginfo.GetContents().AndReturn(pkginfo_dict)
     pkginfo.GetXml().AndReturn('pkginfo xml')
 
     self.client.UploadPackage(
         filename, description, display_name, catalogs, manifests, install_types,
-        'pkginfo xml').AndReturn((response, filename, catalogs, manifests))
+        'pkginfo xml', sha256='hash').AndReturn(
+            (response, filename, catalogs, manifests))
 
     pkginfo.GetPackageName().AndReturn('pkg name')
-    pkginfo.GetContents().AndReturn(pkginfo_dict)
-    pkginfo.GetContents().AndReturn(pkginfo_dict)
-    pkginfo.GetContents().AndReturn(pkginfo_dict)
 
     self.mox.ReplayAll()
     self.assertEqual(
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+import mox
+import stubout
+
+from google.apputils import basetest
+
+# Import and load mock modules before importing flight_common.
+# pylint: disable=g-bad-import-order
+# pylint: disable=g-import-not-at-top
+from tests.simian.mac.client import munkicommon_mock
+munkicommon_mock.LoadMockModules()
+
+from simian.mac.client import flight_common
+
+
+class ExecTest(mox.MoxTestBase):
+  """Test Exec() and ExecParallel(), with real processes."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testExec(self):
+    """Test Exec() of a process which exits."""
+    self.assertEqual(
+        (3, 'out\n', 'err\n'),
+        flight_common.Exec(
+            '/bin/echo out; /bin/echo err >&2; exit 3', timeout=10))
+
+  def testExecWithSubSecondTimeout(self):
+    """Test Exec() kills a silent process at a sub-second deadline."""
+    start = time.time()
+    return_code, stdout, _ = flight_common.Exec(
+        ['/bin/sleep', '10'], timeout=0.2, waitfor=0.5)
+    self.assertTrue(time.time() - start < 5)
+    self.assertEqual(-flight_common.signal.SIGTERM, return_code)
+    self.assertEqual('', stdout)
+
+  def testExecWithTimeoutWhenChatty(self):
+    """Test Exec() kills a process writing output without pause on time."""
+    start = time.time()
+    return_code, stdout, _ = flight_common.Exec(
+        ['/usr/bin/yes'], timeout=0.5, waitfor=0.5, max_output_bytes=1024)
+    self.assertTrue(time.time() - start < 5)
+    self.assertEqual(-flight_common.signal.SIGTERM, return_code)
+    self.assertEqual('y\n' * 512, stdout)
+
+  def testExecTruncatesOutput(self):
+    """Test Exec() truncates stdout at max_output_bytes."""
+    self.stubs.Set(flight_common, 'EXEC_READ_BYTES', 3)
+    self.assertEqual(
+        (0, '0123', ''),
+        flight_common.Exec(
+            ['/usr/bin/printf', '0123456789'], max_output_bytes=4))
+
+  def testExecWithStdoutFile(self):
+    """Test Exec() writes stdout to stdout_file."""
+    f = tempfile.TemporaryFile()
+    self.assertEqual(
+        (0, '', ''),
+        flight_common.Exec(
+            ['/usr/bin/printf', '0123456789'], max_output_bytes=4,
+            stdout_file=f))
+    f.seek(0)
+    self.assertEqual('0123456789', f.read())
+    f.close()
+
+  def testExecParallel(self):
+    """Test ExecParallel() returns results in the order of execs."""
+    self.assertEqual(
+        [(0, 'first\n', ''), (0, 'second\n', ''), (1, '', '')],
+        flight_common.ExecParallel([
+            {'cmd': '/bin/sleep 0.3; /bin/echo first'},
+            {'cmd': ['/bin/echo', 'second']},
+            {'cmd': ['/bin/sh', '-c', 'exit 1'], 'timeout': 10},
+        ]))
+
+  def testExecParallelWhenNotStarted(self):
+    """Test ExecParallel() with a process which cannot be started."""
+    self.assertRaises(
+        OSError, flight_common.ExecParallel, [
+            {'cmd': ['/bin/sleep', '10']},
+            {'cmd': ['/nonexistent/command']},
+        ])
+
+
+class GetClientIdentifierTest(mox.MoxTestBase):
+  """Test GetClientIdentifier()."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.stubs.Set(flight_common, 'GetPlistDateValue', lambda *a, **kw: None)
+    self.stubs.Set(flight_common, 'GetSystemUptime', lambda: 1.0)
+    self.stubs.Set(flight_common, 'GetDiskFree', lambda path=None: 1)
+    self.stubs.Set(flight_common, 'GetClientVersion', lambda: '2.0')
+    self.stubs.Set(flight_common, '_GetHardwareUUID', lambda: 'HWUUID')
+    self.stubs.Set(flight_common, '_GetPrimaryUser', lambda: None)
+    self.stubs.Set(flight_common, '_GetConsoleUser', lambda: None)
+    self.stubs.Set(flight_common, '_GetHostname', lambda: 'host')
+    self.stubs.Set(flight_common, '_GetSerialNumber', lambda: 'serial')
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testGetClientIdentifierWhenOnCorpCmdFails(self):
+    """Test facter's result is kept when on_corp_cmd cannot be started."""
+    self.mox.StubOutWithMock(flight_common, '_GetOnCorpCmd')
+    self.mox.StubOutWithMock(flight_common, '_GetCachedFacterContents')
+    self.mox.StubOutWithMock(flight_common, 'ExecParallel')
+    self.mox.StubOutWithMock(flight_common, 'Exec')
+    self.mox.StubOutWithMock(flight_common, '_CacheFacterOutput')
+    facter_exec = {
+        'cmd': flight_common.FACTER_CMD,
+        'timeout': flight_common.FACTER_TIMEOUT}
+    on_corp_exec = {
+        'cmd': '/bad/on_corp_cmd',
+        'timeout': flight_common.ON_CORP_CMD_TIMEOUT}
+    flight_common._GetOnCorpCmd().AndReturn('/bad/on_corp_cmd')
+    flight_common._GetCachedFacterContents().AndReturn({})
+    flight_common.ExecParallel(
+        [facter_exec, on_corp_exec], waitfor=0.5).AndRaise(OSError)
+    flight_common.Exec(waitfor=0.5, **facter_exec).AndReturn(
+        (0, 'certname => FACTERUUID', ''))
+    flight_common.Exec(waitfor=0.5, **on_corp_exec).AndRaise(OSError)
+    flight_common._CacheFacterOutput(
+        0, 'certname => FACTERUUID').AndReturn({'certname': 'FACTERUUID'})
+
+    self.mox.ReplayAll()
+    client_id = flight_common.GetClientIdentifier('auto')
+    self.mox.VerifyAll()
+    self.assertEqual('facteruuid', client_id['uuid'])
+    self.assertEqual(None, client_id['on_corp'])
+
+  def testGetClientIdentifierWhenFacterFails(self):
+    """Test on_corp_cmd's result is kept when facter cannot be started."""
+    self.mox.StubOutWithMock(flight_common, '_GetOnCorpCmd')
+    self.mox.StubOutWithMock(flight_common, '_GetCachedFacterContents')
+    self.mox.StubOutWithMock(flight_common, 'ExecParallel')
+    self.mox.StubOutWithMock(flight_common, 'Exec')
+    flight_common._GetOnCorpCmd().AndReturn('/on_corp_cmd')
+    flight_common._GetCachedFacterContents().AndReturn({})
+    flight_common.ExecParallel(
+        mox.IgnoreArg(), waitfor=0.5).AndRaise(OSError)
+    flight_common.Exec(
+        waitfor=0.5, cmd=flight_common.FACTER_CMD,
+        timeout=flight_common.FACTER_TIMEOUT).AndRaise(OSError)
+    flight_common.Exec(
+        waitfor=0.5, cmd='/on_corp_cmd',
+        timeout=flight_common.ON_CORP_CMD_TIMEOUT).AndReturn((0, '', ''))
+
+    self.mox.ReplayAll()
+    client_id = flight_common.GetClientIdentifier('auto')
+    self.mox.VerifyAll()
+    self.assertEqual('hwuuid', client_id['uuid'])
+    self.assertEqual('1', client_id['on_corp'])
+
+
+class InstallReportsTest(mox.MoxTestBase):
+  """Test the upload of ManagedInstallReport installs."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _Ack(self, num_reports):
+    """Returns the response acknowledging a batch of num_reports."""
+    return flight_common.JSON_PREFIX + json.dumps({'reports': num_reports})
+
+  def testBatchInstallReports(self):
+    """Test _BatchInstallReports() caps the size of batches."""
+    self.stubs.Set(flight_common, 'INSTALL_REPORT_BATCH_MAX_BYTES', 20)
+    install_reports = [
+        ('a', {'removals': []}),  # 16 bytes of JSON.
+        ('b', {'r': 1}),  # 8 bytes.
+        ('c', {'r': 2}),
+        ('d', {'removals': ['too large']}),
+        ('e', {'r': 3}),
+    ]
+
+    batches = flight_common._BatchInstallReports(install_reports)
+
+    self.assertEqual(
+        [['a'], ['b', 'c'], ['d'], ['e']],
+        [[key for key, _, _ in batch] for batch in batches])
+    self.assertEqual(
+        ('b', {'r': 1}, '{"r": 1}'), batches[1][0])
+
+  def testUploadInstallReportBatch(self):
+    """Test _UploadInstallReportBatch()."""
+    client = self.mox.CreateMockAnything()
+    batch = [('a', {'r': 1}, '{"r": 1}'), ('b', {'r': 2}, '{"r": 2}')]
+    client.PostReport('install_report_batch', {
+        'on_corp': '1', 'reports': '[{"r": 1},{"r": 2}]'}).AndReturn(
+            self._Ack(2))
+
+    self.mox.ReplayAll()
+    flight_common._UploadInstallReportBatch(client, '1', batch)
+    self.mox.VerifyAll()
+
+  def testUploadInstallReportBatchWhenNotAcknowledged(self):
+    """Test _UploadInstallReportBatch() with a wrong acknowledgement."""
+    client = self.mox.CreateMockAnything()
+    batch = [('a', {'r': 1}, '{"r": 1}'), ('b', {'r': 2}, '{"r": 2}')]
+    client.PostReport('install_report_batch', mox.IgnoreArg()).AndReturn(
+        self._Ack(1))
+    client.PostReport('install_report_batch', mox.IgnoreArg()).AndReturn('')
+
+    self.mox.ReplayAll()
+    for _ in xrange(2):
+      self.assertRaises(
+          flight_common.ServerRequestError,
+          flight_common._UploadInstallReportBatch, client, '1', batch)
+    self.mox.VerifyAll()
+
+  def testUploadInstallReportBatchWhenServerError(self):
+    """Test _UploadInstallReportBatch() when the server fails."""
+    client = self.mox.CreateMockAnything()
+    batch = [('a', {'r': 1}, '{"r": 1}')]
+    client.PostReport('install_report_batch', mox.IgnoreArg()).AndRaise(
+        flight_common.simian_client.SimianServerError(
+            500, 'Internal Server Error', ''))
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        flight_common.ServerRequestError,
+        flight_common._UploadInstallReportBatch, client, '1', batch)
+    self.mox.VerifyAll()
+
+  def testUploadInstallReportBatchWhenRejected(self):
+    """Test _UploadInstallReportBatch() drops a batch rejected as malformed."""
+    client = self.mox.CreateMockAnything()
+    batch = [('a', {'r': 1}, '{"r": 1}')]
+    client.PostReport('install_report_batch', mox.IgnoreArg()).AndRaise(
+        flight_common.simian_client.SimianServerError(
+            400, 'Bad Request', ''))
+
+    self.mox.ReplayAll()
+    flight_common._UploadInstallReportBatch(client, '1', batch)
+    self.mox.VerifyAll()
+
+  def testUploadAllManagedInstallReports(self):
+    """Test UploadAllManagedInstallReports() keeps unacknowledged reports."""
+    self.stubs.Set(flight_common, 'INSTALL_REPORT_BATCH_MAX_BYTES', 1)
+    archives_dir = os.path.join(self.temp_dir, 'Archives')
+    os.mkdir(archives_dir)
+    archive_paths = []
+    for i in xrange(3):
+      archive_paths.append(
+          os.path.join(archives_dir, 'ManagedInstallReport-%d.plist' % i))
+      open(archive_paths[-1], 'w').close()
+    open(os.path.join(archives_dir, 'other.plist'), 'w').close()
+    current_path = os.path.join(self.temp_dir, 'ManagedInstallReport.plist')
+    current_report = {
+        'InstallResults': [], 'RemovalResults': ['removal3'],
+        'ProblemInstalls': [], 'StartTime': 'foo'}
+
+    self.mox.StubOutWithMock(flight_common.munkicommon, 'pref')
+    self.mox.StubOutWithMock(flight_common, 'GetManagedInstallReport')
+    self.mox.StubOutWithMock(flight_common.fpl, 'writePlist')
+    client = self.mox.CreateMockAnything()
+    flight_common.munkicommon.pref('ManagedInstallDir').AndReturn(
+        self.temp_dir)
+    flight_common.GetManagedInstallReport(
+        install_report_path=archive_paths[0]).AndReturn(
+            ({'RemovalResults': ['removal0']}, archive_paths[0]))
+    flight_common.GetManagedInstallReport(
+        install_report_path=archive_paths[1]).AndReturn(
+            ({'RemovalResults': []}, archive_paths[1]))
+    flight_common.GetManagedInstallReport(
+        install_report_path=archive_paths[2]).AndReturn(
+            ({'ProblemInstalls': ['problem2']}, archive_paths[2]))
+    flight_common.GetManagedInstallReport().AndReturn(
+        (current_report, current_path))
+    client.PostReport('install_report_batch', {
+        'on_corp': '1', 'reports': mox.StrContains('removal0')}).AndReturn(
+            self._Ack(1))
+    client.PostReport('install_report_batch', {
+        'on_corp': '1', 'reports': mox.StrContains('problem2')}).AndRaise(
+            flight_common.simian_client.SimianServerError(
+                503, 'Service Unavailable', ''))
+    client.PostReport('install_report_batch', {
+        'on_corp': '1', 'reports': mox.StrContains('removal3')}).AndReturn(
+            self._Ack(1))
+    flight_common.fpl.writePlist({
+        'InstallResults': [], 'RemovalResults': [], 'ProblemInstalls': [],
+        'StartTime': 'foo'}, current_path)
+
+    self.mox.ReplayAll()
+    flight_common.UploadAllManagedInstallReports(client, '1')
+    self.mox.VerifyAll()
+    # the report with nothing to report is deleted without an upload, the
+    # one whose upload failed is kept for the next run.
+    self.assertEqual(
+        [False, False, True], [os.path.exists(p) for p in archive_paths])
+
+
+
+class LogFilesTest(mox.MoxTestBase):
+  """Test the upload of client log files."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _WriteFile(self, name, data):
+    """Writes a file in the temp dir; returns its path."""
+    path = os.path.join(self.temp_dir, name)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+    return path
+
+  def testTailFile(self):
+    """Test _TailFile()."""
+    path = self._WriteFile('a.log', '0123456789')
+    self.assertEqual('0123456789', flight_common._TailFile(path, 10))
+    self.assertEqual(
+        '*** Log truncated by Simian due to size ***\n\n6789',
+        flight_common._TailFile(path, 4))
+
+  def testUploadClientLogFiles(self):
+    """Test UploadClientLogFiles() uploads a bundle of tailed logs."""
+    self.stubs.Set(flight_common, 'LOG_UPLOAD_MAX_BYTES', 4)
+    self._WriteFile('InstallInfo.plist', 'plist')
+    self._WriteFile(os.path.join('Logs', 'ManagedSoftwareUpdate.log'), 'log')
+    exists = os.path.exists
+    # only the logs of the temp dir exist, not those of the host.
+    self.stubs.Set(
+        flight_common.os.path, 'exists',
+        lambda p: p.startswith(self.temp_dir) and exists(p))
+    uploaded = {}
+
+    def ReadBundle(bundle_path, unused_file_type):
+      tar = tarfile.open(bundle_path, 'r:gz')
+      for member in tar:
+        uploaded[member.name] = tar.extractfile(member).read()
+      tar.close()
+
+    self.mox.StubOutWithMock(flight_common.munkicommon, 'pref')
+    self.mox.StubOutWithMock(flight_common, 'Exec')
+    client = self.mox.CreateMockAnything()
+    flight_common.munkicommon.pref('ManagedInstallDir').AndReturn(
+        self.temp_dir)
+    flight_common.Exec(['/bin/ps', '-ef']).AndReturn((0, 'ps output', ''))
+    client.UploadFile(
+        mox.StrContains(flight_common.LOG_BUNDLE_NAME),
+        'logbundle').WithSideEffects(ReadBundle)
+
+    self.mox.ReplayAll()
+    flight_common.UploadClientLogFiles(client)
+    self.mox.VerifyAll()
+    self.assertEqual({
+        'InstallInfo.plist':
+            '*** Log truncated by Simian due to size ***\n\nlist',
+        'ManagedSoftwareUpdate.log': 'log',
+        'ps_ef_output': 'ps output',
+    }, uploaded)
+
+if __name__ == '__main__':
+  basetest.main()
@@ -36,6 +36,25 @@ class munkicommon(object):  # pylint: disable=g-bad-name
   def cleanUpTmpDir(cls):  # pylint: disable=g-bad-name
     pass
 
+  @classmethod
+  def pref(cls, unused_pref_name):
+    return None
+
+
+class FoundationPlist(object):  # pylint: disable=g-bad-name
+  """Mock FoundationPlist module."""
+
+  class NSPropertyListSerializationException(Exception):
+    pass
+
+  @classmethod
+  def readPlist(cls, unused_path):  # pylint: disable=g-bad-name
+    return {}
+
+  @classmethod
+  def writePlist(cls, unused_plist, unused_path):  # pylint: disable=g-bad-name
+    pass
+
 
 def LoadMockModules():
   sys.modules['munkilib'] = sys.modules[__name__]
@@ -16,6 +16,8 @@
 #
 
 
+import StringIO
+
 import mox
 import stubout
 
@@ -58,6 +60,7 @@ class PreflightTest(mox.MoxTestBase):
     user_settings = {'setting1': 'value1'}
 
     self.mox.StubOutWithMock(preflight, 'NoteLastRun')
+    self.mox.StubOutWithMock(preflight, 'IsCheckinDeferred')
     self.mox.StubOutWithMock(
         preflight.munkicommon, 'ManagedInstallsPreferences')
     self.mox.StubOutWithMock(
@@ -81,13 +84,15 @@ class PreflightTest(mox.MoxTestBase):
     mock_client = self.mox.CreateMockAnything()
 
     preflight.NoteLastRun().AndReturn(None)
+    preflight.IsCheckinDeferred().AndReturn(False)
     preflight.munkicommon.ManagedInstallsPreferences().AndReturn(prefs)
     preflight.munkicommon.SecureManagedInstallsPreferences().AndReturn(
         secure_config)
     preflight.flight_common.GetClientIdentifier('auto').AndReturn(client_id)
     preflight.flight_common.GetUserSettings().AndReturn(user_settings)
     preflight.LoginToServer(
-        secure_config, client_id, user_settings, None).AndReturn((
+        secure_config, client_id, user_settings, None,
+        runtype='auto').AndReturn((
             mock_client, feedback))
     preflight.WriteRootCaCerts(mock_client)
     preflight.flight_common.UploadClientLogFiles(mock_client)
@@ -100,6 +105,49 @@ class PreflightTest(mox.MoxTestBase):
     preflight.RunPreflight('auto')
     self.mox.VerifyAll()
 
+  def testRunPreflightWhenDeferred(self):
+    """Test RunPreflight() exits without checking in when deferred."""
+    self.mox.StubOutWithMock(preflight, 'NoteLastRun')
+    self.mox.StubOutWithMock(preflight, 'IsCheckinDeferred')
+    preflight.NoteLastRun().AndReturn(None)
+    preflight.IsCheckinDeferred().AndReturn(True)
+
+    self.mox.ReplayAll()
+    try:
+      preflight.RunPreflight('auto')
+      self.fail('RunPreflight() did not exit')
+    except SystemExit, e:
+      self.assertEqual(preflight.STATUS_SERVER_DEFER_FEEDBACK[0], e.code)
+    self.mox.VerifyAll()
+
+  def testDeferCheckin(self):
+    """Test DeferCheckin() and IsCheckinDeferred()."""
+    files = {}
+
+    def _Open(filename, mode):
+      if mode == 'w':
+        files[filename] = StringIO.StringIO()
+        files[filename].close = lambda: None
+        return files[filename]
+      if filename not in files:
+        raise IOError(filename)
+      return StringIO.StringIO(files[filename].getvalue())
+
+    self.mox.StubOutWithMock(preflight.time, 'time')
+    self.mox.StubOutWithMock(preflight.random, 'uniform')
+    preflight.time.time().AndReturn(1000)
+    preflight.random.uniform(0, 60).AndReturn(30)
+    preflight.time.time().AndReturn(1100)
+    preflight.time.time().AndReturn(1150)
+
+    self.mox.ReplayAll()
+    self.assertFalse(preflight.IsCheckinDeferred(open_=_Open))
+    preflight.DeferCheckin(120, 60, open_=_Open)
+    self.assertEqual('1150', files[preflight.DEFER_UNTIL_FILE].getvalue())
+    self.assertTrue(preflight.IsCheckinDeferred(open_=_Open))
+    self.assertFalse(preflight.IsCheckinDeferred(open_=_Open))
+    self.mox.VerifyAll()
+
 
 if __name__ == '__main__':
   basetest.main()
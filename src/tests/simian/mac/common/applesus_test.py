@@ -65,7 +65,8 @@ class AppleModuleTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(applesus.models.AppleSUSCatalog, 'get_by_key_name')
 
     applesus.gae_util.ReleaseLock(
-        applesus.CATALOG_REGENERATION_LOCK_NAME % track)
+        applesus.CATALOG_REGENERATION_LOCK_NAME % track, token=None,
+        durable=True)
     applesus.models.AppleSUSCatalog.get_by_key_name(
         '%s_untouched' % os_version).AndReturn(None)
 
@@ -99,7 +100,8 @@ class AppleModuleTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(applesus.models.AppleSUSProduct, 'AllActive')
 
     applesus.gae_util.ReleaseLock(
-        applesus.CATALOG_REGENERATION_LOCK_NAME % track)
+        applesus.CATALOG_REGENERATION_LOCK_NAME % track, token=None,
+        durable=True)
 
     applesus.models.AppleSUSCatalog.get_by_key_name(
         '%s_untouched' % os_version).AndReturn(mock_catalog_obj)
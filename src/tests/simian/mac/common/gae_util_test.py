@@ -91,39 +91,81 @@ class GaeUtilModuleTest(mox.MoxTestBase):
     self.assertEqual(blob_str, gae_util.GetBlobAndDel(blobstore_key))
     self.mox.VerifyAll()
     
+  def _StubLockDeps(self, token='tok'):
+    """Stub memcache, uuid and lock stats for ObtainLock tests."""
+    self.mox.StubOutWithMock(gae_util, 'memcache')
+    self.mox.StubOutWithMock(gae_util, '_RecordLockStats')
+    self.mox.StubOutWithMock(gae_util.uuid, 'uuid4')
+    uuid_obj = self.mox.CreateMockAnything()
+    uuid_obj.hex = token
+    gae_util.uuid.uuid4().AndReturn(uuid_obj)
+
+  def _ExpectAddWhenHeld(self, lock):
+    """Expect a failed attempt to acquire a lock held by another owner."""
+    mock_client = self.mox.CreateMockAnything()
+    gae_util.memcache.add(
+        'lock_%s' % lock, 'tok', time=mox.IgnoreArg()).AndReturn(False)
+    gae_util.memcache.Client().AndReturn(mock_client)
+    mock_client.gets('lock_%s' % lock).AndReturn('other')
+
   def testObtainLock(self):
     """Test ObtainLock()."""
     lock = 'foo'
-    self.mox.StubOutWithMock(gae_util, 'memcache')
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(1)
+    self._StubLockDeps()
+    gae_util.memcache.add(
+        'lock_%s' % lock, 'tok', time=gae_util.LOCK_DEFAULT_TTL).AndReturn(True)
+    gae_util._RecordLockStats(lock, 1, mox.IsA(float), True)
     self.mox.ReplayAll()
-    self.assertTrue(gae_util.ObtainLock(lock))
+    self.assertEqual('tok', gae_util.ObtainLock(lock))
+    self.mox.VerifyAll()
+
+  def testObtainLockWithTtl(self):
+    """Test ObtainLock() with a ttl."""
+    lock = 'foo'
+    self._StubLockDeps()
+    gae_util.memcache.add('lock_%s' % lock, 'tok', time=30).AndReturn(True)
+    gae_util._RecordLockStats(lock, 1, mox.IsA(float), True)
+    self.mox.ReplayAll()
+    self.assertEqual('tok', gae_util.ObtainLock(lock, ttl=30))
     self.mox.VerifyAll()
 
   def testObtainLockWhenTimeoutTrue(self):
     """Test ObtainLock()."""
     lock = 'foo'
-    self.mox.StubOutWithMock(gae_util, 'memcache')
+    self._StubLockDeps()
+    self.mox.StubOutWithMock(gae_util.time, 'time')
     self.mox.StubOutWithMock(gae_util.time, 'sleep')
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(2)
-    gae_util.time.sleep(1).AndReturn(None)
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(1)
+    gae_util.time.time().AndReturn(100.0)
+    self._ExpectAddWhenHeld(lock)
+    gae_util.time.time().AndReturn(100.0)
+    gae_util.time.sleep(gae_util.LOCK_WAIT_MIN_SLEEP).AndReturn(None)
+    gae_util.memcache.add(
+        'lock_%s' % lock, 'tok', time=mox.IgnoreArg()).AndReturn(True)
+    gae_util.time.time().AndReturn(100.5)
+    gae_util._RecordLockStats(lock, 2, 0.5, True)
     self.mox.ReplayAll()
     self.assertTrue(gae_util.ObtainLock(lock, timeout=1))
     self.mox.VerifyAll()
 
   def testObtainLockWhenTimeoutFalse(self):
-    """Test ObtainLock()."""
+    """Test ObtainLock() backs off until the timeout passes."""
     lock = 'foo'
-    self.mox.StubOutWithMock(gae_util, 'memcache')
+    self._StubLockDeps()
+    self.mox.StubOutWithMock(gae_util.time, 'time')
     self.mox.StubOutWithMock(gae_util.time, 'sleep')
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(2)
-    gae_util.time.sleep(1).AndReturn(None)
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(2)
-    gae_util.time.sleep(1).AndReturn(None)
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(2)
-    gae_util.time.sleep(1).AndReturn(None)
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(2)
+    self.stubs.Set(gae_util, 'LOCK_WAIT_MIN_SLEEP', 0.5)
+    self.stubs.Set(gae_util, 'LOCK_WAIT_MAX_SLEEP', 1.0)
+    gae_util.time.time().AndReturn(100.0)
+    # sleeps double up to LOCK_WAIT_MAX_SLEEP, bounded by remaining time.
+    for now, sleep in ((100.0, 0.5), (100.5, 1.0), (101.5, 1.0),
+                       (102.5, 0.5)):
+      self._ExpectAddWhenHeld(lock)
+      gae_util.time.time().AndReturn(now)
+      gae_util.time.sleep(sleep).AndReturn(None)
+    self._ExpectAddWhenHeld(lock)
+    gae_util.time.time().AndReturn(103.0)
+    gae_util.time.time().AndReturn(103.0)
+    gae_util._RecordLockStats(lock, 5, 3.0, False)
     self.mox.ReplayAll()
     self.assertFalse(gae_util.ObtainLock(lock, timeout=3))
     self.mox.VerifyAll()
@@ -131,21 +173,306 @@ class GaeUtilModuleTest(mox.MoxTestBase):
   def testObtainLockWhenFail(self):
     """Test ObtainLock()."""
     lock = 'foo'
-    self.mox.StubOutWithMock(gae_util, 'memcache')
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(2)
+    self._StubLockDeps()
+    self._ExpectAddWhenHeld(lock)
+    gae_util._RecordLockStats(lock, 1, mox.IsA(float), False)
     self.mox.ReplayAll()
     self.assertFalse(gae_util.ObtainLock(lock))
     self.mox.VerifyAll()
 
+  def testObtainLockWhenReleased(self):
+    """Test ObtainLock() takes over a lock released by its owner."""
+    lock = 'foo'
+    self._StubLockDeps()
+    mock_client = self.mox.CreateMockAnything()
+    gae_util.memcache.add(
+        'lock_%s' % lock, 'tok', time=mox.IgnoreArg()).AndReturn(False)
+    gae_util.memcache.Client().AndReturn(mock_client)
+    mock_client.gets('lock_%s' % lock).AndReturn(gae_util.LOCK_RELEASED)
+    mock_client.cas(
+        'lock_%s' % lock, 'tok', time=gae_util.LOCK_DEFAULT_TTL).AndReturn(
+            True)
+    gae_util._RecordLockStats(lock, 1, mox.IsA(float), True)
+    self.mox.ReplayAll()
+    self.assertEqual('tok', gae_util.ObtainLock(lock))
+    self.mox.VerifyAll()
+
+  def testObtainLockDurable(self):
+    """Test ObtainLock() with durable=True."""
+    lock = 'foo'
+    self._StubLockDeps()
+    self.mox.StubOutWithMock(gae_util.db, 'run_in_transaction')
+    gae_util.db.run_in_transaction(mox.IgnoreArg()).AndReturn(True)
+    gae_util.memcache.set(
+        'lock_%s' % lock, 'tok', time=gae_util.LOCK_DEFAULT_TTL)
+    gae_util._RecordLockStats(lock, 1, mox.IsA(float), True)
+    self.mox.ReplayAll()
+    self.assertEqual('tok', gae_util.ObtainLock(lock, durable=True))
+    self.mox.VerifyAll()
+
+  def testObtainLockDurableWhenTransactionFails(self):
+    """Test ObtainLock() with durable=True when the transaction fails."""
+    lock = 'foo'
+    self._StubLockDeps()
+    self.mox.StubOutWithMock(gae_util.db, 'run_in_transaction')
+    gae_util.db.run_in_transaction(mox.IgnoreArg()).AndRaise(
+        gae_util.db.TransactionFailedError)
+    gae_util._RecordLockStats(lock, 1, mox.IsA(float), False)
+    self.mox.ReplayAll()
+    self.assertFalse(gae_util.ObtainLock(lock, durable=True))
+    self.mox.VerifyAll()
+
+  def testGetLockStats(self):
+    """Test GetLockStats()."""
+    lock = 'foo'
+    self.mox.StubOutWithMock(gae_util, 'memcache')
+    gae_util.memcache.get_multi(
+        ['attempts', 'contended', 'acquired', 'failed', 'wait_ms'],
+        key_prefix='lock_stats_foo_').AndReturn({'attempts': 3, 'failed': 1})
+    self.mox.ReplayAll()
+    self.assertEqual(
+        {'attempts': 3, 'contended': 0, 'acquired': 0, 'failed': 1,
+         'wait_ms': 0},
+        gae_util.GetLockStats(lock))
+    self.mox.VerifyAll()
+
+  def testRecordLockStats(self):
+    """Test _RecordLockStats()."""
+    self.mox.StubOutWithMock(gae_util, 'memcache')
+    gae_util.memcache.offset_multi(
+        {'attempts': 3, 'contended': 1, 'acquired': 1, 'failed': 0,
+         'wait_ms': 250},
+        key_prefix='lock_stats_foo_', initial_value=0)
+    self.mox.ReplayAll()
+    gae_util._RecordLockStats('foo', 3, 0.25, True)
+    self.mox.VerifyAll()
+
+  def testLockExists(self):
+    """Test LockExists()."""
+    self.mox.StubOutWithMock(gae_util, 'memcache')
+    gae_util.memcache.get('lock_foo').AndReturn('tok')
+    gae_util.memcache.get('lock_foo').AndReturn(gae_util.LOCK_RELEASED)
+    gae_util.memcache.get('lock_foo').AndReturn(None)
+    self.mox.ReplayAll()
+    self.assertTrue(gae_util.LockExists('foo'))
+    self.assertFalse(gae_util.LockExists('foo'))
+    self.assertFalse(gae_util.LockExists('foo'))
+    self.mox.VerifyAll()
+
   def testReleaseLock(self):
-    """Test ReleaseLock()."""
+    """Test ReleaseLock() without an owner token."""
     lock = 'foo'
     self.mox.StubOutWithMock(gae_util, 'memcache')
     gae_util.memcache.delete('lock_%s' % lock)
     self.mox.ReplayAll()
     gae_util.ReleaseLock(lock)
     self.mox.VerifyAll()
-    
+
+  def testReleaseLockWhenOwner(self):
+    """Test ReleaseLock() with the token of the owner."""
+    lock = 'foo'
+    self.mox.StubOutWithMock(gae_util, 'memcache')
+    mock_client = self.mox.CreateMockAnything()
+    gae_util.memcache.Client().AndReturn(mock_client)
+    mock_client.gets('lock_%s' % lock).AndReturn('tok')
+    mock_client.cas(
+        'lock_%s' % lock, gae_util.LOCK_RELEASED,
+        time=gae_util.LOCK_RELEASED_TTL).AndReturn(True)
+    self.mox.ReplayAll()
+    gae_util.ReleaseLock(lock, token='tok')
+    self.mox.VerifyAll()
+
+  def testReleaseLockWhenNotOwner(self):
+    """Test ReleaseLock() leaves a lock obtained by another owner."""
+    lock = 'foo'
+    self.mox.StubOutWithMock(gae_util, 'memcache')
+    self.mox.StubOutWithMock(gae_util.logging, 'warning')
+    mock_client = self.mox.CreateMockAnything()
+    gae_util.memcache.Client().AndReturn(mock_client)
+    mock_client.gets('lock_%s' % lock).AndReturn('other')
+    gae_util.logging.warning(mox.IgnoreArg(), lock)
+    self.mox.ReplayAll()
+    gae_util.ReleaseLock(lock, token='tok')
+    self.mox.VerifyAll()
+
+  def testReleaseLockDurable(self):
+    """Test ReleaseLock() with durable=True."""
+    lock = 'foo'
+    self.mox.StubOutWithMock(gae_util, 'memcache')
+    self.mox.StubOutWithMock(gae_util.db, 'run_in_transaction')
+    gae_util.db.run_in_transaction(mox.IgnoreArg()).AndReturn(True)
+    gae_util.memcache.delete('lock_%s' % lock)
+    self.mox.ReplayAll()
+    gae_util.ReleaseLock(lock, token='tok', durable=True)
+    self.mox.VerifyAll()
+
+  def testReleaseLockDurableWhenNotOwner(self):
+    """Test ReleaseLock() with durable=True leaves another owner's lock."""
+    lock = 'foo'
+    self.mox.StubOutWithMock(gae_util, 'memcache')
+    self.mox.StubOutWithMock(gae_util.db, 'run_in_transaction')
+    self.mox.StubOutWithMock(gae_util.logging, 'warning')
+    gae_util.db.run_in_transaction(mox.IgnoreArg()).AndReturn(False)
+    gae_util.logging.warning(mox.IgnoreArg(), lock)
+    self.mox.ReplayAll()
+    gae_util.ReleaseLock(lock, token='tok', durable=True)
+    self.mox.VerifyAll()
+
+  def testReleaseLockWhenCasFails(self):
+    """Test ReleaseLock() when the lock changes while being released."""
+    lock = 'foo'
+    self.mox.StubOutWithMock(gae_util, 'memcache')
+    self.mox.StubOutWithMock(gae_util.logging, 'warning')
+    mock_client = self.mox.CreateMockAnything()
+    gae_util.memcache.Client().AndReturn(mock_client)
+    mock_client.gets('lock_%s' % lock).AndReturn('tok')
+    mock_client.cas(
+        'lock_%s' % lock, gae_util.LOCK_RELEASED,
+        time=gae_util.LOCK_RELEASED_TTL).AndReturn(False)
+    gae_util.logging.warning(mox.IgnoreArg(), lock)
+    self.mox.ReplayAll()
+    gae_util.ReleaseLock(lock, token='tok')
+    self.mox.VerifyAll()
+
+
+class FakeRPC(object):
+  """Fake datastore UserRPC."""
+
+  def __init__(self, error=None):
+    self.error = error
+
+  def get_result(self):
+    if self.error:
+      raise self.error
+
+
+class FakeModel(gae_util.db.Model):
+  """Model for BatchDatastoreOp tests."""
+
+
+class BatchDatastoreOpTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.batches = []
+    self.errors = []
+    self.stubs.Set(
+        gae_util, '_ASYNC_DATASTORE_OPS', {self._Op: self._AsyncOp})
+    self.stubs.Set(gae_util.time, 'sleep', lambda unused_s: None)
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _Op(self, batch):
+    """Fake synchronous operation."""
+    raise AssertionError('synchronous op used')
+
+  def _AsyncOp(self, batch):
+    """Fake async operation, failing with errors from self.errors."""
+    self.batches.append(list(batch))
+    if self.errors:
+      return FakeRPC(self.errors.pop(0))
+    return FakeRPC()
+
+  def testBatchDatastoreOpAsync(self):
+    """Test BatchDatastoreOpAsync()."""
+    self.stubs.Set(gae_util, 'BATCH_OP_TARGET_LATENCY', 0)
+    self.stubs.Set(gae_util, 'BATCH_OP_MAX_IN_FLIGHT', 1)
+    stats = gae_util.BatchDatastoreOpAsync(self._Op, range(10), 4)
+    self.assertEqual([[0, 1, 2, 3], [4, 5], [6], [7], [8], [9]], self.batches)
+    self.assertEqual(10, stats.items)
+    self.assertEqual(6, stats.batches)
+    self.assertEqual(0, stats.failed_items)
+
+  def testBatchDatastoreOpAsyncGrowsBatchSize(self):
+    """Test BatchDatastoreOpAsync() with fast batches."""
+    self.stubs.Set(gae_util, 'BATCH_OP_MAX_IN_FLIGHT', 1)
+    gae_util.BatchDatastoreOpAsync(self._Op, range(10), 2)
+    self.assertEqual([[0, 1], [2, 3, 4, 5], [6, 7, 8, 9]], self.batches)
+
+  def testBatchDatastoreOpAsyncMaxBytes(self):
+    """Test BatchDatastoreOpAsync() limits put batches by size."""
+    self.stubs.Set(
+        gae_util, '_ASYNC_DATASTORE_OPS', {gae_util.db.put: self._AsyncOp})
+    self.stubs.Set(gae_util, 'BATCH_OP_MAX_BYTES', 250)
+    self.stubs.Set(gae_util, '_EntitySize', lambda unused_e: 100)
+    gae_util.BatchDatastoreOpAsync(gae_util.db.put, range(5), 10)
+    self.assertEqual([[0, 1], [2, 3], [4]], self.batches)
+
+  def testBatchDatastoreOpAsyncTransientError(self):
+    """Test BatchDatastoreOpAsync() retries and splits a batch."""
+    self.errors = [gae_util.db.Timeout()]
+    stats = gae_util.BatchDatastoreOpAsync(self._Op, range(4), 4)
+    self.assertEqual([[0, 1, 2, 3], [0, 1], [2, 3]], self.batches)
+    self.assertEqual(2, stats.retries)
+    self.assertEqual(0, stats.failed_items)
+
+  def testBatchDatastoreOpAsyncWhenIncompleteKeys(self):
+    """Test BatchDatastoreOpAsync() does not retry puts of auto-id entities."""
+    self.stubs.Set(
+        gae_util, '_ASYNC_DATASTORE_OPS', {gae_util.db.put: self._AsyncOp})
+    self.stubs.Set(gae_util, '_EntitySize', lambda unused_e: 100)
+    entities = [FakeModel(), FakeModel(key_name='k')]
+    self.errors = [gae_util.db.Timeout(), gae_util.db.Timeout()]
+    stats = gae_util.BatchDatastoreOpAsync(gae_util.db.put, entities[:1], 2)
+    self.assertEqual(1, stats.failed_items)
+    self.assertEqual(0, stats.retries)
+    stats = gae_util.BatchDatastoreOpAsync(gae_util.db.put, entities[1:], 2)
+    self.assertEqual(0, stats.failed_items)
+    self.assertEqual(1, stats.retries)
+
+  def testBatchDatastoreOpAsyncRetriesExhausted(self):
+    """Test BatchDatastoreOpAsync() when retries run out."""
+    self.stubs.Set(gae_util, 'BATCH_OP_RETRIES', 1)
+    self.stubs.Set(gae_util, 'BATCH_OP_MAX_IN_FLIGHT', 1)
+    self.errors = [gae_util.db.Timeout()] * 3
+    stats = gae_util.BatchDatastoreOpAsync(self._Op, range(3), 2)
+    self.assertEqual([[0, 1], [0], [1], [2]], self.batches)
+    self.assertEqual(2, stats.failed_items)
+
+  def testBatchDatastoreOpAsyncPermanentError(self):
+    """Test BatchDatastoreOpAsync() continues after a failed batch."""
+    self.errors = [gae_util.db.BadRequestError()]
+    stats = gae_util.BatchDatastoreOpAsync(self._Op, range(4), 2)
+    self.assertEqual([[0, 1], [2, 3]], self.batches)
+    self.assertEqual(2, stats.failed_items)
+    self.assertEqual(0, stats.retries)
+
+  def testBatchDatastoreOpAsyncWhenNoAsyncOp(self):
+    """Test BatchDatastoreOpAsync() with an op that has no async version."""
+    batches = []
+    op = lambda batch: batches.append(batch)
+    stats = gae_util.BatchDatastoreOpAsync(op, range(5), 2)
+    self.assertEqual([[0, 1], [2, 3], [4]], batches)
+    self.assertEqual(3, stats.batches)
+
+  def testBatchDatastoreOpAsyncInFlight(self):
+    """Test BatchDatastoreOpAsync() starts batches before waiting on any."""
+    stats = gae_util.BatchDatastoreOpAsync(self._Op, range(10), 4)
+    self.assertEqual([[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]], self.batches)
+    self.assertEqual(3, stats.batches)
+
+  def testBatchDatastoreOp(self):
+    """Test BatchDatastoreOp()."""
+    stats = gae_util.BatchDatastoreOp(self._Op, range(3))
+    self.assertEqual([[0, 1, 2]], self.batches)
+    self.assertEqual(3, stats.items)
+
+  def testBatchDatastoreOpWhenFailure(self):
+    """Test BatchDatastoreOp() raises after attempting all batches."""
+    self.errors = [gae_util.db.BadRequestError()]
+    self.assertRaises(
+        gae_util.BatchDatastoreOpError,
+        gae_util.BatchDatastoreOp, self._Op, range(4), 2)
+    self.assertEqual([[0, 1], [2, 3]], self.batches)
+
+  def testBatchDatastoreOpErrorIsDbError(self):
+    """Test BatchDatastoreOpError is caught by callers catching db.Error."""
+    self.assertTrue(
+        issubclass(gae_util.BatchDatastoreOpError, gae_util.db.Error))
+
 
 class QueryIteratorTest(mox.MoxTestBase):
 
@@ -177,11 +504,117 @@ class QueryIteratorTest(mox.MoxTestBase):
 
     self.mox.ReplayAll()
     out = []
-    for entity in gae_util.QueryIterator(mock_query, step=step):
+    for entity in gae_util.QueryIterator(
+        mock_query, step=step, prefetch=False):
       out.append(entity)
     self.assertEqual(out, entities)
     self.mox.VerifyAll()
 
+  def testIterationWithPrefetch(self):
+    """Test iteration with the next page prefetched."""
+    mock_query = self.mox.CreateMockAnything()
+    fetch1 = self.mox.CreateMockAnything()
+    fetch2 = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(gae_util, 'AsyncFetch', True)
+
+    gae_util.AsyncFetch(mock_query, 2).AndReturn(fetch1)
+    fetch1.get_result().AndReturn([1, 2])
+    mock_query.cursor().AndReturn('cursor1')
+    mock_query.with_cursor('cursor1')
+    # the second page is started before the first is processed.
+    gae_util.AsyncFetch(mock_query, 2).AndReturn(fetch2)
+    fetch2.get_result().AndReturn([3])
+    mock_query.cursor().AndReturn('cursor2')
+
+    self.mox.ReplayAll()
+    qi = gae_util.QueryIterator(mock_query, step=2)
+    pages = qi.Pages()
+    self.assertEqual([1, 2], pages.next())
+    self.assertEqual(None, qi.cursor)
+    self.assertEqual([3], pages.next())
+    self.assertEqual('cursor1', qi.cursor)
+    self.assertRaises(StopIteration, pages.next)
+    self.assertEqual('cursor2', qi.cursor)
+    self.mox.VerifyAll()
+
+  def testIterationWithMaxStep(self):
+    """Test iteration with growing page sizes."""
+    mock_query = self.mox.CreateMockAnything()
+
+    mock_query.fetch(2).AndReturn([1, 2])
+    mock_query.cursor().AndReturn('cursor1')
+    mock_query.with_cursor('cursor1')
+    mock_query.fetch(3).AndReturn([3, 4, 5])
+    mock_query.cursor().AndReturn('cursor2')
+    mock_query.with_cursor('cursor2')
+    mock_query.fetch(3).AndReturn([])
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        [1, 2, 3, 4, 5],
+        list(gae_util.QueryIterator(
+            mock_query, step=2, max_step=3, prefetch=False)))
+    self.mox.VerifyAll()
+
+  def testInitWithCursor(self):
+    """Test resuming from a cursor."""
+    mock_query = self.mox.CreateMockAnything()
+    mock_query.with_cursor('checkpoint')
+
+    self.mox.ReplayAll()
+    qi = gae_util.QueryIterator(mock_query, cursor='checkpoint')
+    self.assertEqual('checkpoint', qi.cursor)
+    self.mox.VerifyAll()
+
+
+class AsyncFetchTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testGetResult(self):
+    """Test get_result()."""
+    mock_query = self.mox.CreateMockAnything()
+    mock_query.run(limit=5, batch_size=5).AndReturn(iter([1, 2]))
+
+    self.mox.ReplayAll()
+    fetch = gae_util.AsyncFetch(mock_query, 5)
+    self.assertEqual([1, 2], fetch.get_result())
+    self.assertEqual([1, 2], fetch.get_result())
+    self.mox.VerifyAll()
+
+  def testGetResultWithoutLimit(self):
+    """Test get_result() without a limit."""
+    mock_query = self.mox.CreateMockAnything()
+    mock_query.run().AndReturn(iter([1, 2, 3]))
+
+    self.mox.ReplayAll()
+    self.assertEqual([1, 2, 3], gae_util.AsyncFetch(mock_query).get_result())
+    self.mox.VerifyAll()
+
+  def testFetchMulti(self):
+    """Test FetchMulti() starts all queries before reading results."""
+    query_a = self.mox.CreateMockAnything()
+    query_b = self.mox.CreateMockAnything()
+    results_a = self.mox.CreateMockAnything()
+    results_b = self.mox.CreateMockAnything()
+
+    self.mox.StubOutWithMock(gae_util, 'AsyncFetch', True)
+    gae_util.AsyncFetch(query_a, 10).InAnyOrder().AndReturn(results_a)
+    gae_util.AsyncFetch(query_b, 10).InAnyOrder().AndReturn(results_b)
+    results_a.get_result().InAnyOrder('results').AndReturn([1])
+    results_b.get_result().InAnyOrder('results').AndReturn([2, 3])
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        {'a': [1], 'b': [2, 3]},
+        gae_util.FetchMulti({'a': query_a, 'b': query_b}, 10))
+    self.mox.VerifyAll()
 
 
 def main(unused_argv):
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+"""profiling module tests."""
+
+
+
+import mox
+import stubout
+import webapp2
+
+from google.apputils import app
+from google.apputils import basetest
+from simian.mac.common import profiling
+
+
+class FooHandler(webapp2.RequestHandler):
+  """Handler for the middleware tests, making two RPCs."""
+
+  def get(self):
+    profiling._PreCallHook('memcache', 'Get', 'req1', None)
+    profiling._PreCallHook('datastore_v3', 'Get', 'req2', None)
+    profiling._PostCallHook('memcache', 'Get', 'req1', None)
+    profiling._PostCallHook('datastore_v3', 'Get', 'req2', None, None, None)
+    self.response.out.write('foo')
+
+
+class ProfilingModuleTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.stubs.Set(profiling, '_pending_stats', {})
+    self.stubs.Set(profiling, '_known_routes', set())
+    self.stubs.Set(profiling, '_last_flush', [0])
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testBucketIndex(self):
+    """Test _BucketIndex()."""
+    self.assertEqual(0, profiling._BucketIndex(0))
+    self.assertEqual(0, profiling._BucketIndex(10))
+    self.assertEqual(1, profiling._BucketIndex(10.5))
+    self.assertEqual(
+        len(profiling.LATENCY_BUCKETS_MS), profiling._BucketIndex(99999))
+
+  def testPercentile(self):
+    """Test Percentile()."""
+    buckets = [0] * (len(profiling.LATENCY_BUCKETS_MS) + 1)
+    self.assertEqual(None, profiling.Percentile(buckets, 0.5))
+    buckets[0] = 90
+    buckets[4] = 9
+    buckets[-1] = 1
+    self.assertEqual(10, profiling.Percentile(buckets, 0.5))
+    self.assertEqual(250, profiling.Percentile(buckets, 0.95))
+    self.assertEqual(250, profiling.Percentile(buckets, 0.99))
+    self.assertEqual(None, profiling.Percentile(buckets, 1.0))
+
+  def testRequestStats(self):
+    """Test RequestStats."""
+    self.mox.StubOutWithMock(profiling.time, 'time')
+    profiling.time.time().AndReturn(10.0)
+    profiling.time.time().AndReturn(10.1)
+    profiling.time.time().AndReturn(10.2)
+    profiling.time.time().AndReturn(10.4)
+    profiling.time.time().AndReturn(10.5)
+    self.mox.ReplayAll()
+    stats = profiling.RequestStats('route', 'GET')
+    stats.RpcStarted('memcache', 'Get', 'req')
+    stats.RpcStarted('memcache', 'Get', 'req2')
+    stats.RpcFinished('memcache', 'Get', 'req')
+    stats.Finish('200')
+    self.assertEqual(2, stats.RpcCount())
+    d = stats.ToDict()
+    self.assertEqual(
+        {'route': 'route', 'method': 'GET', 'status': '200', 'ms': 500,
+         'rpc_count': 2, 'rpc_ms': 300,
+         'rpcs': {'memcache.Get': {'count': 2, 'ms': 300}}},
+        d)
+    self.mox.VerifyAll()
+
+  def testHooksWithoutRequest(self):
+    """Test the RPC hooks do nothing outside of a profiled request."""
+    profiling._local.stats = None
+    profiling._PreCallHook('memcache', 'Get', 'req', None)
+    profiling._PostCallHook('memcache', 'Get', 'req', None)
+
+  def testMiddleware(self):
+    """Test ProfileMiddleware."""
+    wsgi_app = webapp2.WSGIApplication([('/foo', FooHandler)])
+    self.mox.StubOutWithMock(profiling, 'InstallHooks')
+    self.mox.StubOutWithMock(profiling, 'FlushStats')
+    self.mox.StubOutWithMock(profiling.logging, 'info')
+    self.mox.StubOutWithMock(profiling.random, 'random')
+    profiling.InstallHooks()
+    profiling.random.random().AndReturn(1.0)
+    profiling.logging.info('request_profile %s', mox.IgnoreArg())
+    profiling.FlushStats()
+    self.mox.ReplayAll()
+    middleware = profiling.ProfileMiddleware(wsgi_app)
+    response = webapp2.Request.blank('/foo').get_response(middleware)
+    self.assertEqual('foo', response.body)
+    counters = profiling._pending_stats['%s.FooHandler' % __name__]
+    self.assertEqual(1, counters['requests'])
+    self.assertEqual(2, counters['rpc_count'])
+    self.assertEqual(1, counters['bucket_0'])
+    self.assertEqual(None, getattr(profiling._local, 'stats', None))
+    self.mox.VerifyAll()
+
+  def testMiddlewareWhenUnmatchedAndSampled(self):
+    """Test ProfileMiddleware with an unmatched route and cProfile."""
+    wsgi_app = webapp2.WSGIApplication([('/foo', FooHandler)])
+    self.mox.StubOutWithMock(profiling, 'FlushStats')
+    self.mox.StubOutWithMock(profiling.logging, 'info')
+    self.mox.StubOutWithMock(profiling.random, 'random')
+    profiling.random.random().AndReturn(0.0)
+    profiling.logging.info('request_profile %s', mox.IgnoreArg())
+    profiling.logging.info(
+        'request_cprofile %s %s\n%s', 'GET', profiling.UNMATCHED_ROUTE,
+        mox.StrContains('function calls'))
+    profiling.FlushStats()
+    self.mox.ReplayAll()
+    middleware = profiling.ProfileMiddleware(wsgi_app)
+    response = webapp2.Request.blank('/bar').get_response(middleware)
+    self.assertEqual(404, response.status_int)
+    self.assertEqual(
+        1, profiling._pending_stats[profiling.UNMATCHED_ROUTE]['requests'])
+    self.mox.VerifyAll()
+
+  def testMiddlewareWhenDisabled(self):
+    """Test ProfileMiddleware when PROFILE_ENABLED is False."""
+    self.stubs.Set(profiling, 'PROFILE_ENABLED', False)
+    wsgi_app = self.mox.CreateMockAnything()
+    wsgi_app('environ', 'start_response').AndReturn(['body'])
+    self.mox.ReplayAll()
+    middleware = profiling.ProfileMiddleware(wsgi_app)
+    self.assertEqual(['body'], middleware('environ', 'start_response'))
+    self.assertEqual({}, profiling._pending_stats)
+    self.mox.VerifyAll()
+
+  def testFlushStats(self):
+    """Test FlushStats()."""
+    counters = profiling._NewCounters()
+    counters['requests'] = 1
+    profiling._pending_stats['r'] = counters
+    self.mox.StubOutWithMock(profiling, '_AddRoutes')
+    self.mox.StubOutWithMock(profiling.memcache, 'offset_multi')
+    self.mox.StubOutWithMock(profiling.time, 'time')
+    profiling.time.time().AndReturn(100.0)
+    profiling._AddRoutes(['r'])
+    profiling.memcache.offset_multi(
+        counters, key_prefix='route_r_', namespace=profiling.STATS_NAMESPACE,
+        initial_value=0)
+    profiling.time.time().AndReturn(101.0)
+    self.mox.ReplayAll()
+    profiling.FlushStats()
+    self.assertEqual({}, profiling._pending_stats)
+    self.assertEqual(set(['r']), profiling._known_routes)
+    # not flushed again within STATS_FLUSH_SECONDS.
+    profiling._pending_stats['r'] = counters
+    profiling.FlushStats()
+    self.assertEqual({'r': counters}, profiling._pending_stats)
+    self.mox.VerifyAll()
+
+  def testGetRouteStats(self):
+    """Test GetRouteStats()."""
+    self.mox.StubOutWithMock(profiling.memcache, 'get')
+    self.mox.StubOutWithMock(profiling.memcache, 'get_multi')
+    profiling.memcache.get(
+        profiling.STATS_ROUTES_KEY,
+        namespace=profiling.STATS_NAMESPACE).AndReturn(['a', 'b', 'c'])
+    profiling.memcache.get_multi(
+        mox.IgnoreArg(), key_prefix='route_a_',
+        namespace=profiling.STATS_NAMESPACE).AndReturn(
+            {'requests': 2, 'total_ms': 30, 'rpc_count': 3, 'rpc_ms': 8,
+             'bucket_0': 1, 'bucket_1': 1})
+    profiling.memcache.get_multi(
+        mox.IgnoreArg(), key_prefix='route_b_',
+        namespace=profiling.STATS_NAMESPACE).AndReturn({})
+    profiling.memcache.get_multi(
+        mox.IgnoreArg(), key_prefix='route_c_',
+        namespace=profiling.STATS_NAMESPACE).AndReturn(
+            {'requests': 1, 'total_ms': 400, 'bucket_5': 1})
+    self.mox.ReplayAll()
+    stats = profiling.GetRouteStats()
+    self.assertEqual(['c', 'a'], [s['route'] for s in stats])
+    self.assertEqual(
+        {'route': 'a', 'requests': 2, 'total_ms': 30, 'mean_ms': 15,
+         'p50': 10, 'p95': 25, 'p99': 25, 'rpc_count': 1.5, 'rpc_ms': 4},
+        stats[1])
+    self.mox.VerifyAll()
+
+
+def main(unused_argv):
+  basetest.main()
+
+
+if __name__ == '__main__':
+  app.run()
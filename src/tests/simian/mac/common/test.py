@@ -21,15 +21,23 @@
 Contents:
 
   RequestHandlerTest
+  RpcCounter
+  RpcBudgetTest
 """
 
 
 
 import tests.appenginesdk
 
+import collections
+import contextlib
+
 import mox
 import stubout
+import webapp2
 
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import testbed
 
 from google.apputils import app
@@ -226,5 +234,135 @@ class RequestHandlerTest(test_base.RequestHandlerTest):
     return model
 
 
+class RpcCounter(object):
+  """Counts App Engine API RPCs, e.g. datastore and memcache calls.
+
+  RPCs are counted through an apiproxy pre call hook, while the counter is
+  used as a context manager:
+
+    counter = RpcCounter()
+    with counter:
+      DoSomething()
+    counter.Count('memcache.Get')
+  """
+
+  def __init__(self):
+    self.counts = collections.defaultdict(int)
+    self._active = False
+    self._installed_apiproxy = None
+
+  def _Hook(self, service, call, unused_request, unused_response):
+    if self._active:
+      self.counts['%s.%s' % (service, call)] += 1
+
+  def Install(self):
+    """Install the hook on the current apiproxy, e.g. after testbed setup."""
+    apiproxy = apiproxy_stub_map.apiproxy
+    if self._installed_apiproxy is not apiproxy:
+      apiproxy.GetPreCallHooks().Append('rpc_counter_%d' % id(self), self._Hook)
+      self._installed_apiproxy = apiproxy
+
+  def Reset(self):
+    """Reset all counts."""
+    self.counts.clear()
+
+  def Count(self, name):
+    """Return the number of RPCs counted.
+
+    Args:
+      name: str, service like 'memcache', or service and call like
+        'datastore_v3.RunQuery'.
+    Returns:
+      int
+    """
+    if '.' in name:
+      return self.counts.get(name, 0)
+    prefix = '%s.' % name
+    return sum(c for k, c in self.counts.iteritems() if k.startswith(prefix))
+
+  def __enter__(self):
+    self.Install()
+    self._active = True
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self._active = False
+
+
+class RpcBudgetTest(test_base.TestBase):
+  """Test class asserting the number of RPCs code makes.
+
+  Real datastore and memcache stubs are used, so code under test can run
+  unmocked against fixture entities.
+  """
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.testbed = testbed.Testbed()
+    self.testbed.setup_env(
+        USER_EMAIL='user@example.com',
+        USER_ID='123',
+        USER_IS_ADMIN='0',
+        DEFAULT_VERSION_HOSTNAME='example.appspot.com')
+    self.testbed.activate()
+    # queries see all puts made during fixture setup.
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub()
+    self.testbed.init_user_stub()
+    self.rpc_counter = RpcCounter()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+    self.testbed.deactivate()
+
+  def CallHandler(self, handler_class, method, url, *args, **kwargs):
+    """Call a request handler method with a real request and response.
+
+    Args:
+      handler_class: webapp2.RequestHandler subclass.
+      method: str, method name like 'get'.
+      url: str, request URL, e.g. '/catalogs/stable'.
+      *args: optional, arguments to supply to the method.
+      **kwargs: optional, headers to set on the request.
+    Returns:
+      webapp2.Response instance.
+    """
+    request = webapp2.Request.blank(url, headers=kwargs)
+    response = webapp2.Response()
+    handler = handler_class(request, response)
+    getattr(handler, method)(*args)
+    return response
+
+  @contextlib.contextmanager
+  def AssertRpcBudget(self, budget):
+    """Assert the code run in the context makes at most a budget of RPCs.
+
+    e.g.
+      with self.AssertRpcBudget({'memcache.Get': 3, 'datastore_v3': 0}):
+        self.CallHandler(manifests.Manifests, 'get', '/manifests/')
+
+    Args:
+      budget: dict, keys service like 'memcache', or service and call like
+        'datastore_v3.RunQuery', values int maximum number of RPCs.
+    Yields:
+      RpcCounter instance.
+    """
+    self.rpc_counter.Reset()
+    with self.rpc_counter:
+      yield self.rpc_counter
+    over = []
+    for name, limit in sorted(budget.iteritems()):
+      count = self.rpc_counter.Count(name)
+      if count > limit:
+        over.append('%s: %d > %d' % (name, count, limit))
+    if over:
+      self.fail('RPC budget exceeded: %s; all RPCs: %s' % (
+          ', '.join(over), dict(self.rpc_counter.counts)))
+
+
 def main(unused_argv):
   basetest.main()
@@ -131,11 +131,11 @@ class UpdateAverageInstallDurationsTest(test.RequestHandlerTest):
     maint.models.ReportsCache.GetInstallCounts().AndReturn(
         (install_counts, None))
     maint.models.PackageInfo.all().AndReturn(pkginfos)
-    maint.gae_util.ObtainLock(pkg1_lock, timeout=5.0).AndReturn(True)
+    maint.gae_util.ObtainLock(pkg1_lock, timeout=5.0).AndReturn('tok')
     mock_pl1.__getitem__('description').AndReturn(pkg1_desc)
     mock_pl1.__getitem__('description').AndReturn(pkg1_desc_updated)
     pkginfo1.put().AndReturn(None)
-    maint.gae_util.ReleaseLock(pkg1_lock).AndReturn(None)
+    maint.gae_util.ReleaseLock(pkg1_lock, token='tok').AndReturn(None)
 
     delay = 0
     for track in maint.common.TRACKS:
@@ -221,6 +221,50 @@ class VerifyPackagesCleanupTest(test.RequestHandlerTest):
     self.mox.VerifyAll()
 
 
+  def testGetWithCloudStoragePackages(self):
+    """Test get() with packages stored in Cloud Storage."""
+    old = maint.datetime.datetime(1970, 1, 1)
+    maint.models.PackageInfo(
+        key_name='pkg.dmg', filename='pkg.dmg', blobstore_key='gskey').put()
+    maint.models.PackageBlobInfo(
+        key_name='gskey', gcs_filename='/bucket/uploadpkg/id1',
+        creation=old).put()
+    maint.models.PackageBlobInfo(
+        key_name='orphankey', gcs_filename='/bucket/uploadpkg/id2',
+        creation=old).put()
+    maint.models.PackageBlobInfo(
+        key_name='newkey', gcs_filename='/bucket/uploadpkg/id3',
+        creation=maint.datetime.datetime.utcnow()).put()
+    self.mox.StubOutWithMock(maint.mail, 'EmailMessage')
+    mock_email = self.mox.CreateMockAnything()
+    maint.mail.EmailMessage().AndReturn(mock_email)
+    mock_email.send().AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.c.get()
+    self.assertEqual(
+        'Orphaned package in Cloud Storage: /bucket/uploadpkg/id2',
+        mock_email.subject)
+    self.mox.VerifyAll()
+
+
+class PackageUploadCleanupTest(test.RequestHandlerTest):
+
+  def GetTestClassInstance(self):
+    return maint.PackageUploadCleanup()
+
+  def GetTestClassModule(self):
+    return maint
+
+  def testGet(self):
+    """Test get()."""
+    self.mox.StubOutWithMock(maint.uploadpkg, 'DeleteIdleUploads')
+    maint.uploadpkg.DeleteIdleUploads().AndReturn(2)
+
+    self.mox.ReplayAll()
+    self.c.get()
+    self.mox.VerifyAll()
+
 def main(unused_argv):
   test.main(unused_argv)
 
@@ -169,7 +169,7 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
     self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
 
-    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn(True)
+    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn('tok')
     reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
     reports_cache.models.KeyValueCache.MemcacheWrappedGet(
         'msu_user_summary_cursor', 'text_value').AndReturn(cursor)
@@ -186,7 +186,8 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
         'msu_user_summary_cursor', prop_name='text_value')
     reports_cache.models.ReportsCache.DeleteMsuUserSummary(
         since=None, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock('msu_user_summary_lock').AndReturn(True)
+    reports_cache.gae_util.ReleaseLock(
+        'msu_user_summary_lock', token='tok').AndReturn(True)
 
     self.mox.ReplayAll()
     rc._GenerateMsuUserSummary()
@@ -223,7 +224,7 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
     self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
 
-    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn(True)
+    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn('tok')
     reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
     reports_cache.models.KeyValueCache.MemcacheWrappedGet(
         'msu_user_summary_cursor', 'text_value').AndReturn(cursor)
@@ -251,7 +252,8 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
         'msu_user_summary_cursor', prop_name='text_value')
     reports_cache.models.ReportsCache.DeleteMsuUserSummary(
         since=None, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock('msu_user_summary_lock').AndReturn(True)
+    reports_cache.gae_util.ReleaseLock(
+        'msu_user_summary_lock', token='tok').AndReturn(True)
 
     self.mox.ReplayAll()
     rc._GenerateMsuUserSummary()
@@ -307,7 +309,7 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
     self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
 
-    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn(True)
+    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn('tok')
     reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
     reports_cache.models.KeyValueCache.MemcacheWrappedGet(
         'msu_user_summary_cursor', 'text_value').AndReturn(cursor)
@@ -335,7 +337,8 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
         'msu_user_summary_cursor', prop_name='text_value')
     reports_cache.models.ReportsCache.DeleteMsuUserSummary(
         since=None, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock('msu_user_summary_lock').AndReturn(True)
+    reports_cache.gae_util.ReleaseLock(
+        'msu_user_summary_lock', token='tok').AndReturn(True)
 
     self.mox.ReplayAll()
     rc._GenerateMsuUserSummary()
@@ -374,7 +377,7 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
     self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
 
-    reports_cache.gae_util.ObtainLock(lock_name).AndReturn(True)
+    reports_cache.gae_util.ObtainLock(lock_name).AndReturn('tok')
     reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
     reports_cache.models.KeyValueCache.MemcacheWrappedGet(
         'msu_user_summary_cursor_%dD' % since_days, 'text_value').AndReturn(cursor)
@@ -402,7 +405,8 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
         'msu_user_summary_cursor_%dD' % since_days, prop_name='text_value')
     reports_cache.models.ReportsCache.DeleteMsuUserSummary(
         since='%dD' % since_days, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock(lock_name).AndReturn(True)
+    reports_cache.gae_util.ReleaseLock(
+        lock_name, token='tok').AndReturn(True)
 
     self.mox.ReplayAll()
     rc._GenerateMsuUserSummary(since_days=since_days, now=now)
@@ -442,7 +446,7 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
     self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
 
-    reports_cache.gae_util.ObtainLock(lock_name).AndReturn(True)
+    reports_cache.gae_util.ObtainLock(lock_name).AndReturn('tok')
     reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
     reports_cache.models.KeyValueCache.MemcacheWrappedGet(
         cursor_name, 'text_value').AndReturn(cursor)
@@ -470,7 +474,8 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
         cursor_name, prop_name='text_value')
     reports_cache.models.ReportsCache.DeleteMsuUserSummary(
         since='%dD' % since_days, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock(lock_name).AndReturn(True)
+    reports_cache.gae_util.ReleaseLock(
+        lock_name, token='tok').AndReturn(True)
 
     self.mox.ReplayAll()
     rc._GenerateMsuUserSummary(since_days=since_days, now=now)
@@ -515,7 +520,7 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
     self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
 
-    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn(True)
+    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn('tok')
     reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
     reports_cache.models.KeyValueCache.MemcacheWrappedGet(
         'msu_user_summary_cursor', 'text_value').AndReturn(cursor)
@@ -543,7 +548,8 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
         'msu_user_summary_cursor', prop_name='text_value')
     reports_cache.models.ReportsCache.DeleteMsuUserSummary(
         since=None, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock('msu_user_summary_lock').AndReturn(True)
+    reports_cache.gae_util.ReleaseLock(
+        'msu_user_summary_lock', token='tok').AndReturn(True)
 
     self.mox.ReplayAll()
     rc._GenerateMsuUserSummary()
@@ -591,7 +597,7 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(reports_cache.time, 'time')
     self.mox.StubOutWithMock(reports_cache, 'taskqueue')
 
-    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn(True)
+    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn('tok')
     reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
     reports_cache.models.KeyValueCache.MemcacheWrappedGet(
         'msu_user_summary_cursor', 'text_value').AndReturn(cursor)
@@ -624,10 +630,11 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
         url='/cron/reports_cache/msu_user_summary',
         method='GET',
         countdown=5).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock('msu_user_summary_lock').AndReturn(True)
+    reports_cache.gae_util.ReleaseLock(
+        'msu_user_summary_lock', token='tok').AndReturn(True)
 
     # second run
-    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn(True)
+    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn('tok')
     reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
     reports_cache.models.KeyValueCache.MemcacheWrappedGet(
         'msu_user_summary_cursor', 'text_value').AndReturn(last_user_cursor)
@@ -643,7 +650,8 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
         'msu_user_summary_cursor', prop_name='text_value')
     reports_cache.models.ReportsCache.DeleteMsuUserSummary(
         since=None, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock('msu_user_summary_lock').AndReturn(True)
+    reports_cache.gae_util.ReleaseLock(
+        'msu_user_summary_lock', token='tok').AndReturn(True)
 
     self.mox.ReplayAll()
     rc._GenerateMsuUserSummary()
@@ -730,7 +738,7 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
         reports_cache.models.ReportsCache, 'SetInstallCounts')
 
     lock_name = 'pkgs_list_cron_lock'
-    reports_cache.gae_util.ObtainLock(lock_name).AndReturn(True)
+    reports_cache.gae_util.ObtainLock(lock_name).AndReturn('tok')
 
     reports_cache.models.ReportsCache.GetInstallCounts().AndReturn(
         (install_counts, None))
@@ -751,7 +759,8 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(reports_cache.deferred, 'defer')
     reports_cache.deferred.defer(
         reports_cache._GenerateInstallCounts).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock(lock_name).AndReturn(True)
+    reports_cache.gae_util.ReleaseLock(
+        lock_name, token='tok').AndReturn(True)
 
     self.mox.ReplayAll()
     reports_cache._GenerateInstallCounts()
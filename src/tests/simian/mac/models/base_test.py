@@ -493,6 +493,122 @@ class ModelsModuleTest(mox.MoxTestBase):
     self.mox.VerifyAll()
 
 
+class ComputerTest(mox.MoxTestBase):
+  """Test Computer class."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testGetMarkInactiveShardRanges(self):
+    """Test _GetMarkInactiveShardRanges()."""
+    self.stubs.Set(models, 'MARK_INACTIVE_SHARD_WINDOW_HOURS', 6)
+    end = models.datetime.datetime(2015, 1, 2)
+    hours = lambda h: models.datetime.timedelta(hours=h)
+    self.assertEqual(
+        [(end - hours(2), end),
+         (end - hours(4), end - hours(2)),
+         (end - hours(6), end - hours(4)),
+         (None, end - hours(6))],
+        models.Computer._GetMarkInactiveShardRanges(end, 4))
+    self.assertEqual(
+        [(None, end)], models.Computer._GetMarkInactiveShardRanges(end, 1))
+
+  def testMarkInactive(self):
+    """Test MarkInactive()."""
+    self.mox.StubOutWithMock(models.Computer, '_GetMarkInactiveShardRanges')
+    self.mox.StubOutWithMock(models.deferred, 'defer')
+
+    models.Computer._GetMarkInactiveShardRanges(
+        mox.IsA(models.datetime.datetime), 2).AndReturn(
+            [(1, 2), (None, 1)])
+    models.deferred.defer(models.Computer.MarkInactiveShard, 1, 2)
+    models.deferred.defer(models.Computer.MarkInactiveShard, None, 1)
+
+    self.mox.ReplayAll()
+    self.assertEqual(2, models.Computer.MarkInactive(shards=2))
+    self.mox.VerifyAll()
+
+  def _MockMarkInactiveShardQuery(self, start, end, cursor=None):
+    """Mock the MarkInactiveShard query and return a mock QueryIterator."""
+    mock_query = self.mox.CreateMockAnything()
+    mock_iter = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(models.Computer, 'AllActive')
+    self.mox.StubOutWithMock(models.gae_util, 'QueryIterator', True)
+    models.Computer.AllActive().AndReturn(mock_query)
+    mock_query.filter('preflight_datetime <', end).AndReturn(mock_query)
+    if start is not None:
+      mock_query.filter('preflight_datetime >=', start).AndReturn(mock_query)
+    models.gae_util.QueryIterator(
+        mock_query, step=models.MARK_INACTIVE_BATCH_SIZE,
+        cursor=cursor).AndReturn(mock_iter)
+    return mock_iter
+
+  def testMarkInactiveShard(self):
+    """Test MarkInactiveShard()."""
+    c1 = self.mox.CreateMockAnything()
+    c2 = self.mox.CreateMockAnything()
+    c3 = self.mox.CreateMockAnything()
+    mock_iter = self._MockMarkInactiveShardQuery(1, 2, cursor='c')
+    self.mox.StubOutWithMock(models.gae_util, 'BatchDatastoreOp')
+
+    mock_iter.Pages().AndReturn(iter([[c1, c2], [c3]]))
+    models.gae_util.BatchDatastoreOp(models.db.put, [c1, c2])
+    models.gae_util.BatchDatastoreOp(models.db.put, [c3])
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        8, models.Computer.MarkInactiveShard(1, 2, cursor='c', count=5))
+    for c in [c1, c2, c3]:
+      self.assertFalse(c.active)
+    self.mox.VerifyAll()
+
+  def testMarkInactiveShardWhenTaskTimeUsed(self):
+    """Test MarkInactiveShard() when the task runs out of time."""
+    c1 = self.mox.CreateMockAnything()
+    c2 = self.mox.CreateMockAnything()
+    mock_iter = self._MockMarkInactiveShardQuery(None, 2)
+    self.mox.StubOutWithMock(models.gae_util, 'BatchDatastoreOp')
+    self.mox.StubOutWithMock(models.time, 'time')
+    self.mox.StubOutWithMock(models.deferred, 'defer')
+
+    models.time.time().AndReturn(0)
+    mock_iter.Pages().AndReturn(iter([[c1], [c2]]))
+    models.gae_util.BatchDatastoreOp(models.db.put, [c1])
+    models.time.time().AndReturn(models.MARK_INACTIVE_TASK_SECONDS + 1)
+    mock_iter.cursor = 'checkpoint'
+    models.deferred.defer(
+        models.Computer.MarkInactiveShard, None, 2,
+        cursor='checkpoint', count=1)
+
+    self.mox.ReplayAll()
+    self.assertEqual(None, models.Computer.MarkInactiveShard(None, 2))
+    self.mox.VerifyAll()
+
+  def testMarkInactiveShardWhenDeadlineExceeded(self):
+    """Test MarkInactiveShard() when the request deadline is reached."""
+    c1 = self.mox.CreateMockAnything()
+    mock_iter = self._MockMarkInactiveShardQuery(None, 2)
+    self.mox.StubOutWithMock(models.gae_util, 'BatchDatastoreOp')
+    self.mox.StubOutWithMock(models.deferred, 'defer')
+
+    mock_iter.Pages().AndReturn(iter([[c1]]))
+    models.gae_util.BatchDatastoreOp(models.db.put, [c1]).AndRaise(
+        models.runtime.DeadlineExceededError)
+    mock_iter.cursor = 'checkpoint'
+    models.deferred.defer(
+        models.Computer.MarkInactiveShard, None, 2,
+        cursor='checkpoint', count=0)
+
+    self.mox.ReplayAll()
+    self.assertEqual(None, models.Computer.MarkInactiveShard(None, 2))
+    self.mox.VerifyAll()
+
+
 class BaseManifestModificationTest(mox.MoxTestBase):
   """BaseManifestModification class test."""
 
@@ -51,13 +51,13 @@ class CatalogTest(mox.MoxTestBase):
     if not hasattr(self, '_mock_obtain_lock'):
       self.mox.StubOutWithMock(models.gae_util, 'ObtainLock')
       self._mock_obtain_lock = True
-    models.gae_util.ObtainLock(name).AndReturn(obtain)
+    models.gae_util.ObtainLock(name, durable=True).AndReturn(obtain and 'tok')
 
   def _MockReleaseLock(self, name):
     if not hasattr(self, '_mock_release_lock'):
       self.mox.StubOutWithMock(models.gae_util, 'ReleaseLock')
       self._mock_release_lock = True
-    models.gae_util.ReleaseLock(name).AndReturn(None)
+    models.gae_util.ReleaseLock(name, token='tok', durable=True).AndReturn(None)
 
   def testGeneratesync(self):
     """Tests calling Generate(delay=2)."""
@@ -97,6 +97,11 @@ class CatalogTest(mox.MoxTestBase):
     mock_model.fetch(None).AndReturn([pkg1, pkg2])
     pkg1.plist.GetXmlContent(indent_num=1).AndReturn(plist1)
     pkg2.plist.GetXmlContent(indent_num=1).AndReturn(plist2)
+    pkg1.plist.get('display_name', None).AndReturn('Foo ')
+    pkg1.plist.get('version', '').AndReturn('1.0')
+    pkg2.plist.get('display_name', None).AndReturn(None)
+    pkg2.plist.get('name').AndReturn('bar')
+    pkg2.plist.get('version', '').AndReturn('2.0')
 
     mock_catalog = self.mox.CreateMockAnything()
     models.Catalog.get_or_insert(name).AndReturn(mock_catalog)
@@ -104,6 +109,8 @@ class CatalogTest(mox.MoxTestBase):
 
     models.Catalog.DeleteMemcacheWrap(
         name, prop_name='plist_xml').AndReturn(None)
+    models.Catalog.DeleteMemcacheWrap(
+        name, prop_name='packagemap').AndReturn(None)
     models.Manifest.Generate(name, delay=1).AndReturn(None)
     self._MockReleaseLock('catalog_lock_%s' % name)
 
@@ -114,6 +121,9 @@ class CatalogTest(mox.MoxTestBase):
     expected_plist = models.constants.CATALOG_PLIST_XML % xml
     self.assertEqual(expected_plist, mock_catalog.plist)
     self.assertEqual(mock_catalog.package_names, ['foo', 'bar'])
+    self.assertEqual(
+        {'foo': 'Foo-1.0', 'bar': 'bar-2.0'},
+        models.util.Deserialize(mock_catalog.packagemap))
     self.mox.VerifyAll()
 
   def testGenerateWithNoPkgsinfo(self):
@@ -172,6 +182,9 @@ class CatalogTest(mox.MoxTestBase):
     mock_model.fetch(None).AndReturn([pkg1, pkg2])
     mock_plist1.GetXmlContent(indent_num=1).AndReturn(plist1)
     mock_plist2.GetXmlContent(indent_num=1).AndReturn(plist2)
+    for mock_plist in [mock_plist1, mock_plist2]:
+      mock_plist.get('display_name', None).AndReturn('foo')
+      mock_plist.get('version', '').AndReturn('1.0')
 
     mock_catalog = self.mox.CreateMockAnything()
     self.mox.StubOutWithMock(models.Catalog, 'get_or_insert')
@@ -184,6 +197,32 @@ class CatalogTest(mox.MoxTestBase):
         models.db.Error, models.Catalog.Generate, name)
     self.mox.VerifyAll()
 
+  def testGetPackageMap(self):
+    """Tests GetPackageMap() with a stored packagemap."""
+    self.mox.StubOutWithMock(models.Catalog, 'MemcacheWrappedGet')
+    models.Catalog.MemcacheWrappedGet(
+        'stable', prop_name='packagemap').AndReturn('{"foo": "Foo-1.0"}')
+    self.mox.ReplayAll()
+    self.assertEqual({'foo': 'Foo-1.0'}, models.Catalog.GetPackageMap('stable'))
+    self.mox.VerifyAll()
+
+  def testGetPackageMapWithoutStoredPackageMap(self):
+    """Tests GetPackageMap() of a catalog generated without a packagemap."""
+    mock_plist = self.mox.CreateMockAnything()
+    pkg = test.GenericContainer(plist=mock_plist, name='foo')
+    self.mox.StubOutWithMock(models.Catalog, 'MemcacheWrappedGet')
+    self.mox.StubOutWithMock(models.PackageInfo, 'all')
+    models.Catalog.MemcacheWrappedGet(
+        'stable', prop_name='packagemap').AndReturn(None)
+    mock_query = self.mox.CreateMockAnything()
+    models.PackageInfo.all().AndReturn(mock_query)
+    mock_query.filter('catalogs =', 'stable').AndReturn([pkg])
+    mock_plist.get('display_name', None).AndReturn('Foo')
+    mock_plist.get('version', '').AndReturn('1.0')
+    self.mox.ReplayAll()
+    self.assertEqual({'foo': 'Foo-1.0'}, models.Catalog.GetPackageMap('stable'))
+    self.mox.VerifyAll()
+
   def testGenerateLocked(self):
     """Tests Generate() where name is locked."""
     name = 'lockedname'
@@ -219,13 +258,13 @@ class ManifestTest(mox.MoxTestBase):
     if not hasattr(self, '_mock_obtain_lock'):
       self.mox.StubOutWithMock(models.gae_util, 'ObtainLock')
       self._mock_obtain_lock = True
-    models.gae_util.ObtainLock(name).AndReturn(obtain)
+    models.gae_util.ObtainLock(name).AndReturn(obtain and 'tok')
 
   def _MockReleaseLock(self, name):
     if not hasattr(self, '_mock_release_lock'):
       self.mox.StubOutWithMock(models.gae_util, 'ReleaseLock')
       self._mock_release_lock = True
-    models.gae_util.ReleaseLock(name).AndReturn(None)
+    models.gae_util.ReleaseLock(name, token='tok').AndReturn(None)
 
   def testGenerateAsync(self):
     """Tests calling Manifest.Generate(delay=2)."""
@@ -361,13 +400,14 @@ class PackageInfoTest(mox.MoxTestBase):
     if not hasattr(self, '_mock_obtain_lock'):
       self.mox.StubOutWithMock(models.gae_util, 'ObtainLock')
       self._mock_obtain_lock = True
-    models.gae_util.ObtainLock(name, timeout=timeout).AndReturn(obtain)
+    models.gae_util.ObtainLock(name, timeout=timeout).AndReturn(
+        obtain and 'tok')
 
   def _MockReleaseLock(self, name):
     if not hasattr(self, '_mock_release_lock'):
       self.mox.StubOutWithMock(models.gae_util, 'ReleaseLock')
       self._mock_release_lock = True
-    models.gae_util.ReleaseLock(name).AndReturn(None)
+    models.gae_util.ReleaseLock(name, token='tok').AndReturn(None)
 
   def _GetTestPackageInfoPlist(self, d=None):
     """String concatenates a description and returns test plist xml."""
@@ -835,6 +875,196 @@ class PackageInfoTest(mox.MoxTestBase):
     self.assertTrue('https://foo.com/admin/package/file%20name.dmg' in body)
 
 
+class PackageInfoSummariesTest(mox.MoxTestBase):
+  """Test PackageInfo denormalized plist fields and summaries."""
+
+  PLIST_XML = (
+      '<plist><dict><key>name</key><string>foo</string>'
+      '<key>display_name</key><string>Foo</string>'
+      '<key>version</key><string>1.0</string>'
+      '<key>installer_item_hash</key><string>hash</string>'
+      '<key>installer_item_location</key><string>foo.dmg</string>'
+      '<key>installer_item_size</key><integer>100</integer>'
+      '<key>unattended_install</key><true/>'
+      '<key>force_install_after_date</key><date>2015-01-02T03:04:05Z</date>'
+      '<key>description</key><string>desc\n\n2 users have installed this '
+      'with an average duration of 10 seconds.</string>'
+      '<key>catalogs</key><array><string>unstable</string></array>'
+      '</dict></plist>')
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _NewPackageInfo(self):
+    p = models.PackageInfo(key_name='foo.dmg', filename='foo.dmg', name='foo')
+    p.plist = self.PLIST_XML
+    p.catalogs = ['unstable']
+    return p
+
+  def testPutDenormalizesPlistFields(self):
+    """Test put() sets the plist fields properties."""
+    self._NewPackageInfo().put()
+    p = models.PackageInfo.get_by_key_name('foo.dmg')
+    self.assertEqual('Foo-1.0', p.munki_name)
+    self.assertEqual('Foo', p.display_name)
+    self.assertEqual('1.0', p.version)
+    self.assertEqual(100, p.installer_item_size)
+    self.assertTrue(p.unattended_install)
+    self.assertFalse(p.forced_install)
+    self.assertTrue(p.uninstallable)
+    self.assertEqual(
+        datetime.datetime(2015, 1, 2, 3, 4, 5), p.force_install_after_date)
+    self.assertEqual('desc', p.admin_description)
+    self.assertEqual(
+        models.PackageInfo.PLIST_FIELDS_VERSION, p.plist_fields_version)
+
+  def testGetSummaryFromPlist(self):
+    """Test _GetSummary() of a pkginfo put before the plist fields existed."""
+    p = self._NewPackageInfo()
+    self.assertEqual(0, p.plist_fields_version)
+    summary = p._GetSummary(None)
+    self.assertFalse(summary['broken_plist'])
+    self.assertEqual('Foo-1.0', summary['munki_name'])
+    self.assertEqual(100, summary['installer_item_size'])
+    self.assertTrue(summary['unattended_install'])
+    self.assertEqual('desc', summary['description'])
+    self.assertEqual('current', summary['catalog_matrix']['unstable'])
+    self.assertEqual('not_in', summary['catalog_matrix']['testing'])
+
+  def testGetSummaryWithBrokenPlist(self):
+    """Test _GetSummary() of a pkginfo with an unparsable plist."""
+    p = models.PackageInfo(filename='foo.dmg')
+    p.plist = '<plist><dict><key>foo</key></plist>'
+    self.assertTrue(p._GetSummary(None)['broken_plist'])
+
+  def testMakeTrackMatrices(self):
+    """Test _MakeTrackMatrices() of pkginfos and proposals."""
+    p = self._NewPackageInfo()
+    proposal = models.PackageInfoProposal(
+        filename='foo.dmg', catalogs=['unstable', 'testing'])
+    catalog_matrix, manifest_matrix = p._MakeTrackMatrices(proposal)
+    self.assertEqual('current', catalog_matrix['unstable'])
+    self.assertEqual('proposed_in', catalog_matrix['testing'])
+    self.assertEqual('not_in', manifest_matrix['unstable'])
+    catalog_matrix, _ = proposal._MakeTrackMatrices(p)
+    self.assertEqual('proposed_in', catalog_matrix['testing'])
+    catalog_matrix, _ = proposal._MakeTrackMatrices(None)
+    self.assertEqual('proposed_in', catalog_matrix['unstable'])
+
+  def testGetSummaries(self):
+    """Test GetSummaries() is cached until a pkginfo is put."""
+    p = self._NewPackageInfo()
+    p.put()
+
+    summaries = models.PackageInfo.GetSummaries()
+    generation = models.PackageInfo._GetSummariesGeneration()
+    memcache_key = models.PACKAGE_SUMMARIES_MEMCACHE_KEY % (
+        'PackageInfo', generation)
+    self.assertEqual(1, len(summaries))
+    self.assertEqual('foo.dmg', summaries[0]['filename'])
+    self.assertEqual('desc', summaries[0]['description'])
+    self.assertEqual('current', summaries[0]['catalog_matrix']['unstable'])
+    self.assertEqual(summaries, models.memcache.get(memcache_key))
+
+    p.install_types = ['managed_installs']
+    p.put()
+    self.assertNotEqual(
+        generation, models.PackageInfo._GetSummariesGeneration())
+    self.assertEqual(
+        ['managed_installs'],
+        models.PackageInfo.GetSummaries()[0]['install_types'])
+
+    p.delete()
+    self.assertEqual([], models.PackageInfo.GetSummaries())
+
+  def testGetSummariesWhenPutDuringRead(self):
+    """Test GetSummaries() does not cache a read racing a put for later."""
+    p = self._NewPackageInfo()
+    p.put()
+    models.PackageInfo.GetSummaries()
+
+    # simulate a reader that read the generation and the datastore just
+    # before the put below, and cached its stale result afterwards.
+    stale_generation = models.PackageInfo._GetSummariesGeneration()
+    p.install_types = ['managed_installs']
+    p.put()
+    models.memcache.set(
+        models.PACKAGE_SUMMARIES_MEMCACHE_KEY % (
+            'PackageInfo', stale_generation), [])
+
+    self.assertEqual(
+        ['managed_installs'],
+        models.PackageInfo.GetSummaries()[0]['install_types'])
+
+  def testGetSummariesWhenGenerationEvicted(self):
+    """Test GetSummaries() does not reuse summaries after an eviction."""
+    p = self._NewPackageInfo()
+    p.put()
+    models.PackageInfo.GetSummaries()
+
+    models.memcache.delete(models.PACKAGE_SUMMARIES_GENERATION_MEMCACHE_KEY)
+    p.install_types = ['managed_installs']
+    p.put()
+
+    self.assertEqual(
+        ['managed_installs'],
+        models.PackageInfo.GetSummaries()[0]['install_types'])
+
+
+
+class PackageBlobInfoTest(mox.MoxTestBase):
+  """Test PackageBlobInfo class."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    self.mox.UnsetStubs()
+
+  def testSafeDelete(self):
+    """Test SafeDelete() of a Cloud Storage package."""
+    models.PackageBlobInfo(
+        key_name='gskey', gcs_filename='/bucket/uploadpkg/id1').put()
+    self.mox.StubOutWithMock(models.gcs, 'SafeDelete')
+    models.gcs.SafeDelete('/bucket/uploadpkg/id1')
+
+    self.mox.ReplayAll()
+    models.PackageBlobInfo.SafeDelete('gskey')
+    self.assertEqual(None, models.PackageBlobInfo.get_by_key_name('gskey'))
+    self.mox.VerifyAll()
+
+  def testPackageInfoBlobInfo(self):
+    """Test PackageInfo.blob_info of a Cloud Storage package."""
+    models.PackageBlobInfo(key_name='gskey', size=11).put()
+    p = models.PackageInfo(key_name='foo.dmg', blobstore_key='gskey')
+    self.assertEqual(11, p.blob_info.size)
+    p.blobstore_key = 'unknownkey'
+    self.assertEqual(None, p.blob_info)
+
+  def testSafeDeleteWhenBlobstore(self):
+    """Test SafeDelete() of a Blobstore package."""
+    self.mox.StubOutWithMock(models.gae_util, 'SafeBlobDel')
+    models.gae_util.SafeBlobDel('blobkey')
+
+    self.mox.ReplayAll()
+    models.PackageBlobInfo.SafeDelete('blobkey')
+    self.mox.VerifyAll()
+
 def main(unused_argv):
   basetest.main()
 
@@ -960,27 +960,14 @@ class CommonModuleTest(test.RequestHandlerTest):
     computer.connections_off_corp = 1
     computer.user_settings = None
 
-    # PackageInfo entities
-    mock_pl1 = self.mox.CreateMockAnything()
-    mock_pl2 = self.mox.CreateMockAnything()
-    mock_pl3 = self.mox.CreateMockAnything()
-    mock_pl4 = self.mox.CreateMockAnything()
-    package_infos = [
-        test.GenericContainer(plist=mock_pl1, version='1.0', name='fooname1'),
-        test.GenericContainer(plist=mock_pl2, version='1.0', name='fooname2'),
-        test.GenericContainer(plist=mock_pl3, version='1.0', name='fooname3'),
-        test.GenericContainer(plist=mock_pl4, version='1.0', name='fooname4'),
-    ]
-
-    packagemap = {}
+    packagemap = {'fooname1': 'fooname1-2.0', 'fooname2': 'fooname2-1.0'}
 
     self.mox.StubOutWithMock(common.models, 'Computer')
     self.mox.StubOutWithMock(common, 'IsPanicModeNoPackages')
     self.mox.StubOutWithMock(common.models, 'Manifest')
     self.mox.StubOutWithMock(common, 'GenerateDynamicManifest')
     self.mox.StubOutWithMock(common.plist_module, 'MunkiManifestPlist')
-    self.mox.StubOutWithMock(common.models, 'PackageInfo')
-    self.mox.StubOutWithMock(common.plist_module, 'MunkiPackageInfoPlist')
+    self.mox.StubOutWithMock(common.models.Catalog, 'GetPackageMap')
 
     # mock manifest creation
     common.models.Computer.get_by_key_name(uuid).AndReturn(computer)
@@ -998,28 +985,13 @@ class CommonModuleTest(test.RequestHandlerTest):
         mock_manifest_plist)
     mock_manifest_plist.Parse().AndReturn(None)
 
-    # mock manifest reading and package map creation
-    mock_package_info = self.mox.CreateMockAnything()
+    # mock manifest reading and package map merging
     mock_manifest_plist.__getitem__('catalogs').AndReturn(
-        {'catalogs': ['catalog1']})
-    common.models.PackageInfo.all().AndReturn(mock_package_info)
-    iter_return = []
-
-    for package_info in package_infos:
-      iter_return.append(test.GenericContainer(
-          plist=package_info.plist,
-          name=package_info.name))
-      package_info.plist.get('display_name', None).AndReturn(None)
-      package_info.plist.get('name').AndReturn(package_info.name)
-      package_info.plist.get('version', '').AndReturn(package_info.version)
-      packagemap[package_info.name] = '%s-%s' % (
-          package_info.name, package_info.version)
-
-    def __iter_func():
-      for i in iter_return:
-        yield i
-
-    mock_package_info.__iter__().AndReturn(__iter_func())
+        ['catalog1', 'catalog2'])
+    common.models.Catalog.GetPackageMap('catalog2').AndReturn(
+        {'fooname1': 'fooname1-1.0', 'fooname2': 'fooname2-1.0'})
+    common.models.Catalog.GetPackageMap('catalog1').AndReturn(
+        {'fooname1': 'fooname1-2.0'})
 
     manifest_expected = {
         'plist': mock_manifest_plist,
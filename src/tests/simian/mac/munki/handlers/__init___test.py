@@ -24,6 +24,8 @@ import datetime
 import logging
 logging.basicConfig(filename='/dev/null')
 
+import webapp2
+
 from google.apputils import app
 from tests.simian.mac.common import test
 from simian.mac.munki import handlers
@@ -112,6 +114,16 @@ class HandlersTest(test.RequestHandlerTest):
     self.assertEqual(r, client_id_dict)
     self.mox.VerifyAll()
 
+  def testServiceUnavailable(self):
+    """Tests AuthenticationHandler.ServiceUnavailable()."""
+    response = webapp2.Response()
+    handler = handlers.AuthenticationHandler(
+        webapp2.Request.blank('/'), response)
+    handler.ServiceUnavailable(retry_after=30)
+    self.assertEqual(503, response.status_int)
+    self.assertEqual('30', response.headers['Retry-After'])
+
+
 
 def main(unused_argv):
   test.main(unused_argv)
@@ -170,6 +170,7 @@ class AuthModuleTest(test.RequestHandlerTest):
     self.response.headers['Set-Cookie'] = '%s=%s; secure; httponly;' % (
         auth.auth.AUTH_TOKEN_COOKIE, 'foo')
     self.response.out.write(auth.auth.AUTH_TOKEN_COOKIE)
+    mock_auth1.FlushSession().AndReturn(None)
     self.mox.ReplayAll()
     self.c.post()
     self.mox.VerifyAll()
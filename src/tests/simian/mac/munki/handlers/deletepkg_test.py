@@ -45,7 +45,7 @@ class DeletePackageTest(test.RequestHandlerTest):
     pkginfo_str = 'pkginfo'
     user = 'foouser'
 
-    self.mox.StubOutWithMock(deletepkg.gae_util, 'SafeBlobDel')
+    self.mox.StubOutWithMock(deletepkg.models.PackageBlobInfo, 'SafeDelete')
     self.mox.StubOutWithMock(deletepkg.models.Catalog, 'Generate')
     mock_pkginfo = self.mox.CreateMockAnything()
     mock_pkginfo.blobstore_key = blobstore_key
@@ -60,7 +60,7 @@ class DeletePackageTest(test.RequestHandlerTest):
     self.MockModelStaticBase(
         'PackageInfo', 'get_by_key_name', filename).AndReturn(mock_pkginfo)
     mock_pkginfo.delete().AndReturn(None)
-    deletepkg.gae_util.SafeBlobDel(blobstore_key).AndReturn(None)
+    deletepkg.models.PackageBlobInfo.SafeDelete(blobstore_key).AndReturn(None)
     for catalog in catalogs:
       deletepkg.models.Catalog.Generate(catalog).AndReturn(None)
 
@@ -93,7 +93,9 @@ class HandlersTest(test.RequestHandlerTest):
     manifests.common.GetComputerManifest(
         client_id=client_id, packagemap=False).AndRaise(
             manifests.common.ManifestDisabledError)
-    self.response.set_status(503).AndReturn(None)
+    self.MockError(503)
+    self.response.headers['Retry-After'] = str(
+        manifests.handlers.RETRY_AFTER_SECONDS)
 
     self.mox.ReplayAll()
     self.c.get()
@@ -114,7 +116,9 @@ class HandlersTest(test.RequestHandlerTest):
     manifests.common.GetComputerManifest(
         client_id=client_id, packagemap=False).AndRaise(
             manifests.common.Error)
-    self.response.set_status(503).AndReturn(None)
+    self.MockError(503)
+    self.response.headers['Retry-After'] = str(
+        manifests.handlers.RETRY_AFTER_SECONDS)
 
     self.mox.ReplayAll()
     self.c.get()
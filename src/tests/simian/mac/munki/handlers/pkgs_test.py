@@ -55,7 +55,9 @@ class PackagesHandlerTest(PackagesTest):
   def GetTestClassModule(self):
     return pkgs
 
-  def testGetSuccessHelper(self, pkg_modified_since=True, supply_etag='etag'):
+  def testGetSuccessHelper(
+      self, pkg_modified_since=True, supply_etag='etag', range_str='',
+      etag_range_str='', use_range=False):
     """Tests Packages.get()."""
     filename = u'good name.dmg'
     filename_quoted = 'good%20name.dmg'
@@ -76,11 +78,12 @@ class PackagesHandlerTest(PackagesTest):
     self.mox.StubOutWithMock(pkgs.handlers, 'IsClientResourceExpired')
     self.mox.StubOutWithMock(pkgs.memcache, 'get')
     self.mox.StubOutWithMock(pkgs.memcache, 'set')
-    self.MockSelf('send_blob')
 
     self.request.headers.get('If-Modified-Since', '').AndReturn(mod_since_date)
     self.request.headers.get('If-None-Match', 0).AndReturn(0)
     self.request.headers.get('If-Match', 0).AndReturn(0)
+    self.request.headers.get('Range', '').AndReturn(range_str)
+    self.request.headers.get('If-Range', '').AndReturn(etag_range_str)
     pkgs.memcache.get(blobinfo_memcache_key).AndReturn(None)
     pkgs.blobstore.BlobInfo.get(blobstore_key).AndReturn(mock_blob_info)
     pkgs.memcache.set(blobinfo_memcache_key, mock_blob_info, 300).AndReturn(
@@ -94,7 +97,8 @@ class PackagesHandlerTest(PackagesTest):
       self.response.headers['Last-Modified'] = pkg_date.strftime(
           pkgs.handlers.HEADER_DATE_FORMAT)
       self.response.headers['X-Download-Size'] = str(pkg_size)
-      self.c.send_blob(blobstore_key).AndReturn(None)
+      self.response.headers['Accept-Ranges'] = 'bytes'
+      self.c.send_blob(blobstore_key, use_range=use_range).AndReturn(None)
     else:
       if supply_etag:
         self.response.headers['ETag'] = supply_etag
@@ -126,11 +130,12 @@ class PackagesHandlerTest(PackagesTest):
     self.mox.StubOutWithMock(pkgs.handlers, 'IsClientResourceExpired')
     self.mox.StubOutWithMock(pkgs.memcache, 'get')
     self.mox.StubOutWithMock(pkgs.memcache, 'set')
-    self.MockSelf('send_blob')
 
     self.request.headers.get('If-Modified-Since', '').AndReturn(mod_since_date)
     self.request.headers.get('If-None-Match', 0).AndReturn(nomatch_etag)
     self.request.headers.get('If-Match', 0).AndReturn(match_etag)
+    self.request.headers.get('Range', '').AndReturn('')
+    self.request.headers.get('If-Range', '').AndReturn('')
     pkgs.memcache.get(blobinfo_memcache_key).AndReturn(None)
     pkgs.blobstore.BlobInfo.get(blobstore_key).AndReturn(mock_blob_info)
     pkgs.memcache.set(blobinfo_memcache_key, mock_blob_info, 300).AndReturn(
@@ -158,6 +163,20 @@ class PackagesHandlerTest(PackagesTest):
     """Tests get() where the If-Modified-Since date is older than pkg date."""
     self.testGetSuccessHelper(pkg_modified_since=False, supply_etag=None)
 
+  def testGetSuccessWithRange(self):
+    """Tests get() resuming a download of the same package version."""
+    self.testGetSuccessHelper(
+        range_str='bytes=100-', etag_range_str='etag', use_range=True)
+
+  def testGetSuccessWithRangeNoIfRange(self):
+    """Tests get() with a Range header and no If-Range header."""
+    self.testGetSuccessHelper(range_str='bytes=100-', use_range=True)
+
+  def testGetSuccessWithRangeOfChangedPackage(self):
+    """Tests get() sends the whole package when If-Range does not match."""
+    self.testGetSuccessHelper(
+        range_str='bytes=100-', etag_range_str='oldetag', use_range=False)
+
   def testGet412WherePackageEtagNoMatch(self):
     """Tests get() where If-Match etag does not match package etag."""
     self._GetFailureHelper(
@@ -216,6 +235,8 @@ class PackagesHandlerTest(PackagesTest):
     self.mox.StubOutWithMock(pkgs.common, 'IsPanicModeNoPackages')
     pkgs.common.IsPanicModeNoPackages().AndReturn(True)
     self.MockError(503)
+    self.response.headers['Retry-After'] = str(
+        pkgs.handlers.RETRY_AFTER_SECONDS)
 
     self.mox.ReplayAll()
     self.c.get(filename)
@@ -86,9 +86,10 @@ class PackagesInfoTest(test.RequestHandlerTest):
       self.mox.StubOutWithMock(pkgsinfo.gae_util, 'ObtainLock')
       self._mock_obtainlock = True
     if timeout is not None:
-      pkgsinfo.gae_util.ObtainLock(lock, timeout=timeout).AndReturn(obtain)
+      pkgsinfo.gae_util.ObtainLock(lock, timeout=timeout).AndReturn(
+          obtain and 'tok')
     else:
-      pkgsinfo.gae_util.ObtainLock(lock).AndReturn(obtain)
+      pkgsinfo.gae_util.ObtainLock(lock).AndReturn(obtain and 'tok')
 
   def _MockReleaseLock(self, lock):
     """Mock ReleaseLock().
@@ -99,7 +100,7 @@ class PackagesInfoTest(test.RequestHandlerTest):
     if not hasattr(self, '_mock_releaselock'):
       self.mox.StubOutWithMock(pkgsinfo.gae_util, 'ReleaseLock')
       self._mock_releaselock = True
-    pkgsinfo.gae_util.ReleaseLock(lock).AndReturn(None)
+    pkgsinfo.gae_util.ReleaseLock(lock, token='tok').AndReturn(None)
 
   def testHash(self):
     """Test _Hash()."""
@@ -272,6 +272,83 @@ class HandlersTest(test.RequestHandlerTest):
         self.c.GetReportFeedback(uuid, report_type, computer=computer))
     self.mox.VerifyAll()
 
+  def testGetReportFeedbackPreflightDefer(self):
+    """Tests GetReportFeedback(preflight) when the checkin is deferred."""
+    report_type = 'preflight'
+    uuid = 'foouuid'
+    self._MockIsExitFeedbackIpAddress()
+    self._MockIsPanicModeNoPackages()
+    self.mox.StubOutWithMock(reports, 'GetCheckinDeferSeconds')
+    reports.GetCheckinDeferSeconds(uuid, can_defer=True).AndReturn(120)
+    computer = self.mox.CreateMockAnything()
+    computer.preflight_datetime = datetime.datetime.utcnow()
+    computer.upload_logs_and_notify = None
+    computer.preflight_count_since_postflight = 0
+    self.mox.ReplayAll()
+    self.assertEqual(
+        {'defer_seconds': 120,
+         'defer_jitter_seconds': reports.CHECKIN_WINDOW_SECONDS},
+        self.c.GetReportFeedback(
+            uuid, report_type, computer=computer, can_defer=True))
+    self.mox.VerifyAll()
+
+  def testGetReportFeedbackPreflightDeferWithOtherFeedback(self):
+    """Tests GetReportFeedback(preflight) does not defer a first checkin."""
+    report_type = 'preflight'
+    uuid = 'foouuid'
+    self._MockIsExitFeedbackIpAddress()
+    self._MockIsPanicModeNoPackages()
+    self.mox.StubOutWithMock(reports, 'GetCheckinDeferSeconds')
+    reports.GetCheckinDeferSeconds(uuid, can_defer=False).AndReturn(0)
+    self.mox.ReplayAll()
+    self.assertEqual(
+        {'force_continue': True},
+        self.c.GetReportFeedback(
+            uuid, report_type, computer=None, can_defer=True))
+    self.mox.VerifyAll()
+
+  def testGetCheckinDeferSeconds(self):
+    """Tests GetCheckinDeferSeconds() spreads checkins over the budget."""
+    self.assertEqual(0, reports.GetCheckinDeferSeconds('uuid0', now=120.0))
+    reports.models.Settings.SetItem('checkin_budget_per_minute', 2)
+    # the first checkin above was not counted, as the budget was disabled.
+    self.assertEqual(
+        [0, 0, 31, 31, 91, 91, 151],
+        [reports.GetCheckinDeferSeconds('uuid%d' % i, now=150.0)
+         for i in xrange(7)])
+    self.assertEqual(122, reports.GetCheckinDeferSeconds('uuid7', now=179.0))
+    # windows 3 to 5 are reserved for the deferred clients.
+    self.assertEqual(180, reports.GetCheckinDeferSeconds('uuid8', now=181.0))
+    # the returning deferred clients are not counted again.
+    self.assertEqual(
+        [0, 0], [reports.GetCheckinDeferSeconds('uuid%d' % i, now=181.0)
+                 for i in (2, 3)])
+    self.assertEqual(
+        [3, 3, 3, 1],
+        [reports.memcache.get(
+            str(window), namespace=reports.CHECKIN_COUNTER_NAMESPACE)
+         for window in xrange(3, 7)])
+
+  def testGetCheckinDeferSecondsCannotDefer(self):
+    """Tests GetCheckinDeferSeconds() counts clients that cannot defer."""
+    reports.models.Settings.SetItem('checkin_budget_per_minute', 1)
+    self.assertEqual(
+        [0, 0], [reports.GetCheckinDeferSeconds(
+            'uuid%d' % i, can_defer=False, now=120.0) for i in xrange(2)])
+    self.assertEqual(
+        2, reports.memcache.get(
+            '2', namespace=reports.CHECKIN_COUNTER_NAMESPACE))
+    self.assertEqual(121, reports.GetCheckinDeferSeconds('uuid2', now=120.0))
+
+  def testGetCheckinDeferSecondsMaximum(self):
+    """Tests GetCheckinDeferSeconds() caps the defer seconds."""
+    reports.models.Settings.SetItem('checkin_budget_per_minute', 1)
+    reports.memcache.set(
+        '2', 10000, namespace=reports.CHECKIN_COUNTER_NAMESPACE)
+    self.assertEqual(
+        reports.MAX_CHECKIN_DEFER_SECONDS - reports.CHECKIN_WINDOW_SECONDS + 1,
+        reports.GetCheckinDeferSeconds('uuid', now=120.0))
+
   def PostSetup(self, uuid=None, report_type=None):
     """Sets up standard mocks and their actions for reports post()."""
     if uuid:
@@ -305,8 +382,8 @@ class HandlersTest(test.RequestHandlerTest):
       report_feedback = {'force_continue': True}
       self.c.GetReportFeedback(
           uuid, report_type, computer=mock_computer,
-          ip_address=ip_address, client_exit=client_exit).AndReturn(
-              report_feedback)
+          ip_address=ip_address, client_exit=client_exit,
+          can_defer=True).AndReturn(report_feedback)
 
     self.PostSetup(uuid=uuid, report_type=report_type)
     self.request.get('client_id').AndReturn(client_id_str)
@@ -321,6 +398,7 @@ class HandlersTest(test.RequestHandlerTest):
     if report_type == 'preflight':
       self.request.get('client_exit', None).AndReturn(None)
       self.request.get('json').AndReturn('1')
+      self.request.get('runtype').AndReturn('auto')
       self.response.out.write(reports.JSON_PREFIX + json.dumps(report_feedback))
 
     self.mox.StubOutWithMock(reports.common, 'LogClientConnection')
@@ -523,15 +601,19 @@ class HandlersTest(test.RequestHandlerTest):
     computer = self.MockModelStatic('Computer', 'get_by_key_name', uuid)
     self.request.get_all('installs').AndReturn([])
     self.request.get_all('removals').AndReturn(['removal1', 'removal2'])
-
-    reports.common.WriteClientLog(
-        reports.models.ClientLog, uuid, computer=computer, action='removal',
-        details='removal1')
-    reports.common.WriteClientLog(
-        reports.models.ClientLog, uuid, computer=computer, action='removal',
-        details='removal2')
     self.request.get_all('problem_installs').AndReturn([])
 
+    self.mox.StubOutWithMock(reports.models, 'ClientLog')
+    reports.models.ClientLog(
+        uuid=uuid, computer=computer, action='removal',
+        details='removal1').AndReturn('log1')
+    reports.models.ClientLog(
+        uuid=uuid, computer=computer, action='removal',
+        details='removal2').AndReturn('log2')
+    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOp')
+    reports.gae_util.BatchDatastoreOp(
+        reports.models.db.put, ['log1', 'log2'])
+
     self.mox.ReplayAll()
     self.c.post()
     self.mox.VerifyAll()
@@ -553,12 +635,16 @@ class HandlersTest(test.RequestHandlerTest):
     problem2 = 'UNKNOWN FORMAT'
 
     self.request.get_all('problem_installs').AndReturn([problem1, problem2])
-    reports.common.WriteClientLog(
-        reports.models.ClientLog, uuid, computer=computer,
-        action='install_problem', details=problem1)
-    reports.common.WriteClientLog(
-        reports.models.ClientLog, uuid, computer=computer,
-        action='install_problem', details=problem2)
+    self.mox.StubOutWithMock(reports.models, 'ClientLog')
+    reports.models.ClientLog(
+        uuid=uuid, computer=computer, action='install_problem',
+        details=problem1).AndReturn('log1')
+    reports.models.ClientLog(
+        uuid=uuid, computer=computer, action='install_problem',
+        details=problem2).AndReturn('log2')
+    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOp')
+    reports.gae_util.BatchDatastoreOp(
+        reports.models.db.put, ['log1', 'log2'])
 
     matched1_pkg, matched1_err = reports.DOWNLOAD_FAILED_STRING_REGEX.search(
         problem1).groups()
@@ -569,6 +655,109 @@ class HandlersTest(test.RequestHandlerTest):
     self.assertEqual(problem1_err, matched1_err)
     self.mox.VerifyAll()
 
+  def testPostInstallReportBatch(self):
+    """Tests post() with _report_type=install_report_batch."""
+    uuid = 'foouuid'
+    report_type = 'install_report_batch'
+    batch = [
+        {'installs': [
+            {'name': 'FooApp1', 'version': '1.0.0', 'applesus': False,
+             'status': 0, 'duration_seconds': 100, 'time': 1312818179.14,
+             'download_kbytes_per_sec': 225}],
+         'removals': ['removal1'],
+         'problem_installs': []},
+        {'installs': [],
+         'removals': [],
+         'problem_installs': ['problem1']},
+    ]
+    self.PostSetup(uuid=uuid, report_type=report_type)
+    self.request.get('reports').AndReturn(json.dumps(batch))
+    computer = self.MockModelStatic('Computer', 'get_by_key_name', uuid)
+    computer.uuid = uuid
+    self.request.get('on_corp').AndReturn('1')
+
+    self.mox.StubOutWithMock(reports.models, 'InstallLog')
+    mock_install = self.mox.CreateMockAnything()
+    reports.models.InstallLog(
+        uuid=uuid, computer=computer, package='FooApp1-1.0.0',
+        status='0', on_corp=True, applesus=False, unattended=False,
+        duration_seconds=100, mtime=datetime.datetime(2011, 8, 8, 15, 42, 59),
+        dl_kbytes_per_sec=225).AndReturn(mock_install)
+    mock_install.success = mock_install.IsSuccess().AndReturn(True)
+    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOp')
+    reports.gae_util.BatchDatastoreOp(
+        reports.models.db.put, [mock_install])
+
+    self.mox.StubOutWithMock(reports.models, 'ClientLog')
+    reports.models.ClientLog(
+        uuid=uuid, computer=computer, action='removal',
+        details='removal1').AndReturn('log1')
+    reports.models.ClientLog(
+        uuid=uuid, computer=computer, action='install_problem',
+        details='problem1').AndReturn('log2')
+    reports.gae_util.BatchDatastoreOp(
+        reports.models.db.put, ['log1', 'log2'])
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(
+        reports.JSON_PREFIX + json.dumps({'reports': 2}))
+
+    self.mox.ReplayAll()
+    self.c.post()
+    self.mox.VerifyAll()
+
+  def testPostInstallReportBatchWhenInvalid(self):
+    """Tests post() with an invalid _report_type=install_report_batch."""
+    uuid = 'foouuid'
+    report_type = 'install_report_batch'
+    self.PostSetup(uuid=uuid, report_type=report_type)
+    self.request.get('reports').AndReturn('{"not": "a list"}')
+    self.response.set_status(400)
+
+    self.mox.ReplayAll()
+    self.c.post()
+    self.mox.VerifyAll()
+
+  def testPostInstallReportBatchWithInvalidReports(self):
+    """Tests post() with install_report_batch skipping invalid reports."""
+    uuid = 'foouuid'
+    report_type = 'install_report_batch'
+    batch = [
+        'not a dict',
+        {'installs': ['not a dict']},
+        {'removals': 'not a list'},
+        {'problem_installs': [{'not': 'a str'}]},
+        {'removals': ['removal1']},
+    ]
+    self.PostSetup(uuid=uuid, report_type=report_type)
+    self.request.get('reports').AndReturn(json.dumps(batch))
+    computer = self.MockModelStatic('Computer', 'get_by_key_name', uuid)
+    self.mox.StubOutWithMock(reports.models, 'ClientLog')
+    reports.models.ClientLog(
+        uuid=uuid, computer=computer, action='removal',
+        details='removal1').AndReturn('log1')
+    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOp')
+    reports.gae_util.BatchDatastoreOp(reports.models.db.put, ['log1'])
+    # all reports are acknowledged, so the client drops the invalid ones.
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(
+        reports.JSON_PREFIX + json.dumps({'reports': 5}))
+
+    self.mox.ReplayAll()
+    self.c.post()
+    self.mox.VerifyAll()
+
+  def testPostInstallReportBatchWhenNotJson(self):
+    """Tests post() with an install_report_batch which is not JSON."""
+    uuid = 'foouuid'
+    report_type = 'install_report_batch'
+    self.PostSetup(uuid=uuid, report_type=report_type)
+    self.request.get('reports').AndReturn('[{"truncated')
+    self.response.set_status(400)
+
+    self.mox.ReplayAll()
+    self.c.post()
+    self.mox.VerifyAll()
+
   def testPostBrokenClient(self):
     """Tests post() with _report_type=broken_client."""
     uuid = 'foouuid'
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+"""RPC budgets of client facing Munki handlers.
+
+Each test runs a handler against real datastore and memcache stubs and
+asserts the number of RPCs it makes, so N+1 query regressions on hot paths
+fail here rather than being found in production.  Budgets are for warm
+requests, after a first request has populated memcache.
+"""
+
+
+
+import datetime
+import logging
+logging.basicConfig(filename='/dev/null')
+
+from google.apputils import app
+from google.appengine.api import datastore
+import webapp2
+
+from tests.simian.mac.common import test
+from simian.auth import gaeserver
+from simian.mac import models
+from simian.mac.common import auth
+from simian.mac.munki.handlers import catalogs
+from simian.mac.munki.handlers import manifests
+from simian.mac.munki.handlers import pkgs
+from simian.mac.munki.handlers import pkgsinfo
+from simian.mac.munki.handlers import reports
+
+
+UUID = 'uuid1'
+CLIENT_ID = 'uuid=%s|owner=user1|hostname=host1|track=stable|site=site1' % (
+    UUID)
+PKG_FILENAME = 'package1.dmg'
+PKG_SHA256 = 'a' * 64
+BLOBSTORE_KEY = 'blobkey1'
+
+PKGINFO_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+  <key>catalogs</key>
+  <array>
+    <string>stable</string>
+  </array>
+  <key>installer_item_hash</key>
+  <string>%s</string>
+  <key>installer_item_location</key>
+  <string>%s</string>
+  <key>name</key>
+  <string>package%%d</string>
+  <key>version</key>
+  <string>1.%%d</string>
+</dict>
+</plist>
+""" % (PKG_SHA256, PKG_FILENAME)
+
+MANIFEST_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+  <key>catalogs</key>
+  <array>
+    <string>stable</string>
+  </array>
+  <key>managed_installs</key>
+  <array>
+    <string>package1</string>
+  </array>
+</dict>
+</plist>
+"""
+
+
+class MunkiSession(object):
+  """Munki client session, as returned by auth.DoAnyAuth()."""
+  uuid = UUID
+
+
+class MunkiHandlersRpcBudgetTest(test.RpcBudgetTest):
+  """RPC budgets of Munki handlers, for an authenticated client."""
+
+  def setUp(self):
+    super(MunkiHandlersRpcBudgetTest, self).setUp()
+    self.stubs.Set(auth, 'DoAnyAuth', lambda *a, **kw: MunkiSession())
+    self.stubs.Set(gaeserver, 'DoMunkiAuth', lambda *a, **kw: MunkiSession())
+
+    c = models.Computer(key_name=UUID, uuid=UUID, track='stable')
+    c.put()
+    for i in xrange(10):
+      p = models.PackageInfo(key_name='package%d.dmg' % i)
+      p.plist = PKGINFO_XML % (i, i)
+      p.filename = 'package%d.dmg' % i
+      p.name = 'package%d' % i
+      p.catalogs = ['stable']
+      p.manifests = ['stable']
+      p.install_types = ['managed_installs']
+      p.blobstore_key = BLOBSTORE_KEY
+      p.pkgdata_sha256 = PKG_SHA256
+      p.put()
+    catalog = models.Catalog(key_name='stable', name='stable')
+    catalog.plist = MANIFEST_XML
+    catalog.put()
+    manifest = models.Manifest(key_name='stable', name='stable')
+    manifest.plist = MANIFEST_XML
+    manifest.put()
+    models.Tag(key_name='tag1', keys=[c.key()]).put()
+
+    blob_info = datastore.Entity('__BlobInfo__', name=BLOBSTORE_KEY)
+    blob_info['content_type'] = 'application/octet-stream'
+    blob_info['creation'] = datetime.datetime(2015, 1, 1)
+    blob_info['filename'] = PKG_FILENAME
+    blob_info['size'] = 1024
+    blob_info['md5_hash'] = 'b' * 32
+    datastore.Put(blob_info)
+
+  def testCatalogsGet(self):
+    """Catalogs.get is served from memcache when warm."""
+    self.CallHandler(catalogs.Catalogs, 'get', '/catalogs/stable', 'stable')
+    with self.AssertRpcBudget({'memcache.Get': 1, 'datastore_v3': 0}):
+      response = self.CallHandler(
+          catalogs.Catalogs, 'get', '/catalogs/stable', 'stable')
+    self.assertEqual(200, response.status_int)
+
+  def testManifestsGet(self):
+    """Manifests.get makes a fixed number of RPCs when warm."""
+    headers = {'X-munki-client-id': CLIENT_ID}
+    self.CallHandler(
+        manifests.Manifests, 'get', '/manifests/', **headers)
+    # the query is the uncached tag lookup of GenerateDynamicManifest, the
+    # gets are the Computer and the panic mode KeyValueCache.
+    with self.AssertRpcBudget({
+        'memcache.Get': 7, 'memcache.Set': 0,
+        'datastore_v3.RunQuery': 1, 'datastore_v3.Get': 2}):
+      response = self.CallHandler(
+          manifests.Manifests, 'get', '/manifests/', **headers)
+    self.assertEqual(200, response.status_int)
+    self.assertTrue('package1' in response.body)
+
+  def testPackagesGetNotModified(self):
+    """Packages.get of an unchanged package is served from memcache."""
+    headers = {'If-None-Match': PKG_SHA256}
+    url = '/pkgs/%s' % PKG_FILENAME
+    self.CallHandler(pkgs.Packages, 'get', url, PKG_FILENAME, **headers)
+    with self.AssertRpcBudget({
+        'memcache.Get': 3, 'memcache.Set': 0, 'datastore_v3.Get': 1,
+        'datastore_v3.RunQuery': 0}):
+      response = self.CallHandler(
+          pkgs.Packages, 'get', url, PKG_FILENAME, **headers)
+    self.assertEqual(304, response.status_int)
+
+  def _PostReport(self, params):
+    """Call Reports.post with POST params, returning the response."""
+    request = webapp2.Request.blank('/reports', POST=params)
+    response = webapp2.Response()
+    reports.Reports(request, response).post()
+    return response
+
+  def testReportsPostPreflight(self):
+    """Reports.post of a preflight report makes a fixed number of RPCs."""
+    params = {
+        '_report_type': 'preflight', 'client_id': CLIENT_ID, 'json': '1'}
+    self._PostReport(params)
+    # the gets are the Computer, the panic mode KeyValueCache and the
+    # checkin budget Settings; the transaction is LogClientConnection.
+    with self.AssertRpcBudget({
+        'memcache.Get': 2, 'memcache.Set': 0, 'datastore_v3.Get': 3,
+        'datastore_v3.Put': 1, 'datastore_v3.Commit': 1,
+        'datastore_v3.RunQuery': 0}):
+      response = self._PostReport(params)
+    self.assertEqual(200, response.status_int)
+
+  def testPackagesInfoGet(self):
+    """PackagesInfo.get of one pkginfo is a single datastore get."""
+    url = '/pkgsinfo/%s' % PKG_FILENAME
+    with self.AssertRpcBudget({
+        'memcache': 0, 'datastore_v3.Get': 1, 'datastore_v3.RunQuery': 0}):
+      response = self.CallHandler(
+          pkgsinfo.PackagesInfo, 'get', url, PKG_FILENAME)
+    self.assertEqual(200, response.status_int)
+
+  def testPackagesInfoList(self):
+    """PackagesInfo.get listing pkginfos is one query, not one per pkginfo."""
+    with self.AssertRpcBudget({
+        'memcache': 0, 'datastore_v3.RunQuery': 1, 'datastore_v3.Next': 1,
+        'datastore_v3.Get': 0}):
+      response = self.CallHandler(pkgsinfo.PackagesInfo, 'get', '/pkgsinfo/')
+    self.assertEqual(200, response.status_int)
+
+
+class RpcCounterTest(test.RpcBudgetTest):
+  """Test the RpcCounter and AssertRpcBudget test harness."""
+
+  def testCount(self):
+    """Test RpcCounter.Count()."""
+    with self.rpc_counter:
+      models.Computer.get_by_key_name('foo')
+      models.Computer.get_by_key_name('bar')
+      models.Computer.all().fetch(1)
+    models.Computer.get_by_key_name('not counted')
+    self.assertEqual(2, self.rpc_counter.Count('datastore_v3.Get'))
+    self.assertEqual(1, self.rpc_counter.Count('datastore_v3.RunQuery'))
+    self.assertEqual(3, self.rpc_counter.Count('datastore_v3'))
+    self.assertEqual(0, self.rpc_counter.Count('memcache'))
+
+  def testAssertRpcBudgetWhenExceeded(self):
+    """Test AssertRpcBudget() fails when the budget is exceeded."""
+    def _Exceed():
+      with self.AssertRpcBudget({'datastore_v3.Get': 1}):
+        models.Computer.get_by_key_name('foo')
+        models.Computer.get_by_key_name('bar')
+    self.assertRaises(self.failureException, _Exceed)
+
+
+def main(unused_argv):
+  test.main(unused_argv)
+
+
+if __name__ == '__main__':
+  app.run()
@@ -151,6 +151,7 @@ class UserAuthTest(test.RequestHandlerTest):
             uauth.auth_init.AUTH_TOKEN_COOKIE, token)).AndReturn(None)
     self.response.out.write(
         uauth.auth_init.AUTH_TOKEN_COOKIE).AndReturn(None)
+    mock_aps.FlushSession().AndReturn(None)
 
     self.mox.ReplayAll()
     self.assertEqual(None, self.ua.get())
@@ -182,6 +183,7 @@ class UserAuthTest(test.RequestHandlerTest):
             uauth.auth_init.AUTH_TOKEN_COOKIE, token)).AndReturn(None)
     self.response.out.write(
         uauth.auth_init.AUTH_TOKEN_COOKIE).AndReturn(None)
+    mock_aps.FlushSession().AndReturn(None)
 
     self.mox.ReplayAll()
     self.assertEqual(None, self.ua.get())
@@ -23,6 +23,8 @@
 import datetime
 import logging
 logging.basicConfig(filename='/dev/null')
+import StringIO
+import tarfile
 
 from google.apputils import app
 from tests.simian.mac.common import test
@@ -79,6 +81,87 @@ class UploadFileHandlerTest(test.RequestHandlerTest):
     self.assertEqual(None, mock_computer.upload_logs_and_notify)
     self.mox.VerifyAll()
 
+  def _BuildLogBundle(self, logs):
+    """Returns a gzip compressed tar archive of (name, data) logs."""
+    f = StringIO.StringIO()
+    tar = tarfile.open(fileobj=f, mode='w:gz')
+    for name, data in logs:
+      info = tarfile.TarInfo(name)
+      info.size = len(data)
+      tar.addfile(info, StringIO.StringIO(data))
+    tar.close()
+    return f.getvalue()
+
+  def testReadLogBundle(self):
+    """Tests ReadLogBundle()."""
+    self.stubs.Set(uploadfile, 'MAX_LOG_BUNDLE_FILE_BYTES', 4)
+    self.stubs.Set(uploadfile, 'MAX_LOG_BUNDLE_FILES', 2)
+    self.stubs.Set(uploadfile, 'LOG_BUNDLE_READ_BYTES', 3)
+    bundle = self._BuildLogBundle([
+        ('a.log', 'abcd'), ('bad name', 'x'), ('dir/b.log', '123456'),
+        ('dir/c.log', '1'), ('d.log', 'ignored')])
+    self.assertEqual(
+        [('a.log', 'abcd'), ('c.log', '1')], uploadfile.ReadLogBundle(bundle))
+
+  def testReadLogBundleWhenTooLarge(self):
+    """Tests ReadLogBundle() with a bundle too large decompressed."""
+    self.stubs.Set(uploadfile, 'MAX_LOG_BUNDLE_FILE_BYTES', 4)
+    self.stubs.Set(uploadfile, 'MAX_LOG_BUNDLE_BYTES', 10)
+    # ignored files count, as they are decompressed too.
+    bundle = self._BuildLogBundle([
+        ('a.log', 'abcd'), ('b.log', '123456'), ('c.log', '1')])
+    self.assertRaises(
+        uploadfile.LogBundleError, uploadfile.ReadLogBundle, bundle)
+
+  def testPutLogBundle(self):
+    """Tests UploadFile.put() with a log bundle."""
+    self.mox.StubOutWithMock(uploadfile.main_common, 'SanitizeUUID')
+    self.mox.StubOutWithMock(uploadfile.models, 'ClientLogFile')
+    self.mox.StubOutWithMock(uploadfile.models.Computer, 'get_by_key_name')
+
+    uuid = 'foouuid'
+    self.request.body = self._BuildLogBundle(
+        [('a.log', 'aaa'), ('b.log', 'bbb')])
+
+    mock_session = self.mox.CreateMockAnything()
+    mock_session.uuid = uuid
+    self.MockDoMunkiAuth(and_return=mock_session)
+    uploadfile.main_common.SanitizeUUID(uuid).AndReturn(uuid)
+
+    mock_a = self.mox.CreateMockAnything()
+    mock_b = self.mox.CreateMockAnything()
+    uploadfile.models.ClientLogFile(key_name='foouuid_a.log').AndReturn(mock_a)
+    mock_a.put().AndReturn(None)
+    uploadfile.models.ClientLogFile(key_name='foouuid_b.log').AndReturn(mock_b)
+    mock_b.put().AndReturn(None)
+
+    mock_computer = self.mox.CreateMockAnything()
+    mock_computer.upload_logs_and_notify = None
+    uploadfile.models.Computer.get_by_key_name(uuid).AndReturn(mock_computer)
+    mock_computer.put().AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.c.put(file_type='logbundle', file_name='logs.tar.gz')
+    self.assertEqual('aaa', mock_a.log_file)
+    self.assertEqual('b.log', mock_b.name)
+    self.mox.VerifyAll()
+
+  def testPutLogBundleWhenInvalid(self):
+    """Tests UploadFile.put() with an invalid log bundle."""
+    self.mox.StubOutWithMock(uploadfile.main_common, 'SanitizeUUID')
+
+    uuid = 'foouuid'
+    self.request.body = 'not a tar.gz'
+    mock_session = self.mox.CreateMockAnything()
+    mock_session.uuid = uuid
+    self.MockDoMunkiAuth(and_return=mock_session)
+    uploadfile.main_common.SanitizeUUID(uuid).AndReturn(uuid)
+    self.MockError(400)
+
+    self.mox.ReplayAll()
+    self.c.put(file_type='logbundle', file_name='logs.tar.gz')
+    self.mox.VerifyAll()
+
   def testPut404(self):
     """Tests UploadFile.put() with 404."""
     self.mox.StubOutWithMock(uploadfile.main_common, 'SanitizeUUID')
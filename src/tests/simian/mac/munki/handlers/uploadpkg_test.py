@@ -20,14 +20,45 @@
 
 
 
+import hashlib
+import json
 import logging
+import StringIO
 logging.basicConfig(filename='/dev/null')
 
+import webapp2
+
 from google.apputils import app
+from google.appengine.api import datastore
+from google.appengine.ext import blobstore
+from google.appengine.ext import db
+from google.appengine.ext.cloudstorage import stub_dispatcher
 from tests.simian.mac.common import test
+from simian.mac import models
 from simian.mac.munki.handlers import uploadpkg
 
 
+PKGINFO_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+  <key>catalogs</key>
+  <array>
+    <string>unstable</string>
+  </array>
+  <key>installer_item_hash</key>
+  <string>%s</string>
+  <key>installer_item_location</key>
+  <string>new.dmg</string>
+  <key>name</key>
+  <string>new</string>
+  <key>version</key>
+  <string>1.0</string>
+</dict>
+</plist>
+""" % hashlib.sha256('hello world').hexdigest()
+
+
 class UploadPackageTest(test.RequestHandlerTest):
 
   def GetTestClassInstance(self):
@@ -160,6 +191,7 @@ class UploadPackageTest(test.RequestHandlerTest):
     self.request.get('install_types').AndReturn(','.join(install_types))
     self.request.get('catalogs', None).AndReturn(','.join(catalogs))
     self.request.get('manifests', None).AndReturn(None)
+    self.request.get('sha256').AndReturn('')
     self.c.get_uploads('file').AndReturn(upload_files)
     self.c.get_uploads('pkginfo').AndReturn(pkginfo_files)
     uploadpkg.gae_util.GetBlobAndDel(blob2_key).AndReturn(pkginfo_str)
@@ -214,6 +246,7 @@ class UploadPackageTest(test.RequestHandlerTest):
     self.request.get('install_types').AndReturn(','.join(install_types))
     self.request.get('catalogs', None).AndReturn(','.join(catalogs))
     self.request.get('manifests', None).AndReturn(','.join(manifests))
+    self.request.get('sha256').AndReturn('')
     self.c.get_uploads('file').AndReturn(upload_files)
     self.c.get_uploads('pkginfo').AndReturn(pkginfo_files)
     blob2.key().AndReturn('pkginfoblobkey')
@@ -233,7 +266,7 @@ class UploadPackageTest(test.RequestHandlerTest):
 
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'ObtainLock')
     uploadpkg.gae_util.ObtainLock(
-        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn(True)
+        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn('tok')
 
     pkg = self.MockModelStatic('PackageInfo', 'get_or_insert', filename)
     pkg.IsSafeToModify().AndReturn(True)
@@ -248,7 +281,8 @@ class UploadPackageTest(test.RequestHandlerTest):
 
 
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'ReleaseLock')
-    uploadpkg.gae_util.ReleaseLock('pkgsinfo_%s' % filename).AndReturn(True)
+    uploadpkg.gae_util.ReleaseLock(
+        'pkgsinfo_%s' % filename, token='tok').AndReturn(True)
 
     mock_plist.GetXml().AndReturn(pkginfo_str)
     mock_log = self.MockModel(
@@ -301,6 +335,7 @@ class UploadPackageTest(test.RequestHandlerTest):
     self.request.get('install_types').AndReturn(','.join(install_types))
     self.request.get('catalogs', None).AndReturn(','.join(catalogs))
     self.request.get('manifests', None).AndReturn(','.join(manifests))
+    self.request.get('sha256').AndReturn('')
     self.c.get_uploads('file').AndReturn(upload_files)
     self.c.get_uploads('pkginfo').AndReturn(pkginfo_files)
     blob2.key().AndReturn('pkginfoblobkey')
@@ -319,7 +354,7 @@ class UploadPackageTest(test.RequestHandlerTest):
 
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'ObtainLock')
     uploadpkg.gae_util.ObtainLock(
-        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn(True)
+        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn('tok')
 
     pkg = self.MockModelStatic('PackageInfo', 'get_or_insert', filename)
     pkg.IsSafeToModify().AndReturn(True)
@@ -330,7 +365,8 @@ class UploadPackageTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(uploadpkg.models.Catalog, 'Generate')
     uploadpkg.models.Catalog.Generate(catalogs[0], delay=1)
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'ReleaseLock')
-    uploadpkg.gae_util.ReleaseLock('pkgsinfo_%s' % filename).AndReturn(True)
+    uploadpkg.gae_util.ReleaseLock(
+        'pkgsinfo_%s' % filename, token='tok').AndReturn(True)
 
     mock_plist.GetXml().AndReturn(pkginfo_str)
     mock_log = self.MockModel(
@@ -352,6 +388,39 @@ class UploadPackageTest(test.RequestHandlerTest):
     self.assertEqual(mock_plist, pkg.plist)
     self.mox.VerifyAll()
 
+  def testPostWithSha256Mismatch(self):
+    """Test uploading a package which does not match its pkginfo sha256."""
+    self.mox.StubOutWithMock(uploadpkg.handlers, 'IsBlobstore')
+    uploadpkg.handlers.IsBlobstore().AndReturn(True)
+    self.MockDoMunkiAuth(require_level=uploadpkg.gaeserver.LEVEL_UPLOADPKG)
+    self.MockSelf('get_uploads')
+    self.mox.StubOutWithMock(uploadpkg.gae_util, 'GetBlobAndDel')
+    self.mox.StubOutWithMock(uploadpkg.gae_util, 'SafeBlobDel')
+    self.mox.StubOutWithMock(uploadpkg, 'GetBlobSha256')
+    self.mox.StubOutWithMock(uploadpkg, 'SavePackage')
+    blob = self.mox.CreateMockAnything()
+    blob2 = self.mox.CreateMockAnything()
+    blobstore_key = 'fookey'
+
+    self.request.get('user').AndReturn('foouser')
+    self.request.get('name').AndReturn('filename.dmg')
+    self.request.get('install_types').AndReturn('managed_installs')
+    self.request.get('catalogs', None).AndReturn('unstable')
+    self.request.get('manifests', None).AndReturn(None)
+    self.c.get_uploads('file').AndReturn([blob])
+    self.c.get_uploads('pkginfo').AndReturn([blob2])
+    blob2.key().AndReturn('pkginfoblobkey')
+    uploadpkg.gae_util.GetBlobAndDel('pkginfoblobkey').AndReturn('pkginfo')
+    blob.key().AndReturn(blobstore_key)
+    self.request.get('sha256').AndReturn('expected')
+    uploadpkg.GetBlobSha256(blobstore_key).AndReturn('changed')
+    uploadpkg.gae_util.SafeBlobDel(blobstore_key).AndReturn(None)
+    self.MockRedirect('/uploadpkg?mode=error&msg=sha256%20mismatch')
+
+    self.mox.ReplayAll()
+    self.c.post()
+    self.mox.VerifyAll()
+
   def testPostWithLock(self):
     """Test uploading where pkgsinfo is locked, revert package blob save."""
     self.mox.StubOutWithMock(uploadpkg.handlers, 'IsBlobstore')
@@ -382,6 +451,7 @@ class UploadPackageTest(test.RequestHandlerTest):
     self.request.get('install_types').AndReturn(','.join(install_types))
     self.request.get('catalogs', None).AndReturn(','.join(catalogs))
     self.request.get('manifests', None).AndReturn(None)
+    self.request.get('sha256').AndReturn('')
     self.c.get_uploads('file').AndReturn(upload_files)
     self.c.get_uploads('pkginfo').AndReturn(pkginfo_files)
     uploadpkg.gae_util.GetBlobAndDel('pkginfoblobkey').AndReturn(pkginfo_str)
@@ -435,6 +505,7 @@ class UploadPackageTest(test.RequestHandlerTest):
     self.request.get('install_types').AndReturn(','.join(install_types))
     self.request.get('catalogs', None).AndReturn(','.join(catalogs))
     self.request.get('manifests', None).AndReturn(None)
+    self.request.get('sha256').AndReturn('')
     self.c.get_uploads('file').AndReturn(upload_files)
     self.c.get_uploads('pkginfo').AndReturn(pkginfo_files)
     uploadpkg.gae_util.GetBlobAndDel('pkginfoblobkey').AndReturn(pkginfo_str)
@@ -449,11 +520,12 @@ class UploadPackageTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'ObtainLock')
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'ReleaseLock')
     uploadpkg.gae_util.ObtainLock(
-        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn(True)
+        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn('tok')
 
     pkg = self.MockModelStatic('PackageInfo', 'get_or_insert', filename)
     pkg.IsSafeToModify().AndReturn(False)
-    uploadpkg.gae_util.ReleaseLock('pkgsinfo_%s' % filename).AndReturn(None)
+    uploadpkg.gae_util.ReleaseLock(
+        'pkgsinfo_%s' % filename, token='tok').AndReturn(None)
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'SafeBlobDel')
     uploadpkg.gae_util.SafeBlobDel(blobstore_key).AndReturn(None)
     self.MockRedirect(
@@ -493,6 +565,7 @@ class UploadPackageTest(test.RequestHandlerTest):
     self.request.get('install_types').AndReturn(','.join(install_types))
     self.request.get('catalogs', None).AndReturn(','.join(catalogs))
     self.request.get('manifests', None).AndReturn(None)
+    self.request.get('sha256').AndReturn('')
     self.c.get_uploads('file').AndReturn(upload_files)
     self.c.get_uploads('pkginfo').AndReturn(pkginfo_files)
     uploadpkg.gae_util.GetBlobAndDel('pkginfoblobkey').AndReturn(pkginfo_str)
@@ -506,7 +579,7 @@ class UploadPackageTest(test.RequestHandlerTest):
 
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'ObtainLock')
     uploadpkg.gae_util.ObtainLock(
-        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn(True)
+        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn('tok')
 
     pkg = self.MockModelStatic('PackageInfo', 'get_or_insert', filename)
     pkg.IsSafeToModify().AndReturn(True)
@@ -523,7 +596,8 @@ class UploadPackageTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'SafeEntityDel')
     uploadpkg.gae_util.SafeEntityDel(pkg)
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'ReleaseLock')
-    uploadpkg.gae_util.ReleaseLock('pkgsinfo_%s' % filename).AndReturn(True)
+    uploadpkg.gae_util.ReleaseLock(
+        'pkgsinfo_%s' % filename, token='tok').AndReturn(True)
     self.MockRedirect('/uploadpkg?mode=error')
 
     self.mox.ReplayAll()
@@ -560,6 +634,7 @@ class UploadPackageTest(test.RequestHandlerTest):
     self.request.get('install_types').AndReturn(','.join(install_types))
     self.request.get('catalogs', None).AndReturn(','.join(catalogs))
     self.request.get('manifests', None).AndReturn(None)
+    self.request.get('sha256').AndReturn('')
     self.c.get_uploads('file').AndReturn(upload_files)
     self.c.get_uploads('pkginfo').AndReturn(pkginfo_files)
     uploadpkg.gae_util.GetBlobAndDel('pkginfoblobkey').AndReturn(pkginfo_str)
@@ -630,6 +705,228 @@ class UploadPackageTest(test.RequestHandlerTest):
     self.mox.VerifyAll()
 
 
+class GetBlobSha256Test(test.RequestHandlerTest):
+  """Test GetBlobSha256(), against a blobstore stub."""
+
+  def GetTestClassInstance(self):
+    return uploadpkg.UploadPackage()
+
+  def GetTestClassModule(self):
+    return uploadpkg
+
+  def testGetBlobSha256(self):
+    """Test the sha256 of a blob larger than one fetch."""
+    self.testbed.init_blobstore_stub()
+    self.stubs.Set(uploadpkg.blobstore, 'MAX_BLOB_FETCH_SIZE', 4)
+    content = 'hello world'
+    self.testbed.get_stub('blobstore').storage.StoreBlob(
+        'blobkey1', StringIO.StringIO(content))
+    blob_info = datastore.Entity('__BlobInfo__', name='blobkey1')
+    blob_info['size'] = len(content)
+    datastore.Put(blob_info)
+    self.assertEqual(
+        hashlib.sha256(content).hexdigest(),
+        uploadpkg.GetBlobSha256('blobkey1'))
+
+
+class ChunkedUploadPackageTest(test.RequestHandlerTest):
+  """Test ChunkedUploadPackage, against a Cloud Storage stub."""
+
+  def GetTestClassInstance(self):
+    return uploadpkg.ChunkedUploadPackage()
+
+  def GetTestClassModule(self):
+    return uploadpkg
+
+  def setUp(self):
+    super(ChunkedUploadPackageTest, self).setUp()
+    self.testbed.init_blobstore_stub()
+    self.testbed.init_app_identity_stub()
+    self.stubs.Set(uploadpkg.gcs.urlfetch, 'fetch', self._FetchGcs)
+    self.stubs.Set(uploadpkg.gaeserver, 'DoMunkiAuth', lambda **kw: None)
+    self.stubs.Set(uploadpkg, 'UPLOAD_CHUNK_SIZE', 4)
+
+  def _FetchGcs(self, url, payload=None, method='GET', headers=None, **_):
+    """Sends a Cloud Storage request to the SDK stub."""
+    url = url.replace(uploadpkg.gcs.GCS_API_URL, 'http://localhost/_ah/gcs')
+    return stub_dispatcher.dispatch(method, headers or {}, url, payload)
+
+  def _Call(self, method, args, body=None, headers=None, post=None):
+    """Call a handler method with a real request; returns the response."""
+    request = webapp2.Request.blank(
+        '/uploadpkg/chunked', headers=headers or {}, POST=post)
+    if body is not None:
+      request.method = 'PUT'
+      request.body = body
+    response = webapp2.Response()
+    getattr(uploadpkg.ChunkedUploadPackage(request, response), method)(*args)
+    return response
+
+  def _Start(self, size=11):
+    response = self._Call('post', [], post={
+        'user': 'user1', 'name': 'new.dmg', 'install_types': 'managed_installs',
+        'catalogs': 'unstable', 'manifests': '', 'pkginfo': PKGINFO_XML,
+        'size': str(size)})
+    self.assertEqual(200, response.status_int)
+    return json.loads(response.body)
+
+  def _PutChunk(self, upload_id, index, chunk, chunk_sha256=None):
+    if chunk_sha256 is None:
+      chunk_sha256 = hashlib.sha256(chunk).hexdigest()
+    return self._Call(
+        'put', [upload_id, str(index)], body=chunk,
+        headers={'X-Chunk-Sha256': chunk_sha256})
+
+  def testUpload(self):
+    """Test an upload resuming after out of order and repeated chunks."""
+    status = self._Start()
+    upload_id = status['id']
+    self.assertEqual(
+        {'id': upload_id, 'chunk_size': 4, 'num_chunks': 3, 'next_chunk': 0},
+        status)
+
+    self.assertEqual(200, self._PutChunk(upload_id, 0, 'hell').status_int)
+    self.assertEqual(409, self._PutChunk(upload_id, 2, 'rld').status_int)
+    response = self._PutChunk(upload_id, 0, 'hell')
+    self.assertEqual(1, json.loads(response.body)['next_chunk'])
+    self.assertEqual(
+        400, self._PutChunk(upload_id, 1, 'o wo', 'bad sha256').status_int)
+    self.assertEqual(200, self._PutChunk(upload_id, 1, 'o wo').status_int)
+    self.assertEqual(400, self._PutChunk(upload_id, 2, 'rl').status_int)
+    self.assertEqual(200, self._PutChunk(upload_id, 2, 'rld').status_int)
+    response = self._Call('get', [upload_id])
+    self.assertEqual(3, json.loads(response.body)['next_chunk'])
+
+    response = self._Call('post', [upload_id])
+
+    self.assertEqual(200, response.status_int)
+    pkg = models.PackageInfo.get_by_key_name('new.dmg')
+    self.assertEqual(response.body, pkg.blobstore_key)
+    self.assertEqual('user1', pkg.user)
+    self.assertEqual(['managed_installs'], pkg.install_types)
+    self.assertEqual(
+        'hello world', blobstore.BlobReader(pkg.blobstore_key).read())
+    self.assertEqual(None, models.PackageUpload.get_by_key_name(upload_id))
+
+  def testPutChunkResentAfterPutFailure(self):
+    """Test a chunk resent after its upload failed to save is written once."""
+    upload_id = self._Start()['id']
+    self.assertEqual(200, self._PutChunk(upload_id, 0, 'hell').status_int)
+    self.mox.StubOutWithMock(uploadpkg.models.PackageUpload, 'put')
+    uploadpkg.models.PackageUpload.put().AndRaise(db.Timeout)
+
+    self.mox.ReplayAll()
+    self.assertRaises(db.Timeout, self._PutChunk, upload_id, 1, 'o wo')
+    self.mox.VerifyAll()
+    self.mox.UnsetStubs()
+
+    self.assertEqual(200, self._PutChunk(upload_id, 1, 'o wo').status_int)
+    self.assertEqual(200, self._PutChunk(upload_id, 2, 'rld').status_int)
+    response = self._Call('post', [upload_id])
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(
+        'hello world', blobstore.BlobReader(response.body).read())
+
+  def testFinishRetried(self):
+    """Test retrying a finish which failed to save, then succeeded."""
+    upload_id = self._Start()['id']
+    for index, chunk in enumerate(['hell', 'o wo', 'rld']):
+      self._PutChunk(upload_id, index, chunk)
+    self.mox.StubOutWithMock(uploadpkg.gae_util, 'ObtainLock')
+    uploadpkg.gae_util.ObtainLock(
+        'uploadpkg_chunked_%s' % upload_id, timeout=5.0).AndReturn('tok')
+    uploadpkg.gae_util.ObtainLock(
+        'pkgsinfo_new.dmg', timeout=5.0).AndReturn(False)
+
+    self.mox.ReplayAll()
+    self.assertEqual(400, self._Call('post', [upload_id]).status_int)
+    self.mox.VerifyAll()
+    self.mox.UnsetStubs()
+
+    self.assertNotEqual(
+        None, models.PackageUpload.get_by_key_name(upload_id))
+    response = self._Call('post', [upload_id])
+    self.assertEqual(200, response.status_int)
+    blobstore_key = response.body
+    self.assertEqual(None, models.PackageUpload.get_by_key_name(upload_id))
+
+    response = self._Call('post', [upload_id])
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(blobstore_key, response.body)
+    pkg = models.PackageInfo.get_by_key_name('new.dmg')
+    self.assertEqual(blobstore_key, pkg.blobstore_key)
+    self.assertEqual(
+        'hello world', blobstore.BlobReader(blobstore_key).read())
+
+  def testFinishWhenLocked(self):
+    """Test finishing an upload while a chunk is being received."""
+    upload_id = self._Start()['id']
+    self.mox.StubOutWithMock(uploadpkg.gae_util, 'ObtainLock')
+    uploadpkg.gae_util.ObtainLock(
+        'uploadpkg_chunked_%s' % upload_id, timeout=5.0).AndReturn(False)
+
+    self.mox.ReplayAll()
+    self.assertEqual(503, self._Call('post', [upload_id]).status_int)
+    self.mox.VerifyAll()
+
+  def testAbort(self):
+    """Test aborting an upload deletes it and its object."""
+    upload_id = self._Start()['id']
+    self._PutChunk(upload_id, 0, 'hell')
+    gcs_filename = models.PackageUpload.get_by_key_name(
+        upload_id).gcs_filename
+
+    self.assertEqual(200, self._Call('delete', [upload_id]).status_int)
+    self.assertEqual(None, models.PackageUpload.get_by_key_name(upload_id))
+    self.assertEqual(None, uploadpkg.gcs.GetSize(gcs_filename))
+    self.assertEqual(404, self._Call('delete', [upload_id]).status_int)
+
+  def testDeleteIdleUploads(self):
+    """Test DeleteIdleUploads() deletes only idle uploads."""
+    idle_id = self._Start()['id']
+    self._PutChunk(idle_id, 0, 'hell')
+    active_id = self._Start()['id']
+    idle = models.PackageUpload.get_by_key_name(idle_id)
+    active = models.PackageUpload.get_by_key_name(active_id)
+    now = (idle.mtime + (active.mtime - idle.mtime) / 2 +
+           uploadpkg.UPLOAD_IDLE_TIMEOUT)
+
+    self.assertEqual(1, uploadpkg.DeleteIdleUploads(now=now))
+    self.assertEqual(None, models.PackageUpload.get_by_key_name(idle_id))
+    self.assertEqual(None, uploadpkg.gcs.GetSize(idle.gcs_filename))
+    self.assertNotEqual(
+        None, models.PackageUpload.get_by_key_name(active_id))
+
+  def testDeleteUploadWhenSaved(self):
+    """Test DeleteUpload() keeps the object of a saved package."""
+    upload_id = self._Start()['id']
+    for index, chunk in enumerate(['hell', 'o wo', 'rld']):
+      self._PutChunk(upload_id, index, chunk)
+    upload = models.PackageUpload.get_by_key_name(upload_id)
+    self.assertEqual(200, self._Call('post', [upload_id]).status_int)
+
+    uploadpkg.DeleteUpload(upload)
+    self.assertEqual(11, uploadpkg.gcs.GetSize(upload.gcs_filename))
+
+  def testFinishWhenMissingChunks(self):
+    """Test finishing an upload which is missing chunks."""
+    upload_id = self._Start()['id']
+    self._PutChunk(upload_id, 0, 'hell')
+    self.assertEqual(409, self._Call('post', [upload_id]).status_int)
+    self.assertEqual(None, models.PackageInfo.get_by_key_name('new.dmg'))
+
+  def testStartWithMissingArgs(self):
+    """Test starting an upload without a size."""
+    response = self._Call('post', [], post={
+        'user': 'user1', 'name': 'new.dmg', 'install_types': 'managed_installs',
+        'catalogs': 'unstable', 'pkginfo': PKGINFO_XML})
+    self.assertEqual(400, response.status_int)
+
+  def testGetUnknownUpload(self):
+    """Test the status of an unknown upload."""
+    self.assertEqual(404, self._Call('get', ['unknown']).status_int)
+
+
 def main(unused_argv):
   test.main(unused_argv)
 